@@ -0,0 +1,246 @@
+# affinity.py  # Chế độ triển khai "mỗi cửa hàng thuộc đúng 1 process": proxy phía trước + nhiều backend gunicorn
+#
+# Chạy:  python affinity.py --workers 4 --port $PORT
+#
+# - Mỗi node là 1 gunicorn riêng (1 worker) nghe trên unix socket, được báo tên node qua AFFINITY_NODE.
+# - Proxy đọc cookie "tenant" (app đặt lúc đăng nhập) rồi băm nhất quán (consistent hashing) sang 1 node:
+#   mọi request của 1 cửa hàng luôn tới cùng 1 process, nên cache trong bộ nhớ của nó luôn "nóng" và
+#   không phải tranh khóa với process khác. Chưa đăng nhập thì băm theo IP client.
+# - Vòng băm (danh sách node) được ghi ra AFFINITY_RING_FILE; app đọc để biết cửa hàng nào thuộc về mình
+#   (chỉ chạy tác vụ nền / nạp sẵn cho các cửa hàng đó).
+# - kill -TTIN <pid proxy> thêm 1 node, kill -TTOU bớt 1 node (như gunicorn). Nhờ băm nhất quán, thêm/bớt
+#   1 node chỉ chuyển khoảng 1/N cửa hàng; node mới nạp cửa hàng từ đĩa ở request đầu tiên.
+# Khóa theo cửa hàng và kiểm tra .version vẫn giữ nguyên trong app để an toàn khi ring đang đổi.
+#
+# Chỉ dùng thư viện chuẩn: app.py import HashRing / read_ring từ đây mà không tốn thời gian khởi động.
+
+import argparse
+import asyncio
+import bisect
+import hashlib
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+
+AFFINITY_COOKIE = "tenant"  # Cookie định tuyến (chỉ để chọn node, không dùng để xác thực)
+VNODES = 64  # Số điểm ảo của mỗi node trên vòng băm (càng nhiều càng chia đều)
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+RING_FILE_DEFAULT = os.path.join(APP_DIR, "data", "affinity_ring.json")
+
+
+def _h(s):
+    return int.from_bytes(hashlib.md5(s.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Vòng băm nhất quán: node_for(key) luôn trả cùng 1 node cho cùng key khi danh sách node không đổi."""
+
+    def __init__(self, nodes, vnodes=VNODES):
+        self.nodes = list(nodes)
+        points = sorted((_h(f"{n}#{v}"), n) for n in self.nodes for v in range(vnodes))
+        self._keys = [p[0] for p in points]
+        self._owners = [p[1] for p in points]
+
+    def node_for(self, key):
+        if not self._keys:
+            return None
+        i = bisect.bisect(self._keys, _h(key)) % len(self._keys)
+        return self._owners[i]
+
+
+def write_ring(path, nodes):
+    # Ghi nguyên tử để app không bao giờ đọc phải file dở
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp-{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"nodes": list(nodes), "vnodes": VNODES}, f)
+    os.replace(tmp, path)
+
+
+def read_ring(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return HashRing(data["nodes"], data.get("vnodes", VNODES))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+# ================== Proxy ==================
+
+def _routing_key(head, peer):
+    # Lấy cookie "tenant" từ header request; không có thì dùng IP client
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() != b"cookie":
+            continue
+        for part in value.decode("latin-1").split(";"):
+            k, _, v = part.strip().partition("=")
+            if k == AFFINITY_COOKIE and v:
+                return "u:" + v
+    return "ip:" + (peer[0] if isinstance(peer, tuple) else str(peer))
+
+
+def _rewrite_head(head, peer):
+    # 1 kết nối = 1 request: cookie có thể đổi sau khi đăng nhập nên không giữ kết nối sang node cũ
+    lines = [ln for ln in head.split(b"\r\n") if ln and not ln.lower().startswith((b"connection:", b"keep-alive:"))]
+    lines.append(b"Connection: close")
+    if isinstance(peer, tuple):
+        lines.append(b"X-Forwarded-For: " + peer[0].encode())
+    return b"\r\n".join(lines) + b"\r\n\r\n"
+
+
+async def _pipe(reader, writer):
+    try:
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk:
+                break
+            writer.write(chunk)
+            await writer.drain()
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        try:
+            writer.close()
+        except Exception:
+            pass
+
+
+async def _reply_error(writer, status):
+    try:
+        writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+class Dispatcher:
+    def __init__(self, sockdir, ring_file, threads):
+        self.sockdir = sockdir
+        self.ring_file = ring_file
+        self.threads = threads
+        self.procs = {}  # node -> subprocess.Popen
+        self.ring = HashRing([])
+        self._seq = 0
+
+    def _sock(self, node):
+        return os.path.join(self.sockdir, f"{node}.sock")
+
+    def spawn(self):
+        node = f"n{self._seq}"
+        self._seq += 1
+        env = dict(os.environ, AFFINITY_NODE=node, AFFINITY_RING_FILE=self.ring_file)
+        self.procs[node] = subprocess.Popen(
+            # gunicorn.conf.py: master nạp app rồi preload_tenants() chỉ các cửa hàng thuộc node này (theo vòng băm
+            # đã ghi sẵn); tham số dòng lệnh (--workers 1) được ưu tiên hơn giá trị trong file cấu hình
+            [sys.executable, "-m", "gunicorn", "app:app", "-c", os.path.join(APP_DIR, "gunicorn.conf.py"),
+             "--workers", "1", "--threads", str(self.threads), "--bind", f"unix:{self._sock(node)}"],
+            cwd=APP_DIR, env=env,
+        )
+        return node
+
+    async def wait_ready(self, node, timeout=60):
+        for _ in range(int(timeout * 10)):
+            if os.path.exists(self._sock(node)):
+                return True
+            if self.procs[node].poll() is not None:
+                return False
+            await asyncio.sleep(0.1)
+        return False
+
+    def publish(self):
+        nodes = sorted(self.procs, key=lambda n: int(n[1:]))
+        write_ring(self.ring_file, nodes)
+        self.ring = HashRing(nodes)
+        print(f"[affinity] node: {', '.join(nodes)}", flush=True)
+
+    async def add_node(self):
+        node = self.spawn()
+        if await self.wait_ready(node):
+            self.publish()  # Chỉ đưa vào vòng băm khi đã sẵn sàng nhận request
+        else:
+            print(f"[affinity] node {node} không khởi động được", flush=True)
+            self.procs.pop(node, None)
+
+    async def remove_node(self):
+        if len(self.procs) <= 1:
+            return
+        node = max(self.procs, key=lambda n: int(n[1:]))
+        proc = self.procs.pop(node)
+        self.publish()  # Ngừng gửi request mới trước, rồi cho node cũ trả nốt request đang chạy
+        await asyncio.sleep(5)
+        proc.terminate()
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        node = self.ring.node_for(_routing_key(head, peer))
+        if node is None:  # Vòng băm rỗng (chưa có node nào sẵn sàng)
+            await _reply_error(writer, b"503 Service Unavailable")
+            return
+        try:
+            b_reader, b_writer = await asyncio.open_unix_connection(self._sock(node))
+        except OSError:
+            await _reply_error(writer, b"502 Bad Gateway")
+            return
+        b_writer.write(_rewrite_head(head, peer))
+        await asyncio.gather(_pipe(reader, b_writer), _pipe(b_reader, writer))
+
+    def shutdown(self):
+        for proc in self.procs.values():
+            proc.terminate()
+        for proc in self.procs.values():
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+async def serve(args):
+    disp = Dispatcher(tempfile.mkdtemp(prefix="affinity-"), args.ring_file, args.threads)
+    # Ghi trước vòng băm dự kiến để mỗi backend (gunicorn preload) chỉ nạp sẵn các cửa hàng của mình
+    write_ring(args.ring_file, [f"n{i}" for i in range(args.workers)])
+    for _ in range(args.workers):
+        disp.spawn()
+    for node in list(disp.procs):
+        if not await disp.wait_ready(node):
+            disp.shutdown()
+            raise SystemExit(f"node {node} không khởi động được")
+    disp.publish()
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTTIN, lambda: asyncio.ensure_future(disp.add_node()))
+    loop.add_signal_handler(signal.SIGTTOU, lambda: asyncio.ensure_future(disp.remove_node()))
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    server = await asyncio.start_server(disp.handle, args.host, args.port, limit=64 * 1024)
+    print(f"[affinity] proxy nghe {args.host}:{args.port}, pid {os.getpid()}", flush=True)
+    async with server:
+        await stop.wait()
+    disp.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Proxy định tuyến theo cửa hàng trước nhiều backend gunicorn.")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", "2")))
+    parser.add_argument("--threads", type=int, default=4, help="Số luồng của mỗi backend")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8000")))
+    parser.add_argument("--ring-file", default=os.environ.get("AFFINITY_RING_FILE", RING_FILE_DEFAULT))
+    asyncio.run(serve(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
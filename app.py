@@ -1,11 +1,47 @@
 # app.py  # Đây là file backend chính của Flask, chứa toàn bộ logic chạy web/app
 
-import os, json, uuid, smtplib, hashlib # os: thao tác thư mục/đường dẫn hệ điều hành, json: đọc/ghi dữ liệu dạng JSON, uuid: tạo ID ngẫu nhiên duy nhất cho bản ghi, smtplib: gửi email qua SMTP, hashlib: băm/mã hóa chuỗi (dùng cho mật khẩu)
+import os, json, uuid, hashlib, hmac # os: thao tác thư mục/đường dẫn hệ điều hành, json: đọc/ghi dữ liệu dạng JSON, uuid: tạo ID ngẫu nhiên duy nhất cho bản ghi, hashlib: băm/mã hóa chuỗi (dùng cho mật khẩu), hmac: so sánh hash trong thời gian cố định
+import sys, copy  # sys.intern: dùng chung chuỗi lặp lại giữa các bản ghi, copy: sao chép bản ghi model
+import gzip, shutil, threading, time  # gzip: nén file lưu trữ, shutil: chép/xóa cây thư mục sao lưu, threading: khóa + luồng chạy nền, time: chờ giữa các lần chạy nền
+import zlib, mimetypes, urllib.request  # zlib: nén gzip từng phần cho trang stream, mimetypes: kiểu file tĩnh nén sẵn, urllib: tải thư viện front-end lúc build
+_BOOT_T0 = time.perf_counter()  # Mốc bắt đầu nạp app (đo thời gian khởi động / TTFB sau khi instance thức dậy)
+import bisect, heapq, re  # Giữ list sắp xếp / chọn top-K cho bảng xếp hạng, re: nhận dạng tên file tháng lưu trữ
+from collections import deque  # Hàng chờ FIFO theo từng truyện (waitlist)
+from html import escape as html_escape  # Chèn tên truyện vào email HTML của chiến dịch
+from io import BytesIO  # Đọc ảnh bìa tải lên ngay trong bộ nhớ để kiểm tra
+import multiprocessing  # Chọn cách tạo process con (spawn) cho tổng hợp admin
+import gc  # Đóng băng bộ gom rác trước khi fork (chia sẻ bộ nhớ copy-on-write với worker)
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed  # Tóm tắt nhiều cửa hàng song song / băm mật khẩu ngoài luồng request
+import click  # Tham số cho lệnh CLI (đi kèm Flask)
+from contextlib import contextmanager, ExitStack  # Tạo context manager cho khóa dữ liệu theo user / giữ unit of work suốt request
+from dataclasses import dataclass, fields as dc_fields  # Model gọn (__slots__) cho truyện/khách/giao dịch
+import numpy as np  # Mảng dạng cột cho bộ phân tích giao dịch (thống kê, báo cáo)
+
+try:
+    import fcntl  # Khóa file giữa các process (Linux/macOS, ví dụ nhiều worker gunicorn)
+except ImportError:  # Windows không có fcntl -> chỉ dùng khóa trong process
+    fcntl = None
+
+try:
+    import orjson  # Tùy chọn: đọc/ghi JSON nhanh hơn nhiều so với thư viện chuẩn
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack  # Tùy chọn: định dạng nhị phân gọn cho cửa hàng có nhiều dữ liệu
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli  # Tùy chọn: build-assets nén sẵn thêm bản .br (nhỏ hơn gzip) cho file tĩnh
+except ImportError:
+    brotli = None
 
 from datetime import datetime, timedelta  # Import datetime để lấy thời gian hiện tại, timedelta để cộng/trừ số ngày (ví dụ tính ngày đến hạn)
-from email.mime.text import MIMEText  # MIMEText dùng để tạo nội dung email dạng text hoặc html
-from email.utils import formataddr    # formataddr giúp ghép "Tên hiển thị + email" chuẩn RFC khi gửi
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify # type: ignore
+# smtplib / email.* chỉ nạp khi gửi mail (xem send_email_if_configured) để khởi động nhanh hơn
+from affinity import AFFINITY_COOKIE, read_ring  # Định tuyến theo cửa hàng (proxy affinity.py, chỉ dùng thư viện chuẩn)
+from jinja2 import FileSystemBytecodeCache  # Lưu template đã biên dịch ra đĩa (đi kèm Flask)
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, abort, stream_template, send_file, g # type: ignore
 # Import các thành phần Flask:
 # Flask: tạo app
 # render_template: render file HTML trong thư mục templates/
@@ -22,7 +58,7 @@ app.secret_key = "super-secret-change-me"  # Secret key để mã hóa session/c
 # ================== Cấu hình & tiện ích ==================  # Comment phân tách khu vực cấu hình/tiện ích
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")  # Tạo đường dẫn tới folder data nằm cạnh app.py
-USERS_FILE = os.path.join(DATA_DIR, "users.json")           # Đường dẫn file users.json lưu tài khoản
+USERS_FILE = os.path.join(DATA_DIR, "users.json")           # Danh sách tài khoản kiểu cũ (tự tách ra account.json, xem migrate_user_registry)
 DT_FMT = "%d-%m-%Y %H:%M:%S"                                # Chuỗi format chuẩn cho ngày giờ toàn hệ thống
 
 def now_str():  # Hàm tiện ích trả về thời gian hiện tại dạng chuỗi
@@ -31,35 +67,264 @@ def now_str():  # Hàm tiện ích trả về thời gian hiện tại dạng ch
 def parse_dt(s):  # Hàm tiện ích chuyển chuỗi thời gian -> datetime
     return datetime.strptime(s, DT_FMT)  # Parse chuỗi s dựa trên DT_FMT
 
+_dirs_ready = set()  # Các DATA_DIR đã kiểm tra trong process này
+
 def ensure_dirs():  # Hàm đảm bảo folder/file dữ liệu tồn tại
-    os.makedirs(DATA_DIR, exist_ok=True)  # Tạo folder data nếu chưa có, exist_ok tránh lỗi nếu đã có
-    if not os.path.exists(USERS_FILE):   # Nếu file users.json chưa tồn tại
-        with open(USERS_FILE, "w", encoding="utf-8") as f:  # Mở file để tạo mới với encoding UTF-8
-            json.dump([], f, ensure_ascii=False, indent=2)  # Ghi list rỗng [] vào file (mặc định chưa có user)
+    if DATA_DIR in _dirs_ready and not os.path.exists(USERS_FILE):
+        return  # Đã kiểm tra rồi -> chỉ còn 1 lần stat
+    _dirs_ready.add(DATA_DIR)
+    os.makedirs(os.path.join(DATA_DIR, "users"), exist_ok=True)  # Tạo data/users nếu chưa có, exist_ok tránh lỗi nếu đã có
+    migrate_user_registry()  # Còn users.json kiểu cũ -> tách ra từng account.json
+
+# ----- Băm mật khẩu -----
+# PBKDF2-SHA256 có salt riêng từng tài khoản, số vòng chỉnh được (PASSWORD_HASH_ITERATIONS). Chuỗi lưu:
+# "pbkdf2_sha256$<số vòng>$<salt hex>$<hash hex>". Hash SHA256 trần kiểu cũ vẫn đăng nhập được và được băm lại
+# theo kiểu mới ngay lần đăng nhập thành công (cũng vậy khi đổi số vòng). Việc băm chạy trong thread pool
+# riêng (hashlib nhả GIL) chỉ để giới hạn số lượt băm chạy cùng lúc (PASSWORD_HASH_THREADS): luồng request
+# đăng nhập/đăng ký vẫn chờ đến khi băm xong. Máy yếu (gói free) thì giảm PASSWORD_HASH_ITERATIONS.
+
+PASSWORD_HASH_ITERATIONS = int(os.environ.get("PASSWORD_HASH_ITERATIONS", "600000"))
+PASSWORD_HASH_THREADS = int(os.environ.get("PASSWORD_HASH_THREADS", "2"))  # Số lượt băm chạy song song tối đa
+PW_SCHEME = "pbkdf2_sha256"
+
+def hash_pw(pw: str, iterations=None) -> str:  # Hàm băm mật khẩu, nhận pw dạng str và trả về str
+    iterations = iterations or PASSWORD_HASH_ITERATIONS
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", pw.encode("utf-8"), salt, iterations)
+    return f"{PW_SCHEME}${iterations}${salt.hex()}${digest.hex()}"
+
+def check_pw(stored: str, pw: str):
+    # Trả (đúng mật khẩu?, cần băm lại?)
+    if stored.startswith(PW_SCHEME + "$"):
+        try:
+            _, iterations, salt, digest = stored.split("$")
+            iterations = int(iterations)
+            actual = hashlib.pbkdf2_hmac("sha256", pw.encode("utf-8"), bytes.fromhex(salt), iterations).hex()
+        except ValueError:
+            return False, False
+        return hmac.compare_digest(actual, digest), iterations != PASSWORD_HASH_ITERATIONS
+    legacy = hashlib.sha256(pw.encode("utf-8")).hexdigest()  # Tài khoản tạo trước khi có salt
+    return hmac.compare_digest(legacy, stored), True
 
-def hash_pw(pw: str) -> str:  # Hàm băm mật khẩu, nhận pw dạng str và trả về str
-    return hashlib.sha256(pw.encode("utf-8")).hexdigest()  # Băm SHA256 để lưu an toàn hơn plaintext
+_DUMMY_PW_HASH = f"{PW_SCHEME}${PASSWORD_HASH_ITERATIONS}$00$00"  # So với tài khoản không tồn tại: tốn thời gian như thật
 
-def read_json(path, default):  # Hàm đọc JSON từ path, nếu lỗi thì trả default
+_pw_pool = {"pid": None, "executor": None}
+_pw_pool_guard = threading.Lock()
+
+def run_pw_job(fn, *args):
+    """
+    Chạy hash_pw / check_pw trong thread pool riêng (tạo lại sau fork: luồng không sống qua fork).
+    Luồng gọi vẫn bị chặn tới khi băm xong: pool chỉ giới hạn số lượt băm đồng thời để các request
+    khác còn CPU, không giải phóng luồng request của lượt đăng nhập đang chờ.
+    """
+    with _pw_pool_guard:
+        if _pw_pool["pid"] != os.getpid():
+            _pw_pool.update(pid=os.getpid(), executor=ThreadPoolExecutor(PASSWORD_HASH_THREADS, thread_name_prefix="pwhash"))
+        executor = _pw_pool["executor"]
+    return executor.submit(fn, *args).result()
+
+def _open_bin(path, mode):  # Mở file nhị phân, tự dùng gzip nếu đuôi .gz
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "b")
+    return open(path, mode + "b")
+
+# ----- Định dạng lưu trữ (codec) -----
+# "json": thụt lề, dễ đọc (mặc định cũ) | "compact": JSON 1 dòng | "msgpack": nhị phân (cần cài msgpack).
+# Có orjson thì cả 2 dạng JSON đều đi qua orjson. Khi đọc tự nhận dạng theo byte đầu tiên
+# ([ hoặc { là JSON, còn lại là msgpack), nên đổi định dạng không cần đổi tên file và file cũ vẫn đọc được.
+# File msgpack gặp process chưa cài msgpack -> StoreFormatError (read_json không nuốt lỗi này).
+STORE_FORMATS = ("json", "compact", "msgpack")
+
+def available_store_formats():
+    return [f for f in STORE_FORMATS if f != "msgpack" or msgpack is not None]
+
+def encode_data(data, fmt="json") -> bytes:
+    # orjson/msgpack không ghi được số nguyên > 64 bit (genre_mask khi có rất nhiều thể loại) -> dùng json chuẩn
+    if fmt == "msgpack":
+        if msgpack is None:
+            raise RuntimeError("Chưa cài msgpack (pip install msgpack)")
+        try:
+            return msgpack.packb(data, use_bin_type=True)
+        except OverflowError:
+            fmt = "compact"
+    if orjson is not None:
+        opt = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if fmt == "json" else 0)
+        try:
+            return orjson.dumps(data, option=opt)
+        except TypeError:
+            pass
+    if fmt != "json":
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+class StoreFormatError(RuntimeError):
+    # File dữ liệu là msgpack nhưng process này chưa cài msgpack: không được coi là file rỗng
+    pass
+
+def decode_data(raw: bytes):
+    head = raw[:64].lstrip()[:1]
+    if head in (b"[", b"{", b""):
+        return _json_loads(raw)
+    if msgpack is None:
+        raise StoreFormatError("File dữ liệu dạng msgpack nhưng chưa cài msgpack (pip install msgpack)")
+    return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+def read_json(path, default):  # Hàm đọc dữ liệu từ path (JSON/msgpack, có thể .gz), nếu lỗi thì trả default
     try:  # Bắt đầu khối try để tránh crash khi file lỗi
-        with open(path, "r", encoding="utf-8") as f:  # Mở file cần đọc theo UTF-8
-            return json.load(f)  # Đọc và parse JSON thành Python object
-    except Exception:  # Nếu có bất kỳ lỗi nào (file mất, JSON hỏng...)
+        with _open_bin(path, "r") as f:  # Đọc nguyên file (hỗ trợ .json.gz)
+            return decode_data(f.read())  # Tự nhận dạng định dạng rồi parse thành Python object
+    except StoreFormatError:  # Không đọc được vì thiếu msgpack: báo lỗi, không trả default (lần ghi sau sẽ đè mất dữ liệu thật)
+        raise
+    except Exception:  # Nếu có bất kỳ lỗi nào (file mất, dữ liệu hỏng...)
         return default  # Trả về giá trị mặc định truyền vào
 
-def write_json(path, data):  # Hàm ghi Python object data ra file JSON path
+def write_json(path, data, fmt="json"):  # Hàm ghi Python object data ra file path theo định dạng fmt
     os.makedirs(os.path.dirname(path), exist_ok=True)  # Tạo thư mục chứa path nếu chưa có
-    with open(path, "w", encoding="utf-8") as f:  # Mở file ở chế độ ghi
-        json.dump(data, f, ensure_ascii=False, indent=2)  # Ghi JSON đẹp, giữ tiếng Việt
+    folder, name = os.path.split(path)
+    tmp = os.path.join(folder, f".tmp-{os.getpid()}-{threading.get_ident()}-{name}")  # File tạm riêng cho process/luồng này (giữ đuôi .gz nếu có)
+    raw = encode_data(data, fmt)  # Mặc định JSON đẹp, giữ tiếng Việt (file cấu hình vẫn sửa tay được)
+    with _open_bin(tmp, "w") as f:  # Ghi ra file tạm trước
+        f.write(raw)
+    os.replace(tmp, path)  # Đổi tên nguyên tử: người đọc không bao giờ thấy file ghi dở
+    owner = _tenant_of(path)
+    if owner and name not in (VERSION_FILE, ACCOUNT_FILE):  # account.json không thuộc dữ liệu đã nạp vào bộ nhớ
+        bump_tenant_version(owner)  # Báo cho các worker khác: dữ liệu cửa hàng này vừa đổi
+
+_user_roots = {}  # (DATA_DIR, username) -> đường dẫn đã tạo sẵn (khỏi makedirs ở mỗi lần user_file)
 
 def user_root(username):  # Hàm tạo/lấy thư mục riêng của 1 user
-    p = os.path.join(DATA_DIR, "users", username)  # Ghép thành data/users/<username>
-    os.makedirs(p, exist_ok=True)  # Tạo folder user nếu chưa có
+    key = (DATA_DIR, username)
+    p = _user_roots.get(key)
+    if p is None:
+        p = os.path.join(DATA_DIR, "users", username)  # Ghép thành data/users/<username>
+        os.makedirs(p, exist_ok=True)  # Tạo folder user nếu chưa có (chỉ lần đầu trong process)
+        _user_roots[key] = p
     return p  # Trả đường dẫn folder đó
 
 def user_file(username, name):  # Hàm tạo đường dẫn file riêng theo user
     return os.path.join(user_root(username), name)  # Ghép data/users/<username>/<name>
 
+_tenant_locks = {}  # username -> threading.RLock
+_tenant_locks_guard = threading.Lock()  # Bảo vệ dict _tenant_locks
+_lock_depth = threading.local()  # Độ sâu khóa lồng nhau của từng luồng
+
+@contextmanager
+def tenant_lock(username):
+    """
+    Khóa ghi dữ liệu của 1 user (cửa hàng).
+
+    - Trong 1 process: dùng RLock theo username (lồng nhau được).
+    - Giữa các process (nhiều worker gunicorn): dùng flock trên file .lock nếu hệ điều hành hỗ trợ.
+    """
+    with _tenant_locks_guard:
+        lk = _tenant_locks.setdefault(username, threading.RLock())
+    with lk:
+        depths = _lock_depth.__dict__.setdefault("d", {})
+        depth = depths.get(username, 0)  # Chỉ flock ở lần khóa ngoài cùng
+        depths[username] = depth + 1
+        fh = None
+        try:
+            if fcntl is not None and depth == 0:
+                fh = open(user_file(username, ".lock"), "a")
+                fcntl.flock(fh, fcntl.LOCK_EX)
+            yield
+        finally:
+            depths[username] = depth
+            if fh is not None:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+                fh.close()
+
+# ===== Tài khoản (registry) =====
+# Mỗi tài khoản là 1 file data/users/<username>/account.json (trước đây: cả danh sách trong users.json).
+# Chỉ mục username.casefold() -> tên thư mục dựng từ danh sách thư mục data/users/, chỉ dựng lại khi thư mục
+# đó đổi (có cửa hàng mới). Đăng nhập/đăng ký chỉ đọc đúng 1 file; đổi tên cửa hàng chỉ ghi file của cửa hàng đó.
+
+ACCOUNT_FILE = "account.json"
+
+_account_index = {"key": None, "map": {}}  # (DATA_DIR, chữ ký thư mục users/) -> {casefold: tên thư mục}
+_account_cache = {}  # đường dẫn account.json -> (chữ ký file, dict)
+_registry_guard = threading.Lock()
+
+@contextmanager
+def registry_lock():
+    # Khóa toàn cục, chỉ dùng khi tạo tài khoản (chống 2 người đăng ký "Bob" và "bob" cùng lúc)
+    with _registry_guard:
+        fh = None
+        try:
+            if fcntl is not None:
+                fh = open(os.path.join(DATA_DIR, ".lock"), "a")
+                fcntl.flock(fh, fcntl.LOCK_EX)
+            yield
+        finally:
+            if fh is not None:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+                fh.close()
+
+def account_index():
+    root = os.path.join(DATA_DIR, "users")
+    key = (DATA_DIR, _file_sig(root))
+    if _account_index["key"] != key:
+        idx = {}
+        for name in list_tenants():
+            idx.setdefault(name.casefold(), name)
+        _account_index.update(key=key, map=idx)
+    return _account_index["map"]
+
+def get_account(username):
+    # Bản ghi tài khoản (bản sao) theo username không phân biệt hoa thường; None nếu không có
+    name = account_index().get((username or "").casefold())
+    if name is None:
+        return None
+    path = os.path.join(DATA_DIR, "users", name, ACCOUNT_FILE)  # Không qua user_root: khỏi makedirs
+    sig = _file_sig(path)
+    if sig is None:
+        return None
+    hit = _account_cache.get(path)
+    if hit is None or hit[0] != sig:
+        hit = _account_cache[path] = (sig, read_json(path, None))
+    return dict(hit[1]) if hit[1] else None
+
+def list_accounts():
+    return [a for a in map(get_account, list_tenants()) if a]
+
+def create_account(rec):
+    # Tạo tài khoản mới; False nếu username (không phân biệt hoa thường) đã có
+    with registry_lock():
+        if get_account(rec["username"]) is not None:
+            return False
+        write_json(user_file(rec["username"], ACCOUNT_FILE), rec)
+    return True
+
+def update_account(username, **changes):
+    # Sửa vài trường của 1 tài khoản: chỉ khóa + ghi file của cửa hàng đó
+    with tenant_lock(username):
+        rec = get_account(username)
+        if rec is None:
+            return None
+        rec.update(changes)
+        write_json(user_file(rec["username"], ACCOUNT_FILE), rec)
+    return rec
+
+def migrate_user_registry():
+    # users.json kiểu cũ -> account.json từng cửa hàng; file cũ đổi tên thành users.json.migrated
+    if not os.path.exists(USERS_FILE):
+        return 0
+    created = 0
+    with registry_lock():
+        users = read_json(USERS_FILE, None)
+        if users is None:  # Process khác vừa chuyển xong
+            return 0
+        for u in users:
+            if u.get("username") and get_account(u["username"]) is None:
+                write_json(user_file(u["username"], ACCOUNT_FILE), u)
+                created += 1
+        os.replace(USERS_FILE, USERS_FILE + ".migrated")
+    if created:
+        app.logger.info("Đã chuyển %d tài khoản từ users.json sang account.json", created)
+    return created
+
 def get_current_username():  # Hàm lấy username đang đăng nhập
     return session.get("username")  # Lấy từ session (nếu chưa login thì None)
 
@@ -67,72 +332,46 @@ def require_login():  # Hàm bắt buộc login
     if not get_current_username():  # Nếu không có username trong session => chưa login
         return redirect(url_for("login"))  # Điều hướng sang trang login
 
-def price_to_int(s: str) -> int:
-    # Hàm ngược lại: "10.000" -> 10000 để tính toán
+def price_to_int(s) -> int:
+    # Hàm ngược lại: "10.000" -> 10000. Chỉ dùng khi đọc ô nhập trên form và khi chuyển dữ liệu cũ;
+    # dữ liệu đã lưu luôn là số nguyên VND nên vòng lặp tính toán không cần parse chuỗi nữa.
+    if isinstance(s, int):  # Đã là số thì giữ nguyên
+        return s
     try:  # Bắt lỗi parse
-        return int(s.replace(".",""))  # Bỏ dấu chấm rồi ép int
+        return int(str(s).replace(".","").strip())  # Bỏ dấu chấm rồi ép int
     except:  # Nếu lỗi parse
         return 0  # Trả 0
 
-def calc_late_fee(r: dict) -> str:
+def calc_late_fee(r) -> int:
     """
-    Tính phí trễ hiện tại cho 1 giao dịch thuê truyện.
+    Tính phí trễ hiện tại cho 1 giao dịch thuê truyện (Rental).
 
     - Nếu giao dịch đã trả (returned_at có giá trị) thì dùng luôn late_fee đang lưu.
     - Nếu chưa trả thì tính lại dựa trên due_at, cấu hình late_fee_per_day của shop.
-    - Trả về chuỗi đã format, ví dụ "10.000".
+    - Trả về số nguyên VND; hiển thị dùng filter |vnd trong template.
     """
-    try:
-        # Nếu r không phải dict chuẩn thì cứ để fallback về "0"
-        late_fee_stored = r.get("late_fee")
-    except Exception:
-        late_fee_stored = None
-
-    # Nếu đã trả thì ưu tiên dùng phí trễ đã lưu trong file
-    if r.get("returned_at"):
-        return late_fee_stored or "0"
-
-    # Giao dịch chưa trả -> tính lại
     username = get_current_username() or ""
-    if not username:
-        return late_fee_stored or "0"
+    if r.returned_at or not username:
+        return r.late_fee
 
-    # Đọc cấu hình phí trễ/ngày
+    # Phí trễ/ngày của cửa hàng (dùng khi giao dịch không lưu sẵn mức riêng)
     shop_cfg = read_shop_cfg(username)
     default_per_day = int(shop_cfg.get("late_fee_per_day", 10000) or 10000)
-
-    # Parse ngày đến hạn
-    try:
-        due = parse_dt(r.get("due_at", ""))
-    except Exception:
-        return late_fee_stored or "0"
-
-    days_late = (datetime.now() - due).days
-    if days_late <= 0:
-        # Chưa trễ ngày nào
-        return late_fee_stored or "0"
-
-    # Lấy phí trễ/ngày
-    per_day = r.get("late_fee_per_day", default_per_day)
-    try:
-        per_day_int = int(per_day)
-    except Exception:
-        per_day_int = default_per_day
-    if per_day_int < 0:
-        per_day_int = 0
-
-    late_fee = days_late * per_day_int
-    return format_price(str(late_fee))
+    return r.late_fee_at(datetime.now(), default_per_day)
 
 # inject helpers vào Jinja
 app.jinja_env.globals.update(
     read_json=read_json,
     user_file=user_file,
     now=now_str,
-    price_to_int=price_to_int,  # thêm dòng này để dùng trong template
     calc_late_fee=calc_late_fee,  # helper tính phí trễ dùng trong template
 )
 
+@app.template_filter("vnd")
+def vnd_filter(amount):
+    # Filter hiển thị tiền: {{ 10000|vnd }} -> "10.000" (chỉ format lúc render)
+    return format_price(amount)
+
 # update globals:
 # read_json: để template đọc dữ liệu
 # user_file: để template biết đường dẫn file user
@@ -151,6 +390,11 @@ def send_email_if_configured(username, subject, html_body, to_email):
         return False, "Email chưa cấu hình hoặc thiếu trường (cần sender_email, smtp_pass, sender_name)."  
         # Nếu thiếu => trả False và thông báo lỗi
 
+    # Nạp module gửi mail ở lần gửi đầu tiên (không làm chậm lúc khởi động)
+    import smtplib  # Gửi email qua SMTP
+    from email.mime.text import MIMEText  # MIMEText dùng để tạo nội dung email dạng text hoặc html
+    from email.utils import formataddr    # formataddr giúp ghép "Tên hiển thị + email" chuẩn RFC khi gửi
+
     try:  # Bắt đầu try vì gửi email có thể lỗi network/login
         msg = MIMEText(html_body, "html", "utf-8")  # Tạo object email nội dung HTML, UTF-8
         msg["Subject"] = subject  # Gán tiêu đề email
@@ -170,71 +414,1195 @@ def send_email_if_configured(username, subject, html_body, to_email):
     except Exception as e:  # Nếu có lỗi khi gửi
         return False, f"Lỗi gửi email: {e}"  # Trả False + chuỗi lỗi để debug
 
-# Render mẫu dạng {key}  # Comment: render template email bằng cách thay {variable}
+# Render mẫu dạng {key}: mẫu được biên dịch 1 lần thành (chữ, tên biến, chữ, tên biến, ..., chữ) và cache theo
+# nội dung, mỗi lần gửi chỉ còn 1 lần join. Biến không có trong ctx được giữ nguyên "{key}" như trước.
+_TPL_VAR_RE = re.compile(r"\{(\w+)\}")
+_tpl_cache = {}  # nội dung mẫu -> tuple đã biên dịch
+
+def compile_tpl(tpl):
+    parts = _tpl_cache.get(tpl)
+    if parts is None:
+        if len(_tpl_cache) >= 256:
+            _tpl_cache.clear()  # Mẫu do người dùng sửa: không giữ vô hạn
+        parts = _tpl_cache[tpl] = tuple(_TPL_VAR_RE.split(tpl))  # Vị trí chẵn: chữ, lẻ: tên biến
+    return parts
+
+def tpl_placeholders(tpl):
+    # Tập tên biến {key} có trong mẫu
+    return set(compile_tpl(tpl or "")[1::2])
+
 def render_tpl(tpl: str, ctx: dict) -> str:
     if not tpl:  # Nếu template rỗng hoặc None
         return ""  # Trả chuỗi rỗng
-    out = tpl  # Copy template vào biến out để thay dần
-    for k, v in ctx.items():  # Duyệt từng cặp key/value trong context
-        out = out.replace("{" + k + "}", str(v))  # Thay {key} bằng giá trị value
-    return out  # Trả template sau khi thay xong
+    return "".join(
+        p if i % 2 == 0 else (str(ctx[p]) if p in ctx else "{" + p + "}")
+        for i, p in enumerate(compile_tpl(tpl))
+    )
+
+# ---------- Mô hình dữ liệu (truyện, khách hàng, giao dịch) ----------
+#
+# Trong bộ nhớ mỗi bản ghi là 1 dataclass có __slots__ (không kèm dict riêng cho từng bản ghi), các chuỗi
+# lặp lại (id, tên truyện/khách chép vào giao dịch, mốc thời gian) được sys.intern để dùng chung 1 bản.
+# from_dict là chỗ DUY NHẤT kiểm tra/ép kiểu khi đọc file (tiền, tồn kho, tuổi, phí trễ -> int), to_dict
+# là chỗ duy nhất dựng lại dict để ghi JSON. Trường lạ không khai báo được giữ nguyên trong extra.
+
+def _m_str(v):
+    # Chuỗi dùng chung (intern); None/rỗng -> ""
+    return sys.intern(str(v).strip()) if v not in (None, "") else ""
+
+def _m_int(v):
+    # Số nguyên (tiền, tồn kho...): nhận cả chuỗi cũ "10.000"; hỏng -> 0
+    if isinstance(v, int) and not isinstance(v, bool):
+        return v
+    return price_to_int(v if v is not None else 0)
+
+def _m_opt_int(v):
+    # Số nguyên không âm hoặc None (chưa lưu -> dùng cấu hình cửa hàng)
+    if v is None or v == "":
+        return None
+    try:
+        return max(0, int(v))
+    except (TypeError, ValueError):
+        return None
+
+def _m_ids(v):
+    return tuple(int(x) for x in (v or ()))
+
+class _Record:
+    __slots__ = ()
+    _DECODE = {}  # tên trường -> hàm ép kiểu khi đọc
+
+    @classmethod
+    def from_dict(cls, d):
+        conv = cls._DECODE
+        rec = cls(**{k: f(d.get(k)) for k, f in conv.items()})
+        extra = {k: v for k, v in d.items() if k not in conv}
+        if extra:
+            rec.extra = extra
+        return rec
+
+    def to_dict(self):
+        out = {}
+        for k in self._DECODE:
+            v = getattr(self, k)
+            if v is not None:
+                out[k] = list(v) if isinstance(v, tuple) else v
+        if self.extra:
+            out.update(self.extra)
+        return out
+
+    def update(self, changes):
+        # Gán nhiều trường từ dict (ví dụ thao tác journal), vẫn qua bộ ép kiểu
+        for k, v in changes.items():
+            f = self._DECODE.get(k)
+            if f is not None:
+                setattr(self, k, f(v))
+            else:
+                self.extra = {**(self.extra or {}), k: v}
+
+    def get(self, key, default=None):
+        # Đọc kiểu dict cho code dùng chung với dữ liệu thô (phân tích, lưu trữ theo tháng)
+        if key in self._DECODE:
+            v = getattr(self, key)
+            return default if v is None else v
+        return (self.extra or {}).get(key, default)
+
+@dataclass(slots=True, eq=False)
+class Manga(_Record):
+    id: str = ""
+    title: str = ""
+    genre: str = ""
+    author: str = ""
+    rent_price: int = 0  # VND
+    condition: str = "Mới"
+    stock: int = 0
+    barcode: str = ""
+    created_at: str = ""
+    updated_at: str = ""
+    genre_ids: tuple = ()
+    genre_mask: int = 0
+    rev: int = 0  # Phiên bản danh mục lúc đổi lần cuối
+    extra: dict = None
+
+    _DECODE = {
+        "id": _m_str, "title": _m_str, "genre": _m_str, "author": _m_str, "rent_price": _m_int,
+        "condition": lambda v: _m_str(v) or "Mới", "stock": _m_int, "barcode": _m_str,
+        "created_at": _m_str, "updated_at": _m_str, "genre_ids": _m_ids, "genre_mask": _m_int, "rev": _m_int,
+    }
+
+    @classmethod
+    def from_dict(cls, d):
+        m = super(Manga, cls).from_dict(d)
+        # genre_mask suy ra từ genre_ids: dựng lại khi đọc (số nguyên > 64 bit có thể mất chính xác qua orjson)
+        m.genre_mask = genre_mask(m.genre_ids)
+        return m
+
+@dataclass(slots=True, eq=False)
+class Customer(_Record):
+    id: str = ""
+    name: str = ""
+    age: int = 0
+    phone: str = ""
+    address: str = ""
+    national_id: str = ""
+    email: str = ""
+    created_at: str = ""
+    updated_at: str = ""
+    extra: dict = None
+
+    _DECODE = {
+        "id": _m_str, "name": _m_str, "age": _m_int, "phone": _m_str, "address": _m_str,
+        "national_id": _m_str, "email": _m_str, "created_at": _m_str, "updated_at": _m_str,
+    }
+
+@dataclass(slots=True, eq=False)
+class Rental(_Record):
+    id: str = ""
+    manga_id: str = ""
+    manga_title: str = ""
+    customer_id: str = ""
+    customer_name: str = ""
+    rent_price: int = 0  # VND
+    late_fee: int = 0  # VND, chốt lúc trả
+    late_fee_per_day: int = None  # Phí trễ/ngày lúc tạo giao dịch; None = theo cấu hình hiện tại
+    created_at: str = ""
+    due_at: str = ""
+    returned_at: str = ""
+    extra: dict = None
+
+    _DECODE = {
+        "id": _m_str, "manga_id": _m_str, "manga_title": _m_str, "customer_id": _m_str,
+        "customer_name": _m_str, "rent_price": _m_int, "late_fee": _m_int,
+        "late_fee_per_day": _m_opt_int, "created_at": _m_str, "due_at": _m_str, "returned_at": _m_str,
+    }
+
+    def late_fee_at(self, now, default_per_day):
+        # Phí trễ nếu trả vào lúc now; giao dịch đã trả (hoặc hạn trả hỏng) -> phí đã lưu
+        if self.returned_at:
+            return self.late_fee
+        try:
+            days_late = (now - parse_dt(self.due_at)).days
+        except ValueError:
+            return self.late_fee
+        if days_late <= 0:
+            return 0
+        per_day = default_per_day if self.late_fee_per_day is None else self.late_fee_per_day
+        return days_late * max(0, per_day)
+
+MODELS = {"manga": Manga, "customers": Customer, "rentals": Rental}  # collection -> model
+
+def decode_rows(name, rows):
+    cls = MODELS.get(name)
+    return [cls.from_dict(x) for x in rows] if cls else rows
+
+def encode_rows(name, rows):
+    return [x.to_dict() for x in rows] if name in MODELS else rows
+
+# ---------- Kho dữ liệu theo collection + nhật ký ghi trước (journal) ----------
+#
+# Mỗi collection là 1 file JSON trong data/users/<username>/ (manga.json, rentals.json...).
+# Khi cửa hàng bật journal_mode, các thao tác nóng (thuê, trả, đổi tồn kho, thêm/đọc thông báo)
+# không ghi lại cả file mà chỉ nối 1 dòng vào journal.log (fsync). Trạng thái trong bộ nhớ
+# = snapshot (các file JSON) + phần đuôi journal. Khi journal vượt JOURNAL_COMPACT_BYTES,
+# nó được gộp vào snapshot mới rồi làm rỗng. Mọi thao tác trong journal đều idempotent
+# (ghi giá trị tuyệt đối theo id), nên phát lại 2 lần sau khi crash vẫn cho cùng kết quả.
+
+COLL_FILES = {
+    "manga": "manga.json",
+    "customers": "customers.json",
+    "rentals": "rentals.json",  # Phần nóng, xem thêm khu lưu trữ theo tháng
+    "notifications": "notifications.json",
+    "genres": "genres.json",  # Danh mục thể loại (id số nguyên ổn định)
+    "waitlist": "waitlist.json",  # Hàng chờ + cuốn đang giữ cho truyện hết hàng
+    "copies": "copies.json",  # Từng cuốn vật lý (mã dán, tình trạng, đang ở kệ hay cho thuê)
+    "campaigns": "campaigns.json",  # Chiến dịch email hàng loạt (tiến độ; kết quả từng người ở campaigns/<id>.log)
+}
+JOURNALED_COLLS = ("manga", "rentals", "notifications", "genres")  # Các collection được ghi qua journal
+JOURNAL_FILE = "journal.log"
+JOURNAL_COMPACT_BYTES = int(os.environ.get("JOURNAL_COMPACT_BYTES", str(256 * 1024)))  # Ngưỡng gộp journal
+JOURNAL_MODE_DEFAULT = os.environ.get("JOURNAL_MODE_DEFAULT", "0") == "1"  # Bật sẵn cho mọi cửa hàng
+STORE_FORMAT_DEFAULT = os.environ.get("STORE_FORMAT_DEFAULT", "json")  # Định dạng file dữ liệu mặc định
+
+_journal_states = {}  # username -> trạng thái đã dựng lại (snapshot + journal)
+_journal_batch = threading.local()  # Gom nhiều thao tác thành 1 bản ghi journal
+
+def _file_sig(path):
+    try:
+        st = os.stat(path)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return None
+
+_raw_cfg_cache = {}  # username -> (chữ ký file, dict shop_config)
+
+def _raw_shop_cfg(username):
+    # Đọc thẳng shop_config.json (không bổ sung key mặc định như read_shop_cfg); chỉ parse lại khi file đổi
+    path = user_file(username, "shop_config.json")
+    sig = _file_sig(path)
+    hit = _raw_cfg_cache.get(username)
+    if hit is None or hit[0] != sig:
+        hit = _raw_cfg_cache[username] = (sig, read_json(path, {}))
+    return hit[1]
+
+def journal_mode(username):
+    return bool(_raw_shop_cfg(username).get("journal_mode", JOURNAL_MODE_DEFAULT))
+
+def store_format(username):
+    # Định dạng ghi các collection + tháng lưu trữ của cửa hàng (json / compact / msgpack)
+    fmt = _raw_shop_cfg(username).get("store_format", STORE_FORMAT_DEFAULT)
+    return fmt if fmt in available_store_formats() else "json"
+
+def _snapshot_sig(username):
+    # Chữ ký snapshot: đổi khi process khác gộp journal hoặc ghi đè cả file
+    return tuple(_file_sig(user_file(username, COLL_FILES[n])) for n in JOURNALED_COLLS) + (
+        (_file_sig(user_file(username, JOURNAL_FILE)) or (None,))[0],
+    )
+
+def _index_by_id(rows):
+    return {x.get("id"): x for x in rows}
+
+def _apply_op(state, op):
+    # Áp 1 thao tác journal vào trạng thái trong bộ nhớ (idempotent)
+    kind = op.get("op")
+    colls, idx = state["colls"], state["index"]
+    if kind == "rental_add":
+        old = idx["rentals"].get(op["rental"]["id"])
+        if old is not None:
+            old.update(op["rental"])
+        else:
+            rec = Rental.from_dict(op["rental"])
+            colls["rentals"].append(rec)
+            idx["rentals"][rec.id] = rec
+    elif kind == "rental_update":
+        r = idx["rentals"].get(op["id"])
+        if r is not None:
+            r.update(op["fields"])
+    elif kind == "stock_set":
+        m = idx["manga"].get(op["manga_id"])
+        if m is not None:
+            m.update({k: op[k] for k in ("stock", "updated_at", "rev") if k in op})
+            slot = state.get("manga_rev")
+            if slot is not None and "rev" in op:
+                slot[1] = max(slot[1], int(op["rev"]))  # Bản ghi của process khác: giữ bộ đếm rev khớp
+    elif kind == "notif_add":
+        n = dict(op["notif"])
+        if n["id"] not in idx["notifications"]:
+            colls["notifications"].append(n)
+            idx["notifications"][n["id"]] = n
+    elif kind == "notif_read":
+        for nid in op["ids"]:
+            n = idx["notifications"].get(nid)
+            if n is not None:
+                n["read"] = True
+    elif kind == "notif_delete":
+        ids = set(op["ids"])
+        colls["notifications"] = [n for n in colls["notifications"] if n.get("id") not in ids]
+        idx["notifications"] = _index_by_id(colls["notifications"])
+    elif kind == "genre_set":
+        gnr = dict(op["genre"])
+        if gnr["id"] in idx["genres"]:
+            idx["genres"][gnr["id"]].update(gnr)
+        else:
+            colls["genres"].append(gnr)
+            idx["genres"][gnr["id"]] = gnr
+
+def _replay_tail(username, state):
+    # Đọc phần journal mới từ state["offset"], chỉ nhận các dòng đã kết thúc bằng \n
+    path = user_file(username, JOURNAL_FILE)
+    try:
+        with open(path, "rb") as f:
+            f.seek(state["offset"])
+            chunk = f.read()
+    except FileNotFoundError:
+        return
+    end = chunk.rfind(b"\n")
+    if end < 0:
+        return
+    for line in chunk[:end].split(b"\n"):
+        if not line.strip():
+            continue
+        try:
+            rec = _json_loads(line)
+        except ValueError:
+            app.logger.warning("Bỏ qua dòng journal hỏng của %s", username)
+            continue
+        for op in rec.get("ops", []):
+            _apply_op(state, op)
+    state["offset"] += end + 1
+
+def journal_state(username):
+    """
+    Trạng thái hiện tại của các collection có journal: dựng từ snapshot 1 lần,
+    sau đó mỗi lần gọi chỉ đọc thêm phần đuôi journal mới.
+    """
+    sig = _snapshot_sig(username)
+    state = _journal_states.get(username)
+    hit = state is not None and state["sig"] == sig
+    note_tenant_access(username, hit)
+    if not hit:
+        colls = {n: decode_rows(n, read_json(user_file(username, COLL_FILES[n]), [])) for n in JOURNALED_COLLS}
+        state = {
+            "sig": sig,
+            "offset": 0,
+            "colls": colls,
+            "index": {n: _index_by_id(rows) for n, rows in colls.items()},
+        }
+        _journal_states[username] = state
+    _replay_tail(username, state)
+    return state
+
+def read_coll(username, name):
+    """
+    Đọc 1 collection của user dạng dict thô (migration, lưu trữ, phân tích). Ở journal_mode, lấy từ
+    trạng thái trong bộ nhớ (trả bản sao từng bản ghi để route sửa tạm không làm bẩn trạng thái).
+    Route làm việc với truyện/khách/giao dịch dùng read_models.
+    """
+    w = _uow_of(username, name)
+    if w is not None:
+        rows = _uow_rows(w, name)
+        return encode_rows(name, rows) if name in MODELS else [dict(x) for x in rows]
+    if name in JOURNALED_COLLS and journal_mode(username):
+        with tenant_lock(username):
+            rows = journal_state(username)["colls"][name]
+            return encode_rows(name, rows) if name in MODELS else [dict(x) for x in rows]
+    return read_json(user_file(username, COLL_FILES[name]), [])
+
+def write_coll(username, name, data):
+    # Ghi đè cả collection. Ở journal_mode phải gộp journal trước để phần đuôi cũ không bị phát lại đè lên.
+    w = _uow_of(username, name)
+    if w is not None:  # Đang trong unit of work: chỉ giữ lại, ghi 1 lần khi kết thúc
+        _uow_put(w, name, decode_rows(name, data) if name in MODELS else [dict(x) for x in data])
+        return
+    fmt = store_format(username)
+    if name in JOURNALED_COLLS and journal_mode(username):
+        with tenant_lock(username):
+            journal_compact(username)
+            write_json(user_file(username, COLL_FILES[name]), data, fmt)
+            _journal_states.pop(username, None)
+        return
+    write_json(user_file(username, COLL_FILES[name]), data, fmt)
+
+def read_models(username, name):
+    # Truyện/khách/giao dịch dạng model đã kiểm tra kiểu (bản sao: route sửa rồi gọi write_models)
+    w = _uow_of(username, name)
+    if w is not None:
+        return [copy.copy(x) for x in _uow_rows(w, name)]
+    if name in JOURNALED_COLLS and journal_mode(username):
+        with tenant_lock(username):
+            return [copy.copy(x) for x in journal_state(username)["colls"][name]]
+    return [copy.copy(x) for x in shared_models(username, name)]
+
+def write_models(username, name, items):
+    w = _uow_of(username, name)
+    if w is not None:
+        _uow_put(w, name, [copy.copy(x) for x in items])
+        return
+    write_coll(username, name, encode_rows(name, items))
+
+# ----- Danh mục dùng chung chỉ đọc + kênh báo thay đổi (.version) -----
+#
+# Model đã parse của mỗi cửa hàng được giữ trong _shared_models và dùng chung cho mọi request của process.
+# Khi chạy gunicorn với preload (gunicorn.conf.py), process master nạp sẵn danh mục mọi cửa hàng rồi mới fork:
+# các worker dùng chung trang nhớ đó theo copy-on-write, nên bộ nhớ mỗi worker không tăng theo số cửa hàng.
+# Mỗi lần write_json ghi vào thư mục 1 cửa hàng, file .version của cửa hàng đó được thay bằng token mới;
+# worker chỉ đọc file nhỏ này để biết cửa hàng đã đổi và chỉ nạp lại đúng cửa hàng đó.
+# (Sửa tay file dữ liệu thì xóa .version hoặc khởi động lại để worker nạp lại.)
+
+VERSION_FILE = ".version"
+
+_shared_models = {}  # username -> {"ver": token .version, "colls": {name: [model]}, "index": {name: {id: model}}}
+
+def _tenant_of(path):
+    # Tên cửa hàng nếu path nằm trong data/users/<username>/, ngược lại None
+    root = os.path.join(DATA_DIR, "users") + os.sep
+    if not path.startswith(root):
+        return None
+    parts = path[len(root):].split(os.sep, 1)
+    return parts[0] if len(parts) == 2 else None
+
+def bump_tenant_version(username):
+    # Token mới duy nhất (thời gian ns + pid + luồng), ghi nguyên tử để worker khác không đọc phải file dở
+    path = user_file(username, VERSION_FILE)
+    tmp = user_file(username, f".tmp-{os.getpid()}-{threading.get_ident()}{VERSION_FILE}")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(f"{time.time_ns()}-{os.getpid()}-{threading.get_ident()}")
+    os.replace(tmp, path)
+
+def tenant_data_version(username):
+    try:
+        with open(user_file(username, VERSION_FILE), encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def _shared_entry(username):
+    ver = tenant_data_version(username)
+    ent = _shared_models.get(username)
+    if ent is None or ent["ver"] != ver:
+        # Đọc version TRƯỚC khi đọc file: nếu có ghi xen vào thì lần sau version khác -> nạp lại, không bao giờ giữ bản cũ
+        ent = _shared_models[username] = {"ver": ver, "colls": {}, "index": {}}
+    return ent
+
+def _shared_load(username, name):
+    ent = _shared_entry(username)
+    rows = ent["colls"].get(name)
+    note_tenant_access(username, rows is not None)
+    if rows is None:
+        rows = decode_rows(name, read_json(user_file(username, COLL_FILES[name]), []))
+        ent["index"][name] = _index_by_id(rows)
+        ent["colls"][name] = rows
+    return rows, ent["index"][name]
+
+def shared_models(username, name):
+    """
+    List model dùng chung CHỈ ĐỌC của 1 collection (truyện/khách/giao dịch phần nóng).
+    Không được sửa các phần tử trả về; cần sửa thì dùng read_models (bản sao) + write_models.
+    """
+    w = _uow_of(username, name)
+    if w is not None:
+        return _uow_rows(w, name)  # Có thể đã sửa trong request này (chưa ghi đĩa)
+    if name in JOURNALED_COLLS and journal_mode(username):
+        with tenant_lock(username):
+            return journal_state(username)["colls"][name]
+    return _shared_load(username, name)[0]
+
+def journal_append(username, ops):
+    """
+    Nối các thao tác vào journal thành 1 dòng (1 bản ghi) rồi fsync, đồng thời áp vào bộ nhớ.
+    Nếu đang ở trong journal_batch thì chỉ gom lại, ghi 1 lần khi kết thúc khối.
+    """
+    with tenant_lock(username):
+        state = journal_state(username)
+        for op in ops:
+            _apply_op(state, op)
+        batches = _journal_batch.__dict__.setdefault("b", {})
+        if username in batches:
+            batches[username].extend(ops)
+            return
+        _journal_write(username, state, ops)
+
+def _journal_write(username, state, ops):
+    path = user_file(username, JOURNAL_FILE)
+    line = encode_data({"ts": now_str(), "ops": ops}, "compact") + b"\n"  # Journal luôn là JSON 1 dòng
+    with open(path, "ab") as f:
+        size = f.tell()
+        if size and state["offset"] < size:
+            # Dòng cuối bị ghi dở (crash giữa chừng) -> xuống dòng để bản ghi mới không dính vào
+            with open(path, "rb") as rf:
+                rf.seek(size - 1)
+                if rf.read(1) != b"\n":
+                    line = b"\n" + line
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+    if state["offset"] == size:
+        state["offset"] = size + len(line)  # Không ai ghi xen vào -> bỏ qua đọc lại chính dòng này
+    state["sig"] = _snapshot_sig(username)
+    if size + len(line) > JOURNAL_COMPACT_BYTES:
+        journal_compact(username)
+
+@contextmanager
+def journal_batch(username):
+    """
+    Gom mọi journal_append trong khối thành 1 bản ghi (ví dụ thuê truyện = trừ kho + thêm giao dịch).
+    Nếu khối lỗi: bỏ cả lô và xóa trạng thái trong bộ nhớ để dựng lại từ đĩa.
+    """
+    with tenant_lock(username):
+        batches = _journal_batch.__dict__.setdefault("b", {})
+        if username in batches:  # Lồng nhau -> dùng chung lô ngoài
+            yield
+            return
+        batches[username] = []
+        try:
+            yield
+        except BaseException:
+            batches.pop(username, None)
+            _journal_states.pop(username, None)
+            raise
+        ops = batches.pop(username)
+        if ops:
+            _journal_write(username, journal_state(username), ops)
+
+# ----- Unit of work theo request -----
+#
+# Trong 1 request ghi (POST...), mỗi collection chỉ đọc từ đĩa tối đa 1 lần: read_coll / read_models /
+# find_by_id lấy từ bản giữ trong unit of work, write_coll / write_models chỉ thay bản đó và đánh dấu "bẩn".
+# Route chạy xong thì mỗi collection bẩn được ghi đúng 1 lần; route lỗi (exception hoặc trả mã >= 400) thì bỏ hết.
+# Cả request giữ tenant_lock nên không request nào khác chen vào giữa lúc đọc và lúc ghi.
+# journal_mode: collection có journal vẫn đi qua trạng thái journal, cả request gom thành 1 bản ghi (journal_batch).
+
+_uow = threading.local()  # Unit of work đang mở của luồng hiện tại
+
+class _Rollback(Exception):
+    """Báo cho các khối with (journal_batch...) biết request bị hủy để bỏ thay đổi."""
+
+def _uow_of(username, name):
+    w = getattr(_uow, "w", None)
+    if w is None or w["username"] != username or (w["journal"] and name in JOURNALED_COLLS):
+        return None
+    return w
+
+def _uow_rows(w, name):
+    # Bản collection trong unit of work (đọc từ đĩa ở lần đầu)
+    rows = w["colls"].get(name)
+    if rows is None:
+        if name in MODELS:
+            rows = [copy.copy(x) for x in _shared_load(w["username"], name)[0]]  # Bản riêng, không đụng cache dùng chung
+        else:
+            rows = read_json(user_file(w["username"], COLL_FILES[name]), [])
+        w["colls"][name] = rows
+    return rows
+
+def _uow_put(w, name, rows):
+    w["colls"][name] = rows
+    w["index"].pop(name, None)
+    if name not in w["dirty"]:
+        w["dirty"].append(name)
+
+def on_commit(username, fn, locked=True):
+    """
+    Gọi fn sau khi dữ liệu của unit of work đang mở đã ghi xong (không mở thì gọi ngay).
+    locked=True: còn giữ tenant_lock (cập nhật cache theo chữ ký file); False: sau khi nhả khóa (gửi email...).
+    Request bị hủy thì fn không được gọi.
+    """
+    w = getattr(_uow, "w", None)
+    if w is None or w["username"] != username:
+        fn()
+        return
+    w["on_commit" if locked else "after"].append(fn)
+
+@contextmanager
+def unit_of_work(username):
+    w = getattr(_uow, "w", None)
+    if w is not None and w["username"] == username:  # Lồng nhau -> dùng chung khối ngoài
+        yield w
+        return
+    w = {"username": username, "journal": journal_mode(username), "colls": {}, "index": {}, "dirty": [],
+         "on_commit": [], "after": []}
+    with tenant_lock(username):
+        try:
+            with journal_batch(username):
+                _uow.w = w
+                try:
+                    yield w
+                finally:
+                    _uow.w = None
+                for name in w["dirty"]:  # Mỗi collection bẩn ghi đúng 1 lần
+                    rows = w["colls"][name]
+                    write_coll(username, name, encode_rows(name, rows) if name in MODELS else rows)
+        except BaseException:
+            _leaderboards.pop(username, None)  # Có thể đã áp sự kiện của request bị hủy
+            raise
+        for fn in w["on_commit"]:
+            fn()
+    for fn in w["after"]:
+        try:
+            fn()
+        except Exception:
+            app.logger.exception("Tác vụ sau khi ghi của %s lỗi", username)
+
+def journal_compact(username):
+    """
+    Gộp journal vào snapshot: ghi lại manga/rentals/notifications/genres từ trạng thái hiện tại,
+    sau đó thay journal bằng file rỗng. Crash giữa chừng vẫn an toàn vì phát lại là idempotent.
+    """
+    with tenant_lock(username):
+        path = user_file(username, JOURNAL_FILE)
+        if not os.path.exists(path):
+            return False
+        state = journal_state(username)
+        fmt = store_format(username)
+        for n in JOURNALED_COLLS:
+            write_json(user_file(username, COLL_FILES[n]), encode_rows(n, state["colls"][n]), fmt)
+        with open(path + ".new", "wb") as f:
+            os.fsync(f.fileno())
+        os.replace(path + ".new", path)
+        state["offset"] = 0
+        state["sig"] = _snapshot_sig(username)
+        return True
+
+def journal_maintenance(username):
+    # Tác vụ nền: gộp journal còn sót (kể cả khi cửa hàng vừa tắt journal_mode)
+    path = user_file(username, JOURNAL_FILE)
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        journal_compact(username)
+
+def convert_store(username, fmt):
+    """
+    Đổi định dạng lưu trữ của 1 cửa hàng: ghi store_format vào shop_config.json rồi ghi lại ngay
+    mọi collection và các tháng lưu trữ theo định dạng mới. Trả số file đã ghi lại.
+    (Không chạy cũng không sao: file cũ vẫn đọc được, lần ghi sau tự dùng định dạng mới.)
+    """
+    if fmt not in available_store_formats():
+        raise ValueError(f"Định dạng không hỗ trợ: {fmt}")
+    with tenant_lock(username):
+        journal_maintenance(username)  # Gộp journal trước để snapshot là bản đầy đủ
+        cfg_path = user_file(username, "shop_config.json")
+        cfg = read_json(cfg_path, {})
+        cfg["store_format"] = fmt
+        write_json(cfg_path, cfg)
+        count = 0
+        for fname in COLL_FILES.values():
+            path = user_file(username, fname)
+            if os.path.exists(path):
+                write_json(path, read_json(path, []), fmt)
+                count += 1
+        idx = read_archive_index(username)
+        for meta in idx["months"].values():
+            path = os.path.join(archive_dir(username), meta["file"])
+            write_json(path, read_json(path, []), fmt)
+            count += 1
+        _journal_states.pop(username, None)
+        return count
+
+@app.cli.command("convert-store")
+@click.argument("fmt", type=click.Choice(STORE_FORMATS))
+@click.option("--user", "usernames", multiple=True, help="Chỉ đổi các cửa hàng này (mặc định: tất cả).")
+def convert_store_command(fmt, usernames):
+    """Đổi định dạng file dữ liệu (json / compact / msgpack) cho các cửa hàng."""
+    if fmt not in available_store_formats():
+        raise click.ClickException("Chưa cài msgpack (pip install msgpack).")
+    for username in usernames or list_tenants():
+        n = convert_store(username, fmt)
+        print(f"{username}: đã ghi lại {n} file dạng {fmt}")
+
+def find_by_id(username, name, rid):
+    # Tìm 1 bản ghi theo id (journal_mode: tra chỉ mục trong bộ nhớ, O(1)); truyện/khách/giao dịch trả model
+    w = _uow_of(username, name)
+    if w is not None:
+        idx = w["index"].get(name)
+        if idx is None:
+            idx = w["index"][name] = _index_by_id(_uow_rows(w, name))
+        x = idx.get(rid)
+        if x is None:
+            return None
+        return copy.copy(x) if name in MODELS else dict(x)
+    if name in JOURNALED_COLLS and journal_mode(username):
+        with tenant_lock(username):
+            x = journal_state(username)["index"][name].get(rid)
+            if x is None:
+                return None
+            return copy.copy(x) if name in MODELS else dict(x)
+    if name in MODELS:
+        x = _shared_load(username, name)[1].get(rid)
+        return copy.copy(x) if x is not None else None
+    return next((x for x in read_coll(username, name) if x.get("id") == rid), None)
+
+def append_rental(username, rec):
+    # Thêm 1 giao dịch (Rental) vào phần nóng
+    if journal_mode(username):
+        journal_append(username, [{"op": "rental_add", "rental": rec.to_dict()}])
+        return
+    with tenant_lock(username):  # Tránh ghi đè cùng lúc với tác vụ dồn lưu trữ
+        rentals = read_models(username, "rentals")
+        rentals.append(rec)
+        write_models(username, "rentals", rentals)
+
+def update_rental(username, rid, fields):
+    # Cập nhật vài trường của 1 giao dịch ở phần nóng (ví dụ khi trả truyện)
+    if journal_mode(username):
+        journal_append(username, [{"op": "rental_update", "id": rid, "fields": fields}])
+        return
+    with tenant_lock(username):
+        rentals = read_models(username, "rentals")
+        for r in rentals:
+            if r.id == rid:
+                r.update(fields)
+                break
+        write_models(username, "rentals", rentals)
+
+def add_notification(username, notif):
+    if journal_mode(username):
+        journal_append(username, [{"op": "notif_add", "notif": notif}])
+        return
+    with tenant_lock(username):
+        notifs = read_coll(username, "notifications")
+        notifs.append(notif)
+        write_coll(username, "notifications", notifs)
+
+def mark_notifications_read(username, ids):
+    if journal_mode(username):
+        journal_append(username, [{"op": "notif_read", "ids": list(ids)}])
+        return
+    ids = set(ids)
+    with tenant_lock(username):
+        notifs = read_coll(username, "notifications")
+        for n in notifs:
+            if n.get("id") in ids:
+                n["read"] = True
+        write_coll(username, "notifications", notifs)
+
+def delete_notifications(username, ids):
+    if journal_mode(username):
+        journal_append(username, [{"op": "notif_delete", "ids": list(ids)}])
+        return
+    ids = set(ids)
+    with tenant_lock(username):
+        notifs = [n for n in read_coll(username, "notifications") if n.get("id") not in ids]
+        write_coll(username, "notifications", notifs)
+
+# ---------- Thể loại (danh mục genre) ----------
+#
+# genres.json: [{"id": 0, "name": "Hành động", "rentals": 12}, ...]. id là số nguyên nhỏ, cấp tăng dần
+# và không tái sử dụng, nên mỗi truyện chỉ cần lưu genre_ids + genre_mask (bit i = thể loại id i).
+# Chuỗi manga.genre vẫn giữ để hiển thị/tìm kiếm; thống kê, lọc và gợi ý dùng id và phép AND trên mask.
+
+def split_genres(genre_str):
+    # Tách "Hành động, Ninja" -> ["Hành động", "Ninja"] (bỏ rỗng, bỏ trùng không phân biệt hoa/thường)
+    out, seen = [], set()
+    for p in (genre_str or "").split(","):
+        p = p.strip()
+        if p and p.casefold() not in seen:
+            seen.add(p.casefold())
+            out.append(p)
+    return out
+
+def genre_mask(ids):
+    # [0, 3] -> 0b1001
+    mask = 0
+    for gid in ids:
+        mask |= 1 << gid
+    return mask
+
+def _intern_genres(genres, names):
+    # Tra/cấp id cho từng tên trên list genres (sửa tại chỗ); trả (ids, các thể loại mới thêm)
+    by_name = {gnr["name"].casefold(): gnr["id"] for gnr in genres}
+    next_id = max((gnr["id"] for gnr in genres), default=-1) + 1
+    ids, new = [], []
+    for name in names:
+        gid = by_name.get(name.casefold())
+        if gid is None:
+            gid = next_id
+            next_id += 1
+            by_name[name.casefold()] = gid
+            gnr = {"id": gid, "name": name, "rentals": 0}
+            genres.append(gnr)
+            new.append(gnr)
+        ids.append(gid)
+    return ids, new
+
+def _save_genres(username, changed):
+    # Ghi các thể loại vừa thêm/đổi (journal_mode: mỗi thể loại 1 thao tác genre_set, giá trị tuyệt đối)
+    if journal_mode(username):
+        journal_append(username, [{"op": "genre_set", "genre": dict(gnr)} for gnr in changed])
+        return
+    genres = read_coll(username, "genres")
+    by_id = _index_by_id(genres)
+    for gnr in changed:
+        if gnr["id"] in by_id:
+            by_id[gnr["id"]].update(gnr)
+        else:
+            genres.append(dict(gnr))
+    write_coll(username, "genres", genres)
+
+def set_manga_genres(username, m):
+    """
+    Tách m.genre 1 lần khi thêm/sửa truyện (Manga), gán genre_ids + genre_mask.
+    Tên thể loại mới được cấp id tiếp theo trong danh mục của cửa hàng.
+    """
+    with tenant_lock(username):
+        ids, new = _intern_genres(read_coll(username, "genres"), split_genres(m.genre))
+        if new:
+            _save_genres(username, new)
+    m.genre_ids = tuple(ids)
+    m.genre_mask = genre_mask(ids)
+    return m
+
+def count_genre_rentals(username, genre_ids):
+    # Cộng 1 lượt thuê cho từng thể loại của truyện vừa cho thuê
+    if not genre_ids:
+        return
+    with tenant_lock(username):
+        by_id = _index_by_id(read_coll(username, "genres"))
+        changed = []
+        for gid in genre_ids:
+            gnr = by_id.get(gid)
+            if gnr is not None:
+                gnr["rentals"] = int(gnr.get("rentals", 0)) + 1
+                changed.append(gnr)
+        if changed:
+            _save_genres(username, changed)
+
+def migrate_genres(username):
+    """
+    Dựng danh mục thể loại cho dữ liệu cũ: gán genre_ids/genre_mask cho mọi truyện và đếm sẵn
+    lượt thuê mỗi thể loại từ lịch sử (phần nóng + lưu trữ). Chạy 1 lần, đánh dấu genre_catalog.
+    """
+    with tenant_lock(username):
+        cfg_path = user_file(username, "shop_config.json")
+        cfg = read_json(cfg_path, {})
+        if cfg.get("genre_catalog"):
+            return False
+        genres = read_coll(username, "genres")
+        manga = read_coll(username, "manga")
+        for m in manga:
+            m["genre_ids"], _ = _intern_genres(genres, split_genres(m.get("genre")))
+            m["genre_mask"] = genre_mask(m["genre_ids"])
+        ids_by_manga = {m["id"]: m["genre_ids"] for m in manga}
+        counts = {}
+        for r in load_rentals(username):
+            for gid in ids_by_manga.get(r.get("manga_id"), ()):
+                counts[gid] = counts.get(gid, 0) + 1
+        for gnr in genres:
+            gnr["rentals"] = counts.get(gnr["id"], 0)
+        write_coll(username, "genres", genres)
+        write_coll(username, "manga", manga)
+        cfg["genre_catalog"] = True
+        write_json(cfg_path, cfg)
+        return True
+
+# ---------- Danh mục truyện cho quầy quét mã (snapshot + delta) ----------
+#
+# Mỗi truyện có "rev" = phiên bản danh mục lúc nó đổi lần cuối (thêm, sửa, đổi tồn kho). Truyện đã xóa
+# được ghi vào catalog_deleted.json kèm rev. Phiên bản danh mục = rev lớn nhất, nên ?since=<version>
+# chỉ cần trả các truyện có rev lớn hơn + id đã xóa sau đó. Chỉ giữ CATALOG_DELETED_KEEP id đã xóa;
+# client cũ hơn mốc "floor" sẽ nhận lại toàn bộ snapshot.
+# rev lớn nhất được nhớ cạnh list truyện đang dùng (trạng thái journal / bản dùng chung / unit of work) và chỉ
+# quét lại khi list đó được nạp lại; catalog_deleted.json cache theo chữ ký file. next_catalog_rev chỉ cộng
+# bộ đếm, nên mỗi lượt thuê/trả không phải quét cả danh mục hay đọc đĩa.
+
+CATALOG_DELETED_FILE = "catalog_deleted.json"
+CATALOG_DELETED_KEEP = 500
+CATALOG_FIELDS = ("id", "barcode", "title", "price", "stock")  # Thứ tự cột trong mỗi dòng trả về
+
+_catalog_deleted_cache = {}  # đường dẫn -> (chữ ký file, dict catalog_deleted, rev lớn nhất trong file)
+
+def _catalog_deleted(username, fresh=False):
+    # Chỉ đọc (cache theo chữ ký file); fresh=True: bản đọc mới từ đĩa để sửa rồi ghi lại
+    path = user_file(username, CATALOG_DELETED_FILE)
+    sig = _file_sig(path)
+    hit = _catalog_deleted_cache.get(path)
+    if fresh or hit is None or hit[0] != sig:
+        d = read_json(path, {})
+        d.setdefault("floor", 0)
+        d.setdefault("deleted", [])
+        if fresh:
+            return d
+        top = max([int(d["floor"])] + [int(x["rev"]) for x in d["deleted"]])
+        hit = _catalog_deleted_cache[path] = (sig, d, top)
+    return hit[1]
+
+def _catalog_rev_slot(username):
+    # [list truyện, rev lớn nhất] gắn với list truyện đang dùng (giống shared_models); quét lại khi list đổi
+    w = _uow_of(username, "manga")
+    if w is not None:
+        holder, rows = w, _uow_rows(w, "manga")
+    elif journal_mode(username):
+        holder = journal_state(username)
+        rows = holder["colls"]["manga"]
+    else:
+        holder, rows = _shared_entry(username), _shared_load(username, "manga")[0]
+    slot = holder.get("manga_rev")
+    if slot is None or slot[0] is not rows:
+        slot = holder["manga_rev"] = [rows, max((m.rev for m in rows), default=0)]
+    return slot
+
+def _manga_rows(username):
+    # List truyện (Manga) chỉ để đọc (dùng thẳng bản dùng chung trong bộ nhớ, không sao chép)
+    return shared_models(username, "manga")
+
+def catalog_version(username, manga=None):
+    # manga: list truyện cụ thể (quét); mặc định dùng bộ đếm của list đang dùng
+    with tenant_lock(username):
+        top = _catalog_rev_slot(username)[1] if manga is None else max((m.rev for m in manga), default=0)
+        _catalog_deleted(username)
+        return max(top, _catalog_deleted_cache[user_file(username, CATALOG_DELETED_FILE)][2])
+
+def next_catalog_rev(username):
+    # rev cho truyện sắp đổi (gọi trong tenant_lock, gán ngay vào truyện đó rồi mới ghi)
+    with tenant_lock(username):
+        slot = _catalog_rev_slot(username)
+        slot[1] = catalog_version(username) + 1
+        return slot[1]
+
+def record_catalog_delete(username, manga_id, manga):
+    # Gọi TRƯỚC khi ghi list truyện đã bỏ manga_id (manga = list cũ, để rev mới lớn hơn rev của truyện bị xóa)
+    with tenant_lock(username):
+        d = _catalog_deleted(username, fresh=True)
+        d["deleted"].append({"id": manga_id, "rev": catalog_version(username, manga) + 1})
+        if len(d["deleted"]) > CATALOG_DELETED_KEEP:
+            cut = d["deleted"][:-CATALOG_DELETED_KEEP]
+            d["floor"] = max([int(d["floor"])] + [int(x["rev"]) for x in cut])
+            d["deleted"] = d["deleted"][-CATALOG_DELETED_KEEP:]
+        write_json(user_file(username, CATALOG_DELETED_FILE), d)
+
+def catalog_row(m):
+    return [m.id, m.barcode, m.title, m.rent_price, m.stock]
+
+def catalog_payload(username, since=None):
+    """
+    since=None -> toàn bộ danh mục; since=<version> -> chỉ các thay đổi sau version đó.
+    Trả thêm "full": True khi client quá cũ (hoặc version lạ) và phải thay toàn bộ bản sao.
+    """
+    with tenant_lock(username):
+        manga = _manga_rows(username)
+        d = _catalog_deleted(username)
+        version = catalog_version(username)
+        if since is None or since < int(d["floor"]) or since > version:
+            return {"version": version, "full": True, "fields": CATALOG_FIELDS,
+                    "items": [catalog_row(m) for m in manga], "deleted": []}
+        return {
+            "version": version,
+            "full": False,
+            "fields": CATALOG_FIELDS,
+            "items": [catalog_row(m) for m in manga if m.rev > since],
+            "deleted": [x["id"] for x in d["deleted"] if int(x["rev"]) > since],
+        }
+
+# ---------- Xóa mềm (tombstone) ----------
+#
+# Xóa truyện/khách chỉ bỏ bản ghi khỏi manga.json/customers.json và ghi id vào tombstones.json (kèm bản ghi cũ
+# + thời điểm xóa). Giao dịch và thông báo liên quan vẫn nằm nguyên trong file nhưng bị chỉ mục này ẩn khỏi
+# danh sách, tìm kiếm và API (cả bảng xếp hạng, báo cáo top-N, số đang thuê/quá hạn: hidden_mask). Tác vụ nền purge_tombstones xử lý dần từng lô TOMBSTONE_BATCH id: xóa thông báo
+# tồn kho của truyện, còn giao dịch thì gắn cờ "deleted" (mặc định, keep_deleted_revenue: thống kê doanh thu
+# vẫn tính) hoặc xóa hẳn. Id nào xử lý xong mới được bỏ khỏi chỉ mục (và từ đó mới được dùng lại).
+
+TOMBSTONE_FILE = "tombstones.json"
+TOMBSTONE_BATCH = int(os.environ.get("TOMBSTONE_BATCH", "50"))  # Số id xử lý mỗi lần chạy tác vụ nền
+TOMBSTONE_KINDS = ("manga", "customers")
+
+_tombstone_cache = {}  # đường dẫn -> (chữ ký file, {"manga": {id: {...}}, "customers": {...}})
+
+def tombstones(username):
+    # Chỉ mục id đã xóa (chỉ đọc); chỉ parse lại khi file đổi
+    path = user_file(username, TOMBSTONE_FILE)
+    sig = _file_sig(path)
+    hit = _tombstone_cache.get(path)
+    if hit is None or hit[0] != sig:
+        d = read_json(path, {})
+        hit = _tombstone_cache[path] = (sig, {k: d.get(k) or {} for k in TOMBSTONE_KINDS})
+    return hit[1]
+
+def add_tombstone(username, kind, rec):
+    # Ghi sau khi unit of work ghi xong bản ghi đã bỏ (request lỗi -> không để lại tombstone cho bản ghi còn sống)
+    def write():
+        path = user_file(username, TOMBSTONE_FILE)
+        d = read_json(path, {})
+        d.setdefault(kind, {})[rec["id"]] = {"deleted_at": now_str(), "record": rec}
+        write_json(path, d)
+    on_commit(username, write)
+
+def rental_hidden(r, tomb):
+    # Giao dịch của truyện/khách đã xóa: đang chờ dọn (có trong chỉ mục) hoặc đã dọn nhưng giữ doanh thu
+    return bool(r.get("deleted")) or r.get("manga_id") in tomb["manga"] or r.get("customer_id") in tomb["customers"]
+
+def _notif_of(n, ids):
+    # Thông báo (mọi loại) gắn với truyện/khách trong ids {"manga": ..., "customers": ...};
+    # LOW_STOCK cũ chưa có manga_id thì dò "(ID ...)" trong message
+    if n.get("manga_id") in ids["manga"] or n.get("customer_id") in ids["customers"]:
+        return True
+    if n.get("type") != "LOW_STOCK" or n.get("manga_id"):
+        return False
+    msg = n.get("message") or ""
+    return any(f"(ID {mid})" in msg for mid in ids["manga"])
+
+def purge_tombstones(username, batch=None):
+    """
+    Tác vụ nền: dọn dữ liệu liên quan của tối đa batch id đã xóa (cũ trước), rồi bỏ chúng khỏi tombstones.json.
+    Trả số id đã xử lý.
+    """
+    batch = batch or TOMBSTONE_BATCH
+    with tenant_lock(username):
+        tomb = tombstones(username)
+        todo = [(kind, tid) for kind in TOMBSTONE_KINDS for tid in tomb[kind]][:batch]
+        if not todo:
+            return 0
+        ids = {kind: {tid for k, tid in todo if k == kind} for kind in TOMBSTONE_KINDS}
+        covers = {(tomb["manga"][mid].get("record") or {}).get("cover") for mid in ids["manga"]}
+        keep_revenue = _raw_shop_cfg(username).get("keep_deleted_revenue", True)  # Chạy nền: không có session
+
+        def related(r):
+            return r.get("manga_id") in ids["manga"] or r.get("customer_id") in ids["customers"]
+
+        def mutate(rows):
+            if keep_revenue:  # Giữ bản ghi cho thống kê, chỉ gắn cờ ẩn
+                hit = [r for r in rows if related(r) and not r.get("deleted")]
+                for r in hit:
+                    r["deleted"] = True
+                return rows if hit else None
+            kept = [r for r in rows if not related(r)]
+            return kept if len(kept) != len(rows) else None
+
+        rows = mutate(read_coll(username, "rentals"))
+        if rows is not None:
+            write_coll(username, "rentals", rows)
+        drop = [n["id"] for n in read_coll(username, "notifications") if _notif_of(n, ids)]
+        if drop:
+            delete_notifications(username, drop)
+        if ids["manga"]:
+            update_archived_rentals(username, mutate, manga_ids=sorted(ids["manga"]))
+            copies = read_coll(username, "copies")
+            kept = [c for c in copies if c["manga_id"] not in ids["manga"]]
+            if len(kept) != len(copies):
+                write_coll(username, "copies", kept)
+        if ids["customers"]:
+            update_archived_rentals(username, mutate, customer_ids=sorted(ids["customers"]))
+        dropped = remove_waitlist(username, [e["id"] for e in read_coll(username, "waitlist") if related(e)])
+
+        path = user_file(username, TOMBSTONE_FILE)
+        d = read_json(path, {})
+        for kind, tid in todo:
+            d.get(kind, {}).pop(tid, None)
+        write_json(path, d)
+    # Cuốn đang giữ cho khách đã xóa -> chuyển cho người kế tiếp
+    refill_holds(username, sorted({e["manga_id"] for e in dropped if e.get("status") == "held" and e["manga_id"] not in ids["manga"]}))
+    release_covers(covers)  # Ảnh bìa của truyện đã dọn (nếu cửa hàng khác không dùng chung)
+    return len(todo)
 
 # ---------- Giá & Stock ----------  # Comment phân tách khu xử lý giá thuê và tồn kho
 
-def format_price(raw: str) -> str:
-    # Hàm chuẩn hóa giá về dạng có dấu chấm: 10000 -> 10.000
-    try:  # Bắt lỗi nếu raw không ép được số
-        n = int(str(raw).replace(".","").strip())  # Bỏ dấu chấm, bỏ khoảng trắng, ép int
-    except:  # Nếu lỗi
-        n = 0  # Giá trị mặc định 0
+def format_price(raw) -> str:
+    # Hàm hiển thị giá có dấu chấm: 10000 -> "10.000" (chỉ dùng khi render HTML/email)
+    n = price_to_int(raw)  # Số nguyên giữ nguyên; chuỗi cũ "10.000" vẫn đọc được
     s = f"{n:,}".replace(",", ".")  # Format theo dấu phẩy ngàn rồi đổi sang dấu chấm
     return s  # Trả chuỗi giá chuẩn
 
+def migrate_money(username):
+    """
+    Chuyển dữ liệu cũ lưu tiền dạng chuỗi ("10.000") sang số nguyên VND:
+    manga.rent_price, rentals.rent_price, rentals.late_fee (cả phần nóng và các tháng lưu trữ).
+    Chạy 1 lần cho mỗi cửa hàng, đánh dấu money_int trong shop_config.json.
+    """
+    with tenant_lock(username):
+        cfg_path = user_file(username, "shop_config.json")
+        cfg = read_json(cfg_path, {})
+        if cfg.get("money_int"):
+            return False
+
+        def fix_rentals(rows):
+            for r in rows:
+                r["rent_price"] = price_to_int(r.get("rent_price") or 0)
+                r["late_fee"] = price_to_int(r.get("late_fee") or 0)
+            return rows
+
+        manga = read_coll(username, "manga")
+        for m in manga:
+            m["rent_price"] = price_to_int(m.get("rent_price") or 0)
+        write_coll(username, "manga", manga)
+        write_coll(username, "rentals", fix_rentals(read_coll(username, "rentals")))
+        idx = read_archive_index(username)
+        for month in list(idx["months"]):
+            write_archive_month(username, month, fix_rentals(read_archive_month(username, month, idx)), idx)
+        if idx["months"]:
+            write_archive_index(username, idx)
+        cfg["money_int"] = True
+        write_json(cfg_path, cfg)
+        return True
+
+TENANT_MIGRATIONS = [migrate_money, migrate_genres]  # Chuyển đổi dữ liệu 1 lần, theo thứ tự
+_migrated_checked = set()  # Các cửa hàng đã kiểm tra chuyển đổi trong process này
+
+@app.before_request
+def ensure_tenant_migrated():
+    # Đảm bảo dữ liệu của user đang đăng nhập đã được chuyển đổi trước khi route đọc
+    username = get_current_username()
+    if username and username not in _migrated_checked:
+        for migrate in TENANT_MIGRATIONS:
+            migrate(username)
+        _migrated_checked.add(username)
+
+UOW_METHODS = {"POST", "PUT", "PATCH", "DELETE"}  # Request ghi dữ liệu chạy trong unit of work
+
+@app.before_request
+def begin_unit_of_work():
+    # Đăng ký sau ensure_tenant_migrated: chuyển đổi dữ liệu ghi thẳng ra đĩa, không phụ thuộc request
+    username = get_current_username()
+    if request.method in UOW_METHODS and username:
+        stack = ExitStack()
+        stack.enter_context(unit_of_work(username))
+        g.uow_stack = stack
+
+@app.after_request
+def commit_unit_of_work(resp):
+    stack = g.pop("uow_stack", None)
+    if stack is not None:
+        if resp.status_code >= 400:
+            stack.__exit__(_Rollback, _Rollback(), None)
+        else:
+            stack.close()  # Ghi các collection bẩn; lỗi ghi -> 500
+    return resp
+
+@app.teardown_request
+def end_unit_of_work(exc):
+    # Route ném exception (after_request không chạy) -> bỏ mọi thay đổi, nhả khóa
+    stack = g.pop("uow_stack", None)
+    if stack is not None:
+        exc = exc or _Rollback()
+        stack.__exit__(type(exc), exc, exc.__traceback__)
+
+@app.cli.command("migrate-money")
+def migrate_money_command():
+    """Chuyển tiền dạng chuỗi sang số nguyên VND cho mọi cửa hàng."""
+    for username in list_tenants():
+        if migrate_money(username):
+            print(f"{username}: đã chuyển sang số nguyên")
+
+@app.cli.command("migrate-genres")
+def migrate_genres_command():
+    """Dựng danh mục thể loại (genre_ids) cho mọi cửa hàng."""
+    for username in list_tenants():
+        if migrate_genres(username):
+            print(f"{username}: đã dựng danh mục thể loại")
+
+LOW_STOCK_THRESHOLD = 10  # Tồn kho dưới mức này thì báo "sắp hết"
+
 def log_low_stock(username, manga_id):
     # Hàm tạo thông báo nếu tồn kho thấp (<10)
-    mpath = user_file(username, "manga.json")  # Đường dẫn file manga của user
-    items = read_json(mpath, [])  # Đọc danh sách truyện
-    mg = next((x for x in items if x["id"] == manga_id), None)  
+    mg = find_by_id(username, "manga", manga_id)
     # Tìm truyện có id = manga_id, không thấy thì None
     if not mg:  # Nếu không tìm thấy truyện
         return  # Thoát hàm
-    stock_now = int(mg.get("stock", 0))  # Lấy tồn kho hiện tại của truyện
-    if stock_now < 10:  # Nếu tồn kho ít hơn 10
-        npath = user_file(username, "notifications.json")  # File thông báo của user
-        notifs = read_json(npath, [])  # Đọc danh sách thông báo hiện có
-        notifs.append({  # Thêm thông báo mới vào list
+    stock_now = mg.stock  # Lấy tồn kho hiện tại của truyện
+    if stock_now < LOW_STOCK_THRESHOLD:  # Nếu tồn kho ít hơn 10
+        add_notification(username, {  # Thêm thông báo mới (journal_mode: chỉ nối 1 dòng journal)
             "id": str(uuid.uuid4()),          # Tạo ID noti duy nhất
             "type": "LOW_STOCK",              # Loại thông báo: tồn kho thấp
             "created_at": now_str(),          # Thời gian tạo
             "read": False,                    # Đánh dấu chưa đọc
-            "manga_id": mg["id"],             # Lưu luôn ID truyện để sau này dễ xử lý
+            "manga_id": mg.id,                # Lưu luôn ID truyện để sau này dễ xử lý
             "message": (
-                f"Truyện '{mg['title']}' (ID {mg['id']}) còn {stock_now} cuốn (< 10)."
+                f"Truyện '{mg.title}' (ID {mg.id}) còn {stock_now} cuốn (< 10)."
             ),  # Nội dung thông báo cụ thể
         })
 
-        write_json(npath, notifs)  # Ghi lại danh sách thông báo
-
 def adjust_stock(username, manga_id, delta):
     # Hàm thay đổi tồn kho (delta âm là trừ, dương là cộng)
-    items = read_json(user_file(username, "manga.json"), [])  # Đọc list truyện hiện có
-    updated = None  # Biến lưu truyện vừa được update stock
-    for x in items:  # Duyệt từng truyện trong list
-        if x["id"] == manga_id:  # Nếu đúng truyện cần thay đổi
-            x["stock"] = max(0, int(x["stock"]) + int(delta))  
-            # Cộng delta vào stock, max(0,...) để không cho âm
-            x["updated_at"] = now_str()  # Cập nhật thời gian sửa truyện
-            updated = x  # Lưu lại object truyện đã sửa
-            break  # Thoát vòng lặp vì đã tìm thấy
-    write_json(user_file(username, "manga.json"), items)  # Ghi lại list truyện sau thay đổi
-    if updated:  # Nếu có update thành công
-        log_low_stock(username, manga_id)  # Kiểm tra và tạo noti nếu stock thấp
+    with tenant_lock(username):  # Hai lượt thuê cùng lúc không được ghi đè tồn kho của nhau
+        if journal_mode(username):
+            # Ghi tồn kho mới (giá trị tuyệt đối) vào journal thay vì ghi lại cả manga.json
+            updated = find_by_id(username, "manga", manga_id)
+            if updated:
+                updated.stock = max(0, updated.stock + delta)
+                updated.updated_at = now_str()
+                updated.rev = next_catalog_rev(username)  # Máy quét chỉ tải lại truyện này
+                journal_append(username, [{
+                    "op": "stock_set",
+                    "manga_id": manga_id,
+                    "stock": updated.stock,
+                    "updated_at": updated.updated_at,
+                    "rev": updated.rev,
+                }])
+        else:
+            items = read_models(username, "manga")  # Đọc list truyện hiện có
+            updated = None  # Biến lưu truyện vừa được update stock
+            for x in items:  # Duyệt từng truyện trong list
+                if x.id == manga_id:  # Nếu đúng truyện cần thay đổi
+                    x.stock = max(0, x.stock + delta)
+                    # Cộng delta vào stock, max(0,...) để không cho âm
+                    x.updated_at = now_str()  # Cập nhật thời gian sửa truyện
+                    x.rev = next_catalog_rev(username)  # Phiên bản danh mục mới
+                    updated = x  # Lưu lại object truyện đã sửa
+                    break  # Thoát vòng lặp vì đã tìm thấy
+            write_models(username, "manga", items)  # Ghi lại list truyện sau thay đổi
+        if updated:  # Nếu có update thành công
+            log_low_stock(username, manga_id)  # Kiểm tra và tạo noti nếu stock thấp
     return updated  # Trả truyện đã sửa (hoặc None nếu không tìm thấy)
 
 def count_unread_notifications(username):
     # Hàm đếm số thông báo chưa đọc của user
-    lst = read_json(user_file(username, "notifications.json"), [])  # Đọc list thông báo
-    return sum(1 for n in lst if not n.get("read"))  
+    lst = read_coll(username, "notifications")  # Đọc list thông báo
+    tomb = tombstones(username)  # Thông báo của truyện/khách đã xóa (chờ dọn) không tính
+    return sum(1 for n in lst if not n.get("read") and not _notif_of(n, tomb))
     # Đếm số item có read=False
 
 # ===== Cấu hình cửa hàng (per user) =====  # Comment phân tách khu cấu hình shop theo user
@@ -242,15 +1610,13 @@ def count_unread_notifications(username):
 def default_shop_cfg(username: str):
     """
     Giá trị mặc định:
-      - shop_name: lấy từ session hoặc users.json, nếu không có thì dùng chuỗi mặc định
+      - shop_name: lấy từ session hoặc account.json, nếu không có thì dùng chuỗi mặc định
       - default_rent_days: 5 ngày
       - late_fee_per_day: 10.000 VND
     """  # Docstring: mô tả rõ cấu hình mặc định
     shop_name = session.get("shop_name", "")  # Thử lấy tên shop từ session
     if not shop_name and username:  # Nếu session không có shop_name và có username
-        users = read_json(USERS_FILE, [])  # Đọc file users.json chung
-        u = next((u for u in users if u.get("username") == username), None)  
-        # Tìm user trong users.json
+        u = get_account(username)  # Đọc account.json của user (có cache theo chữ ký file)
         if u:  # Nếu tìm thấy user
             shop_name = u.get("shop_name", "")  # Lấy shop_name đã lưu
 
@@ -271,9 +1637,11 @@ def read_shop_cfg(username: str):
     path = user_file(username, "shop_config.json")  # File cấu hình shop riêng user
     cfg = read_json(path, {})  # Đọc cấu hình hiện có
     base = default_shop_cfg(username)  # Lấy cấu hình mặc định
-    for k, v in base.items():  # Duyệt từng cặp key/value của mặc định
-        cfg.setdefault(k, v)  # Nếu cfg thiếu key thì thêm value mặc định
-    write_json(path, cfg)  # Ghi lại file cấu hình (đảm bảo có đủ key)
+    missing = [k for k in base if k not in cfg]  # Các key mặc định còn thiếu
+    for k in missing:  # Duyệt từng key còn thiếu
+        cfg[k] = base[k]  # Thêm value mặc định
+    if missing:
+        write_json(path, cfg)  # Chỉ ghi lại khi thật sự thiếu key (không đổi .version ở mỗi lần render)
     return cfg  # Trả cấu hình cuối cùng
 
 @app.context_processor
@@ -300,29 +1668,1084 @@ def inject_shop_cfg():
 
 def propagate_manga_changes(username, manga_obj):
     # Hàm đồng bộ khi sửa truyện: cập nhật tên truyện trong rentals.json
-    rpath = user_file(username, "rentals.json")  # File lịch sử thuê/trả của user
-    rentals = read_json(rpath, [])  # Đọc list rentals
-    changed = False  # Cờ đánh dấu có thay đổi không
-    for r in rentals:  # Duyệt từng giao dịch thuê
-        if r.get("manga_id") == manga_obj["id"]:  # Nếu giao dịch thuộc truyện đang sửa
-            if r.get("manga_title") != manga_obj["title"]:  # Nếu tên cũ khác tên mới
-                r["manga_title"] = manga_obj["title"]  # Update tên mới
-                changed = True  # Đánh dấu đã đổi dữ liệu
-    if changed:  # Nếu có bất kỳ giao dịch nào đổi
-        write_json(rpath, rentals)  # Ghi lại rentals.json
+    with tenant_lock(username):  # Không để tác vụ nền ghi đè rentals.json cùng lúc
+        rentals = read_models(username, "rentals")  # Đọc list rentals (phần nóng)
+        changed = False  # Cờ đánh dấu có thay đổi không
+        for r in rentals:  # Duyệt từng giao dịch thuê
+            if r.manga_id == manga_obj.id:  # Nếu giao dịch thuộc truyện đang sửa
+                if r.manga_title != manga_obj.title:  # Nếu tên cũ khác tên mới
+                    r.manga_title = manga_obj.title  # Update tên mới
+                    changed = True  # Đánh dấu đã đổi dữ liệu
+        if changed:  # Nếu có bất kỳ giao dịch nào đổi
+            write_models(username, "rentals", rentals)  # Ghi lại rentals.json
+
+    def rename(rows):  # Đổi tên trong các tháng lưu trữ có truyện này (dict thô)
+        hit = [r for r in rows if r.get("manga_id") == manga_obj.id and r.get("manga_title") != manga_obj.title]
+        for r in hit:
+            r["manga_title"] = manga_obj.title
+        return rows if hit else None
+    update_archived_rentals(username, rename, manga_ids=[manga_obj.id])
 
 def propagate_customer_changes(username, customer_obj):
     # Hàm đồng bộ khi sửa khách: cập nhật tên khách trong rentals.json
-    rpath = user_file(username, "rentals.json")  # File rentals của user
-    rentals = read_json(rpath, [])  # Đọc rentals
-    changed = False  # Cờ đánh dấu thay đổi
-    for r in rentals:  # Duyệt từng rental
-        if r.get("customer_id") == customer_obj["id"]:  # Đúng khách hàng này
-            if r.get("customer_name") != customer_obj["name"]:  # Tên cũ khác tên mới
-                r["customer_name"] = customer_obj["name"]  # Update tên mới
-                changed = True  # Đánh dấu thay đổi
-    if changed:  # Nếu có đổi
-        write_json(rpath, rentals)  # Ghi lại file rentals
+    with tenant_lock(username):  # Không để tác vụ nền ghi đè rentals.json cùng lúc
+        rentals = read_models(username, "rentals")  # Đọc rentals (phần nóng)
+        changed = False  # Cờ đánh dấu thay đổi
+        for r in rentals:  # Duyệt từng rental
+            if r.customer_id == customer_obj.id:  # Đúng khách hàng này
+                if r.customer_name != customer_obj.name:  # Tên cũ khác tên mới
+                    r.customer_name = customer_obj.name  # Update tên mới
+                    changed = True  # Đánh dấu thay đổi
+        if changed:  # Nếu có đổi
+            write_models(username, "rentals", rentals)  # Ghi lại file rentals
+
+    def rename(rows):  # Đổi tên trong các tháng lưu trữ có khách này (dict thô)
+        hit = [r for r in rows if r.get("customer_id") == customer_obj.id and r.get("customer_name") != customer_obj.name]
+        for r in hit:
+            r["customer_name"] = customer_obj.name
+        return rows if hit else None
+    update_archived_rentals(username, rename, customer_ids=[customer_obj.id])
+
+# ===== Lưu trữ giao dịch: phân vùng nóng / lạnh =====
+#
+# rentals.json chỉ giữ phần "nóng": giao dịch chưa trả + giao dịch trả trong RENTALS_HOT_DAYS ngày gần đây.
+# Giao dịch cũ đã trả được dồn sang rentals_archive/<YYYY-MM>.json(.gz) theo tháng thuê,
+# kèm rentals_archive/index.json tóm tắt từng tháng để người đọc chỉ mở đúng tháng cần.
+
+RENTALS_HOT_DAYS = int(os.environ.get("RENTALS_HOT_DAYS", "90"))  # Số ngày lịch sử giữ trong phần nóng
+RENTALS_ARCHIVE_GZIP = os.environ.get("RENTALS_ARCHIVE_GZIP", "1") == "1"  # Nén gzip các tháng lưu trữ
+ARCHIVE_DIR_NAME = "rentals_archive"  # Thư mục lưu trữ trong data/users/<username>/
+
+def archive_dir(username):
+    return user_file(username, ARCHIVE_DIR_NAME)  # data/users/<username>/rentals_archive
+
+def read_archive_index(username):
+    # index.json: {"months": {"2025-11": {"file":..., "count":..., ...}}}
+    idx = read_json(os.path.join(archive_dir(username), "index.json"), {})
+    idx.setdefault("months", {})
+    return idx
+
+def _day_key(dt_str):
+    # "09-11-2025 09:53:12" -> "2025-11-09" (chuỗi so sánh được theo thời gian), lỗi -> ""
+    try:
+        return parse_dt(dt_str).strftime("%Y-%m-%d")
+    except Exception:
+        return ""
+
+def _summarize_segment(rows):
+    # Tóm tắt 1 tháng lưu trữ để lọc tháng mà không phải mở file
+    created = [d for d in (_day_key(r.get("created_at", "")) for r in rows) if d]
+    returned = [d for d in (_day_key(r.get("returned_at", "")) for r in rows) if d]
+    return {
+        "count": len(rows),
+        "total_rent": sum(price_to_int(r.get("rent_price") or 0) for r in rows),
+        "total_late": sum(price_to_int(r.get("late_fee") or 0) for r in rows),
+        "first_day": min(created) if created else "",
+        "last_day": max(created) if created else "",
+        "last_return_day": max(returned) if returned else "",
+        "customer_ids": sorted({r.get("customer_id", "") for r in rows}),
+        "manga_ids": sorted({r.get("manga_id", "") for r in rows}),
+    }
+
+def read_archive_month(username, month, idx=None):
+    idx = idx or read_archive_index(username)
+    meta = idx["months"].get(month)
+    if not meta:
+        return []
+    return read_json(os.path.join(archive_dir(username), meta["file"]), [])
+
+def write_archive_month(username, month, rows, idx):
+    # Ghi lại 1 tháng (ghi file mới rồi thay thế nguyên tử), cập nhật index trong bộ nhớ
+    adir = archive_dir(username)
+    old = idx["months"].get(month, {}).get("file")
+    if not rows:
+        idx["months"].pop(month, None)
+        if old:
+            try:
+                os.remove(os.path.join(adir, old))
+            except FileNotFoundError:
+                pass
+        return
+    fname = month + (".json.gz" if RENTALS_ARCHIVE_GZIP else ".json")
+    rows.sort(key=lambda r: _day_key(r.get("created_at", "")) + r.get("created_at", "")[11:])
+    write_json(os.path.join(adir, fname), rows, store_format(username))
+    if old and old != fname:
+        try:
+            os.remove(os.path.join(adir, old))
+        except FileNotFoundError:
+            pass
+    meta = _summarize_segment(rows)
+    meta["file"] = fname
+    idx["months"][month] = meta
+
+def write_archive_index(username, idx):
+    write_json(os.path.join(archive_dir(username), "index.json"), idx)
+
+def archive_months_for(username, date_from=None, date_to=None, customer_ids=None, manga_ids=None, idx=None):
+    """
+    Chọn các tháng lưu trữ cần mở.
+
+    - date_from/date_to (date): tháng có giao dịch thuê hoặc ngày trả rơi vào khoảng này
+      (ngày trả cần cho phí trễ tính theo từng ngày trễ).
+    - customer_ids/manga_ids: chỉ lấy tháng có chứa các ID này.
+    """
+    idx = idx or read_archive_index(username)
+    f = date_from.strftime("%Y-%m-%d") if date_from else ""
+    t = date_to.strftime("%Y-%m-%d") if date_to else ""
+    out = []
+    for month, meta in sorted(idx["months"].items()):
+        if t and meta.get("first_day", "") > t:
+            continue
+        if f and max(meta.get("last_day", ""), meta.get("last_return_day", "")) < f:
+            continue
+        if customer_ids is not None and not set(meta.get("customer_ids", [])) & set(customer_ids):
+            continue
+        if manga_ids is not None and not set(meta.get("manga_ids", [])) & set(manga_ids):
+            continue
+        out.append(month)
+    return out
+
+def load_rentals(username, date_from=None, date_to=None, customer_ids=None, manga_ids=None, archive=True, models=False):
+    """
+    Đọc giao dịch: phần nóng (rentals.json) + các tháng lưu trữ cần thiết.
+    archive=False chỉ đọc phần nóng (đủ cho giao dịch đang mở).
+    models=True trả Rental thay vì dict thô (cho route/template).
+    """
+    hot = read_models(username, "rentals") if models else read_coll(username, "rentals")
+    if not archive:
+        return hot
+    idx = read_archive_index(username)
+    months = archive_months_for(username, date_from, date_to, customer_ids, manga_ids, idx=idx)
+    if not months:
+        return hot
+    seen = {r.get("id") for r in hot}  # Phòng trường hợp compactor dừng giữa chừng -> trùng bản ghi
+    out = list(hot)
+    for month in months:
+        for r in read_archive_month(username, month, idx):
+            if r.get("id") not in seen:
+                seen.add(r.get("id"))
+                out.append(Rental.from_dict(r) if models else r)
+    return out
+
+def update_archived_rentals(username, mutate, customer_ids=None, manga_ids=None):
+    """
+    Sửa/xóa giao dịch trong các tháng lưu trữ có chứa customer_ids/manga_ids.
+    mutate(rows) trả về list mới (hoặc None nếu không đổi gì).
+    """
+    with tenant_lock(username):
+        idx = read_archive_index(username)
+        months = archive_months_for(username, customer_ids=customer_ids, manga_ids=manga_ids, idx=idx)
+        changed = False
+        for month in months:
+            rows = mutate(read_archive_month(username, month, idx))
+            if rows is not None:
+                write_archive_month(username, month, rows, idx)
+                changed = True
+        if changed:
+            write_archive_index(username, idx)
+
+def compact_rentals(username, hot_days=None):
+    """
+    Dồn giao dịch đã trả quá hot_days ngày từ rentals.json sang lưu trữ theo tháng.
+    Thứ tự ghi: file tháng -> index -> rentals.json, nên dừng giữa chừng chỉ gây trùng
+    (load_rentals đã tự bỏ trùng), không bao giờ mất dữ liệu.
+    """
+    hot_days = RENTALS_HOT_DAYS if hot_days is None else hot_days
+    cutoff = (datetime.now() - timedelta(days=hot_days)).strftime("%Y-%m-%d")
+    with tenant_lock(username):
+        hot = read_coll(username, "rentals")
+        by_month = {}
+        keep = []
+        for r in hot:
+            ret_day = _day_key(r.get("returned_at", ""))
+            created = r.get("created_at", "")
+            if ret_day and ret_day < cutoff and _day_key(created):
+                by_month.setdefault(parse_dt(created).strftime("%Y-%m"), []).append(r)
+            else:
+                keep.append(r)
+        if not by_month:
+            return 0
+        idx = read_archive_index(username)
+        for month, rows in by_month.items():
+            ids = {r.get("id") for r in rows}
+            merged = [r for r in read_archive_month(username, month, idx) if r.get("id") not in ids] + rows
+            write_archive_month(username, month, merged, idx)
+        write_archive_index(username, idx)
+        write_coll(username, "rentals", keep)
+        return len(hot) - len(keep)
+
+# ===== Bộ nhớ theo cửa hàng: nạp lười, thống kê, dọn cửa hàng nhàn rỗi =====
+#
+# Trạng thái trong bộ nhớ của 1 cửa hàng (model dùng chung, trạng thái journal, bảng dạng cột, bảng xếp hạng)
+# chỉ được nạp khi có request cần tới. Mỗi lần tra cache ghi nhận trúng/trượt + lúc truy cập cuối; kích thước
+# ước lượng lại sau mỗi lần nạp. Sau request, cửa hàng nhàn rỗi quá TENANT_IDLE_SEC bị bỏ khỏi bộ nhớ, và nếu
+# tổng vẫn vượt TENANT_MEMORY_BUDGET_MB thì bỏ tiếp theo thứ tự (thời gian nhàn rỗi x kích thước) lớn trước.
+# Cửa hàng master gunicorn nạp sẵn (preload) không bị bỏ: trang nhớ đó dùng chung, bỏ đi cũng không giải phóng.
+
+TENANT_MEMORY_BUDGET_MB = float(os.environ.get("TENANT_MEMORY_BUDGET_MB", "256"))  # Ngân sách mỗi process (<= 0 = không giới hạn)
+TENANT_IDLE_SEC = int(os.environ.get("TENANT_IDLE_SEC", "1800"))  # Nhàn rỗi quá lâu thì bỏ (<= 0 = không bỏ theo thời gian)
+TENANT_SWEEP_SEC = 30  # Quét định kỳ tối thiểu giữa 2 lần (ngoài lần quét ngay sau khi có cửa hàng được nạp)
+_SIZE_SAMPLE = 64  # Số phần tử lấy mẫu khi ước lượng kích thước list/dict lớn
+
+_tenant_usage = {}  # username -> {"last", "hits", "misses", "evictions", "bytes", "dirty", "pinned"}
+_tenant_sweep = {"at": 0.0, "dirty": False}
+
+def _tenant_caches():
+    # Các cache theo cửa hàng được quản lý (khai báo rải rác trong file, lấy lúc chạy)
+    return (_shared_models, _journal_states, _analytics, _leaderboards)
+
+def note_tenant_access(username, hit):
+    # Gọi ở mỗi lần tra cache của cửa hàng: hit=False nghĩa là vừa phải nạp/dựng lại từ đĩa
+    u = _tenant_usage.get(username)
+    if u is None:
+        u = _tenant_usage[username] = {"last": 0.0, "hits": 0, "misses": 0, "evictions": 0,
+                                       "bytes": 0, "dirty": True, "pinned": False}
+    u["last"] = time.monotonic()
+    if hit:
+        u["hits"] += 1
+    else:
+        u["misses"] += 1
+        u["dirty"] = True
+        u["pinned"] = False  # Dữ liệu mới là của riêng process này, bỏ được
+        _tenant_sweep["dirty"] = True
+
+def _approx_bytes(obj, depth=0):
+    # Ước lượng kích thước (byte) của obj và các phần tử con; list/dict lớn tính theo mẫu.
+    # Chuỗi dùng chung (sys.intern) bị đếm lặp nên thường cao hơn thực tế -> dọn sớm hơn là trễ hơn.
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes + sys.getsizeof(obj)
+    n = sys.getsizeof(obj)
+    if depth > 5 or isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return n
+    if isinstance(obj, dict):
+        if "index" in obj:  # Chỉ mục id -> bản ghi chỉ trỏ lại các bản ghi đã đếm trong "colls": chỉ tính khung dict
+            n += sum(sys.getsizeof(v) for v in obj["index"].values())
+            obj = {k: v for k, v in obj.items() if k != "index"}
+        items = list(obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        items = list(obj)
+    elif isinstance(obj, _Record):
+        return n + sum(_approx_bytes(getattr(obj, f.name), depth + 1) for f in dc_fields(obj))
+    else:
+        return n
+    if not items:
+        return n
+    step = max(1, len(items) // _SIZE_SAMPLE)
+    sample = items[::step]
+    sampled = sum(_approx_bytes(x, depth + 1) for x in sample)
+    return n + sampled * len(items) // len(sample)
+
+def tenant_bytes(username):
+    return sum(_approx_bytes(c[username]) for c in _tenant_caches() if username in c)
+
+def evict_tenant(username):
+    """
+    Bỏ toàn bộ trạng thái trong bộ nhớ của 1 cửa hàng (lần truy cập sau nạp lại từ đĩa).
+    Không chờ: nếu cửa hàng đang được luồng khác khóa (đang dùng) thì bỏ qua, trả False.
+    """
+    lk = _tenant_locks.get(username)
+    if lk is not None and not lk.acquire(blocking=False):
+        return False
+    try:
+        for cache in _tenant_caches():
+            cache.pop(username, None)
+    finally:
+        if lk is not None:
+            lk.release()
+    u = _tenant_usage.get(username)
+    if u is not None:
+        u["evictions"] += 1
+        u["bytes"] = 0
+        u["dirty"] = False
+    return True
+
+def _resident(username):
+    return any(username in c for c in _tenant_caches())
+
+def sweep_tenant_states(keep=None):
+    """
+    Đo lại kích thước cửa hàng vừa nạp, bỏ cửa hàng nhàn rỗi, rồi ép tổng về dưới ngân sách.
+    keep: cửa hàng của request hiện tại (không bỏ). Trả danh sách cửa hàng đã bỏ.
+    """
+    now = time.monotonic()
+    _tenant_sweep.update(at=now, dirty=False)
+    evicted = []
+    total = 0
+    for username, u in list(_tenant_usage.items()):
+        if not _resident(username):
+            u["bytes"] = 0
+            continue
+        if u["dirty"]:
+            u["bytes"] = tenant_bytes(username)
+            u["dirty"] = False
+        if (TENANT_IDLE_SEC > 0 and username != keep and not u["pinned"]
+                and now - u["last"] > TENANT_IDLE_SEC and evict_tenant(username)):
+            evicted.append(username)
+            continue
+        if not u["pinned"]:
+            total += u["bytes"]  # Ngân sách chỉ tính bộ nhớ riêng của process (không tính phần preload dùng chung)
+    budget = TENANT_MEMORY_BUDGET_MB * 1024 * 1024
+    if budget > 0 and total > budget:
+        victims = sorted(
+            (u for u in _tenant_usage if u != keep and not _tenant_usage[u]["pinned"] and _tenant_usage[u]["bytes"]),
+            key=lambda u: (now - _tenant_usage[u]["last"] + 1) * _tenant_usage[u]["bytes"],
+            reverse=True,
+        )
+        for username in victims:
+            if total <= budget * 0.9:  # Chừa khoảng trống để không phải dọn lại ngay ở request sau
+                break
+            size = _tenant_usage[username]["bytes"]
+            if evict_tenant(username):
+                evicted.append(username)
+                total -= size
+    if evicted:
+        app.logger.info("Bỏ trạng thái trong bộ nhớ của %d cửa hàng: %s", len(evicted), ", ".join(evicted))
+    return evicted
+
+@app.after_request
+def enforce_tenant_budget(resp):
+    # Quét sau request (đã trả xong dữ liệu, không giữ khóa): ngay khi có cửa hàng vừa nạp, hoặc định kỳ
+    if _tenant_sweep["dirty"] or time.monotonic() - _tenant_sweep["at"] > TENANT_SWEEP_SEC:
+        sweep_tenant_states(keep=get_current_username())
+    return resp
+
+def tenant_state_stats():
+    # Thống kê từng cửa hàng trong process này: có đang nằm trong bộ nhớ, kích thước, tỉ lệ trúng cache
+    now = time.monotonic()
+    out = {}
+    for username, u in sorted(_tenant_usage.items()):
+        lookups = u["hits"] + u["misses"]
+        out[username] = {
+            "resident": _resident(username),
+            "pinned": u["pinned"],
+            "approx_mb": round(u["bytes"] / 1024 / 1024, 3),
+            "idle_sec": round(now - u["last"], 1),
+            "hits": u["hits"],
+            "misses": u["misses"],
+            "hit_rate": round(u["hits"] / lookups, 4) if lookups else None,
+            "evictions": u["evictions"],
+        }
+    return {
+        "budget_mb": TENANT_MEMORY_BUDGET_MB,
+        "idle_sec": TENANT_IDLE_SEC,
+        "resident_mb": round(sum(u["bytes"] for u in _tenant_usage.values()) / 1024 / 1024, 3),
+        "tenants": out,
+    }
+
+# ===== Định tuyến theo cửa hàng (affinity.py) =====
+# Khi chạy sau proxy affinity.py, mỗi process backend có tên node (AFFINITY_NODE) và proxy băm nhất quán
+# cookie "tenant" để mọi request của 1 cửa hàng luôn tới cùng 1 node. Node đó giữ trạng thái trong bộ nhớ
+# của cửa hàng và là nơi duy nhất ghi dữ liệu của nó; tác vụ nền / nạp sẵn cũng chỉ chạy cho cửa hàng mình sở hữu.
+# Khóa file + .version vẫn giữ nguyên: lúc thêm/bớt node, 1 cửa hàng có thể vừa chuyển chủ.
+
+AFFINITY_NODE = os.environ.get("AFFINITY_NODE", "")  # Rỗng = không chạy sau proxy, process sở hữu mọi cửa hàng
+AFFINITY_RING_FILE = os.environ.get("AFFINITY_RING_FILE", "")
+
+_ring_cache = {"sig": None, "ring": None}
+
+def affinity_ring():
+    # Vòng băm hiện tại do proxy ghi ra; chỉ đọc lại khi file đổi (proxy thêm/bớt node)
+    sig = _file_sig(AFFINITY_RING_FILE)
+    if sig != _ring_cache["sig"]:
+        _ring_cache.update(sig=sig, ring=read_ring(AFFINITY_RING_FILE))
+    return _ring_cache["ring"]
+
+def affinity_key(username):
+    return (username or "").casefold()
+
+def owns_tenant(username):
+    # True nếu cửa hàng này được định tuyến về process hiện tại (luôn True khi không dùng proxy)
+    if not AFFINITY_NODE or not AFFINITY_RING_FILE:
+        return True
+    ring = affinity_ring()
+    return ring is None or ring.node_for("u:" + affinity_key(username)) == AFFINITY_NODE
+
+@app.after_request
+def set_affinity_cookie(resp):
+    # Cookie chỉ dùng để chọn node (không xác thực); đăng nhập/đăng xuất đổi cookie -> request sau sang đúng node
+    username = get_current_username()
+    current = request.cookies.get(AFFINITY_COOKIE)
+    if username and current != affinity_key(username):
+        resp.set_cookie(AFFINITY_COOKIE, affinity_key(username), httponly=True, samesite="Lax")
+    elif not username and current:
+        resp.delete_cookie(AFFINITY_COOKIE)
+    return resp
+
+# ===== Tác vụ nền định kỳ =====
+
+MAINTENANCE_INTERVAL_SEC = int(os.environ.get("MAINTENANCE_INTERVAL_SEC", "3600"))  # <= 0 để tắt
+MAINTENANCE_TASKS = [migrate_money, migrate_genres, journal_maintenance, purge_tombstones, compact_rentals]  # Các hàm task(username) chạy định kỳ cho từng cửa hàng
+
+def list_tenants():
+    # Liệt kê các thư mục cửa hàng có trong data/users/
+    root = os.path.join(DATA_DIR, "users")
+    try:
+        return sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+    except FileNotFoundError:
+        return []
+
+def run_maintenance_once():
+    for username in filter(owns_tenant, list_tenants()):
+        for task in MAINTENANCE_TASKS:
+            try:
+                task(username)
+            except Exception:
+                app.logger.exception("Tác vụ nền %s lỗi với user %s", task.__name__, username)
+
+def _maintenance_loop():
+    while True:
+        run_maintenance_once()
+        time.sleep(MAINTENANCE_INTERVAL_SEC)
+
+_maintenance_started = False
+_maintenance_guard = threading.Lock()
+
+@app.before_request
+def start_maintenance_thread():
+    # Khởi động luồng nền ở request đầu tiên của mỗi process (sau khi gunicorn fork worker)
+    global _maintenance_started
+    if _maintenance_started or MAINTENANCE_INTERVAL_SEC <= 0:
+        return
+    with _maintenance_guard:
+        if _maintenance_started:
+            return
+        _maintenance_started = True
+    threading.Thread(target=_maintenance_loop, name="maintenance", daemon=True).start()
+
+# ================== Phân tích dữ liệu thuê (NumPy, dạng cột) ==================
+#
+# Giao dịch của mỗi cửa hàng được nạp thành các mảng NumPy theo cột (thời gian epoch, tiền số nguyên,
+# mã số truyện/khách) và giữ trong bộ nhớ. Phần lưu trữ (ít đổi) và phần nóng được cache riêng theo
+# chữ ký file: ghi vào phần nóng chỉ dựng lại phần nóng (tối đa RENTALS_HOT_DAYS ngày), phần lưu trữ
+# chỉ dựng lại khi index.json đổi. /stats và /api/reports/* chỉ còn là các phép group-by vector hóa.
+#
+# Thời gian lưu dạng giây kể từ 01-01-1970 theo giờ địa phương (coi như UTC), nên ngày = t // 86400.
+
+_NA = np.iinfo(np.int64).min  # Giá trị thiếu/hỏng trong cột thời gian (trùng với NaT của NumPy)
+_analytics = {}  # username -> {"codes", "cold", "hot", "full"}
+
+def _iso(s):
+    # "DD-MM-YYYY HH:MM:SS" -> "YYYY-MM-DDTHH:MM:SS" để NumPy parse hàng loạt
+    if not s or len(s) < 10:
+        return "NaT"
+    return f"{s[6:10]}-{s[3:5]}-{s[0:2]}T{s[11:19] or '00:00:00'}"
+
+def _epoch_col(values):
+    # Cột chuỗi ngày giờ -> mảng int64 giây; rỗng/hỏng -> _NA
+    iso = [_iso(s) for s in values]
+    try:
+        return np.array(iso, dtype="datetime64[s]").astype(np.int64)
+    except ValueError:  # Có dòng hỏng -> parse từng dòng
+        out = np.full(len(iso), _NA, dtype=np.int64)
+        for i, s in enumerate(iso):
+            try:
+                out[i] = np.datetime64(s, "s").astype(np.int64)
+            except ValueError:
+                pass
+        return out
+
+def epoch_now():
+    return int(np.datetime64(datetime.now(), "s").astype(np.int64))
+
+def epoch_day(d):
+    # date -> số ngày kể từ 01-01-1970
+    return (d - datetime(1970, 1, 1).date()).days
+
+def day_str(day):
+    # số ngày kể từ 01-01-1970 -> "DD-MM-YYYY"
+    return (datetime(1970, 1, 1) + timedelta(days=int(day))).strftime("%d-%m-%Y")
+
+def _new_codes():
+    # Mã số nguyên ổn định cho truyện/khách (chỉ tăng, dùng chung cho phần nóng + lưu trữ)
+    return {"manga": {}, "manga_ids": [], "manga_titles": [], "cust": {}, "cust_ids": [], "cust_names": []}
+
+def _intern_code(codes, kind, key, label):
+    c = codes[kind].get(key)
+    if c is None:
+        c = codes[kind][key] = len(codes[kind + "_ids"])
+        codes[kind + "_ids"].append(key)
+        codes[kind + ("_titles" if kind == "manga" else "_names")].append(label or key)
+    elif label:
+        codes[kind + ("_titles" if kind == "manga" else "_names")][c] = label
+    return c
+
+def _int_or(v, default):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return default
+
+def _build_frame(rows, codes):
+    # list giao dịch -> dict các cột NumPy cùng độ dài
+    n = len(rows)
+    return {
+        "id": [r.get("id") for r in rows],
+        "start": _epoch_col([r.get("created_at") for r in rows]),
+        "due": _epoch_col([r.get("due_at") for r in rows]),
+        "ret": _epoch_col([r.get("returned_at") for r in rows]),
+        "open": np.fromiter((not r.get("returned_at") for r in rows), bool, n),
+        "deleted": np.fromiter((bool(r.get("deleted")) for r in rows), bool, n),  # Giữ doanh thu của truyện/khách đã xóa
+        "price": np.fromiter((price_to_int(r.get("rent_price") or 0) for r in rows), np.int64, n),
+        "late": np.fromiter((price_to_int(r.get("late_fee") or 0) for r in rows), np.int64, n),
+        "late_per_day": np.fromiter((_int_or(r.get("late_fee_per_day"), -1) for r in rows), np.int64, n),  # -1 = theo cấu hình
+        "manga": np.fromiter(
+            (_intern_code(codes, "manga", r.get("manga_id"), r.get("manga_title")) for r in rows), np.int32, n),
+        "cust": np.fromiter(
+            (_intern_code(codes, "cust", r.get("customer_id"), r.get("customer_name")) for r in rows), np.int32, n),
+    }
+
+def _concat_frames(a, b):
+    return {k: (a[k] + b[k]) if k == "id" else np.concatenate([a[k], b[k]]) for k in a}
+
+def _rental_sigs(username):
+    # Chữ ký (phần lưu trữ, phần nóng) + list phần nóng nếu đang có sẵn trong bộ nhớ (journal_mode)
+    cold_sig = _file_sig(os.path.join(archive_dir(username), "index.json"))
+    if journal_mode(username):
+        state = journal_state(username)
+        return cold_sig, ("j", state["sig"], state["offset"]), state["colls"]["rentals"]
+    return cold_sig, ("f", _file_sig(user_file(username, COLL_FILES["rentals"]))), None
+
+def rental_frame(username):
+    """
+    Toàn bộ giao dịch (lưu trữ + phần nóng) dạng cột, kèm "codes" để đổi mã số về id/tên.
+    Chỉ dựng lại phần có chữ ký thay đổi; giao dịch trùng id (dồn lưu trữ dở dang) lấy bản lưu trữ.
+    """
+    with tenant_lock(username):
+        eng = _analytics.setdefault(username, {"codes": _new_codes(), "cold": None, "hot": None, "full": None})
+        codes = eng["codes"]
+
+        cold_sig, hot_sig, hot_rows = _rental_sigs(username)
+        if eng["cold"] is None or eng["cold"]["sig"] != cold_sig:
+            idx = read_archive_index(username)
+            rows = []
+            for month in sorted(idx["months"]):
+                rows.extend(read_archive_month(username, month, idx))
+            frame = _build_frame(rows, codes)
+            eng["cold"] = {"sig": cold_sig, "frame": frame, "ids": set(frame["id"])}
+
+        if eng["hot"] is None or eng["hot"]["sig"] != hot_sig:
+            if hot_rows is None:
+                hot_rows = read_coll(username, "rentals")
+            cold_ids = eng["cold"]["ids"]
+            eng["hot"] = {"sig": hot_sig, "frame": _build_frame([r for r in hot_rows if r.get("id") not in cold_ids], codes)}
+
+        key = (cold_sig, hot_sig)
+        note_tenant_access(username, eng["full"] is not None and eng["full"]["key"] == key)
+        if eng["full"] is None or eng["full"]["key"] != key:
+            eng["full"] = {"key": key, "frame": _concat_frames(eng["cold"]["frame"], eng["hot"]["frame"])}
+        return eng["full"]["frame"], codes
+
+def genre_matrix(username, codes):
+    # Ma trận bool [mã truyện x id thể loại] từ danh mục truyện hiện tại
+    manga = read_coll(username, "manga")
+    with tenant_lock(username):  # codes dùng chung với rental_frame
+        for m in manga:
+            _intern_code(codes, "manga", m["id"], m.get("title"))
+    genres = read_coll(username, "genres")
+    width = max((gnr["id"] for gnr in genres), default=-1) + 1
+    mat = np.zeros((len(codes["manga_ids"]), width), dtype=bool)
+    for m in manga:
+        ids = m.get("genre_ids") or ()
+        if ids:
+            mat[codes["manga"][m["id"]], list(ids)] = True
+    return mat, {gnr["id"]: gnr["name"] for gnr in genres}
+
+def range_bounds(date_from, date_to):
+    # Khoảng lọc theo ngày thuê như /stats: "DD-MM-YYYY" (cả ngày) hoặc "DD-MM-YYYY HH:MM:SS"
+    def one(s, tail):
+        if not s:
+            return None
+        v = _epoch_col([s + tail if len(s) == 10 else s])[0]
+        return None if v == _NA else int(v)
+    return one(date_from, " 00:00:00"), one(date_to, " 23:59:59")
+
+def range_mask(fr, t0, t1):
+    start = fr["start"]
+    sel = start != _NA
+    if t0 is not None:
+        sel &= start >= t0
+    if t1 is not None:
+        sel &= start <= t1
+    return sel
+
+def hidden_mask(username, fr, codes):
+    # Như rental_hidden trên cả frame: cờ "deleted" + giao dịch của truyện/khách có trong tombstones
+    hidden = fr["deleted"].copy()
+    tomb = tombstones(username)
+    for kind, col, ids in (("manga", "manga", tomb["manga"]), ("cust", "cust", tomb["customers"])):
+        hit = [codes[kind][i] for i in ids if i in codes[kind]]
+        if hit:
+            hidden |= np.isin(fr[col], hit)
+    return hidden
+
+def revenue_mask(username, fr, codes):
+    # Giao dịch được tính vào doanh thu/thống kê tổng: mọi giao dịch nếu keep_deleted_revenue, không thì bỏ phần ẩn
+    if _raw_shop_cfg(username).get("keep_deleted_revenue", True):
+        return np.ones(len(fr["id"]), dtype=bool)
+    return ~hidden_mask(username, fr, codes)
+
+# ----- Chỉ mục thời gian cho danh sách giao dịch (/rentals, /api/rentals) -----
+# Vị trí giao dịch trong rental_frame sắp theo lúc thuê + các bitmap (mảng bool) cùng thứ tự: đang mở, thuộc
+# phần nóng, đã đánh dấu xóa. Lọc khoảng ngày = searchsorted (bisect) 2 đầu rồi cắt lát; trạng thái, khách,
+# truyện chỉ AND mask trên lát đó. Chỉ mục dựng lại khi rental_frame đổi (cùng chữ ký), không quét rentals.json.
+
+RENTAL_STATUSES = ("open", "returned", "overdue")  # Đang thuê / đã trả / quá hạn chưa trả
+
+def rental_timeline(username):
+    """Chỉ mục thời gian của cửa hàng: {"order", "start", "due", "open", "hot", "deleted", "manga", "cust", "bad"}."""
+    with tenant_lock(username):  # RLock: rental_frame khóa lồng bên trong
+        fr, codes = rental_frame(username)
+        eng = _analytics[username]
+        tl = eng.get("timeline")
+        if tl is None or tl["key"] != eng["full"]["key"]:
+            order = np.argsort(fr["start"], kind="stable")
+            start = fr["start"][order]
+            tl = eng["timeline"] = {
+                "key": eng["full"]["key"],
+                "order": order,
+                "start": start,
+                "due": fr["due"][order],
+                "open": fr["open"][order],
+                "hot": order >= len(eng["cold"]["frame"]["id"]),  # _concat_frames: lưu trữ trước, phần nóng sau
+                "deleted": fr["deleted"][order],
+                "manga": fr["manga"][order],
+                "cust": fr["cust"][order],
+                "bad": int(np.searchsorted(start, _NA, side="right")),  # Ngày thuê hỏng (_NA) nằm đầu mảng
+            }
+        return tl, fr, codes
+
+def query_rentals(username, t0=None, t1=None, status="", customer_id="", manga_id="", q="", hot_only=False, now=None):
+    """
+    Vị trí (trong rental_frame) các giao dịch khớp bộ lọc, mới nhất trước, kèm (frame, codes).
+    t0/t1: giây như range_bounds; có khoảng ngày thì bỏ giao dịch có ngày thuê hỏng.
+    q: chuỗi thường, so với tên truyện / tên khách đã mã hóa. Ẩn giao dịch của truyện/khách đã xóa.
+    """
+    tl, fr, codes = rental_timeline(username)
+    start = tl["start"]
+    lo, hi = 0, len(start)
+    if t0 is not None or t1 is not None:
+        lo = tl["bad"] if t0 is None else max(tl["bad"], int(np.searchsorted(start, t0, side="left")))
+        hi = hi if t1 is None else int(np.searchsorted(start, t1, side="right"))
+    if hi <= lo:
+        return np.zeros(0, dtype=np.int64), fr, codes
+
+    sel = ~tl["deleted"][lo:hi]
+    if status == "open":
+        sel &= tl["open"][lo:hi]
+    elif status == "returned":
+        sel &= ~tl["open"][lo:hi]
+    elif status == "overdue":
+        due = tl["due"][lo:hi]
+        sel &= tl["open"][lo:hi] & (due != _NA) & (due < (epoch_now() if now is None else now))
+    if hot_only:
+        sel &= tl["hot"][lo:hi]
+    for kind, key, col in (("cust", customer_id, "cust"), ("manga", manga_id, "manga")):
+        if key:
+            code = codes[kind].get(key)
+            if code is None:
+                return np.zeros(0, dtype=np.int64), fr, codes
+            sel &= tl[col][lo:hi] == code
+
+    tomb = tombstones(username)
+    hidden_m = [codes["manga"][i] for i in tomb["manga"] if i in codes["manga"]]
+    hidden_c = [codes["cust"][i] for i in tomb["customers"] if i in codes["cust"]]
+    if hidden_m:
+        sel &= ~np.isin(tl["manga"][lo:hi], hidden_m)
+    if hidden_c:
+        sel &= ~np.isin(tl["cust"][lo:hi], hidden_c)
+    if q:
+        m_hit = [c for c, t in enumerate(codes["manga_titles"]) if q in (t or "").lower()]
+        c_hit = [c for c, n in enumerate(codes["cust_names"]) if q in (n or "").lower()]
+        sel &= np.isin(tl["manga"][lo:hi], m_hit) | np.isin(tl["cust"][lo:hi], c_hit)
+    return tl["order"][lo:hi][sel][::-1], fr, codes
+
+def rentals_at(username, fr, pos):
+    """Bản ghi Rental tại các vị trí pos (giữ thứ tự): phần nóng tra theo id, lưu trữ chỉ mở đúng tháng chứa chúng."""
+    ids = [fr["id"][p] for p in pos]
+    want = set(ids)
+    found = {r.id: r for r in read_models(username, "rentals") if r.id in want}
+    months = {str(np.datetime64(int(fr["start"][p]), "s"))[:7]
+              for p in pos if fr["id"][p] not in found and fr["start"][p] != _NA}
+    if months:
+        idx = read_archive_index(username)
+        for month in sorted(months):
+            for r in read_archive_month(username, month, idx):
+                if r.get("id") in want and r.get("id") not in found:
+                    found[r["id"]] = Rental.from_dict(r)
+    return [found[i] for i in ids if i in found]
+
+def late_by_day(fr, default_per_day, from_day=None, to_day=None, today_day=None, rows=None):
+    """
+    Phí trễ trải theo từng ngày trễ (ngày sau hạn -> ngày trả, chưa trả thì đến hôm nay),
+    cắt theo [from_day, to_day]; rows (mask) giới hạn các giao dịch được tính.
+    Trả (các ngày có trễ, phí mỗi ngày tương ứng) — mảng difference + cumsum.
+    """
+    today_day = epoch_day(datetime.now().date()) if today_day is None else today_day
+    due, ret, is_open = fr["due"], fr["ret"], fr["open"]
+    ok = (due != _NA) & (is_open | (ret != _NA))
+    if rows is not None:
+        ok &= rows
+    start = np.where(ok, due // 86400 + 1, 0)
+    end = np.where(is_open, today_day, np.where(ret != _NA, ret // 86400, 0))
+    if to_day is not None:
+        end = np.minimum(end, to_day)
+    if from_day is not None:
+        start = np.maximum(start, from_day)
+    ok &= end >= start
+    if not ok.any():
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    start, end = start[ok], end[ok]
+    per_day = fr["late_per_day"][ok]
+    per_day = np.maximum(np.where(per_day < 0, default_per_day, per_day), 0)
+    base = int(start.min())
+    size = int(end.max()) - base + 2
+    fee = np.zeros(size, dtype=np.int64)
+    hits = np.zeros(size, dtype=np.int64)
+    np.add.at(fee, start - base, per_day)
+    np.add.at(fee, end - base + 1, -per_day)
+    np.add.at(hits, start - base, 1)
+    np.add.at(hits, end - base + 1, -1)
+    fee, hits = np.cumsum(fee)[:-1], np.cumsum(hits)[:-1]
+    days = np.nonzero(hits > 0)[0]
+    return days + base, fee[days]
+
+def _top(values, weights_by_code, limit):
+    # Chỉ số của limit phần tử lớn nhất (argpartition rồi mới sắp xếp K phần tử)
+    nz = np.nonzero(values)[0]
+    if len(nz) > limit:
+        nz = nz[np.argpartition(-values[nz], limit - 1)[:limit]]
+    return nz[np.lexsort((-weights_by_code[nz], -values[nz]))]
+
+def report_top_titles(username, fr, codes, sel, limit):
+    sel = sel & ~hidden_mask(username, fr, codes)  # Truyện/khách đã xóa không lên bảng xếp hạng
+    m = fr["manga"][sel]
+    size = len(codes["manga_ids"])
+    counts = np.bincount(m, minlength=size)
+    revenue = np.bincount(m, weights=fr["price"][sel], minlength=size).astype(np.int64)
+    titles = {x["id"]: x.get("title") for x in read_coll(username, "manga")}
+    return [
+        {
+            "manga_id": codes["manga_ids"][i],
+            "title": titles.get(codes["manga_ids"][i]) or codes["manga_titles"][i],
+            "rentals": int(counts[i]),
+            "revenue": int(revenue[i]),
+        }
+        for i in _top(counts, revenue, limit)
+    ]
+
+def report_top_customers(username, fr, codes, sel, limit):
+    sel = sel & ~hidden_mask(username, fr, codes)
+    c = fr["cust"][sel]
+    size = len(codes["cust_ids"])
+    counts = np.bincount(c, minlength=size)
+    spent = np.bincount(c, weights=(fr["price"] + fr["late"])[sel], minlength=size).astype(np.int64)
+    names = {x["id"]: x.get("name") for x in read_coll(username, "customers")}
+    return [
+        {
+            "customer_id": codes["cust_ids"][i],
+            "name": names.get(codes["cust_ids"][i]) or codes["cust_names"][i],
+            "rentals": int(counts[i]),
+            "spent": int(spent[i]),
+        }
+        for i in _top(spent, counts, limit)
+    ]
+
+def report_by_weekday(username, fr, codes, sel, limit):
+    day = fr["start"][sel] // 86400
+    wd = (day + 3) % 7  # 01-01-1970 là thứ Năm -> 0 = thứ Hai
+    counts = np.bincount(wd, minlength=7)
+    revenue = np.bincount(wd, weights=fr["price"][sel], minlength=7).astype(np.int64)
+    labels = ["Thứ 2", "Thứ 3", "Thứ 4", "Thứ 5", "Thứ 6", "Thứ 7", "Chủ nhật"]
+    return [{"weekday": labels[i], "rentals": int(counts[i]), "revenue": int(revenue[i])} for i in range(7)]
+
+def report_by_hour(username, fr, codes, sel, limit):
+    hour = (fr["start"][sel] % 86400) // 3600
+    counts = np.bincount(hour, minlength=24)
+    revenue = np.bincount(hour, weights=fr["price"][sel], minlength=24).astype(np.int64)
+    return [{"hour": i, "rentals": int(counts[i]), "revenue": int(revenue[i])} for i in range(24)]
+
+def report_rental_length(username, fr, codes, sel, limit):
+    done = sel & ~fr["open"] & (fr["ret"] != _NA)
+    days = (fr["ret"][done] - fr["start"][done]) / 86400.0
+    if not len(days):
+        return {"returned": 0, "avg_days": None, "median_days": None, "max_days": None}
+    return {
+        "returned": int(len(days)),
+        "avg_days": round(float(days.mean()), 2),
+        "median_days": round(float(np.median(days)), 2),
+        "max_days": round(float(days.max()), 2),
+    }
+
+def report_late_rate_by_genre(username, fr, codes, sel, limit):
+    mat, names = genre_matrix(username, codes)
+    done = sel & ~fr["open"] & (fr["ret"] != _NA) & (fr["due"] != _NA)
+    m = fr["manga"][done]
+    late = fr["ret"][done] > fr["due"][done]
+    size = mat.shape[0]
+    total_by_genre = np.bincount(m, minlength=size) @ mat
+    late_by_genre = np.bincount(m[late], minlength=size) @ mat
+    out = []
+    for gid in np.nonzero(total_by_genre)[0]:
+        out.append({
+            "genre_id": int(gid),
+            "genre": names.get(int(gid), "Khác"),
+            "returned": int(total_by_genre[gid]),
+            "late": int(late_by_genre[gid]),
+            "late_rate": round(float(late_by_genre[gid]) / float(total_by_genre[gid]), 4),
+        })
+    out.sort(key=lambda x: -x["late_rate"])
+    return out
+
+def report_revenue(username, fr, codes, sel, limit, from_day=None, to_day=None):
+    # Doanh thu theo ngày = tiền thuê (theo ngày thuê) + phí trễ (theo từng ngày trễ), giống /stats
+    keep = revenue_mask(username, fr, codes)
+    sel = sel & keep
+    rent_days, rent_inv = np.unique(fr["start"][sel] // 86400, return_inverse=True)
+    rent_sum = np.bincount(rent_inv, weights=fr["price"][sel], minlength=len(rent_days)).astype(np.int64)
+    default_per_day = int(read_shop_cfg(username).get("late_fee_per_day", 10000) or 10000)
+    late_days, late_fee = late_by_day(fr, default_per_day, from_day, to_day, rows=keep)
+    days = np.union1d(rent_days, late_days)
+    total = np.zeros(len(days), dtype=np.int64)
+    total[np.searchsorted(days, rent_days)] += rent_sum
+    total[np.searchsorted(days, late_days)] += late_fee
+    return {
+        "days": [day_str(d) for d in days],
+        "revenue": [int(x) for x in total],
+        "total_rent": int(rent_sum.sum()),
+        "total_late": int(late_fee.sum()),
+    }
+
+REPORTS = {
+    "top-titles": report_top_titles,
+    "top-customers": report_top_customers,
+    "by-weekday": report_by_weekday,
+    "by-hour": report_by_hour,
+    "rental-length": report_rental_length,
+    "late-rate-by-genre": report_late_rate_by_genre,
+    "revenue": report_revenue,
+}
+
+# ================== Bảng xếp hạng (7/30/365 ngày) ==================
+#
+# Mỗi cửa hàng giữ trong bộ nhớ: bucket theo ngày (lượt thuê mỗi truyện, tiền/lượt của mỗi khách),
+# tổng cộng dồn cho từng cửa sổ LEADERBOARD_WINDOWS và danh sách top-K đã sắp sẵn. Thuê/trả chỉ cộng
+# vào bucket hôm nay + chỉnh top-K (giá trị chỉ tăng nên chỉ cần so với phần tử cuối); sang ngày mới thì
+# trừ các bucket vừa rời cửa sổ rồi chọn lại top-K. Giao dịch đang mở nằm trong 1 list sắp theo hạn trả,
+# nên "quá hạn lâu nhất" chỉ là K phần tử đầu. Đọc bảng xếp hạng = O(K).
+# Nếu dữ liệu thuê bị đổi ngoài các sự kiện này (worker khác, sửa/xóa, dồn lưu trữ) thì dựng lại từ rental_frame.
+
+LEADERBOARD_WINDOWS = (7, 30, 365)
+LEADERBOARD_SIZE = int(os.environ.get("LEADERBOARD_SIZE", "10"))  # K
+_leaderboards = {}  # username -> trạng thái bảng xếp hạng
+
+def _lb_bucket():
+    return {"titles": {}, "spent": {}, "visits": {}}
+
+def _lb_add(st, day, field, key, amount):
+    # Cộng vào bucket ngày `day` và vào tổng của các cửa sổ đang chứa ngày đó
+    b = st["buckets"].setdefault(day, _lb_bucket())
+    b[field][key] = b[field].get(key, 0) + amount
+    for w in LEADERBOARD_WINDOWS:
+        if day > st["today"] - w:
+            totals = st["totals"][w][field]
+            totals[key] = totals.get(key, 0) + amount
+            if field in st["top"][w]:
+                _lb_bump(st["top"][w][field], key, totals[key])
+
+def _lb_bump(top, key, value):
+    # top: list [[key, value], ...] giảm dần, tối đa LEADERBOARD_SIZE; value của key chỉ tăng
+    for item in top:
+        if item[0] == key:
+            item[1] = value
+            break
+    else:
+        if len(top) >= LEADERBOARD_SIZE and value <= top[-1][1]:
+            return
+        top.append([key, value])
+    top.sort(key=lambda x: -x[1])
+    del top[LEADERBOARD_SIZE:]
+
+def _lb_select(st):
+    for w in LEADERBOARD_WINDOWS:
+        st["top"][w] = {
+            field: [[k, v] for k, v in heapq.nlargest(LEADERBOARD_SIZE, st["totals"][w][field].items(), key=lambda kv: kv[1])]
+            for field in ("titles", "spent")
+        }
+
+def _lb_roll(st, today):
+    # Sang ngày mới: trừ các bucket rời khỏi từng cửa sổ, bỏ bucket quá cửa sổ dài nhất
+    old = st["today"]
+    for w in LEADERBOARD_WINDOWS:
+        for day in range(old - w + 1, min(today - w, old) + 1):
+            b = st["buckets"].get(day)
+            if not b:
+                continue
+            for field, counts in b.items():
+                totals = st["totals"][w][field]
+                for key, amount in counts.items():
+                    left = totals.get(key, 0) - amount
+                    if left > 0:
+                        totals[key] = left
+                    else:
+                        totals.pop(key, None)
+    oldest = today - max(LEADERBOARD_WINDOWS) + 1
+    for day in [d for d in st["buckets"] if d < oldest]:
+        del st["buckets"][day]
+    st["today"] = today
+    _lb_select(st)
+
+def _build_leaderboards(username):
+    # Dựng lại từ đầu: group-by (ngày, truyện/khách) bằng NumPy trên rental_frame
+    fr, codes = rental_frame(username)
+    today = epoch_day(datetime.now().date())
+    oldest = today - max(LEADERBOARD_WINDOWS) + 1
+    st = {
+        "sig": None,
+        "today": today,
+        "buckets": {},
+        "totals": {w: _lb_bucket() for w in LEADERBOARD_WINDOWS},
+        "top": {},
+        "names": {"manga": dict(zip(codes["manga_ids"], codes["manga_titles"])),
+                  "cust": dict(zip(codes["cust_ids"], codes["cust_names"]))},
+        "open": [],
+        "hidden": {"manga": set(tombstones(username)["manga"]), "cust": set(tombstones(username)["customers"])},
+    }
+    shown = ~hidden_mask(username, fr, codes)  # Truyện/khách đã xóa (chờ dọn hoặc đã gắn cờ) không lên bảng
+
+    def fill(field, when, key_codes, ids, weights):
+        ok = shown & (when != _NA) & (when // 86400 >= oldest)
+        if not ok.any():
+            return
+        n = max(len(ids), 1)
+        combo = (when[ok] // 86400) * n + key_codes[ok]
+        uniq, inv = np.unique(combo, return_inverse=True)
+        sums = np.bincount(inv, weights=weights[ok]).astype(np.int64)
+        for c, v in zip(uniq.tolist(), sums.tolist()):
+            if v:
+                day, key = divmod(c, n)
+                counts = st["buckets"].setdefault(day, _lb_bucket())[field]
+                counts[ids[key]] = counts.get(ids[key], 0) + v
+
+    ones = np.ones(len(fr["id"]), dtype=np.int64)
+    fill("titles", fr["start"], fr["manga"], codes["manga_ids"], ones)
+    fill("visits", fr["start"], fr["cust"], codes["cust_ids"], ones)
+    fill("spent", fr["start"], fr["cust"], codes["cust_ids"], fr["price"])
+    fill("spent", np.where(fr["open"], _NA, fr["ret"]), fr["cust"], codes["cust_ids"], fr["late"])  # Phí trễ tính vào ngày trả
+
+    for day, b in st["buckets"].items():
+        for w in LEADERBOARD_WINDOWS:
+            if day > today - w:
+                for field, counts in b.items():
+                    totals = st["totals"][w][field]
+                    for key, amount in counts.items():
+                        totals[key] = totals.get(key, 0) + amount
+    _lb_select(st)
+
+    for i in np.nonzero(fr["open"] & shown)[0].tolist():
+        st["open"].append((int(fr["due"][i]), fr["id"][i], codes["manga_ids"][fr["manga"][i]], codes["cust_ids"][fr["cust"][i]]))
+    st["open"].sort()
+    return st
+
+def _rental_sig(username):
+    # Giao dịch + tombstones: xóa truyện/khách cũng làm bảng xếp hạng dựng lại
+    return _rental_sigs(username)[:2] + (_file_sig(user_file(username, TOMBSTONE_FILE)),)
+
+def _lb_apply(st, kind, rec):
+    # rec: Rental vừa tạo / vừa trả
+    today = st["today"]
+    if rec.get("deleted") or rec.manga_id in st["hidden"]["manga"] or rec.customer_id in st["hidden"]["cust"]:
+        return  # Như lúc dựng: giao dịch bị ẩn không được tính
+    if kind == "rent":
+        mid, cid = rec.manga_id, rec.customer_id
+        st["names"]["manga"][mid] = rec.manga_title or mid
+        st["names"]["cust"][cid] = rec.customer_name or cid
+        _lb_add(st, today, "titles", mid, 1)
+        _lb_add(st, today, "visits", cid, 1)
+        _lb_add(st, today, "spent", cid, rec.rent_price)
+        due = _epoch_col([rec.due_at])[0]
+        bisect.insort(st["open"], (int(due), rec.id, mid, cid))
+    elif kind == "return":
+        if rec.late_fee:
+            _lb_add(st, today, "spent", rec.customer_id, rec.late_fee)
+        st["open"] = [x for x in st["open"] if x[1] != rec.id]
+
+@contextmanager
+def leaderboard_events(username):
+    """
+    Bọc 1 thao tác ghi giao dịch: trong khối, thêm ("rent", rec) / ("return", rec) vào list được yield.
+    Cuối khối, nếu bảng xếp hạng trong bộ nhớ vẫn khớp dữ liệu trước khi ghi thì chỉ áp các sự kiện này;
+    nếu không (worker khác vừa ghi) thì bỏ để lần đọc sau dựng lại.
+    """
+    with tenant_lock(username):
+        before = _rental_sig(username) if username in _leaderboards else None
+        events = []
+        try:
+            yield events
+        except BaseException:
+            _leaderboards.pop(username, None)
+            raise
+        st = _leaderboards.get(username)
+        if st is None:
+            return
+        if st["sig"] != before:
+            _leaderboards.pop(username, None)
+            return
+        today = epoch_day(datetime.now().date())
+        if today != st["today"]:
+            _lb_roll(st, today)
+        for kind, rec in events:
+            _lb_apply(st, kind, rec)
+        # Trong unit of work, giao dịch mới chỉ nằm trên đĩa sau khi request ghi xong -> lấy chữ ký lúc đó
+        on_commit(username, lambda: st.__setitem__("sig", _rental_sig(username)))
+
+def get_leaderboards(username, windows=LEADERBOARD_WINDOWS, limit=None):
+    """
+    Top truyện được thuê nhiều, top khách chi nhiều cho từng cửa sổ ngày và các giao dịch quá hạn lâu nhất.
+    """
+    limit = LEADERBOARD_SIZE if limit is None else min(limit, LEADERBOARD_SIZE)
+    with tenant_lock(username):
+        st = _leaderboards.get(username)
+        sig = _rental_sig(username)
+        note_tenant_access(username, st is not None and st["sig"] == sig)
+        if st is None or st["sig"] != sig:
+            st = _build_leaderboards(username)
+            st["sig"] = sig
+            _leaderboards[username] = st
+        today = epoch_day(datetime.now().date())
+        if today != st["today"]:
+            _lb_roll(st, today)
+
+        names = st["names"]
+        out = {"windows": {}, "overdue": []}
+        for w in windows:
+            top, totals = st["top"][w], st["totals"][w]
+            out["windows"][w] = {
+                "titles": [
+                    {"manga_id": k, "title": names["manga"].get(k, k), "rentals": v}
+                    for k, v in top["titles"][:limit]
+                ],
+                "customers": [
+                    {"customer_id": k, "name": names["cust"].get(k, k), "spent": v,
+                     "rentals": totals["visits"].get(k, 0)}
+                    for k, v in top["spent"][:limit]
+                ],
+            }
+        now_ts = epoch_now()
+        for due, rid, mid, cid in st["open"]:  # Sắp theo hạn trả: quá hạn lâu nhất đứng đầu
+            if due == _NA:
+                continue
+            if due >= now_ts or len(out["overdue"]) >= limit:
+                break
+            out["overdue"].append({
+                "rental_id": rid,
+                "manga_id": mid,
+                "title": names["manga"].get(mid, mid),
+                "customer_id": cid,
+                "name": names["cust"].get(cid, cid),
+                "due_at": (datetime(1970, 1, 1) + timedelta(seconds=due)).strftime(DT_FMT),
+                "days_overdue": (now_ts - due) // 86400,
+            })
+        return out
 
 # ================== Auth ==================  # Khu xác thực đăng nhập/đăng ký
 
@@ -336,17 +2759,18 @@ def root():
 @app.route("/login", methods=["GET", "POST"])
 def login():
     # Route /login nhận GET để hiển thị form, POST để xử lý đăng nhập
-    ensure_dirs()  # Đảm bảo thư mục data/users.json tồn tại
+    ensure_dirs()  # Đảm bảo thư mục data tồn tại + đã chuyển users.json cũ
     if request.method == "POST":  # Nếu user submit form
         username = request.form.get("username","").strip()  # Lấy username từ form, bỏ khoảng trắng
         password = request.form.get("password","")  # Lấy password từ form
-        users = read_json(USERS_FILE, [])  # Đọc danh sách user từ file chung
-        found = next((u for u in users if u["username"].lower()==username.lower()), None)
-        # Tìm user có username trùng (không phân biệt hoa thường)
-        if not found or found["password_hash"] != hash_pw(password):
+        found = get_account(username)  # Tra chỉ mục username (không phân biệt hoa thường)
+        ok_pw, stale = run_pw_job(check_pw, found["password_hash"] if found else _DUMMY_PW_HASH, password)
+        if not found or not ok_pw:
             # Nếu không tìm thấy user hoặc hash mật khẩu không đúng
             flash("Sai tài khoản hoặc mật khẩu.", "danger")  # Thông báo lỗi
             return render_template("login.html")  # Render lại trang login
+        if stale:  # Hash kiểu cũ / số vòng cũ -> băm lại theo cấu hình hiện tại
+            update_account(found["username"], password_hash=run_pw_job(hash_pw, password))
         session["username"] = found["username"]  # Lưu username vào session (đánh dấu login)
         session["shop_name"] = found.get("shop_name","")  # Lưu shop_name để dùng nhanh
         return redirect(url_for("manga_list"))  # Đăng nhập thành công -> về manga_list
@@ -361,7 +2785,7 @@ def logout():
 @app.route("/register", methods=["GET","POST"])
 def register():
     # Route /register: GET hiển thị form, POST tạo tài khoản
-    ensure_dirs()  # Đảm bảo data folder + users.json tồn tại
+    ensure_dirs()  # Đảm bảo data folder tồn tại + đã chuyển users.json cũ
     if request.method == "POST":  # Nếu submit form đăng ký
         username = request.form.get("username","").strip()  # Lấy username
         email = request.form.get("email","").strip()  # Lấy email
@@ -375,20 +2799,20 @@ def register():
         if password != repass:  # Nếu mật khẩu nhập lại không giống
             flash("Mật khẩu nhập lại không khớp.", "danger")  # Báo lỗi
             return render_template("register.html")  # Render lại register
-        users = read_json(USERS_FILE, [])  # Đọc users.json
-        if any(u["username"].lower()==username.lower() for u in users):
+        if get_account(username) is not None:
             # Nếu đã có user trùng username
             flash("Tên tài khoản đã tồn tại.", "danger")  # Báo lỗi
             return render_template("register.html")  # Render lại register
-        users.append({
-            # Thêm object user mới vào list users
+        created = create_account({
             "username": username,  # Lưu username
             "email": email,  # Lưu email
-            "password_hash": hash_pw(password),  # Lưu mật khẩu dạng hash
+            "password_hash": run_pw_job(hash_pw, password),  # Lưu mật khẩu dạng hash (có salt)
             "shop_name": shop_name,  # Lưu tên shop
             "created_at": now_str()  # Lưu thời điểm tạo
         })
-        write_json(USERS_FILE, users)  # Ghi list users mới ra file users.json
+        if not created:  # Người khác vừa đăng ký cùng tên trong lúc băm mật khẩu
+            flash("Tên tài khoản đã tồn tại.", "danger")
+            return render_template("register.html")
         write_json(user_file(username, "manga.json"), [])  # Tạo file manga rỗng cho user mới
         write_json(user_file(username, "customers.json"), [])  # Tạo file customers rỗng
         write_json(user_file(username, "rentals.json"), [])  # Tạo file rentals rỗng
@@ -401,6 +2825,421 @@ def register():
         return redirect(url_for("manga_list"))  # Chuyển về danh sách truyện
     return render_template("register.html")  # Nếu GET -> hiển thị form register
 
+# ================== Ảnh bìa truyện ==================
+#
+# Ảnh gốc tải lên được lưu theo nội dung ở data/covers/<2 ký tự đầu>/<hash>, truyện chỉ giữ "cover" = hash.
+# Thread pool nền (Pillow) tạo thumbnail WebP + JPEG cho từng cỡ COVER_SIZES ra static/covers/<2 ký tự>/<hash>-<rộng>.<đuôi>.
+# Tên file chứa hash nội dung nên 1 URL không bao giờ đổi nội dung -> trả Cache-Control immutable 1 năm; cùng 1 ảnh
+# dùng cho nhiều truyện/cửa hàng chỉ lưu và xử lý 1 lần. Pillow là tùy chọn: chưa cài thì không nhận ảnh bìa.
+# Ảnh gốc được sao lưu cùng snapshot (covers/ trong "flask backup"); ảnh không còn truyện nào ở mọi cửa hàng trỏ tới
+# (truyện đã xóa được dọn ở nền, hoặc đổi/bỏ ảnh bìa) bị xóa cả gốc lẫn thumbnail bởi release_covers.
+
+COVER_SIZES = (160, 480)  # Chiều rộng thumbnail: ô trong danh sách / xem lớn
+COVER_FORMATS = (("webp", "WEBP"), ("jpg", "JPEG"))
+COVER_MAX_BYTES = int(os.environ.get("COVER_MAX_BYTES", str(8 * 1024 * 1024)))  # Giới hạn dung lượng ảnh tải lên
+COVER_MAX_PIXELS = 40_000_000  # Chặn ảnh "bom giải nén"
+COVER_THREADS = int(os.environ.get("COVER_THREADS", "2"))  # Số ảnh xử lý song song mỗi process
+COVER_STATIC_DIR = "covers"  # Thư mục con trong static/
+COVER_GC_GRACE_SEC = 3600  # Ảnh vừa tải lên / vừa dùng lại chưa bị xóa (request khác có thể sắp lưu truyện trỏ tới)
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+def _pil():
+    # Nạp Pillow khi cần (không làm chậm khởi động); None nếu chưa cài
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+    return Image, ImageOps
+
+def cover_src_path(h):
+    return os.path.join(DATA_DIR, "covers", h[:2], h)
+
+def cover_thumb_name(h, width, ext):
+    # Đường dẫn trong static/ (dùng cho url_for("static", filename=...))
+    return f"{COVER_STATIC_DIR}/{h[:2]}/{h}-{width}.{ext}"
+
+def _cover_thumb_path(h, width, ext):
+    return os.path.join(app.static_folder, cover_thumb_name(h, width, ext))
+
+_cover_pool = {"pid": None, "executor": None}
+_cover_pool_guard = threading.Lock()
+_cover_ready = set()  # hash đã có đủ thumbnail (nhớ trong process, khỏi stat lại)
+_cover_pending = set()  # hash đang chờ/đang xử lý trong pool
+
+def save_cover(upload):
+    """
+    Nhận ảnh bìa từ form: kiểm tra đúng là ảnh (chỉ đọc header, chưa giải mã), lưu bản gốc theo hash nội dung rồi
+    xếp việc tạo thumbnail vào pool nền. Trả hash; ảnh không hợp lệ -> ValueError kèm thông báo cho người dùng.
+    """
+    pil = _pil()
+    if pil is None:
+        raise ValueError("Máy chủ chưa cài Pillow nên chưa nhận ảnh bìa.")
+    data = upload.read(COVER_MAX_BYTES + 1)
+    if len(data) > COVER_MAX_BYTES:
+        raise ValueError(f"Ảnh bìa quá lớn (tối đa {COVER_MAX_BYTES // (1024 * 1024)} MB).")
+    try:
+        with pil[0].open(BytesIO(data)) as im:
+            w, h = im.size
+            im.verify()
+    except Exception:
+        raise ValueError("File tải lên không phải ảnh hợp lệ.")
+    if w * h > COVER_MAX_PIXELS:
+        raise ValueError("Ảnh bìa có quá nhiều điểm ảnh.")
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    path = cover_src_path(digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = os.path.join(os.path.dirname(path), f".tmp-{digest}-{os.getpid()}-{threading.get_ident()}")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    else:
+        os.utime(path)  # Dùng lại ảnh đã có: tính lại thời gian chờ trước khi release_covers được xóa
+    queue_cover(digest)
+    return digest
+
+def queue_cover(h):
+    # Xếp việc tạo thumbnail (mỗi hash tối đa 1 việc đang chờ; pool tạo lại sau fork)
+    if cover_ready(h):
+        return
+    with _cover_pool_guard:
+        if _cover_pool["pid"] != os.getpid():
+            _cover_pool.update(pid=os.getpid(), executor=ThreadPoolExecutor(COVER_THREADS, thread_name_prefix="cover"))
+            _cover_pending.clear()
+        if h in _cover_pending:
+            return
+        _cover_pending.add(h)
+        executor = _cover_pool["executor"]
+    executor.submit(_make_cover_thumbs, h)
+
+def _make_cover_thumbs(h):
+    # Chạy trong pool: tạo các cỡ/định dạng còn thiếu (ghi file tạm rồi đổi tên, request không gặp file dở)
+    try:
+        Image, ImageOps = _pil()
+        with Image.open(cover_src_path(h)) as im:
+            im = ImageOps.exif_transpose(im).convert("RGB")  # Ảnh chụp điện thoại: xoay theo EXIF
+            for width in COVER_SIZES:
+                thumb = im.copy()
+                thumb.thumbnail((width, width * 2), Image.LANCZOS)  # Giữ tỉ lệ, không phóng to ảnh nhỏ
+                for ext, fmt in COVER_FORMATS:
+                    path = _cover_thumb_path(h, width, ext)
+                    if os.path.exists(path):
+                        continue
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    tmp = os.path.join(os.path.dirname(path), f".tmp-{os.path.basename(path)}-{os.getpid()}")
+                    opts = {"method": 4} if fmt == "WEBP" else {"optimize": True, "progressive": True}
+                    thumb.save(tmp, fmt, quality=80, **opts)
+                    os.replace(tmp, path)
+        _cover_ready.add(h)
+    except Exception:
+        app.logger.exception("Tạo thumbnail ảnh bìa %s lỗi", h)
+    finally:
+        with _cover_pool_guard:
+            _cover_pending.discard(h)
+
+def cover_ready(h):
+    if h in _cover_ready:
+        return True
+    if all(os.path.exists(_cover_thumb_path(h, w, ext)) for w in COVER_SIZES for ext, _ in COVER_FORMATS):
+        _cover_ready.add(h)
+        return True
+    return False
+
+def cover_thumbs(h):
+    """
+    Cho template: {"src": ảnh JPEG nhỏ, "webp": srcset WebP, "jpg": srcset JPEG, "large": WebP lớn} nếu đã có
+    thumbnail, không thì None (còn ảnh gốc mà chưa có thumbnail, ví dụ process cũ dừng giữa chừng -> xếp việc lại).
+    """
+    if not h:
+        return None
+    if not cover_ready(h):
+        if os.path.exists(cover_src_path(h)) and _pil() is not None:
+            queue_cover(h)
+        return None
+
+    def url(width, ext):
+        return url_for("static", filename=cover_thumb_name(h, width, ext))
+    return {
+        "src": url(COVER_SIZES[0], "jpg"),
+        "webp": ", ".join(f"{url(w, 'webp')} {w}w" for w in COVER_SIZES),
+        "jpg": ", ".join(f"{url(w, 'jpg')} {w}w" for w in COVER_SIZES),
+        "large": url(COVER_SIZES[-1], "webp"),
+    }
+
+app.jinja_env.globals.update(cover_thumbs=cover_thumbs)
+
+def release_covers(hashes):
+    """
+    Xóa ảnh gốc + thumbnail của các hash không còn truyện nào (ở mọi cửa hàng) trỏ tới. Ảnh gốc sửa đổi trong
+    COVER_GC_GRACE_SEC gần nhất thì để lại. Gọi ngoài tenant_lock (đọc danh mục mọi cửa hàng). Trả số ảnh đã xóa.
+    """
+    hashes = {h for h in hashes if h}
+    for username in list_tenants():
+        if not hashes:
+            return 0
+        hashes -= {m.get("cover") for m in shared_models(username, "manga")}
+    removed = 0
+    for h in sorted(hashes):
+        src = cover_src_path(h)
+        try:
+            if time.time() - os.stat(src).st_mtime < COVER_GC_GRACE_SEC:
+                continue
+            os.remove(src)
+        except FileNotFoundError:
+            pass  # Chỉ còn thumbnail (ảnh gốc đã xóa / chưa khôi phục)
+        for width in COVER_SIZES:
+            for ext, _ in COVER_FORMATS:
+                try:
+                    os.remove(_cover_thumb_path(h, width, ext))
+                except FileNotFoundError:
+                    pass
+        _cover_ready.discard(h)
+        removed += 1
+    return removed
+
+@app.after_request
+def immutable_static_cache(resp):
+    # File tĩnh có hash nội dung trong tên không bao giờ đổi -> trình duyệt giữ 1 năm, không hỏi lại server
+    if request.endpoint == "static" and resp.status_code == 200 \
+            and (request.view_args or {}).get("filename", "").startswith((COVER_STATIC_DIR + "/", ASSET_DIST + "/")):
+        resp.headers["Cache-Control"] = f"public, max-age={STATIC_IMMUTABLE_MAX_AGE}, immutable"
+    return resp
+
+def apply_cover_upload(mg):
+    # Ảnh bìa trong form thêm/sửa truyện: tải ảnh mới hoặc tick bỏ ảnh cũ
+    upload = request.files.get("cover")
+    if upload and upload.filename:
+        try:
+            mg.update({"cover": save_cover(upload)})
+        except ValueError as e:
+            flash(str(e), "warning")
+    elif request.form.get("remove_cover") and mg.get("cover"):
+        mg.extra = {k: v for k, v in mg.extra.items() if k != "cover"} or None
+
+# ================== Tài nguyên tĩnh & nén response ==================
+#
+# Bootstrap, Chart.js, html5-qrcode được tự host trong static/vendor/ (bản cố định ở VENDOR_ASSETS) thay vì
+# tải từ CDN mỗi trang; CSS chung nằm ở static/css/app.css thay vì <style> trong base.html.
+# "flask build-assets" (chạy lúc build) tải file vendor còn thiếu, chép mọi file ở ASSET_DIRS sang
+# static/dist/ với hash nội dung trong tên (+ bản .gz/.br nén sẵn) và ghi manifest.json. Template gọi
+# asset_url("css/app.css"): có manifest -> URL dist (cache immutable 1 năm), chưa build -> file gốc, file
+# vendor chưa tải -> CDN cũ. Trang HTML / JSON được nén gzip khi trình duyệt nhận, kể cả trang stream.
+# sha256 của từng file vendor được ghim trong VENDOR_PINS_FILE (dạng sha256sum, commit cùng mã nguồn): file tải về
+# sai hash thì không được ghi, và build-assets dừng với mã lỗi khi file vendor thiếu / chưa ghim / sai hash.
+# Nâng phiên bản: sửa URL, kiểm tra file rồi chạy "flask build-assets --pin" để ghi lại hash.
+
+VENDOR_ASSETS = {  # Tên file trong static/ -> URL tải (ghim phiên bản)
+    "vendor/bootstrap.min.css": "https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css",
+    "vendor/bootstrap.bundle.min.js": "https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/js/bootstrap.bundle.min.js",
+    "vendor/chart.umd.js": "https://cdn.jsdelivr.net/npm/chart.js@4.4.1/dist/chart.umd.js",
+    "vendor/html5-qrcode.min.js": "https://unpkg.com/html5-qrcode@2.3.8/html5-qrcode.min.js",
+}
+VENDOR_PINS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vendor-assets.sha256")
+ASSET_DIRS = ("css", "js", "img", "vendor")  # Thư mục trong static/ được build-assets đánh hash
+ASSET_DIST = "dist"  # static/dist/: file đã đánh hash + manifest.json
+ASSET_COMPRESS_EXT = (".css", ".js", ".svg", ".json", ".map", ".txt")  # Chỉ nén sẵn file dạng chữ
+COMPRESS_TYPES = ("text/html", "application/json")  # Response động được nén
+COMPRESS_MIN_BYTES = 1024  # Nhỏ hơn thì nén không đáng
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", "6"))  # gzip 1-9 cho response động (build-assets luôn dùng 9)
+
+def _static_path(name):
+    return os.path.join(app.static_folder, *name.split("/"))
+
+_asset_manifest = {"sig": None, "map": {}}
+
+def asset_manifest():
+    # manifest.json của lần build gần nhất (đọc lại khi file đổi); chưa build -> {}
+    path = _static_path(f"{ASSET_DIST}/manifest.json")
+    sig = _file_sig(path)
+    if sig != _asset_manifest["sig"]:
+        _asset_manifest["map"] = read_json(path, {}) if sig else {}
+        _asset_manifest["sig"] = sig
+    return _asset_manifest["map"]
+
+def asset_url(name):
+    """URL của file tĩnh: bản đánh hash nếu đã build, file gốc nếu chưa, CDN nếu file vendor chưa được tải."""
+    built = asset_manifest().get(name)
+    if built:
+        return url_for("static", filename=built)
+    if name in VENDOR_ASSETS and not os.path.exists(_static_path(name)):
+        return VENDOR_ASSETS[name]
+    return url_for("static", filename=name)
+
+app.jinja_env.globals.update(asset_url=asset_url)
+
+@app.before_request
+def serve_precompressed_asset():
+    # static/dist/...: trả luôn bản .br/.gz đã nén lúc build nếu trình duyệt nhận, không nén lại mỗi lần
+    if request.endpoint != "static":
+        return None
+    filename = (request.view_args or {}).get("filename", "")
+    if not filename.startswith(ASSET_DIST + "/"):
+        return None
+    for enc, ext in (("br", ".br"), ("gzip", ".gz")):
+        path = _static_path(filename) + ext
+        if request.accept_encodings.quality(enc) > 0 and os.path.isfile(path):
+            resp = send_file(path, mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+                             conditional=True, etag=True)
+            resp.headers["Content-Encoding"] = enc
+            resp.vary.add("Accept-Encoding")
+            return resp
+    return None
+
+def _gzip_stream(chunks, level):
+    # Nén từng phần của trang stream: flush sau mỗi phần để trình duyệt vẫn nhận dần như trước
+    z = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        data = z.compress(chunk) + z.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield z.flush()
+
+@app.after_request
+def compress_response(resp):
+    # Chỉ đụng tới body (các hook after_request khác chỉ sửa header) nên thứ tự đăng ký không quan trọng
+    if resp.status_code != 200 or resp.direct_passthrough or "Content-Encoding" in resp.headers \
+            or resp.mimetype not in COMPRESS_TYPES or request.method == "HEAD":
+        return resp
+    resp.vary.add("Accept-Encoding")
+    if request.accept_encodings.quality("gzip") <= 0:
+        return resp
+    if resp.is_streamed:
+        resp.response = _gzip_stream(resp.response, COMPRESS_LEVEL)
+        resp.headers.pop("Content-Length", None)
+    else:
+        body = resp.get_data()
+        if len(body) < COMPRESS_MIN_BYTES:
+            return resp
+        resp.set_data(gzip.compress(body, COMPRESS_LEVEL))
+    resp.headers["Content-Encoding"] = "gzip"
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(etag, weak=True)  # Byte đã khác bản gốc
+    return resp
+
+def _sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def vendor_pins():
+    # Tên file vendor -> sha256 đã ghim; chưa có file ghim -> {}
+    pins = {}
+    try:
+        with open(VENDOR_PINS_FILE, encoding="utf-8") as f:
+            for line in f:
+                digest, _, name = line.strip().partition("  ")
+                if name:
+                    pins[name] = digest
+    except FileNotFoundError:
+        pass
+    return pins
+
+def write_vendor_pins():
+    # Ghim sha256 của các file vendor đang có trong static/ (chạy tay sau khi đã kiểm tra file); trả số file đã ghim
+    pins = {name: _sha256_file(_static_path(name)) for name in VENDOR_ASSETS if os.path.exists(_static_path(name))}
+    with open(VENDOR_PINS_FILE, "w", encoding="utf-8") as f:
+        f.writelines(f"{digest}  {name}\n" for name, digest in sorted(pins.items()))
+    return len(pins)
+
+def _fetch_vendor(name, url, sha256=None):
+    # Tải 1 file vendor (chỉ chạy lúc build); lỗi mạng / sai hash đã ghim -> False và không ghi file
+    path = _static_path(name)
+    try:
+        with urllib.request.urlopen(url, timeout=30) as r:
+            data = r.read()
+    except (OSError, ValueError) as e:
+        print(f"  ! Không tải được {name} từ {url}: {e}")
+        return False
+    if sha256 is not None and hashlib.sha256(data).hexdigest() != sha256:
+        print(f"  ! {name} tải từ {url} không khớp sha256 đã ghim")
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp-{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return True
+
+def vendor_problems(allow_missing=False):
+    # Các file vendor không dùng được: [(tên, lý do)] (thiếu, chưa ghim sha256, sai sha256 đã ghim)
+    pins = vendor_pins()
+    out = []
+    for name in VENDOR_ASSETS:
+        path = _static_path(name)
+        if not os.path.exists(path):
+            if not allow_missing:
+                out.append((name, "chưa tải được"))
+        elif name not in pins:
+            out.append((name, "chưa ghim sha256"))
+        elif _sha256_file(path) != pins[name]:
+            out.append((name, "không khớp sha256 đã ghim"))
+    return out
+
+def fetch_vendor_assets(verify=True):
+    # Tải các file vendor còn thiếu; verify=False chỉ dùng khi ghim lại hash (build-assets --pin)
+    pins = vendor_pins() if verify else {}
+    for name, url in VENDOR_ASSETS.items():
+        if not os.path.exists(_static_path(name)):
+            _fetch_vendor(name, url, pins.get(name))
+
+def build_assets(fetch=True):
+    """Dựng lại static/dist/: file đánh hash nội dung + bản nén sẵn + manifest.json. Trả về manifest."""
+    if fetch:
+        fetch_vendor_assets()
+    dist = _static_path(ASSET_DIST)
+    shutil.rmtree(dist, ignore_errors=True)
+    manifest = {}
+    for top in ASSET_DIRS:
+        root = _static_path(top)
+        for dirpath, _, files in os.walk(root):
+            for fn in sorted(files):
+                if ".tmp-" in fn:
+                    continue
+                src = os.path.join(dirpath, fn)
+                name = os.path.relpath(src, app.static_folder).replace(os.sep, "/")
+                with open(src, "rb") as f:
+                    data = f.read()
+                stem, ext = os.path.splitext(name)
+                built = f"{ASSET_DIST}/{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}"
+                out = _static_path(built)
+                os.makedirs(os.path.dirname(out), exist_ok=True)
+                with open(out, "wb") as f:
+                    f.write(data)
+                if ext.lower() in ASSET_COMPRESS_EXT and len(data) >= COMPRESS_MIN_BYTES:
+                    with open(out + ".gz", "wb") as f:
+                        f.write(gzip.compress(data, 9, mtime=0))
+                    if brotli is not None:
+                        with open(out + ".br", "wb") as f:
+                            f.write(brotli.compress(data, quality=11))
+                manifest[name] = built
+    write_json(os.path.join(dist, "manifest.json"), manifest)
+    return manifest
+
+@app.cli.command("build-assets")
+@click.option("--no-fetch", is_flag=True, help="Không tải file vendor còn thiếu (dùng CDN cho file đó).")
+@click.option("--pin", is_flag=True, help="Ghim lại sha256 của các file vendor đang có (sau khi nâng phiên bản).")
+def build_assets_command(no_fetch, pin):
+    """Tải thư viện front-end, đánh hash + nén sẵn file tĩnh vào static/dist (chạy lúc build)."""
+    if not no_fetch:
+        fetch_vendor_assets(verify=not pin)
+    if pin:
+        print(f"Đã ghim sha256 của {write_vendor_pins()} file vendor vào {os.path.basename(VENDOR_PINS_FILE)}")
+    problems = vendor_problems(allow_missing=no_fetch)
+    if problems:
+        raise click.ClickException("File vendor không dùng được: "
+                                   + "; ".join(f"{name} ({why})" for name, why in problems))
+    manifest = build_assets(fetch=False)
+    missing = [n for n in VENDOR_ASSETS if n not in manifest]
+    print(f"Đã dựng {len(manifest)} file tĩnh vào static/{ASSET_DIST}"
+          f" (nén .br: {'có' if brotli is not None else 'không, chưa cài brotli'})")
+    if missing:
+        print(f"Chưa có (trang vẫn tải từ CDN): {', '.join(missing)}")
+
 # ================== Quản lý Truyện ==================  # Khu CRUD truyện
 
 @app.route("/manga", methods=["GET"])
@@ -411,20 +3250,23 @@ def manga_list():
 
     q = (request.args.get("q") or "").strip().lower()
     # Lấy query tìm kiếm từ URL ?q=..., nếu None thì dùng "", rồi lower để so sánh
+    genre_id = request.args.get("genre", type=int)  # Lọc theo id thể loại (?genre=3)
 
     username = get_current_username()  # Lấy username hiện tại
-    items = read_json(user_file(username, "manga.json"), [])
-    # Đọc danh sách truyện của user từ manga.json
+    items = list(shared_models(username, "manga"))
+    # Danh sách truyện (Manga) dùng chung, chỉ đọc (list mới để sắp xếp, không sao chép từng truyện)
+    genres = sorted(read_coll(username, "genres"), key=lambda gnr: (-int(gnr.get("rentals", 0)), gnr["name"]))
+    # Danh mục thể loại (thuê nhiều lên trước) cho ô lọc + gợi ý nhập
 
-    items.sort(key=lambda x: x.get("created_at", ""), reverse=True)
+    items.sort(key=lambda x: x.created_at, reverse=True)
     # Sắp xếp truyện theo ngày tạo giảm dần (mới nhất trước)
 
     if q:  # Nếu có từ khóa tìm kiếm
         def match_item(m):
-            title = (m.get("title") or "").lower()
-            author = (m.get("author") or "").lower()
-            genre = (m.get("genre") or "").lower()
-            barcode = (m.get("barcode") or "").lower()
+            title = m.title.lower()
+            author = m.author.lower()
+            genre = m.genre.lower()
+            barcode = m.barcode.lower()
             # Cho phép:
             #  - gõ tên / tác giả / thể loại: chỉ cần chứa q
             #  - quét mã vạch: chuỗi q phải trùng đúng barcode
@@ -438,39 +3280,54 @@ def manga_list():
         items = [m for m in items if match_item(m)]
         # Lọc truyện khớp với từ khóa / mã vạch
 
+    if genre_id is not None and genre_id >= 0:
+        bit = 1 << genre_id
+        items = [m for m in items if m.genre_mask & bit]
+        # Lọc theo thể loại bằng bit trong genre_mask
+
     unread_count = count_unread_notifications(username)
     # Đếm số noti chưa đọc để hiển thị badge
 
-    return render_template("manga_list.html", items=items, q=q, unread_count=unread_count)
-    # Render trang manga_list.html và truyền biến items, q, unread_count
+    return render_template(
+        "manga_list.html", items=items, q=q, unread_count=unread_count,
+        genres=genres, genre_id=genre_id,
+    )
+    # Render trang manga_list.html và truyền biến items, q, unread_count, danh mục thể loại
 
 @app.route("/manga/add", methods=["POST"])
 def manga_add():
     # Route thêm truyện mới (POST từ form)
     if require_login(): return require_login()  # Chặn nếu chưa login
     username = get_current_username()  # Lấy username
-    items = read_json(user_file(username, "manga.json"), [])  # Đọc list truyện hiện có
-    payload = {
-        # Tạo object truyện mới từ form
-        "id": (request.form.get("id") or "").strip(),          # ID truyện
-        "title": (request.form.get("title") or "").strip(),    # Tên truyện
-        "genre": (request.form.get("genre") or "").strip(),    # Thể loại
-        "author": (request.form.get("author") or "").strip(),  # Tác giả
-        "rent_price": format_price(request.form.get("rent_price") or "0"),  # Giá thuê chuẩn hóa
-        "condition": (request.form.get("condition") or "Mới").strip(),      # Tình trạng (mặc định "Mới")
-        "stock": int(request.form.get("stock") or "0"),        # Tồn kho ép int
-        "barcode": (request.form.get("barcode") or "").strip(),  # Mã vạch gắn với truyện
-        "created_at": now_str(),                               # Ngày tạo
-        "updated_at": now_str()                                # Ngày cập nhật
-    }
-    if any(x["id"]==payload["id"] for x in items):
+    items = read_models(username, "manga")  # Đọc list truyện hiện có
+    payload = Manga.from_dict({
+        # Tạo truyện mới từ form (from_dict ép giá thuê/tồn kho về số nguyên)
+        "id": request.form.get("id"),                  # ID truyện
+        "title": request.form.get("title"),            # Tên truyện
+        "genre": request.form.get("genre"),            # Thể loại
+        "author": request.form.get("author"),          # Tác giả
+        "rent_price": request.form.get("rent_price"),  # Giá thuê (số nguyên VND)
+        "condition": request.form.get("condition"),    # Tình trạng (mặc định "Mới")
+        "stock": request.form.get("stock"),            # Tồn kho
+        "barcode": request.form.get("barcode"),        # Mã vạch gắn với truyện
+        "created_at": now_str(),                       # Ngày tạo
+        "updated_at": now_str(),                       # Ngày cập nhật
+    })
+    if any(x.id == payload.id for x in items):
         # Nếu ID mới trùng với ID cũ
         flash("ID truyện đã tồn tại.", "danger")  # Báo lỗi
+    elif payload.id in tombstones(username)["manga"]:
+        # Truyện cùng ID vừa bị xóa, lịch sử chưa dọn xong -> chưa cho dùng lại
+        flash("ID truyện vừa bị xóa, đang chờ dọn lịch sử. Vui lòng thử lại sau.", "danger")
     else:
         # Nếu không trùng
+        set_manga_genres(username, payload)  # Tách thể loại 1 lần -> genre_ids + genre_mask
+        apply_cover_upload(payload)  # Ảnh bìa (thumbnail tạo ở nền)
+        payload.rev = next_catalog_rev(username)  # Phiên bản danh mục cho máy quét
         items.append(payload)  # Thêm truyện mới vào list
-        write_json(user_file(username, "manga.json"), items)  # Ghi list ra file
-        log_low_stock(username, payload["id"])  # Kiểm tra stock thấp để tạo noti
+        write_models(username, "manga", items)  # Ghi list ra file
+        sync_copies(username, payload)  # Tạo sẵn từng cuốn (mã dán) theo tồn kho
+        log_low_stock(username, payload.id)  # Kiểm tra stock thấp để tạo noti
         flash("Đã thêm truyện.", "success")  # Báo thành công
     return redirect(url_for("manga_list"))  # Quay lại danh sách truyện
 
@@ -479,71 +3336,63 @@ def manga_update(mid):
     # Route cập nhật truyện theo ID mid
     if require_login(): return require_login()  # Chặn nếu chưa login
     username = get_current_username()  # Lấy username
-    items = read_json(user_file(username, "manga.json"), [])  # Đọc list truyện
+    items = read_models(username, "manga")  # Đọc list truyện
     updated_obj = None  # Khởi tạo biến lưu truyện vừa sửa
     for x in items:  # Duyệt từng truyện
-        if x["id"] == mid:  # Nếu đúng truyện cần sửa
-            x["title"] = (request.form.get("title") or "").strip()   # Cập nhật tên
-            x["genre"] = (request.form.get("genre") or "").strip()   # Cập nhật thể loại
-            x["author"] = (request.form.get("author") or "").strip() # Cập nhật tác giả
-            x["rent_price"] = format_price(request.form.get("rent_price") or "0")  # Cập nhật giá thuê
-            x["condition"] = (request.form.get("condition") or "Mới").strip()      # Cập nhật tình trạng
-            x["stock"] = int(request.form.get("stock") or "0")       # Cập nhật tồn kho
-            x["barcode"] = (request.form.get("barcode") or "").strip()  # Cập nhật / thay mã vạch
-            x["updated_at"] = now_str()  # Cập nhật thời gian sửa
+        if x.id == mid:  # Nếu đúng truyện cần sửa
+            x.update({  # Gán các trường từ form (ép kiểu giá thuê/tồn kho như lúc đọc file)
+                "title": request.form.get("title"),            # Cập nhật tên
+                "genre": request.form.get("genre"),            # Cập nhật thể loại
+                "author": request.form.get("author"),          # Cập nhật tác giả
+                "rent_price": request.form.get("rent_price"),  # Cập nhật giá thuê (VND)
+                "condition": request.form.get("condition"),    # Cập nhật tình trạng
+                "stock": request.form.get("stock"),            # Cập nhật tồn kho
+                "barcode": request.form.get("barcode"),        # Cập nhật / thay mã vạch
+                "updated_at": now_str(),                       # Cập nhật thời gian sửa
+            })
+            set_manga_genres(username, x)  # Tách lại thể loại -> genre_ids + genre_mask
+            old_cover = x.get("cover")
+            apply_cover_upload(x)  # Đổi / bỏ ảnh bìa
+            if old_cover and x.get("cover") != old_cover:
+                on_commit(username, lambda: release_covers([old_cover]), locked=False)  # Ảnh cũ không ai dùng thì xóa
+            x.rev = next_catalog_rev(username)  # Phiên bản danh mục cho máy quét
             updated_obj = x  # Lưu object vừa sửa
             break  # Thoát vòng lặp
-    write_json(user_file(username, "manga.json"), items)  # Ghi list truyện mới
+    write_models(username, "manga", items)  # Ghi list truyện mới
     if updated_obj:
         # Nếu có truyện được sửa thật
         propagate_manga_changes(username, updated_obj)  # Đồng bộ tên vào rentals
-        log_low_stock(username, updated_obj["id"])  # Kiểm tra tồn kho thấp
+        sync_copies(username, updated_obj)  # Sửa tồn kho = thêm/bớt cuốn trên kệ
+        log_low_stock(username, updated_obj.id)  # Kiểm tra tồn kho thấp
+        fill_holds(username, updated_obj.id)  # Thêm tồn kho -> phục vụ hàng chờ
     flash("Đã cập nhật truyện.", "success")  # Thông báo thành công
     return redirect(url_for("manga_list"))  # Quay lại danh sách
 
 @app.route("/manga/delete/<mid>", methods=["POST"])
 def manga_delete(mid):
-    # Route xóa truyện theo ID mid
+    # Route xóa truyện theo ID mid (xóa mềm: lịch sử + thông báo được tác vụ nền dọn sau, xem purge_tombstones)
     if require_login():
-        return require_login()  # Chặn nếu chưa login
+        return require_login()
 
     username = get_current_username()  # Lấy username
 
-    # 1) Kiểm tra còn giao dịch chưa trả với truyện này không
-    rentals = read_json(user_file(username, "rentals.json"), [])  # Đọc lịch sử thuê
-    if any(r["manga_id"] == mid and not r.get("returned_at") for r in rentals):
-        # Nếu còn giao dịch chưa trả của truyện này
-        flash("còn người chưa trả truyện", "danger")  # Báo lỗi không cho xóa
-        return redirect(url_for("manga_list"))  # Quay lại danh sách
-
-    # 2) Xóa các rental liên quan đến truyện này
-    rentals = [r for r in rentals if r["manga_id"] != mid]
-    write_json(user_file(username, "rentals.json"), rentals)
-
-    # 3) Xóa truyện trong manga.json
-    items = read_json(user_file(username, "manga.json"), [])
-    items = [x for x in items if x["id"] != mid]
-    write_json(user_file(username, "manga.json"), items)
-
-    # 4) Xóa các thông báo tồn kho thấp của truyện này
-    npath = user_file(username, "notifications.json")
-    notifs = read_json(npath, [])
-
-    def is_low_stock_of_deleted_manga(n):
-        # Chỉ xóa thông báo tồn kho thấp của truyện này
-        if n.get("type") != "LOW_STOCK":
-            return False
-        # Trường hợp mới: có lưu manga_id
-        if n.get("manga_id") == mid:
-            return True
-        # Trường hợp cũ: chưa có manga_id, thì dò trong message
-        msg = (n.get("message") or "")
-        return f"(ID {mid})" in msg
-
-    notifs = [n for n in notifs if not is_low_stock_of_deleted_manga(n)]
-    write_json(npath, notifs)
-
-    flash("Đã xóa truyện, lịch sử liên quan và thông báo tồn kho.", "success")
+    with tenant_lock(username):
+        # 1) Kiểm tra còn giao dịch chưa trả với truyện này không (giao dịch mở luôn nằm ở phần nóng)
+        rentals = shared_models(username, "rentals")  # Chỉ đọc
+        if any(r.manga_id == mid and not r.returned_at for r in rentals):
+            # Nếu còn giao dịch chưa trả của truyện này
+            flash("còn người chưa trả truyện", "danger")  # Báo lỗi không cho xóa
+            return redirect(url_for("manga_list"))  # Quay lại danh sách
+
+        # 2) Bỏ truyện khỏi manga.json (ghi nhận id đã xóa để máy quét đồng bộ delta) + ghi tombstone
+        items = read_models(username, "manga")
+        gone = next((x for x in items if x.id == mid), None)
+        if gone is not None:
+            record_catalog_delete(username, mid, items)
+            write_models(username, "manga", [x for x in items if x.id != mid])
+            add_tombstone(username, "manga", gone.to_dict())
+
+    flash("Đã xóa truyện. Lịch sử liên quan được ẩn và dọn dần ở nền.", "success")
     return redirect(url_for("manga_list"))
 
 # ================== Quản lý Khách hàng ==================  # Khu CRUD khách hàng
@@ -554,13 +3403,47 @@ def customers_list():
     if require_login(): return require_login()  # Chặn nếu chưa login
     q = (request.args.get("q") or "").strip().lower()  # Lấy từ khóa tìm kiếm
     username = get_current_username()  # Lấy username hiện tại
-    items = read_json(user_file(username, "customers.json"), [])  # Đọc list khách
-    items.sort(key=lambda x: x.get("created_at",""), reverse=True)  # Sắp xếp khách mới lên trước
+    items = read_models(username, "customers")  # Đọc list khách
+    items.sort(key=lambda x: x.created_at, reverse=True)  # Sắp xếp khách mới lên trước
     if q:  # Nếu có tìm kiếm
-        items = [c for c in items if q in c["name"].lower() or q in c["phone"].lower() or q in c["email"].lower() or q in c["id"].lower()]
+        items = [c for c in items if q in c.name.lower() or q in c.phone.lower() or q in c.email.lower() or q in c.id.lower()]
         # Lọc khách theo tên/sđt/email/id
+    # Lịch sử cho modal hồ sơ: chỉ mở các tháng lưu trữ có chứa khách đang hiển thị, gom sẵn theo khách
+    histories = {}
+    tomb = tombstones(username)
+    for r in load_rentals(username, customer_ids=[c.id for c in items], models=True):
+        if not rental_hidden(r, tomb):  # Bỏ giao dịch của truyện đã xóa
+            histories.setdefault(r.customer_id, []).append(r)
+    all_manga = shared_models(username, "manga")  # Chỉ đọc
+
+    # Gợi ý: truyện khách chưa thuê, có chung ít nhất 1 thể loại (AND genre_mask) với truyện đã thuê
+    mask_by_id = {m.id: m.genre_mask for m in all_manga}
+    suggestions = {}
+    for c in items:
+        history = histories.get(c.id, ())
+        fm = 0
+        for r in history:
+            fm |= mask_by_id.get(r.manga_id, 0)
+        if not fm:
+            continue
+        rented = {r.manga_id for r in history}
+        picks = []
+        for m in all_manga:
+            if m.genre_mask & fm and m.id not in rented:
+                picks.append(m)
+                if len(picks) == 5:
+                    break
+        suggestions[c.id] = picks
+
     unread_count = count_unread_notifications(username)  # Đếm thông báo chưa đọc
-    return render_template("customers_list.html", items=items, q=q, unread_count=unread_count)
+    return render_template(
+        "customers_list.html",
+        items=items,
+        q=q,
+        unread_count=unread_count,
+        histories=histories,
+        suggestions=suggestions,
+    )
     # Render trang customers_list.html
 
 @app.route("/customers/add", methods=["POST"])
@@ -568,26 +3451,29 @@ def customers_add():
     # Route thêm khách hàng mới
     if require_login(): return require_login()  # Chặn nếu chưa login
     username = get_current_username()  # Lấy user
-    items = read_json(user_file(username, "customers.json"), [])  # Đọc list khách
-    new = {
-        # Object khách mới
-        "id": (request.form.get("id") or "").strip(),  # ID khách
-        "name": (request.form.get("name") or "").strip(),  # Tên khách
-        "age": int(request.form.get("age") or "0"),  # Tuổi
-        "phone": (request.form.get("phone") or "").strip(),  # SĐT
-        "address": (request.form.get("address") or "").strip(),  # Địa chỉ
-        "national_id": (request.form.get("national_id") or "").strip(),  # CCCD
-        "email": (request.form.get("email") or "").strip(),  # Email
+    items = read_models(username, "customers")  # Đọc list khách
+    new = Customer.from_dict({
+        # Khách mới từ form (from_dict ép tuổi về số nguyên)
+        "id": request.form.get("id"),  # ID khách
+        "name": request.form.get("name"),  # Tên khách
+        "age": request.form.get("age"),  # Tuổi
+        "phone": request.form.get("phone"),  # SĐT
+        "address": request.form.get("address"),  # Địa chỉ
+        "national_id": request.form.get("national_id"),  # CCCD
+        "email": request.form.get("email"),  # Email
         "created_at": now_str(),  # Ngày tạo
-        "updated_at": now_str()  # Ngày sửa
-    }
-    if any(x["id"]==new["id"] for x in items):
+        "updated_at": now_str(),  # Ngày sửa
+    })
+    if any(x.id == new.id for x in items):
         # Nếu trùng ID khách
         flash("ID khách hàng đã tồn tại.", "danger")  # Báo lỗi
+    elif new.id in tombstones(username)["customers"]:
+        # Khách cùng ID vừa bị xóa, lịch sử chưa dọn xong -> chưa cho dùng lại
+        flash("ID khách hàng vừa bị xóa, đang chờ dọn lịch sử. Vui lòng thử lại sau.", "danger")
     else:
         # Nếu không trùng
         items.append(new)  # Thêm khách
-        write_json(user_file(username, "customers.json"), items)  # Ghi lại file
+        write_models(username, "customers", items)  # Ghi lại file
         flash("Đã thêm khách hàng.", "success")  # Báo thành công
     return redirect(url_for("customers_list"))  # Quay lại danh sách khách
 
@@ -596,20 +3482,22 @@ def customers_update(cid):
     # Route cập nhật khách theo ID cid
     if require_login(): return require_login()  # Chặn nếu chưa login
     username = get_current_username()  # Lấy user
-    items = read_json(user_file(username, "customers.json"), [])  # Đọc list khách
+    items = read_models(username, "customers")  # Đọc list khách
     updated_obj = None  # Biến lưu khách vừa sửa
     for x in items:  # Duyệt từng khách
-        if x["id"] == cid:  # Nếu đúng khách cần sửa
-            x["name"] = (request.form.get("name") or "").strip()  # Sửa tên
-            x["age"] = int(request.form.get("age") or "0")  # Sửa tuổi
-            x["phone"] = (request.form.get("phone") or "").strip()  # Sửa SĐT
-            x["address"] = (request.form.get("address") or "").strip()  # Sửa địa chỉ
-            x["national_id"] = (request.form.get("national_id") or "").strip()  # Sửa CCCD
-            x["email"] = (request.form.get("email") or "").strip()  # Sửa email
-            x["updated_at"] = now_str()  # Cập nhật thời gian sửa
+        if x.id == cid:  # Nếu đúng khách cần sửa
+            x.update({
+                "name": request.form.get("name"),  # Sửa tên
+                "age": request.form.get("age"),  # Sửa tuổi
+                "phone": request.form.get("phone"),  # Sửa SĐT
+                "address": request.form.get("address"),  # Sửa địa chỉ
+                "national_id": request.form.get("national_id"),  # Sửa CCCD
+                "email": request.form.get("email"),  # Sửa email
+                "updated_at": now_str(),  # Cập nhật thời gian sửa
+            })
             updated_obj = x  # Lưu khách vừa sửa
             break  # Thoát vòng lặp
-    write_json(user_file(username, "customers.json"), items)  # Ghi list khách mới
+    write_models(username, "customers", items)  # Ghi list khách mới
     if updated_obj:
         propagate_customer_changes(username, updated_obj)  # Đồng bộ tên khách trong rentals
     flash("Đã cập nhật khách hàng.", "success")  # Báo thành công
@@ -617,33 +3505,44 @@ def customers_update(cid):
 
 @app.route("/customers/delete/<cid>", methods=["POST"])
 def customers_delete(cid):
-    # Route xóa khách theo ID cid
+    # Route xóa khách theo ID cid (xóa mềm như manga_delete)
     if require_login(): return require_login()  # Chặn nếu chưa login
     username = get_current_username()  # Lấy user
-    rentals = read_json(user_file(username, "rentals.json"), [])  # Đọc rentals
-    if any(r["customer_id"]==cid and not r.get("returned_at") for r in rentals):
-        # Nếu khách còn giao dịch chưa trả
-        flash("khách hàng còn giao dịch chưa trả truyện", "danger")  # Báo lỗi
-        return redirect(url_for("customers_list"))  # Quay lại danh sách
-    rentals = [r for r in rentals if r["customer_id"] != cid]  # Xóa rentals liên quan khách này
-    write_json(user_file(username, "rentals.json"), rentals)  # Ghi lại rentals
-    items = read_json(user_file(username, "customers.json"), [])  # Đọc list khách
-    items = [x for x in items if x["id"] != cid]  # Loại bỏ khách cần xóa
-    write_json(user_file(username, "customers.json"), items)  # Ghi lại file
-    flash("Đã xóa khách hàng và lịch sử liên quan.", "success")  # Báo thành công
+    with tenant_lock(username):
+        rentals = shared_models(username, "rentals")  # Đọc rentals (phần nóng, chỉ đọc)
+        if any(r.customer_id == cid and not r.returned_at for r in rentals):
+            # Nếu khách còn giao dịch chưa trả
+            flash("khách hàng còn giao dịch chưa trả truyện", "danger")  # Báo lỗi
+            return redirect(url_for("customers_list"))  # Quay lại danh sách
+        items = read_models(username, "customers")  # Đọc list khách
+        gone = next((x for x in items if x.id == cid), None)
+        if gone is not None:
+            write_models(username, "customers", [x for x in items if x.id != cid])  # Loại bỏ khách cần xóa
+            add_tombstone(username, "customers", gone.to_dict())
+    flash("Đã xóa khách hàng. Lịch sử liên quan được ẩn và dọn dần ở nền.", "success")  # Báo thành công
     return redirect(url_for("customers_list"))  # Quay lại danh sách khách
 
 # ================== Thuê / Trả truyện ==================  # Khu xử lý giao dịch
 
 @app.route("/rentals")
 def rentals_list():
-    # Route hiển thị danh sách thuê/trả
+    # Route hiển thị danh sách thuê/trả (lọc theo khoảng ngày thuê, trạng thái, khách, truyện qua chỉ mục thời gian)
     if require_login(): 
         return require_login()  # Nếu chưa login thì redirect
-    q = (request.args.get("q") or "").strip().lower()  # Lấy từ khóa tìm kiếm giao dịch
     username = get_current_username()  # Lấy user hiện tại
-
-    rentals = read_json(user_file(username, "rentals.json"), [])  # Đọc list giao dịch thuê/trả
+    f, err = rental_query_args()  # from/to/status/customer/manga/q từ query string
+    if err:
+        flash(err, "warning")
+
+    show_archive = request.args.get("archive") == "1"  # ?archive=1 -> xem cả các tháng đã lưu trữ
+    # Mặc định chỉ phần nóng; chọn khoảng ngày thì lấy cả lưu trữ (chỉ mở các tháng chứa kết quả của trang)
+    pos, fr, _ = query_rentals(username, hot_only=not (show_archive or f["t0"] is not None or f["t1"] is not None),
+                               **{k: f[k] for k in ("t0", "t1", "status", "customer_id", "manga_id", "q")})
+    page = max(1, request.args.get("page", 1, type=int))
+    pages = max(1, -(-len(pos) // RENTALS_PAGE_SIZE))
+    page = min(page, pages)
+    rentals = rentals_at(username, fr, pos[(page - 1) * RENTALS_PAGE_SIZE:page * RENTALS_PAGE_SIZE])
+    # Đã sắp theo thời gian thuê thật (mới nhất trước), không theo chuỗi created_at
 
         # ===== TÍNH LẠI PHÍ TRỄ CHO CÁC GIAO DỊCH CHƯA TRẢ =====
     now = datetime.now()  # Lấy thời gian hiện tại để so với hạn trả
@@ -652,49 +3551,83 @@ def rentals_list():
     # Lấy phí trễ/ngày mặc định, nếu cfg thiếu thì 10000
 
     for r in rentals:
-        # Chỉ tính cho những giao dịch chưa trả
-        if not r.get("returned_at"):  # Nếu returned_at rỗng => chưa trả
-            try:
-                due = parse_dt(r["due_at"])  # Parse ngày đến hạn trả
-            except Exception:
-                # Nếu dữ liệu ngày bị lỗi thì bỏ qua để không crash
-                continue  # Bỏ qua rental lỗi format
-
-            days_late = (now - due).days  # Tính số ngày trễ: hiện tại - hạn trả
-            late_fee = 0  # Mặc định phí trễ = 0
-            if days_late > 0:
-                # Lấy phí trễ/ngày từ giao dịch, nếu không có thì dùng cấu hình hiện tại
-                per_day = r.get("late_fee_per_day", default_per_day)  # Ưu tiên phí lưu lúc tạo GD
-                try:
-                    per_day_int = int(per_day)  # Ép phí/ngày thành int
-                except Exception:
-                    per_day_int = default_per_day  # Nếu lỗi ép -> dùng mặc định
-
-                if per_day_int < 0:
-                    per_day_int = 0  # Không cho phí âm
+        if not r.returned_at:  # Chỉ tính cho những giao dịch chưa trả
+            r.late_fee = r.late_fee_at(now, default_per_day)
+            # Ưu tiên phí/ngày lưu lúc tạo giao dịch; chỉ sửa bản sao để hiển thị, không ghi file
+    # =======================================================
 
-                late_fee = days_late * per_day_int  # Phí trễ = số ngày trễ * phí/ngày
-
-            # Ghi lại vào object để hiển thị ra bảng
-            r["late_fee"] = format_price(str(late_fee))  # Lưu late_fee dạng "10.000"
-    # =======================================================
-
-    rentals.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-    # Sắp xếp giao dịch mới nhất lên trước
-    if q:
-        rentals = [
-            r for r in rentals
-            if q in r["manga_title"].lower() or q in r["customer_name"].lower()
-        ]
-        # Lọc giao dịch theo tên truyện hoặc tên khách chứa q
     unread_count = count_unread_notifications(username)  # Đếm noti chưa đọc
     return render_template(
         "rentals_list.html",
         rentals=rentals,
-        q=q,
+        q=f["q"],
+        filters=f,
+        filter_args=f["args"],  # Tham số lọc đang dùng (giữ lại khi bật/tắt lưu trữ, chuyển trang)
+        total=len(pos),
+        page=page,
+        pages=pages,
         unread_count=unread_count,
+        show_archive=show_archive,
+        customers=shared_models(username, "customers"),  # Cho datalist chọn khách (chỉ đọc)
+        manga=_manga_rows(username),  # Cho datalist chọn truyện (chỉ đọc)
     )
-    # Render rentals_list.html với list giao dịch + keyword + badge noti
+    # Render rentals_list.html với list giao dịch + bộ lọc + badge noti
+
+RENTALS_PAGE_SIZE = 100  # Số giao dịch mỗi trang /rentals
+RENTALS_API_MAX = 1000  # limit tối đa của /api/rentals
+
+def rental_query_args():
+    """
+    Đọc bộ lọc chung của /rentals và /api/rentals từ query string.
+    Trả (dict bộ lọc, thông báo lỗi hoặc None); ngày/trạng thái sai thì bỏ qua bộ lọc đó.
+    """
+    a = request.args
+    date_from = (a.get("from") or "").strip()
+    date_to = (a.get("to") or "").strip()
+    status = (a.get("status") or "").strip()
+    err = None
+    t0, t1 = range_bounds(date_from, date_to)
+    if (date_from and t0 is None) or (date_to and t1 is None):
+        err = "Ngày lọc phải có dạng DD-MM-YYYY."
+    if status and status not in RENTAL_STATUSES:
+        err, status = "Trạng thái phải là một trong: " + ", ".join(RENTAL_STATUSES) + ".", ""
+    f = {
+        "date_from": date_from, "date_to": date_to, "t0": t0, "t1": t1, "status": status,
+        "customer_id": (a.get("customer") or "").strip(),
+        "manga_id": (a.get("manga") or "").strip(),
+        "q": (a.get("q") or "").strip().lower(),
+    }
+    f["args"] = {k: v for k, v in (("q", f["q"]), ("from", date_from), ("to", date_to), ("status", status),
+                                   ("customer", f["customer_id"]), ("manga", f["manga_id"])) if v}
+    return f, err
+
+@app.route("/api/rentals")
+def api_rentals():
+    """
+    Giao dịch dạng JSON (gồm cả lưu trữ), mới nhất trước:
+      /api/rentals?from=01-11-2025&to=30-11-2025&status=overdue&customer=C1&manga=M1&q=naruto&limit=100&offset=0
+    status là 1 trong RENTAL_STATUSES; from/to lọc theo ngày thuê (DD-MM-YYYY hoặc DD-MM-YYYY HH:MM:SS).
+    """
+    if require_login():
+        return require_login()
+    f, err = rental_query_args()
+    if err:
+        return jsonify({"ok": False, "error": err}), 400
+
+    username = get_current_username()
+    limit = max(1, min(request.args.get("limit", RENTALS_PAGE_SIZE, type=int), RENTALS_API_MAX))
+    offset = max(0, request.args.get("offset", 0, type=int))
+    pos, fr, _ = query_rentals(username, **{k: f[k] for k in ("t0", "t1", "status", "customer_id", "manga_id", "q")})
+    rows = rentals_at(username, fr, pos[offset:offset + limit])
+    now = datetime.now()
+    default_per_day = int(read_shop_cfg(username).get("late_fee_per_day", 10000) or 10000)
+    items = []
+    for r in rows:
+        d = r.to_dict()
+        if not r.returned_at:
+            d["late_fee"] = r.late_fee_at(now, default_per_day)  # Phí trễ tính đến hiện tại
+        items.append(d)
+    return jsonify({"ok": True, "total": int(len(pos)), "offset": offset, "limit": limit, "items": items})
 
 @app.route("/api/manga-price")
 def api_manga_price():
@@ -706,23 +3639,24 @@ def api_manga_price():
     username = get_current_username()  # Lấy user
     manga_id = (request.args.get("manga_id") or "").strip()  # Lấy manga_id từ query string
 
-    items = read_json(user_file(username, "manga.json"), [])  # Đọc list truyện
-    mg = next((m for m in items if m.get("id") == manga_id), None)
+    mg = find_by_id(username, "manga", manga_id)
     # Tìm truyện có id = manga_id
 
     if not mg:
         return jsonify({"ok": False})  # Không tìm thấy truyện => trả ok False
 
-    return jsonify({"ok": True, "price": mg.get("rent_price", "0")})
+    return jsonify({"ok": True, "price": mg.rent_price})
     # Nếu thấy truyện => trả ok True + giá thuê
 
 @app.route("/api/manga-from-barcode")
 def api_manga_from_barcode():
     """
     API tìm truyện theo mã vạch để dùng khi quét trong form tạo giao dịch.
+    Mã dán trên từng cuốn được tra trước (chỉ mục dict), sau đó mới tới mã vạch in trên bìa truyện.
 
     Trả về:
       { "ok": True, "id": "...", "price": "..." } nếu tìm thấy
+      (+ "copy": {"id", "barcode", "condition", "status"} nếu là mã dán của 1 cuốn)
       { "ok": False } nếu không tìm thấy
     """
     if require_login():
@@ -734,13 +3668,19 @@ def api_manga_from_barcode():
     if not barcode:
         return jsonify({"ok": False})
 
-    items = read_json(user_file(username, "manga.json"), [])
+    cp = copy_index(username)["barcode"].get(barcode)
+    if cp is not None:
+        mg = find_by_id(username, "manga", cp["manga_id"])
+        if mg:
+            return jsonify({
+                "ok": True,
+                "id": mg.id,
+                "price": mg.rent_price,
+                "copy": {k: cp.get(k) for k in ("id", "barcode", "condition", "status")},
+            })
 
     # Tìm truyện có barcode trùng khớp
-    mg = next(
-        (m for m in items if (m.get("barcode") or "").strip() == barcode),
-        None,
-    )
+    mg = next((m for m in _manga_rows(username) if m.barcode == barcode), None)
 
     if not mg:
         return jsonify({"ok": False})
@@ -748,20 +3688,41 @@ def api_manga_from_barcode():
     return jsonify(
         {
             "ok": True,
-            "id": mg.get("id", ""),
-            "price": mg.get("rent_price", "0"),
+            "id": mg.id,
+            "price": mg.rent_price,
         }
     )
 
+@app.route("/api/catalog")
+def api_catalog():
+    """
+    Danh mục truyện gọn cho form thuê (tra mã vạch / giá ngay trên trình duyệt):
+      /api/catalog             -> {"version", "full": true, "fields", "items": [[id, barcode, title, price, stock], ...]}
+      /api/catalog?since=<v>   -> chỉ các truyện đổi sau v + "deleted": [id đã xóa]
+    Có ETag theo version: client gửi If-None-Match khi kiểm tra lại thì nhận 304 nếu không có gì mới.
+    """
+    if require_login():
+        return require_login()
+
+    username = get_current_username()
+    since = request.args.get("since", type=int)
+    etag = f'"catalog-{catalog_version(username)}"'
+    if since is not None and request.headers.get("If-None-Match") == etag:
+        return "", 304, {"ETag": etag}
+    data = catalog_payload(username, since)
+    resp = jsonify({"ok": True, **data})
+    resp.headers["ETag"] = f'"catalog-{data["version"]}"'
+    resp.headers["Cache-Control"] = "no-cache"  # Luôn kiểm tra lại, nhưng 304 thì không tải body
+    return resp
+
 @app.route("/rentals/create", methods=["POST"])
 def rentals_create():
     # Route tạo giao dịch thuê mới
     if require_login(): return require_login()  # Chặn nếu chưa login
     username = get_current_username()  # Lấy user
-    customers = read_json(user_file(username, "customers.json"), [])  # Đọc list khách
-    manga = read_json(user_file(username, "manga.json"), [])  # Đọc list truyện
     customer_id = (request.form.get("customer_id") or "").strip()  # Lấy id khách từ form
     manga_id = (request.form.get("manga_id") or "").strip()  # Lấy id truyện từ form
+    copy_barcode = (request.form.get("copy_barcode") or "").strip()  # Mã dán của cuốn vừa quét (nếu có)
         # Đọc cấu hình cửa hàng (số ngày thuê + phí trễ)
     shop_cfg = read_shop_cfg(username)  # Đọc shop config
     rent_days = int(shop_cfg.get("default_rent_days", 5) or 5)
@@ -769,45 +3730,63 @@ def rentals_create():
     if rent_days < 1:
         rent_days = 1  # Không cho số ngày thuê nhỏ hơn 1
 
-    rent_price = format_price(request.form.get("rent_price") or "0")  
+    rent_price = price_to_int(request.form.get("rent_price") or "0")  
     # Lấy giá thuê từ form và chuẩn hóa
     start_at = now_str()  # Thời điểm tạo giao dịch
     due_at = (datetime.now() + timedelta(days=rent_days)).strftime(DT_FMT)
     # Tính ngày đến hạn = hôm nay + rent_days
 
-    cust = next((c for c in customers if c["id"]==customer_id), None)
+    cust = find_by_id(username, "customers", customer_id)
     # Tìm khách đã chọn
-    mg = next((m for m in manga if m["id"]==manga_id), None)
+    if not copy_barcode and not find_by_id(username, "manga", manga_id):
+        copy_barcode = manga_id  # Máy quét gõ thẳng mã dán vào ô ID truyện
+    cp = copy_index(username)["barcode"].get(copy_barcode) if copy_barcode else None
+    if cp is not None:
+        manga_id = cp["manga_id"]  # Mã dán quyết định truyện (và đúng cuốn đó)
+    mg = find_by_id(username, "manga", manga_id)
     # Tìm truyện đã chọn
     if not cust or not mg:
         flash("Không tìm thấy khách hàng hoặc truyện.", "danger")  # Báo lỗi nếu thiếu
         return redirect(url_for("rentals_list"))  # Quay về list
-    if int(mg["stock"]) <= 0:
-        flash("Truyện đã hết hàng.", "danger")  # Báo hết hàng
+    if cp is not None and cp.get("status") != "available":
+        flash(f"Cuốn {cp['barcode']} đang được thuê, chưa trả.", "danger")
+        return redirect(url_for("rentals_list"))
+    wl = waitlist_index(username)
+    hold = next((e for e in wl["customer"].get(cust.id, ()) if e["manga_id"] == mg.id and e["status"] == "held"), None)
+    if hold is None and available_copies(mg, wl) <= 0:
+        # Hết hàng (hoặc cuốn còn lại đang giữ cho người khác) -> cho khách vào hàng chờ
+        _, pos = join_waitlist(username, mg.id, cust.id)
+        eta = waitlist_eta(username, mg.id, pos)
+        flash(f"Truyện đã hết hàng. Đã thêm {cust.name} vào hàng chờ (vị trí {pos}"
+              + (f", dự kiến có truyện từ {eta}" if eta else "") + ").", "warning")
         return redirect(url_for("rentals_list"))  # Quay về list
 
-    adjust_stock(username, manga_id, -1)  
-    # Trừ tồn kho đi 1 vì vừa cho thuê
-
-    rec = {
-        # Tạo object giao dịch thuê mới
-        "id": str(uuid.uuid4()),  # ID giao dịch duy nhất
-        "manga_id": mg["id"],  # ID truyện thuê
-        "manga_title": mg["title"],  # Tên truyện tại thời điểm thuê
-        "customer_id": cust["id"],  # ID khách thuê
-        "customer_name": cust["name"],  # Tên khách tại thời điểm thuê
-        "rent_price": rent_price,  # Giá thuê
-        "late_fee": "0",  # Phí trễ ban đầu là 0
-        # lưu phí trễ theo ngày tại thời điểm tạo giao dịch
-        "late_fee_per_day": int(shop_cfg.get("late_fee_per_day", 10000) or 0),
+    rec = Rental(
+        # Tạo giao dịch thuê mới
+        id=str(uuid.uuid4()),  # ID giao dịch duy nhất
+        manga_id=mg.id,  # ID truyện thuê
+        manga_title=mg.title,  # Tên truyện tại thời điểm thuê (dùng chung chuỗi đã intern)
+        customer_id=cust.id,  # ID khách thuê
+        customer_name=cust.name,  # Tên khách tại thời điểm thuê
+        rent_price=rent_price,  # Giá thuê
+        late_fee=0,  # Phí trễ ban đầu là 0
         # Lưu phí trễ/ngày tại thời điểm tạo để sau này cfg đổi vẫn giữ đúng
-        "created_at": start_at,  # Ngày thuê
-        "due_at": due_at,  # Ngày đến hạn
-        "returned_at": "",  # Chưa trả nên rỗng
-    }
-    rentals = read_json(user_file(username, "rentals.json"), [])  # Đọc list rentals cũ
-    rentals.append(rec)  # Thêm giao dịch mới
-    write_json(user_file(username, "rentals.json"), rentals)  # Ghi list rentals mới
+        late_fee_per_day=max(0, int(shop_cfg.get("late_fee_per_day", 10000) or 0)),
+        created_at=start_at,  # Ngày thuê
+        due_at=due_at,  # Ngày đến hạn
+        returned_at="",  # Chưa trả nên rỗng
+    )
+    with leaderboard_events(username) as events:  # Cập nhật bảng xếp hạng trong bộ nhớ
+        with journal_batch(username):  # journal_mode: trừ kho + thêm giao dịch = 1 bản ghi journal
+            taken = checkout_copy(username, mg.id, rec.id, cp and cp["id"])  # Cuốn cụ thể rời kệ
+            if taken is not None:
+                rec.extra = {"copy_id": taken["id"]}
+            adjust_stock(username, mg.id, -1)  # Trừ tồn kho đi 1 vì vừa cho thuê
+            if hold is not None:
+                remove_waitlist(username, [hold["id"]])  # Khách lấy cuốn đang giữ cho mình
+            append_rental(username, rec)  # Thêm giao dịch mới vào phần nóng
+            count_genre_rentals(username, mg.genre_ids)  # Cộng lượt thuê theo thể loại
+        events.append(("rent", rec))
 
     # ------ Gửi email theo mẫu người dùng ------
     cfg = read_json(user_file(username, "email.json"), {})  
@@ -816,9 +3795,9 @@ def rentals_create():
     # Lấy template thuê; nếu user chưa có thì dùng mặc định
     ctx = {
         # Tạo context để nhét vào template
-        "customer_name": cust["name"],
-        "manga_title": mg["title"],
-        "rent_price": rent_price,
+        "customer_name": cust.name,
+        "manga_title": mg.title,
+        "rent_price": format_price(rent_price),
         "start_at": start_at,
         "due_at": due_at,
         "return_at": "",
@@ -828,8 +3807,8 @@ def rentals_create():
     subject = f"[{session.get('shop_name','Cửa hàng')}] Xác nhận thuê truyện"
     # Tiêu đề email
     html = render_tpl(tpl, ctx)  # Render template thành HTML hoàn chỉnh
-    send_email_if_configured(username, subject, html, cust["email"])
-    # Gửi email nếu user đã cấu hình
+    on_commit(username, lambda: send_email_if_configured(username, subject, html, cust.email), locked=False)
+    # Gửi email (nếu user đã cấu hình) sau khi giao dịch đã ghi xong và nhả khóa cửa hàng
     # -------------------------------------------
 
     flash("Đã tạo giao dịch thuê.", "success")  # Thông báo tạo thành công
@@ -840,52 +3819,35 @@ def rentals_return(rid):
     # Route xử lý trả truyện theo rental id rid
     if require_login(): return require_login()  # Chặn nếu chưa login
     username = get_current_username()  # Lấy user
-    rentals = read_json(user_file(username, "rentals.json"), [])  # Đọc rentals
-    customers = read_json(user_file(username, "customers.json"), [])  # Đọc list khách
-    found = None  # Biến lưu giao dịch cần trả
-    for r in rentals:  # Duyệt từng giao dịch
-        if r["id"] == rid and not r.get("returned_at"):
-            # Nếu đúng giao dịch và chưa trả
-            found = r  # Lưu vào found
-            break  # Thoát vòng lặp
-
-    if not found:
-        # Nếu không tìm thấy hoặc đã trả
-        flash("Không tìm thấy giao dịch hoặc đã trả.", "danger")  # Báo lỗi
-        return redirect(url_for("rentals_list"))  # Quay lại list
-    else:
-        # chỉ chạy khi tìm thấy giao dịch
-        shop_cfg = read_shop_cfg(username)  # Đọc cấu hình hiện tại
-        default_per_day = int(shop_cfg.get("late_fee_per_day", 10000) or 10000)
-        # Phí trễ/ngày mặc định
-
-        due = parse_dt(found["due_at"])  # Parse ngày đến hạn
-        days_late = (datetime.now() - due).days  # Tính số ngày trễ
-
-        late_fee = 0  # Mặc định phí trễ
-        if days_late > 0:
-            per_day = found.get("late_fee_per_day", default_per_day)
-            # Lấy phí/ngày đã lưu lúc tạo giao dịch
-            try:
-                per_day_int = int(per_day)  # Ép int
-            except Exception:
-                per_day_int = default_per_day  # Lỗi ép -> dùng mặc định
-
-            if per_day_int < 0:
-                per_day_int = 0  # Không cho âm
-
-            late_fee = days_late * per_day_int  # Phí trễ = ngày trễ * phí/ngày
+    with leaderboard_events(username) as events:  # Cập nhật bảng xếp hạng trong bộ nhớ
+        with journal_batch(username):  # Trong khóa; journal_mode: trả truyện + cộng kho = 1 bản ghi journal
+            found = find_by_id(username, "rentals", rid)  # Giao dịch cần trả (giao dịch mở luôn ở phần nóng)
+            if found and found.returned_at:
+                found = None  # Đã trả rồi thì coi như không tìm thấy
+
+            if not found:
+                # Nếu không tìm thấy hoặc đã trả
+                flash("Không tìm thấy giao dịch hoặc đã trả.", "danger")  # Báo lỗi
+                return redirect(url_for("rentals_list"))  # Quay lại list
+            else:
+                # chỉ chạy khi tìm thấy giao dịch
+                shop_cfg = read_shop_cfg(username)  # Đọc cấu hình hiện tại
+                default_per_day = int(shop_cfg.get("late_fee_per_day", 10000) or 10000)
+                # Phí trễ/ngày mặc định (giao dịch có lưu phí/ngày lúc tạo thì dùng mức đó)
 
-    found["late_fee"] = format_price(str(late_fee))  # Lưu phí trễ dạng đẹp
-    found["returned_at"] = now_str()  # Lưu thời điểm trả
+            found.late_fee = found.late_fee_at(datetime.now(), default_per_day)  # Lưu phí trễ (số nguyên VND)
+            found.returned_at = now_str()  # Lưu thời điểm trả
 
-    write_json(user_file(username, "rentals.json"), rentals)  
-    # Ghi lại rentals sau khi update
+            update_rental(username, rid, {"late_fee": found.late_fee, "returned_at": found.returned_at})
+            # Ghi lại rentals sau khi update
 
-    adjust_stock(username, found["manga_id"], +1)  
-    # Cộng tồn kho lại 1 vì đã trả truyện
+            return_copy(username, found, request.form.get("condition"))  # Đúng cuốn đó về kệ
+            adjust_stock(username, found.manga_id, +1)
+            # Cộng tồn kho lại 1 vì đã trả truyện
+            fill_holds(username, found.manga_id)  # Có người chờ -> giữ cuốn vừa trả cho người đầu hàng
+        events.append(("return", found))
 
-    cust = next((c for c in customers if c["id"]==found["customer_id"]), None)
+    cust = find_by_id(username, "customers", found.customer_id)
     # Tìm khách của giao dịch này
     if cust:
         # Nếu tìm thấy khách
@@ -895,24 +3857,890 @@ def rentals_return(rid):
         # Lấy template trả truyện
         ctx = {
             # Context cho email trả
-            "customer_name": cust["name"],
-            "manga_title": found["manga_title"],
-            "rent_price": found["rent_price"],
-            "start_at": found["created_at"],
-            "due_at": found["due_at"],
-            "return_at": found["returned_at"],
-            "late_fee": found["late_fee"],
+            "customer_name": cust.name,
+            "manga_title": found.manga_title,
+            "rent_price": format_price(found.rent_price),
+            "start_at": found.created_at,
+            "due_at": found.due_at,
+            "return_at": found.returned_at,
+            "late_fee": format_price(found.late_fee),
             "shop_name": session.get("shop_name","Cửa hàng")
         }
         subject = f"[{session.get('shop_name','Cửa hàng')}] Xác nhận trả truyện"
         # Tiêu đề email trả
         html = render_tpl(tpl, ctx)  # Render template trả
-        send_email_if_configured(username, subject, html, cust["email"])
-        # Gửi email thông báo trả truyện
+        on_commit(username, lambda: send_email_if_configured(username, subject, html, cust.email), locked=False)
+        # Gửi email thông báo trả truyện (sau khi đã ghi xong)
 
     flash("Đã cập nhật trả truyện.", "success")  # Báo thành công
     return redirect(url_for("rentals_list"))  # Quay lại list
 
+# ================== Hàng chờ & giữ truyện (waitlist) ==================
+#
+# waitlist.json: mỗi dòng 1 lượt chờ {"id", "manga_id", "customer_id", "created_at", "status", "hold_until"},
+# theo thứ tự vào hàng (FIFO theo từng truyện). status "waiting" = đang chờ; "held" = đã có 1 cuốn giữ riêng cho
+# khách tới hold_until. Cuốn đang giữ vẫn tính trong stock nhưng khách khác không thuê được (còn cho thuê =
+# stock - số cuốn đang giữ). Trả truyện / thêm tồn kho -> giữ cho người đầu hàng (thông báo + email); giữ quá hạn
+# thì tác vụ nền expire_holds bỏ lượt đó và chuyển cuốn cho người kế tiếp. Chỉ mục theo truyện (deque) và theo
+# khách dựng 1 lần mỗi khi file đổi.
+
+WAITLIST_HOLD_HOURS = int(os.environ.get("WAITLIST_HOLD_HOURS", "48"))  # Thời gian giữ truyện cho khách
+
+DEFAULT_TPL_HOLD = (
+    "Kính gửi {customer_name},<br>"
+    "Truyện <b>{manga_title}</b> bạn đăng ký chờ đã có. Cửa hàng giữ truyện cho bạn đến <b>{hold_until}</b>.<br><br>"
+    "Trân trọng,<br>{shop_name}"
+)
+
+_waitlist_cache = {}  # username -> (chữ ký file, chỉ mục)
+
+def _waitlist_index_of(rows):
+    queue, holds, by_customer = {}, {}, {}
+    for e in rows:
+        (holds if e.get("status") == "held" else queue).setdefault(e["manga_id"], deque()).append(e)
+        by_customer.setdefault(e["customer_id"], []).append(e)
+    return {"rows": rows, "queue": queue, "holds": holds, "customer": by_customer}
+
+def waitlist_index(username):
+    # Chỉ mục để đọc: {"queue": {manga_id: deque}, "holds": {manga_id: deque}, "customer": {customer_id: [..]}}
+    if _uow_of(username, "waitlist") is not None:  # Đang ghi trong request: đọc bản đang sửa
+        return _waitlist_index_of(read_coll(username, "waitlist"))
+    sig = _file_sig(user_file(username, COLL_FILES["waitlist"]))
+    hit = _waitlist_cache.get(username)
+    if hit is None or hit[0] != sig:
+        hit = _waitlist_cache[username] = (sig, _waitlist_index_of(read_coll(username, "waitlist")))
+    return hit[1]
+
+def _waitlist_edit(username):
+    # Chỉ mục trên bản sao để sửa rồi write_coll(idx["rows"])
+    return _waitlist_index_of(read_coll(username, "waitlist"))
+
+def available_copies(mg, idx):
+    return mg.stock - len(idx["holds"].get(mg.id, ()))
+
+def waitlist_position(e, idx):
+    # 0 = đang được giữ truyện, 1 = đầu hàng...
+    if e.get("status") == "held":
+        return 0
+    return next(i for i, x in enumerate(idx["queue"][e["manga_id"]], 1) if x["id"] == e["id"])
+
+def waitlist_eta(username, manga_id, position, idx=None):
+    """
+    Ngày dự kiến có truyện cho người thứ position trong hàng: dùng cuốn còn trống trước, sau đó lần lượt theo
+    hạn trả (sớm trước) của các giao dịch đang mở (quá hạn rồi thì tính là ngay bây giờ); hàng dài hơn số cuốn
+    đang cho thuê thì mỗi vòng cộng thêm số ngày thuê mặc định. None = không có cuốn nào đang lưu hành.
+    """
+    idx = idx or waitlist_index(username)
+    mg = find_by_id(username, "manga", manga_id)
+    if mg is None:
+        return None
+    k = position - max(0, available_copies(mg, idx)) - 1
+    if k < 0:
+        return now_str()
+    dues = []
+    for r in shared_models(username, "rentals"):
+        if r.manga_id == manga_id and not r.returned_at:
+            try:
+                dues.append(parse_dt(r.due_at))
+            except ValueError:
+                pass
+    if not dues:
+        return None
+    dues = [max(d, datetime.now()) for d in sorted(dues)]
+    rounds, i = divmod(k, len(dues))
+    rent_days = max(1, int(_raw_shop_cfg(username).get("default_rent_days", 5) or 5))
+    return (dues[i] + timedelta(days=rent_days * rounds)).strftime(DT_FMT)
+
+def join_waitlist(username, manga_id, customer_id):
+    # Thêm khách vào cuối hàng chờ của truyện (đã có thì giữ nguyên chỗ); trả (lượt chờ, vị trí)
+    with tenant_lock(username):
+        idx = _waitlist_edit(username)
+        for e in idx["customer"].get(customer_id, ()):
+            if e["manga_id"] == manga_id:
+                return e, waitlist_position(e, idx)
+        e = {"id": str(uuid.uuid4()), "manga_id": manga_id, "customer_id": customer_id,
+             "created_at": now_str(), "status": "waiting", "hold_until": ""}
+        idx["rows"].append(e)
+        write_coll(username, "waitlist", idx["rows"])
+        return e, len(idx["queue"].get(manga_id, ())) + 1
+
+def remove_waitlist(username, ids):
+    # Bỏ các lượt chờ/giữ; trả list lượt đã bỏ
+    ids = set(ids)
+    with tenant_lock(username):
+        rows = read_coll(username, "waitlist")
+        gone = [e for e in rows if e["id"] in ids]
+        if gone:
+            write_coll(username, "waitlist", [e for e in rows if e["id"] not in ids])
+        return gone
+
+def fill_holds(username, manga_id):
+    # Còn cuốn trống mà hàng chờ chưa hết -> giữ cho người đầu hàng (mỗi lượt O(1): lấy đầu deque)
+    with tenant_lock(username):
+        mg = find_by_id(username, "manga", manga_id)
+        idx = _waitlist_edit(username)
+        q = idx["queue"].get(manga_id)
+        if mg is None or not q:
+            return []
+        free = available_copies(mg, idx)
+        until = (datetime.now() + timedelta(hours=WAITLIST_HOLD_HOURS)).strftime(DT_FMT)
+        held = []
+        while q and free > 0:
+            e = q.popleft()
+            e.update(status="held", hold_until=until)
+            held.append(e)
+            free -= 1
+        if held:
+            write_coll(username, "waitlist", idx["rows"])
+            for e in held:
+                notify_hold(username, mg, e)
+        return held
+
+def notify_hold(username, mg, e):
+    # Thông báo cho cửa hàng + email cho khách (email gửi sau khi ghi xong và nhả khóa)
+    cust = find_by_id(username, "customers", e["customer_id"])
+    name = cust.name if cust else e["customer_id"]
+    add_notification(username, {
+        "id": str(uuid.uuid4()),
+        "type": "HOLD",
+        "created_at": now_str(),
+        "read": False,
+        "manga_id": mg.id,
+        "customer_id": e["customer_id"],
+        "message": f"Đang giữ truyện '{mg.title}' (ID {mg.id}) cho khách {name} đến {e['hold_until']}.",
+    })
+    if cust and cust.email:
+        shop_name = _raw_shop_cfg(username).get("shop_name") or "Cửa hàng"  # Có thể chạy nền (không có session)
+        tpl = read_json(user_file(username, "email.json"), {}).get("tpl_hold") or DEFAULT_TPL_HOLD
+        html = render_tpl(tpl, {"customer_name": cust.name, "manga_title": mg.title,
+                                "hold_until": e["hold_until"], "shop_name": shop_name})
+        subject = f"[{shop_name}] Truyện bạn chờ đã có"
+        on_commit(username, lambda: send_email_if_configured(username, subject, html, cust.email), locked=False)
+
+def refill_holds(username, manga_ids):
+    # Chạy nền: giữ truyện cho người kế tiếp trong 1 unit of work (email gửi sau khi nhả khóa)
+    with unit_of_work(username):
+        for mid in manga_ids:
+            fill_holds(username, mid)
+
+def expire_holds(username):
+    # Tác vụ nền: bỏ các lượt giữ quá hạn rồi chuyển cuốn cho người kế tiếp; trả số lượt đã bỏ
+    now = datetime.now()
+
+    def expired(e):
+        try:
+            return parse_dt(e["hold_until"]) < now
+        except (KeyError, ValueError):
+            return True
+    if not any(expired(e) for q in waitlist_index(username)["holds"].values() for e in q):
+        return 0  # Đọc không khóa: phần lớn các lần chạy dừng ở đây
+    gone = remove_waitlist(username, [e["id"] for q in _waitlist_edit(username)["holds"].values() for e in q if expired(e)])
+    refill_holds(username, sorted({e["manga_id"] for e in gone}))
+    return len(gone)
+
+MAINTENANCE_TASKS.append(expire_holds)  # Chạy cùng lượt quét nền định kỳ
+
+def _waitlist_rows(username):
+    # Dòng hiển thị/API: lượt chờ kèm tên, vị trí và ngày dự kiến
+    idx = waitlist_index(username)
+    tomb = tombstones(username)
+    out = []
+    for e in idx["rows"]:
+        if e["manga_id"] in tomb["manga"] or e["customer_id"] in tomb["customers"]:
+            continue  # Truyện/khách đã xóa (chờ dọn)
+        mg = find_by_id(username, "manga", e["manga_id"])
+        cust = find_by_id(username, "customers", e["customer_id"])
+        pos = waitlist_position(e, idx)
+        out.append({
+            **e,
+            "manga_title": mg.title if mg else e["manga_id"],
+            "customer_name": cust.name if cust else e["customer_id"],
+            "position": pos,
+            "eta": "" if pos == 0 else waitlist_eta(username, e["manga_id"], pos, idx),
+        })
+    out.sort(key=lambda r: (r["manga_title"], r["position"]))
+    return out
+
+@app.route("/waitlist")
+def waitlist_list():
+    if require_login():
+        return require_login()
+    username = get_current_username()
+    return render_template(
+        "waitlist.html",
+        rows=_waitlist_rows(username),
+        unread_count=count_unread_notifications(username),
+        customers=shared_models(username, "customers"),
+        manga=_manga_rows(username),
+    )
+
+@app.route("/waitlist/add", methods=["POST"])
+def waitlist_add():
+    if require_login():
+        return require_login()
+    username = get_current_username()
+    customer_id = (request.form.get("customer_id") or "").strip()
+    manga_id = (request.form.get("manga_id") or "").strip()
+    if not find_by_id(username, "customers", customer_id) or not find_by_id(username, "manga", manga_id):
+        flash("Không tìm thấy khách hàng hoặc truyện.", "danger")
+        return redirect(url_for("waitlist_list"))
+    _, pos = join_waitlist(username, manga_id, customer_id)
+    fill_holds(username, manga_id)  # Truyện đang còn cuốn trống -> giữ luôn
+    flash(f"Đã thêm vào hàng chờ (vị trí {pos}).", "success")
+    return redirect(url_for("waitlist_list"))
+
+@app.route("/waitlist/cancel/<wid>", methods=["POST"])
+def waitlist_cancel(wid):
+    if require_login():
+        return require_login()
+    username = get_current_username()
+    gone = remove_waitlist(username, [wid])
+    for e in gone:
+        if e.get("status") == "held":
+            fill_holds(username, e["manga_id"])  # Cuốn đang giữ -> chuyển cho người kế tiếp
+    flash("Đã hủy lượt chờ." if gone else "Không tìm thấy lượt chờ.", "success" if gone else "danger")
+    return redirect(url_for("waitlist_list"))
+
+@app.route("/api/waitlist")
+def api_waitlist():
+    """
+    Hàng chờ: /api/waitlist?manga_id=M1 hoặc ?customer_id=C1 (bỏ trống = tất cả).
+    Mỗi dòng có position (0 = đang giữ truyện) và eta (ngày dự kiến có truyện, null = chưa ước lượng được).
+    """
+    if require_login():
+        return require_login()
+    manga_id = request.args.get("manga_id")
+    customer_id = request.args.get("customer_id")
+    rows = [r for r in _waitlist_rows(get_current_username())
+            if (manga_id is None or r["manga_id"] == manga_id) and (customer_id is None or r["customer_id"] == customer_id)]
+    return jsonify({"ok": True, "hold_hours": WAITLIST_HOLD_HOURS, "items": rows})
+
+# ================== Bản sao truyện (copies) ==================
+#
+# copies.json: mỗi cuốn vật lý 1 dòng {"id", "manga_id", "barcode", "condition", "status", "rental_id",
+# "created_at", "updated_at"}; status "available" = trên kệ, "rented" = đang cho thuê (rental_id = giao dịch).
+# barcode là mã dán trên cuốn, duy nhất trong cửa hàng (mặc định = id, ví dụ "M1-003"); mã vạch in trên bìa
+# (manga.barcode) vẫn quét được khi không cần biết cuốn nào. manga.stock giờ là bộ đếm suy ra = số cuốn
+# "available": chỉ cộng/trừ đúng lúc 1 cuốn đổi trạng thái (adjust_stock), check-data đối chiếu lại với file.
+# Chỉ mục mã dán -> cuốn và truyện -> các cuốn còn trên kệ dựng 1 lần mỗi khi file đổi, nên quét mã ở quầy
+# chỉ là tra dict.
+
+_copy_cache = {}  # username -> (chữ ký file, chỉ mục)
+
+def _copy_index_of(rows):
+    by_id, by_barcode, available = {}, {}, {}
+    for c in rows:
+        by_id[c["id"]] = c
+        by_barcode[c.get("barcode") or c["id"]] = c
+        if c.get("status") == "available":
+            available.setdefault(c["manga_id"], {})[c["id"]] = c  # dict giữ thứ tự: cuốn cũ nhất ra trước
+    return {"rows": rows, "id": by_id, "barcode": by_barcode, "available": available}
+
+def copy_index(username):
+    # Chỉ mục để đọc: {"id": {copy_id: cuốn}, "barcode": {mã dán: cuốn}, "available": {manga_id: {copy_id: cuốn}}}
+    if _uow_of(username, "copies") is not None:  # Đang ghi trong request: đọc bản đang sửa
+        return _copy_index_of(read_coll(username, "copies"))
+    sig = _file_sig(user_file(username, COLL_FILES["copies"]))
+    hit = _copy_cache.get(username)
+    if hit is None or hit[0] != sig:
+        hit = _copy_cache[username] = (sig, _copy_index_of(read_coll(username, "copies")))
+    return hit[1]
+
+def _copy_edit(username):
+    # Chỉ mục trên bản sao để sửa rồi write_coll(idx["rows"])
+    return _copy_index_of(read_coll(username, "copies"))
+
+def _new_copies(idx, mg, n, status="available"):
+    # Thêm n cuốn cho truyện mg vào chỉ mục đang sửa; id/mã dán = "<id truyện>-<số thứ tự>"
+    made, seq = [], 0
+    while len(made) < n:
+        seq += 1
+        cid = f"{mg.id}-{seq:03d}"
+        if cid in idx["id"] or cid in idx["barcode"]:
+            continue
+        c = {"id": cid, "manga_id": mg.id, "barcode": cid, "condition": mg.condition, "status": status,
+             "rental_id": "", "created_at": now_str(), "updated_at": now_str()}
+        idx["rows"].append(c)
+        idx["id"][cid] = idx["barcode"][cid] = c
+        if status == "available":
+            idx["available"].setdefault(mg.id, {})[cid] = c
+        made.append(c)
+    return made
+
+def sync_copies(username, mg):
+    """
+    Khớp số cuốn trên kệ với manga.stock sau khi thêm/sửa truyện: thiếu thì tạo thêm cuốn mới, thừa thì bỏ các
+    cuốn trên kệ mới nhất (cuốn đang cho thuê không bị đụng tới).
+    """
+    with tenant_lock(username):
+        idx = _copy_edit(username)
+        shelf = list(idx["available"].get(mg.id, {}).values())
+        diff = mg.stock - len(shelf)
+        if diff > 0:
+            _new_copies(idx, mg, diff)
+            write_coll(username, "copies", idx["rows"])
+        elif diff < 0:
+            drop = {c["id"] for c in shelf[diff:]}
+            write_coll(username, "copies", [c for c in idx["rows"] if c["id"] not in drop])
+
+def checkout_copy(username, manga_id, rental_id, copy_id=None):
+    # Chuyển 1 cuốn trên kệ sang "rented" (cuốn đã quét, không thì cuốn cũ nhất); trả cuốn đó hoặc None
+    with tenant_lock(username):
+        idx = _copy_edit(username)
+        shelf = idx["available"].get(manga_id) or {}
+        c = shelf.get(copy_id) if copy_id else next(iter(shelf.values()), None)
+        if c is None:
+            return None
+        c.update(status="rented", rental_id=rental_id, updated_at=now_str())
+        write_coll(username, "copies", idx["rows"])
+        return c
+
+def return_copy(username, rental, condition=None):
+    # Đưa cuốn của giao dịch về kệ; giao dịch tạo trước khi có copies.json thì dò theo rental_id
+    with tenant_lock(username):
+        idx = _copy_edit(username)
+        c = idx["id"].get(rental.get("copy_id") or "")
+        if c is None or c.get("rental_id") != rental.id:
+            c = next((x for x in idx["rows"] if x.get("rental_id") == rental.id), None)
+        if c is None:
+            return None
+        c.update(status="available", rental_id="", updated_at=now_str())
+        if condition:
+            c["condition"] = condition
+        write_coll(username, "copies", idx["rows"])
+        return c
+
+def migrate_copies(username):
+    """
+    Tạo copies.json cho dữ liệu cũ: mỗi truyện có stock cuốn trên kệ + 1 cuốn "rented" cho mỗi giao dịch đang mở
+    (gắn rental_id để trả đúng cuốn). Chạy 1 lần, đánh dấu copy_inventory.
+    """
+    with tenant_lock(username):
+        cfg_path = user_file(username, "shop_config.json")
+        cfg = read_json(cfg_path, {})
+        if cfg.get("copy_inventory"):
+            return False
+        idx = _copy_edit(username)
+        have = {c["manga_id"] for c in idx["rows"]}
+        open_by_manga = {}
+        for r in shared_models(username, "rentals"):
+            if not r.returned_at:
+                open_by_manga.setdefault(r.manga_id, []).append(r.id)
+        for mg in _manga_rows(username):
+            if mg.id in have:
+                continue
+            _new_copies(idx, mg, mg.stock)
+            rids = open_by_manga.get(mg.id, [])
+            for c, rid in zip(_new_copies(idx, mg, len(rids), "rented"), rids):
+                c["rental_id"] = rid
+        write_coll(username, "copies", idx["rows"])
+        cfg["copy_inventory"] = True
+        write_json(cfg_path, cfg)
+        return True
+
+TENANT_MIGRATIONS.append(migrate_copies)
+
+@app.route("/manga/<mid>/copies")
+def manga_copies(mid):
+    # Danh sách từng cuốn của 1 truyện (mã dán, tình trạng, đang ở kệ hay ai đang thuê)
+    if require_login():
+        return require_login()
+    username = get_current_username()
+    mg = find_by_id(username, "manga", mid)
+    if mg is None:
+        flash("Không tìm thấy truyện.", "danger")
+        return redirect(url_for("manga_list"))
+    rows = []
+    for c in copy_index(username)["rows"]:
+        if c["manga_id"] != mid:
+            continue
+        r = find_by_id(username, "rentals", c["rental_id"]) if c.get("rental_id") else None
+        rows.append({**c, "customer_name": r.customer_name if r else "", "due_at": r.due_at if r else ""})
+    return render_template(
+        "manga_copies.html",
+        manga=mg,
+        copies=rows,
+        unread_count=count_unread_notifications(username),
+    )
+
+@app.route("/copies/update/<cid>", methods=["POST"])
+def copies_update(cid):
+    # Sửa mã dán / tình trạng của 1 cuốn
+    if require_login():
+        return require_login()
+    username = get_current_username()
+    with tenant_lock(username):
+        idx = _copy_edit(username)
+        c = idx["id"].get(cid)
+        if c is None:
+            flash("Không tìm thấy cuốn truyện.", "danger")
+            return redirect(url_for("manga_list"))
+        barcode = (request.form.get("barcode") or "").strip() or c["barcode"]
+        other = idx["barcode"].get(barcode)
+        if other is not None and other is not c:
+            flash(f"Mã {barcode} đã dán cho cuốn {other['id']}.", "danger")
+            return redirect(url_for("manga_copies", mid=c["manga_id"]))
+        c.update(barcode=barcode, condition=request.form.get("condition") or c["condition"], updated_at=now_str())
+        write_coll(username, "copies", idx["rows"])
+    flash("Đã cập nhật cuốn truyện.", "success")
+    return redirect(url_for("manga_copies", mid=c["manga_id"]))
+
+@app.route("/copies/retire/<cid>", methods=["POST"])
+def copies_retire(cid):
+    # Bỏ 1 cuốn trên kệ (mất/hỏng): xóa khỏi copies.json và trừ tồn kho 1
+    if require_login():
+        return require_login()
+    username = get_current_username()
+    with tenant_lock(username):
+        idx = _copy_edit(username)
+        c = idx["id"].get(cid)
+        if c is None or c.get("status") != "available":
+            flash("Chỉ bỏ được cuốn đang ở trên kệ.", "danger")
+            return redirect(url_for("manga_copies", mid=c["manga_id"]) if c else url_for("manga_list"))
+        write_coll(username, "copies", [x for x in idx["rows"] if x["id"] != cid])
+        adjust_stock(username, c["manga_id"], -1)
+    flash(f"Đã bỏ cuốn {c['barcode']}.", "success")
+    return redirect(url_for("manga_copies", mid=c["manga_id"]))
+
+# ================== Chiến dịch email (gửi hàng loạt) ==================
+#
+# campaigns.json: mỗi chiến dịch 1 dòng {"id", "name", "subject", "body", "rate_per_min", "status", "cursor", "total",
+# "sent", "failed", "skipped", "error", "base_url", "lease_until", "created_at", "started_at", "finished_at"}.
+# status: queued -> sending -> done; paused / cancelled do chủ cửa hàng bấm (lỗi đăng nhập SMTP cũng tự paused).
+# Tiêu đề + nội dung được biên dịch và kiểm tra {biến} 1 lần lúc tạo: biến lạ bị từ chối ngay, không phải lúc gửi.
+# Luồng nền đi lần lượt theo id khách (cursor = id khách cuối đã xử lý) từng lô CAMPAIGN_CHUNK người, gửi qua kết
+# nối SMTP dùng lại trong smtp_pool và giữ nhịp rate_per_min. Kết quả từng người nối vào campaigns/<id>.log (1 dòng
+# JSON/người) trước khi lưu cursor, nên chạy lại sau khi process chết chỉ tiếp tục từ cursor và bỏ qua người đã có
+# trong log. lease_until (epoch) giữ quyền gửi cho 1 process; tác vụ nền resume_campaigns nhận lại chiến dịch hết lease.
+
+CAMPAIGN_CHUNK = int(os.environ.get("CAMPAIGN_CHUNK", "50"))  # Số người mỗi lô (lưu tiến độ sau mỗi lô)
+CAMPAIGN_RATE_PER_MIN = int(os.environ.get("CAMPAIGN_RATE_PER_MIN", "20"))  # Nhịp gửi mặc định (email/phút)
+CAMPAIGN_RATE_MAX = 600
+CAMPAIGN_RETRY_SEC = 600  # Mất kết nối SMTP: nhả lease, tác vụ nền thử lại sau khoảng này
+SMTP_POOL_SIZE = int(os.environ.get("SMTP_POOL_SIZE", "2"))  # Số kết nối rảnh giữ lại cho mỗi tài khoản gửi
+SMTP_POOL_IDLE_SEC = int(os.environ.get("SMTP_POOL_IDLE_SEC", "120"))  # Rảnh lâu hơn thì đóng (Gmail tự ngắt)
+CAMPAIGN_DIR = "campaigns"
+CAMPAIGN_LIVE = ("queued", "sending")
+CAMPAIGN_VARS = {
+    "customer_name": "Tên khách",
+    "customer_email": "Email khách",
+    "customer_phone": "Số điện thoại khách",
+    "shop_name": "Tên cửa hàng",
+    "open_rentals": "Số truyện khách đang thuê",
+    "month_rentals": "Số lượt thuê của khách trong tháng này",
+    "month_total": "Tiền thuê + phí trễ của khách trong tháng này (VND)",
+    "new_arrivals": "Danh sách truyện mới thêm trong 30 ngày (HTML)",
+    "unsubscribe_url": "Link hủy nhận email",
+}
+CAMPAIGN_FOOTER = (
+    '<br><br><small>Không muốn nhận email từ {shop_name}? '
+    '<a href="{unsubscribe_url}">Hủy đăng ký</a>.</small>'
+)
+
+class SmtpPool:
+    """Kết nối SMTP đã STARTTLS + đăng nhập, giữ lại theo tài khoản gửi để các email/lô sau dùng lại."""
+
+    def __init__(self, size, idle_sec):
+        self.size = size
+        self.idle_sec = idle_sec
+        self._idle = {}  # (email gửi, mật khẩu) -> [(kết nối, lúc trả về)]
+        self._lock = threading.Lock()
+
+    def acquire(self, cfg):
+        import smtplib  # Nạp lúc gửi lần đầu như send_email_if_configured
+        key = (cfg["sender_email"], cfg["smtp_pass"])
+        while True:
+            with self._lock:
+                conns = self._idle.get(key)
+                conn, since = conns.pop() if conns else (None, 0)
+            if conn is None:
+                break
+            if time.monotonic() - since <= self.idle_sec:
+                try:
+                    if conn.noop()[0] == 250:
+                        return conn
+                except (smtplib.SMTPException, OSError):
+                    pass
+            self._close(conn)
+        conn = smtplib.SMTP("smtp.gmail.com", 587, timeout=30)
+        conn.starttls()
+        conn.login(cfg["sender_email"], cfg["smtp_pass"])
+        return conn
+
+    def release(self, cfg, conn, broken=False):
+        key = (cfg["sender_email"], cfg["smtp_pass"])
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if not broken and len(conns) < self.size:
+                conns.append((conn, time.monotonic()))
+                return
+        self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.quit()
+        except Exception:
+            conn.close()
+
+smtp_pool = SmtpPool(SMTP_POOL_SIZE, SMTP_POOL_IDLE_SEC)
+
+def _unsub_serializer():
+    from itsdangerous import URLSafeSerializer  # Đi kèm Flask
+    return URLSafeSerializer(app.secret_key, salt="unsubscribe")
+
+def _campaign_log_path(username, cid):
+    return user_file(username, os.path.join(CAMPAIGN_DIR, f"{cid}.log"))
+
+def campaign_log(username, cid):
+    # Kết quả từng người nhận theo thứ tự gửi (dòng cuối ghi dở lúc crash thì bỏ)
+    try:
+        with open(_campaign_log_path(username, cid), "rb") as f:
+            lines = f.read().split(b"\n")
+    except FileNotFoundError:
+        return []
+    out = []
+    for line in lines:
+        try:
+            out.append(_json_loads(line))
+        except ValueError:
+            pass
+    return out
+
+def _campaign_update(username, cid, fields, when=None):
+    # Đọc-sửa-ghi 1 chiến dịch trong khóa; fields là dict hoặc hàm(c) -> dict. Không thấy / when(c) sai -> None
+    with tenant_lock(username):
+        rows = read_coll(username, "campaigns")
+        c = next((x for x in rows if x["id"] == cid), None)
+        if c is None or (when is not None and not when(c)):
+            return None
+        c.update(fields(c) if callable(fields) else fields)
+        write_coll(username, "campaigns", rows)
+        return c
+
+def _campaign_claimable(c):
+    return c["status"] in CAMPAIGN_LIVE and float(c.get("lease_until") or 0) < time.time()
+
+def _campaign_lease(c):
+    return time.time() + CAMPAIGN_CHUNK * 60.0 / c["rate_per_min"] + 120  # Đủ cho 1 lô + dư 2 phút
+
+def _campaign_context(username, keys, base_url):
+    """
+    Trả hàm cust -> ctx cho mẫu. Phần dùng chung (tên cửa hàng, truyện mới, thống kê giao dịch) tính 1 lần mỗi lượt
+    chạy và chỉ khi mẫu thật sự dùng tới biến đó.
+    """
+    shop_name = _raw_shop_cfg(username).get("shop_name") or "Cửa hàng"
+    stats = {}
+    if keys & {"open_rentals", "month_rentals", "month_total"}:
+        month = datetime.now().strftime("-%m-%Y ")  # created_at dạng dd-mm-YYYY HH:MM:SS
+        tomb = tombstones(username)
+        for r in shared_models(username, "rentals"):  # Phần nóng giữ >= RENTALS_HOT_DAYS ngày: đủ tháng này
+            if rental_hidden(r, tomb):
+                continue
+            st = stats.setdefault(r.customer_id, [0, 0, 0])
+            st[0] += not r.returned_at
+            if r.created_at[2:11] == month:
+                st[1] += 1
+                st[2] += r.rent_price + r.late_fee
+    arrivals = ""
+    if "new_arrivals" in keys:
+        since = datetime.now() - timedelta(days=30)
+        rows = []
+        for m in _manga_rows(username):
+            try:
+                if parse_dt(m.created_at) >= since:
+                    rows.append(f"<li>{html_escape(m.title)} — {format_price(m.rent_price)} VND</li>")
+            except ValueError:
+                pass
+        arrivals = "<ul>" + "".join(rows) + "</ul>" if rows else ""
+    signer = _unsub_serializer()
+
+    def ctx(cust):
+        st = stats.get(cust.id, (0, 0, 0))
+        return {
+            "customer_name": cust.name,
+            "customer_email": cust.email,
+            "customer_phone": cust.phone,
+            "shop_name": shop_name,
+            "open_rentals": st[0],
+            "month_rentals": st[1],
+            "month_total": format_price(st[2]),
+            "new_arrivals": arrivals,
+            "unsubscribe_url": f"{base_url.rstrip('/')}/unsubscribe/{signer.dumps([username, cust.id])}",
+        }
+    return ctx
+
+_campaign_threads = {}  # (username, id chiến dịch) -> Thread đang gửi trong process này
+_campaign_threads_guard = threading.Lock()
+
+def start_campaign(username, cid):
+    # Gửi ở luồng nền (mỗi chiến dịch tối đa 1 luồng trong process; giữa các process đã có lease)
+    key = (username, cid)
+    with _campaign_threads_guard:
+        t = _campaign_threads.get(key)
+        if t is not None and t.is_alive():
+            return False
+        t = _campaign_threads[key] = threading.Thread(
+            target=run_campaign, args=(username, cid), name=f"campaign-{cid[:8]}", daemon=True)
+    t.start()
+    return True
+
+def run_campaign(username, cid):
+    try:
+        _run_campaign(username, cid)
+    except Exception:
+        app.logger.exception("Chiến dịch %s của %s lỗi", cid, username)
+        _campaign_update(username, cid, {"lease_until": time.time() + CAMPAIGN_RETRY_SEC})  # Tác vụ nền thử lại
+
+def _run_campaign(username, cid):
+    import smtplib
+    from email.mime.text import MIMEText
+    from email.utils import formataddr
+
+    c = _campaign_update(username, cid, lambda c: {
+        "status": "sending", "lease_until": _campaign_lease(c), "started_at": c.get("started_at") or now_str(),
+    }, when=_campaign_claimable)
+    if c is None:
+        return  # Process khác đang gửi, hoặc đã dừng/xong
+    cfg = read_json(user_file(username, "email.json"), {})
+    if not all(cfg.get(k) for k in ("smtp_pass", "sender_name", "sender_email")):
+        _campaign_update(username, cid, {"status": "paused", "lease_until": 0,
+                                         "error": "Email chưa cấu hình (cần sender_email, smtp_pass, sender_name)."})
+        return
+    log = campaign_log(username, cid)
+    done = {x.get("customer_id") for x in log}
+    pending = [x for x in log if (x.get("customer_id") or "") > c["cursor"]]  # Đã gửi nhưng process cũ chưa kịp lưu tiến độ
+    if pending:
+        def catch_up(c):
+            out = {k: c.get(k, 0) + sum(1 for x in pending if x.get("status") == k) for k in ("sent", "failed", "skipped")}
+            return dict(out, cursor=max(x["customer_id"] for x in pending))
+        c = _campaign_update(username, cid, catch_up)
+    ctx_of = _campaign_context(username, tpl_placeholders(c["subject"]) | tpl_placeholders(c["body"]), c["base_url"])
+    todo = sorted(cu.id for cu in shared_models(username, "customers") if cu.id > c["cursor"] and cu.id not in done)
+    sender = formataddr((cfg["sender_name"], cfg["sender_email"]))
+    interval = 60.0 / c["rate_per_min"]
+    next_at = time.monotonic()
+    os.makedirs(os.path.dirname(_campaign_log_path(username, cid)), exist_ok=True)
+    coll_path = user_file(username, COLL_FILES["campaigns"])
+    seen = [_file_sig(coll_path), "sending"]
+
+    def still_sending():
+        # Tạm dừng / hủy ghi lại campaigns.json: mỗi người nhận chỉ stat file, đọc lại khi chữ ký file đổi
+        sig = _file_sig(coll_path)
+        if sig != seen[0]:
+            seen[:] = [sig, next((x["status"] for x in read_coll(username, "campaigns") if x["id"] == cid), None)]
+        return seen[1] == "sending"
+
+    for start in range(0, len(todo), CAMPAIGN_CHUNK):
+        lines, counts, last, stop = [], {"sent": 0, "failed": 0, "skipped": 0}, None, None
+        conn = None
+        try:
+            for cust_id in todo[start:start + CAMPAIGN_CHUNK]:
+                if not still_sending():
+                    stop = {}  # Bị tạm dừng / hủy giữa chừng: chỉ lưu phần đã gửi
+                    break
+                cust = find_by_id(username, "customers", cust_id)
+                entry = {"customer_id": cust_id, "email": cust.email if cust else "", "at": now_str(), "error": ""}
+                if cust is None:
+                    entry.update(status="skipped", error="Khách đã bị xóa")
+                elif not cust.email:
+                    entry.update(status="skipped", error="Không có email")
+                elif cust.get("unsubscribed"):
+                    entry.update(status="skipped", error="Đã hủy nhận email")
+                else:
+                    ctx = ctx_of(cust)
+                    msg = MIMEText(render_tpl(c["body"], ctx), "html", "utf-8")
+                    msg["Subject"] = render_tpl(c["subject"], ctx)
+                    msg["From"] = sender
+                    msg["To"] = cust.email
+                    msg["List-Unsubscribe"] = f"<{ctx['unsubscribe_url']}>"
+                    time.sleep(max(0.0, next_at - time.monotonic()))  # Giữ nhịp rate_per_min
+                    next_at = max(next_at, time.monotonic()) + interval
+                    try:
+                        conn = conn or smtp_pool.acquire(cfg)
+                        conn.sendmail(cfg["sender_email"], [cust.email], msg.as_string())
+                        entry["status"] = "sent"
+                    except smtplib.SMTPAuthenticationError as e:
+                        stop = {"status": "paused", "lease_until": 0, "error": f"Đăng nhập SMTP lỗi: {e}"}
+                        break
+                    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, smtplib.SMTPSenderRefused) as e:
+                        entry.update(status="failed", error=str(e))  # Lỗi riêng người nhận này
+                    except (smtplib.SMTPException, OSError) as e:
+                        if conn is not None:
+                            smtp_pool.release(cfg, conn, broken=True)
+                            conn = None
+                        stop = {"lease_until": time.time() + CAMPAIGN_RETRY_SEC, "error": f"Mất kết nối SMTP: {e}"}
+                        break
+                lines.append(encode_data(entry, "compact") + b"\n")
+                counts[entry["status"]] += 1
+                last = cust_id
+        finally:
+            if conn is not None:
+                smtp_pool.release(cfg, conn)
+            if lines:
+                with open(_campaign_log_path(username, cid), "ab") as f:  # Log trước, cursor sau
+                    f.write(b"".join(lines))
+                    f.flush()
+                    os.fsync(f.fileno())
+
+        def progress(c, last=last, counts=counts, stop=stop):
+            out = {k: c.get(k, 0) + n for k, n in counts.items()}
+            if last is not None:
+                out["cursor"] = last
+            out.update(stop if stop is not None else {"lease_until": _campaign_lease(c), "error": ""})
+            return out
+        if _campaign_update(username, cid, progress) is None or stop is not None:
+            return
+    _campaign_update(username, cid, {"status": "done", "finished_at": now_str(), "lease_until": 0},
+                     when=lambda c: c["status"] == "sending")
+
+def resume_campaigns(username):
+    # Tác vụ nền: nhận lại chiến dịch đang gửi mà process giữ lease đã chết / mất kết nối SMTP đã hết thời gian chờ
+    started = 0
+    for c in read_coll(username, "campaigns"):
+        if _campaign_claimable(c):
+            started += start_campaign(username, c["id"])
+    return started
+
+MAINTENANCE_TASKS.append(resume_campaigns)
+
+@app.route("/campaigns")
+def campaigns_list():
+    if require_login():
+        return require_login()
+    username = get_current_username()
+    rows = sorted(read_coll(username, "campaigns"), key=lambda c: _iso(c.get("created_at")), reverse=True)
+    return render_template(
+        "campaigns.html",
+        campaigns=rows,
+        variables=CAMPAIGN_VARS,
+        default_rate=CAMPAIGN_RATE_PER_MIN,
+        unread_count=count_unread_notifications(username),
+    )
+
+@app.route("/campaigns/create", methods=["POST"])
+def campaigns_create():
+    if require_login():
+        return require_login()
+    username = get_current_username()
+    name = (request.form.get("name") or "").strip()
+    subject = (request.form.get("subject") or "").strip()
+    body = request.form.get("body") or ""
+    try:
+        rate = min(CAMPAIGN_RATE_MAX, max(1, int(request.form.get("rate_per_min") or CAMPAIGN_RATE_PER_MIN)))
+    except ValueError:
+        rate = CAMPAIGN_RATE_PER_MIN
+    if not subject or not body.strip():
+        flash("Cần nhập tiêu đề và nội dung email.", "danger")
+        return redirect(url_for("campaigns_list"))
+    unknown = sorted((tpl_placeholders(subject) | tpl_placeholders(body)) - set(CAMPAIGN_VARS))
+    if unknown:
+        flash("Biến không hỗ trợ: " + ", ".join("{" + k + "}" for k in unknown), "danger")
+        return redirect(url_for("campaigns_list"))
+    if "unsubscribe_url" not in tpl_placeholders(body):
+        body += CAMPAIGN_FOOTER  # Email hàng loạt luôn có link hủy nhận
+    tomb = tombstones(username)
+    c = {
+        "id": str(uuid.uuid4()),
+        "name": name or subject,
+        "subject": subject,
+        "body": body,
+        "rate_per_min": rate,
+        "status": "queued",
+        "cursor": "",
+        "total": sum(1 for cu in shared_models(username, "customers") if cu.id not in tomb["customers"]),
+        "sent": 0,
+        "failed": 0,
+        "skipped": 0,
+        "error": "",
+        "base_url": request.url_root,  # Luồng nền không có request để dựng link hủy nhận
+        "lease_until": 0,
+        "created_at": now_str(),
+        "started_at": "",
+        "finished_at": "",
+    }
+    rows = read_coll(username, "campaigns")
+    rows.append(c)
+    write_coll(username, "campaigns", rows)
+    on_commit(username, lambda: start_campaign(username, c["id"]), locked=False)  # Chỉ gửi khi đã ghi xong
+    flash(f"Đã tạo chiến dịch, đang gửi cho {c['total']} khách ({rate} email/phút).", "success")
+    return redirect(url_for("campaign_detail", cid=c["id"]))
+
+def _campaign_or_404(username, cid):
+    c = next((x for x in read_coll(username, "campaigns") if x["id"] == cid), None)
+    if c is None:
+        abort(404)
+    return c
+
+@app.route("/campaigns/<cid>")
+def campaign_detail(cid):
+    if require_login():
+        return require_login()
+    username = get_current_username()
+    c = _campaign_or_404(username, cid)
+    status = request.args.get("status")
+    log = [x for x in campaign_log(username, cid) if not status or x.get("status") == status]
+    names = {cu.id: cu.name for cu in shared_models(username, "customers")}
+    return render_template(
+        "campaign_detail.html",
+        c=c,
+        log=log[-500:][::-1],  # 500 người gần nhất, mới trước
+        log_count=len(log),
+        names=names,
+        status=status,
+        unread_count=count_unread_notifications(username),
+    )
+
+@app.route("/campaigns/<cid>/<action>", methods=["POST"])
+def campaign_action(cid, action):
+    # pause / resume / cancel
+    if require_login():
+        return require_login()
+    username = get_current_username()
+    _campaign_or_404(username, cid)
+    if action == "pause":
+        ok = _campaign_update(username, cid, {"status": "paused"}, when=lambda c: c["status"] in CAMPAIGN_LIVE)
+    elif action == "resume":
+        ok = _campaign_update(username, cid, {"status": "queued", "error": "", "lease_until": 0},
+                              when=lambda c: c["status"] == "paused" or (c["status"] in CAMPAIGN_LIVE and c.get("error")))
+        if ok:
+            on_commit(username, lambda: start_campaign(username, cid), locked=False)
+    elif action == "cancel":
+        ok = _campaign_update(username, cid, {"status": "cancelled", "finished_at": now_str(), "lease_until": 0},
+                              when=lambda c: c["status"] in CAMPAIGN_LIVE + ("paused",))
+    else:
+        abort(404)
+    flash("Đã cập nhật chiến dịch." if ok else "Chiến dịch không ở trạng thái phù hợp.", "success" if ok else "danger")
+    return redirect(url_for("campaign_detail", cid=cid))
+
+@app.route("/api/campaigns/<cid>")
+def api_campaign(cid):
+    # Tiến độ chiến dịch (trang chi tiết tự làm mới bằng API này)
+    if require_login():
+        return require_login()
+    c = _campaign_or_404(get_current_username(), cid)
+    return jsonify({"ok": True, **{k: c[k] for k in ("id", "status", "total", "sent", "failed", "skipped", "error", "cursor")}})
+
+@app.route("/unsubscribe/<token>", methods=["GET", "POST"])
+def unsubscribe(token):
+    # Link hủy nhận email trong chiến dịch (không cần đăng nhập; token ký bằng secret_key)
+    from itsdangerous import BadSignature
+    try:
+        username, cust_id = _unsub_serializer().loads(token)
+    except (BadSignature, ValueError, TypeError):
+        abort(404)
+    done = False
+    if request.method == "POST":  # Chỉ đổi dữ liệu khi khách bấm xác nhận (trình quét link trong mail chỉ GET)
+        with tenant_lock(username):
+            items = read_models(username, "customers")
+            cust = next((x for x in items if x.id == cust_id), None)
+            if cust is not None:
+                cust.update({"unsubscribed": True, "updated_at": now_str()})
+                write_models(username, "customers", items)
+        done = True
+    shop_name = _raw_shop_cfg(username).get("shop_name") or "Cửa hàng"
+    return render_template("unsubscribe.html", shop_name=shop_name, done=done)
+
 # ================== Thông báo ==================  # Khu thông báo stock thấp
 
 @app.route("/notifications", methods=["GET","POST"])
@@ -922,16 +4750,14 @@ def notifications():
         return require_login()  # Chặn nếu chưa login
 
     username = get_current_username()  # Lấy user hiện tại
-    notifs_path = user_file(username, "notifications.json")  # File noti của user
-    notifs = read_json(notifs_path, [])  # Đọc list noti
+    notifs = read_coll(username, "notifications")  # Đọc list noti
 
     if request.method == "POST":
         # Ưu tiên xử lý yêu cầu xóa toàn bộ thông báo
         delete_flag = request.args.get("delete")
         if delete_flag == "all":
             # Xóa TẤT CẢ thông báo của user
-            notifs = []
-            write_json(notifs_path, notifs)
+            delete_notifications(username, [n["id"] for n in notifs])
             return jsonify({"ok": True})
 
         # Còn lại là đánh dấu đã đọc như cũ
@@ -939,19 +4765,17 @@ def notifications():
 
         if nid == "all":
             # Đánh dấu tất cả thông báo là đã đọc
-            for n in notifs:
-                n["read"] = True
+            mark_notifications_read(username, [n["id"] for n in notifs if not n.get("read")])
         else:
             # Đánh dấu 1 thông báo (double-click)
-            for n in notifs:
-                if n["id"] == nid:
-                    n["read"] = True
-                    break
+            mark_notifications_read(username, [nid])
 
-        write_json(notifs_path, notifs)  # Ghi list noti sau khi update
         return jsonify({"ok": True})  # Trả JSON ok cho frontend
 
     # GET: hiển thị trang thông báo
+    tomb = tombstones(username)
+    if tomb["manga"] or tomb["customers"]:
+        notifs = [n for n in notifs if not _notif_of(n, tomb)]  # Thông báo của truyện/khách đã xóa (chờ dọn)
     notifs.sort(key=lambda x: x.get("created_at", ""), reverse=True)
     unread_count = count_unread_notifications(username)
     return render_template("notifications.html", notifs=notifs, unread_count=unread_count)
@@ -963,12 +4787,9 @@ def stats():
     if require_login():
         return require_login()
 
-    from datetime import datetime, timedelta
-
     username = get_current_username()
-    rentals = read_json(user_file(username, "rentals.json"), [])
-    customers = read_json(user_file(username, "customers.json"), [])
-    manga = read_json(user_file(username, "manga.json"), [])
+    customers = read_coll(username, "customers")
+    manga = read_coll(username, "manga")
 
     # Lấy ngày từ query string
     date_from = (request.args.get("from") or "").strip()
@@ -982,195 +4803,60 @@ def stats():
         if not date_to:
             date_to = today
 
-    # Hàm kiểm tra giao dịch có nằm trong khoảng ngày thuê hay không (created_at)
-    def in_range(rec):
-        try:
-            t = parse_dt(rec["created_at"])
-        except Exception:
-            return False
-
-        ok = True
-        if date_from:
-            if len(date_from) == 10:
-                ok &= t >= parse_dt(date_from + " 00:00:00")
-            else:
-                ok &= t >= parse_dt(date_from)
-        if date_to:
-            if len(date_to) == 10:
-                ok &= t <= parse_dt(date_to + " 23:59:59")
-            else:
-                ok &= t <= parse_dt(date_to)
-        return ok
-
-    # Giữ lại bản đầy đủ để tính phí trễ theo NGÀY và các thống kê khác
-    rentals_all = list(rentals)
-
-    # Lọc danh sách theo khoảng ngày thuê (cho tổng giao dịch + tổng giá thuê)
-    if date_from or date_to:
-        rentals = [r for r in rentals if in_range(r)]
-
-    # Hàm kiểm tra giao dịch có ngày trả nằm trong khoảng lọc hay không (returned_at)
-    # (giữ lại nếu sau này cần, hiện tại không dùng cho phí trễ nữa)
-    def in_return_range(rec):
-        returned_at_str = rec.get("returned_at")
-        if not returned_at_str:
-            return False
-        try:
-            t = parse_dt(returned_at_str)
-        except Exception:
-            return False
+    # Toàn bộ giao dịch dạng cột (cache trong bộ nhớ, chỉ dựng lại phần vừa thay đổi)
+    fr, codes = rental_frame(username)
 
-        ok = True
-        if date_from:
-            if len(date_from) == 10:
-                ok &= t >= parse_dt(date_from + " 00:00:00")
-            else:
-                ok &= t >= parse_dt(date_from)
-        if date_to:
-            if len(date_to) == 10:
-                ok &= t <= parse_dt(date_to + " 23:59:59")
-            else:
-                ok &= t <= parse_dt(date_to)
-        return ok
+    # Lọc theo khoảng ngày thuê (created_at) cho tổng giao dịch + tổng giá thuê
+    t0, t1 = range_bounds(date_from, date_to)
+    sel = range_mask(fr, t0, t1) & revenue_mask(username, fr, codes)  # keep_deleted_revenue: vẫn tính giao dịch đã ẩn
+    live = fr["open"] & ~hidden_mask(username, fr, codes)  # Đang thuê của truyện/khách còn tồn tại
 
-    # ========= Chuẩn bị một số biến date cho việc tính phí trễ theo NGÀY =========
-    def parse_date_only(s: str):
+    # ========= Khoảng ngày (chỉ khi nhập đúng dạng DD-MM-YYYY) để cắt phí trễ theo NGÀY =========
+    def parse_day(s: str):
         try:
-            return datetime.strptime(s, "%d-%m-%Y").date()
+            return epoch_day(datetime.strptime(s, "%d-%m-%Y").date())
         except Exception:
             return None
 
-    from_date = parse_date_only(date_from) if date_from else None
-    to_date = parse_date_only(date_to) if date_to else None
-    today_date = datetime.now().date()
+    from_day = parse_day(date_from) if date_from else None
+    to_day = parse_day(date_to) if date_to else None
 
-    # ========== 1) Thống kê doanh thu (giữ logic tổng tiền thuê như cũ) ==========
+    # ========== 1) Thống kê doanh thu ==========
     # Tổng số giao dịch + tổng giá thuê tính theo NGÀY THUÊ
-    total_trans = len(rentals)
-    total_rent = sum(price_to_int(r["rent_price"]) for r in rentals)
-
-    # Tổng phí trễ sẽ được tính lại dựa trên từng NGÀY TRỄ (xem thêm bên dưới)
-    total_late = 0
+    total_trans = int(sel.sum())
 
     # ========== 2) Thống kê tổng quan cửa hàng ==========
     total_customers = len(customers)
     total_manga = len(manga)
 
-    # Giao dịch đang cho thuê (chưa có returned_at)
-    rentals_open = [r for r in rentals_all if not r.get("returned_at")]
-    total_active = len(rentals_open)
-
-    # Giao dịch đang quá hạn
-    now_dt = datetime.now()
-    total_overdue = 0
-    for r in rentals_open:
-        try:
-            due_dt = parse_dt(r["due_at"])
-        except Exception:
-            continue
-        if due_dt < now_dt:
-            total_overdue += 1
-
-    # ========== 3) Chuẩn bị dữ liệu biểu đồ doanh thu theo ngày ==========
-    rent_per_day = {}
-    late_per_day = {}
+    # Giao dịch đang cho thuê (chưa có returned_at) và đang quá hạn
+    total_active = int(live.sum())
+    total_overdue = int((live & (fr["due"] != _NA) & (fr["due"] < epoch_now())).sum())
 
-    # Đọc cấu hình phí trễ/ngày mặc định để dùng khi rental không có late_fee_per_day riêng
-    shop_cfg = read_shop_cfg(username)
-    default_per_day = int(shop_cfg.get("late_fee_per_day", 10000) or 10000)
-
-    def date_only_from_str(dt_str: str):
-        try:
-            return parse_dt(dt_str).date()
-        except Exception:
-            return None
-
-    for r in rentals_all:
-        # --- Doanh thu tiền thuê theo ngày thuê ---
-        if in_range(r):
-            try:
-                d = parse_dt(r["created_at"]).strftime("%d-%m-%Y")
-            except Exception:
-                d = None
-            if d:
-                rent_per_day[d] = rent_per_day.get(d, 0) + price_to_int(r["rent_price"])
-
-        # --- Phí trễ tính THEO TỪNG NGÀY TRỄ ---
-        # Ngày đến hạn
-        due_date = date_only_from_str(r.get("due_at", ""))
-        if not due_date:
-            continue
-
-        # Ngày bắt đầu tính trễ là NGÀY SAU hạn trả
-        start_late_date = due_date + timedelta(days=1)
-
-        # Ngày kết thúc tính trễ:
-        # - Nếu đã trả: lấy ngày trả
-        # - Nếu chưa trả: lấy min(ngày hôm nay, to_date nếu người dùng chọn)
-        returned_at_str = r.get("returned_at", "")
-        if returned_at_str:
-            end_late_date = date_only_from_str(returned_at_str)
-        else:
-            end_late_date = today_date
-
-        if to_date and end_late_date and end_late_date > to_date:
-            end_late_date = to_date
-
-        # Nếu người dùng có chọn from_date thì không tính những ngày trước đó
-        if from_date and start_late_date < from_date:
-            start_late_date = from_date
-
-        # Nếu sau khi hiệu chỉnh mà end < start thì không có ngày trễ nào trong khoảng lọc
-        if not end_late_date or end_late_date < start_late_date:
-            continue
-
-        # Lấy phí trễ/ngày cho giao dịch này
-        per_day = r.get("late_fee_per_day", default_per_day)
-        try:
-            per_day_int = int(per_day)
-        except Exception:
-            per_day_int = default_per_day
-        if per_day_int < 0:
-            per_day_int = 0
-
-        # Cộng phí trễ cho từng ngày trong [start_late_date, end_late_date]
-        cur = start_late_date
-        while cur <= end_late_date:
-            d_str = cur.strftime("%d-%m-%Y")
-            late_per_day[d_str] = late_per_day.get(d_str, 0) + per_day_int
-            total_late += per_day_int
-            cur += timedelta(days=1)
-
-    # Tổng phí trễ trong khoảng lọc = tổng phí của mọi ngày trễ
+    # ========== 3) Doanh thu theo ngày: tiền thuê theo ngày thuê + phí trễ trải theo TỪNG NGÀY TRỄ ==========
+    revenue = report_revenue(username, fr, codes, sel, None, from_day=from_day, to_day=to_day)
+    total_rent = revenue["total_rent"]
+    total_late = revenue["total_late"]
     total = total_rent + total_late
-
-    all_days = sorted(
-        set(list(rent_per_day.keys()) + list(late_per_day.keys())),
-        key=lambda s: datetime.strptime(s, "%d-%m-%Y")
-    )
-    chart_labels = all_days
-    chart_revenue = [
-        rent_per_day.get(d, 0) + late_per_day.get(d, 0)
-        for d in all_days
-    ]
+    chart_labels = revenue["days"]
+    chart_revenue = revenue["revenue"]
 
     # ========== 4) Chuẩn bị dữ liệu biểu đồ thể loại ==========
-    manga_map = {m["id"]: m for m in manga}
-    genre_count = {}
-
-    for r in rentals:
-        mg = manga_map.get(r.get("manga_id"))
-        genre_str = ""
-        if mg:
-            genre_str = mg.get("genre", "") or ""
-        parts = [p.strip() for p in genre_str.split(",") if p.strip()]
-        if not parts:
-            parts = ["Khác"]
-        for g in parts:
-            genre_count[g] = genre_count.get(g, 0) + 1
-
-    genre_labels = list(genre_count.keys())
-    genre_counts = [genre_count[g] for g in genre_labels]
+    # Đếm lượt thuê theo mã truyện (bincount) rồi nhân với ma trận truyện x thể loại
+    mat, genre_names = genre_matrix(username, codes)
+    per_manga = np.bincount(fr["manga"][sel], minlength=mat.shape[0])
+    per_genre = per_manga @ mat
+    other = int(per_manga[~mat.any(axis=1)].sum())  # Truyện không có thể loại / đã xóa -> "Khác"
+
+    order = [int(gnr) for gnr in np.argsort(-per_genre, kind="stable") if per_genre[gnr]]
+    genre_labels = [genre_names.get(gnr, "Khác") for gnr in order]
+    genre_counts = [int(per_genre[gnr]) for gnr in order]
+    if other:
+        genre_labels.append("Khác")
+        genre_counts.append(other)
+
+    # ========== 5) Bảng xếp hạng 7/30/365 ngày (duy trì sẵn trong bộ nhớ) ==========
+    boards = get_leaderboards(username)
 
     unread_count = count_unread_notifications(username)
 
@@ -1192,9 +4878,60 @@ def stats():
         chart_revenue=chart_revenue,
         genre_labels=genre_labels,
         genre_counts=genre_counts,
+        boards=boards,
         unread_count=unread_count,
     )
 
+@app.route("/api/reports/<name>")
+def api_reports(name):
+    """
+    Báo cáo dạng JSON từ bộ phân tích dạng cột:
+      /api/reports/top-titles?from=01-11-2025&to=30-11-2025&limit=10
+    Tên hợp lệ: xem REPORTS. from/to lọc theo ngày thuê (bỏ trống = toàn bộ), limit mặc định 10.
+    """
+    if require_login():
+        return require_login()
+
+    report = REPORTS.get(name)
+    if report is None:
+        return jsonify({"ok": False, "error": "Không có báo cáo này.", "reports": sorted(REPORTS)}), 404
+
+    username = get_current_username()
+    date_from = (request.args.get("from") or "").strip()
+    date_to = (request.args.get("to") or "").strip()
+    limit = max(1, min(request.args.get("limit", 10, type=int), 1000))
+
+    fr, codes = rental_frame(username)
+    t0, t1 = range_bounds(date_from, date_to)
+    sel = range_mask(fr, t0, t1) & revenue_mask(username, fr, codes)
+    if report is report_revenue:
+        # Phí trễ cắt theo khoảng ngày giống /stats
+        day0 = t0 // 86400 if t0 is not None and len(date_from) == 10 else None
+        day1 = t1 // 86400 if t1 is not None and len(date_to) == 10 else None
+        data = report_revenue(username, fr, codes, sel, limit, from_day=day0, to_day=day1)
+    else:
+        data = report(username, fr, codes, sel, limit)
+    return jsonify({"ok": True, "report": name, "from": date_from, "to": date_to, "data": data})
+
+@app.route("/api/leaderboards")
+def api_leaderboards():
+    """
+    Bảng xếp hạng: /api/leaderboards?window=7&limit=5
+    window là 1 trong LEADERBOARD_WINDOWS (bỏ trống = tất cả), limit tối đa LEADERBOARD_SIZE.
+    """
+    if require_login():
+        return require_login()
+
+    window = request.args.get("window", type=int)
+    if window is not None and window not in LEADERBOARD_WINDOWS:
+        return jsonify({"ok": False, "error": "window phải là một trong %s." % (LEADERBOARD_WINDOWS,)}), 400
+    limit = max(1, request.args.get("limit", LEADERBOARD_SIZE, type=int))
+
+    username = get_current_username()
+    data = get_leaderboards(username, windows=(window,) if window else LEADERBOARD_WINDOWS, limit=limit)
+    return jsonify({"ok": True, **data})
+
+
 # ============== Cấu hình email (thêm 2 mẫu) ==============  # Khu default email template
 
 def default_email_cfg(shop_name: str = ""):
@@ -1288,26 +5025,30 @@ def email_settings():
             if late_per_day < 0:
                 late_per_day = 0  # Không cho phí âm
 
-            shop_cfg.update(
-                {
-                    "shop_name": shop_name,  # Update tên shop
-                    "default_rent_days": default_days,  # Update số ngày thuê
-                    "late_fee_per_day": late_per_day,  # Update phí trễ/ngày
-                }
-            )
-            write_json(user_file(username, "shop_config.json"), shop_cfg)
-            # Ghi shop_cfg mới vào file shop_config.json
-
-            # Cập nhật users.json để lần đăng nhập sau vẫn thấy tên mới
-            users = read_json(USERS_FILE, [])  # Đọc users.json chung
-            changed = False  # Cờ đánh dấu có đổi không
-            for u in users:  # Duyệt users
-                if u.get("username") == username:  # Đúng user hiện tại
-                    u["shop_name"] = shop_name  # Update shop_name trong users.json
-                    changed = True  # Đánh dấu đã đổi
-                    break  # Thoát vòng lặp
-            if changed:
-                write_json(USERS_FILE, users)  # Ghi lại users.json nếu có đổi
+            use_journal = request.form.get("journal_mode") == "1"  # Chế độ ghi nhanh bằng journal
+            keep_revenue = request.form.get("keep_deleted_revenue") == "1"  # Giữ doanh thu của truyện/khách đã xóa
+            fmt = request.form.get("store_format") or shop_cfg.get("store_format", STORE_FORMAT_DEFAULT)
+            if fmt not in available_store_formats():
+                fmt = "json"  # Định dạng lạ / chưa cài msgpack -> JSON
+
+            with tenant_lock(username):
+                shop_cfg.update(
+                    {
+                        "shop_name": shop_name,  # Update tên shop
+                        "default_rent_days": default_days,  # Update số ngày thuê
+                        "late_fee_per_day": late_per_day,  # Update phí trễ/ngày
+                        "journal_mode": use_journal,  # Bật/tắt journal
+                        "keep_deleted_revenue": keep_revenue,  # purge_tombstones gắn cờ thay vì xóa giao dịch
+                        "store_format": fmt,  # Định dạng file dữ liệu (áp dụng từ lần ghi tiếp theo)
+                    }
+                )
+                write_json(user_file(username, "shop_config.json"), shop_cfg)
+                # Ghi shop_cfg mới vào file shop_config.json
+                if not use_journal:
+                    journal_maintenance(username)  # Tắt journal -> gộp phần còn lại vào file JSON ngay
+
+            # Cập nhật account.json để lần đăng nhập sau vẫn thấy tên mới (chỉ ghi file của cửa hàng này)
+            update_account(username, shop_name=shop_name)
 
             # Cập nhật session hiện tại
             session["shop_name"] = shop_name  # Update shop_name trong session
@@ -1346,10 +5087,900 @@ def email_settings():
         "email_settings.html",
         cfg=cfg,
         shop_cfg=shop_cfg,
+        store_formats=available_store_formats(),
+        store_format=store_format(username),
         unread_count=unread_count,
     )
     # Render trang email_settings.html
 
+# ================== Quản trị toàn hệ thống (admin) ==================
+#
+# Chỉ các tài khoản trong biến môi trường ADMIN_USERS (phân tách bằng dấu phẩy) được xem.
+# Mỗi cửa hàng được tóm tắt riêng (doanh thu, đang thuê, quá hạn, truyện sắp hết); bản tóm tắt
+# được cache trong data/admin_summary_cache.json kèm "phiên bản dữ liệu" (chữ ký các file của cửa hàng),
+# nên chỉ những cửa hàng có dữ liệu thay đổi mới phải tính lại — song song bằng ProcessPoolExecutor.
+
+ADMIN_USERS = {u.strip().casefold() for u in os.environ.get("ADMIN_USERS", "").split(",") if u.strip()}
+ADMIN_WORKERS = int(os.environ.get("ADMIN_WORKERS", "0")) or None  # None = theo số CPU
+ADMIN_CACHE_FILE = "admin_summary_cache.json"  # Nằm trong DATA_DIR
+
+def is_admin(username=None):
+    username = username or get_current_username()
+    return bool(username) and username.casefold() in ADMIN_USERS
+
+app.jinja_env.globals["is_admin"] = is_admin  # Hiện menu Quản trị cho tài khoản admin
+
+def tenant_version(username):
+    # Phiên bản dữ liệu = chữ ký các file mà bản tóm tắt đọc tới (đổi khi có ghi mới)
+    names = [COLL_FILES[n] for n in ("manga", "customers", "rentals")] + [JOURNAL_FILE]
+    paths = [user_file(username, n) for n in names] + [os.path.join(archive_dir(username), "index.json")]
+    return [list(_file_sig(p) or ()) for p in paths]
+
+def summarize_tenant(username):
+    """
+    Tóm tắt 1 cửa hàng (chạy trong process con, không dùng session/request).
+    Doanh thu = tiền thuê + phí trễ đã lưu: phần nóng cộng từ rentals, phần lưu trữ lấy từ index.json.
+    """
+    manga = read_coll(username, "manga")
+    hot = read_coll(username, "rentals")
+    idx = read_archive_index(username)
+
+    revenue = sum(price_to_int(r.get("rent_price") or 0) + price_to_int(r.get("late_fee") or 0) for r in hot)
+    revenue += sum(int(m.get("total_rent", 0)) + int(m.get("total_late", 0)) for m in idx["months"].values())
+    open_due = sorted(_iso(r.get("due_at")) for r in hot if not r.get("returned_at"))  # Giao dịch mở luôn ở phần nóng
+    low = sorted(
+        ({"id": m["id"], "title": m.get("title", ""), "stock": int(m.get("stock", 0))}
+         for m in manga if int(m.get("stock", 0)) < LOW_STOCK_THRESHOLD),
+        key=lambda x: x["stock"],
+    )
+    return {
+        "manga": len(manga),
+        "customers": len(read_coll(username, "customers")),
+        "rentals": len(hot) + sum(int(m.get("count", 0)) for m in idx["months"].values()),
+        "revenue": revenue,
+        "active": len(open_due),
+        "open_due": open_due,  # Số quá hạn tính lúc đọc (phụ thuộc giờ hiện tại, không cache được)
+        "low_stock": low,
+        "computed_at": now_str(),
+    }
+
+def _summarize_tenant_job(data_dir, username):
+    # Hàm chạy trong process con (spawn): nhận DATA_DIR từ process cha
+    global DATA_DIR
+    DATA_DIR = data_dir
+    return summarize_tenant(username)
+
+def _with_overdue(summary):
+    now_iso = _iso(now_str())
+    out = dict(summary)
+    out["overdue"] = bisect.bisect_left(summary["open_due"], now_iso)  # "NaT" (hạn hỏng) xếp sau mọi ngày nên không bị đếm
+    return out
+
+def iter_tenant_summaries(usernames=None, workers=None):
+    """
+    Sinh (username, tóm tắt, lấy_từ_cache) cho từng cửa hàng ngay khi có kết quả:
+    cửa hàng không đổi dữ liệu trả ngay từ cache, còn lại tính song song và trả theo thứ tự xong trước.
+    """
+    usernames = list_tenants() if usernames is None else usernames
+    cache_path = os.path.join(DATA_DIR, ADMIN_CACHE_FILE)
+    cache = read_json(cache_path, {})
+    stale = []
+    for u in usernames:
+        v = tenant_version(u)
+        hit = cache.get(u)
+        if hit and hit.get("version") == v:
+            yield u, _with_overdue(hit["summary"]), True
+        else:
+            stale.append((u, v))
+    if not stale:
+        return
+
+    fresh = {}
+    try:
+        workers = workers or ADMIN_WORKERS or os.cpu_count() or 1
+        if len(stale) == 1 or workers == 1:
+            for u, v in stale:
+                fresh[u] = {"version": v, "summary": summarize_tenant(u)}
+                yield u, _with_overdue(fresh[u]["summary"]), False
+        else:
+            # spawn: process con không thừa hưởng khóa đang giữ bởi luồng nền của worker web
+            ctx = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=min(workers, len(stale)), mp_context=ctx) as ex:
+                futs = {ex.submit(_summarize_tenant_job, DATA_DIR, u): (u, v) for u, v in stale}
+                for fut in as_completed(futs):
+                    u, v = futs[fut]
+                    try:
+                        summary = fut.result()
+                    except Exception:
+                        app.logger.exception("Không tóm tắt được cửa hàng %s", u)
+                        continue
+                    fresh[u] = {"version": v, "summary": summary}
+                    yield u, _with_overdue(summary), False
+    finally:
+        if fresh:  # Gộp vào cache mới nhất (process khác có thể vừa ghi)
+            cache = read_json(cache_path, {})
+            cache.update(fresh)
+            write_json(cache_path, cache)
+
+def _admin_rows(results, shop_names):
+    # Gắn tên cửa hàng + cộng dồn tổng cho trang admin / CLI
+    totals = {"tenants": 0, "revenue": 0, "rentals": 0, "active": 0, "overdue": 0, "low_stock": 0}
+    for u, s, cached in results:
+        totals["tenants"] += 1
+        for k in ("revenue", "rentals", "active", "overdue"):
+            totals[k] += s[k]
+        totals["low_stock"] += len(s["low_stock"])
+        yield {"username": u, "shop_name": shop_names.get(u, u), "cached": cached, "totals": dict(totals), **s}
+
+@app.route("/admin")
+def admin_dashboard():
+    # Trang tổng quan mọi cửa hàng; trả dần từng dòng (stream) khi mỗi cửa hàng tính xong
+    if require_login():
+        return require_login()
+    if not is_admin():
+        abort(403)
+    shop_names = {u["username"]: u.get("shop_name", "") for u in list_accounts()}
+    rows = _admin_rows(iter_tenant_summaries(), shop_names)
+    return stream_template("admin_dashboard.html", rows=rows, low_stock_limit=LOW_STOCK_THRESHOLD)
+
+@app.cli.command("admin-report")
+@click.option("--json", "as_json", is_flag=True, help="In mỗi cửa hàng 1 dòng JSON.")
+@click.option("--workers", type=int, default=None, help="Số process tính song song.")
+def admin_report_command(as_json, workers):
+    """Tổng hợp doanh thu, đang thuê, quá hạn, truyện sắp hết của mọi cửa hàng."""
+    ensure_dirs()  # Tên cửa hàng đọc từ account.json (chuyển users.json cũ nếu còn)
+    shop_names = {u["username"]: u.get("shop_name", "") for u in list_accounts()}
+    last = None
+    for row in _admin_rows(iter_tenant_summaries(workers=workers), shop_names):
+        last = row["totals"]
+        if as_json:
+            print(json.dumps({k: v for k, v in row.items() if k not in ("open_due", "totals")}, ensure_ascii=False))
+        else:
+            print(f"{row['username']:<20} doanh thu {format_price(row['revenue']):>15}  đang thuê {row['active']:>5}"
+                  f"  quá hạn {row['overdue']:>5}  sắp hết {len(row['low_stock']):>4}{'  (cache)' if row['cached'] else ''}")
+    if last and not as_json:
+        print(f"{'TỔNG (' + str(last['tenants']) + ' cửa hàng)':<20} doanh thu {format_price(last['revenue']):>15}"
+              f"  đang thuê {last['active']:>5}  quá hạn {last['overdue']:>5}  sắp hết {last['low_stock']:>4}")
+
+# ================== Kiểm tra & sửa dữ liệu (check-data) ==================
+#
+# read_json trả giá trị mặc định khi file hỏng, nên 1 rentals.json hỏng trông y như cửa hàng chưa có giao dịch.
+# "flask check-data" quét mọi cửa hàng song song (mỗi cửa hàng 1 process con, giống admin-report) và báo:
+#   - file không parse được, collection không phải list bản ghi có id, id trùng
+#   - tồn kho / giá không phải số nguyên >= 0, giao dịch trỏ tới truyện/khách không còn
+#   - thông báo LOW_STOCK chưa đọc trùng nội dung, thời gian sai định dạng, hạn trả trước ngày thuê
+#   - chỉ mục dẫn xuất lệch với dữ liệu: index.json của lưu trữ, genre_mask, số lượt thuê theo thể loại không hợp lệ
+# --repair ghi lại (nguyên tử, giữ khóa cửa hàng) những gì sửa tự động được rồi dựng lại chỉ mục dẫn xuất.
+# File không parse được chỉ được báo, không bao giờ bị ghi đè (read_json sẽ coi nó là rỗng).
+
+_DT_FALLBACK_FMTS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%d/%m/%Y %H:%M:%S", "%d-%m-%Y %H:%M", "%d-%m-%Y")
+_ARCHIVE_MONTH_RE = re.compile(r"^(\d{4}-\d{2})\.json(\.gz)?$")
+
+def _parse_problem(path):
+    # None nếu file không có hoặc parse được; ngược lại là mô tả lỗi
+    try:
+        with _open_bin(path, "r") as f:
+            raw = f.read()
+        decode_data(raw)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    return None
+
+def _fix_dt(s):
+    # Chuẩn hóa thời gian ghi sai định dạng về DT_FMT; None nếu không đọc được
+    for fmt in _DT_FALLBACK_FMTS:
+        try:
+            return datetime.strptime(str(s).strip(), fmt).strftime(DT_FMT)
+        except ValueError:
+            pass
+    return None
+
+def _is_count(v):
+    return isinstance(v, int) and not isinstance(v, bool) and v >= 0
+
+def check_tenant(username, repair=False):
+    """
+    Kiểm tra 1 cửa hàng, trả list vấn đề {"level": "error"|"warn", "file", "code", "msg", "fixed"}.
+    repair=True: gộp journal, sửa những gì sửa được rồi ghi lại từng file bị đổi.
+    """
+    issues = []
+
+    def report(level, file, code, msg, fixed=False):
+        issues.append({"level": level, "file": file, "code": code, "msg": msg, "fixed": fixed})
+
+    with tenant_lock(username):
+        # 1) Cú pháp từng file
+        broken = set()
+        for name in list(COLL_FILES.values()) + ["shop_config.json", "email.json", CATALOG_DELETED_FILE, TOMBSTONE_FILE]:
+            err = _parse_problem(user_file(username, name))
+            if err:
+                broken.add(name)
+                report("error", name, "parse", f"Không đọc được file: {err}")
+        adir = archive_dir(username)
+        month_files = {}
+        if os.path.isdir(adir):
+            for fname in sorted(os.listdir(adir)):
+                m = _ARCHIVE_MONTH_RE.match(fname)
+                if not m:
+                    continue
+                err = _parse_problem(os.path.join(adir, fname))
+                if err:
+                    broken.add(fname)
+                    report("error", f"{ARCHIVE_DIR_NAME}/{fname}", "parse", f"Không đọc được file: {err}")
+                else:
+                    month_files.setdefault(m.group(1), []).append(fname)
+        index_path = os.path.join(adir, "index.json")
+        index_broken = _parse_problem(index_path)
+        if index_broken:
+            report("error", f"{ARCHIVE_DIR_NAME}/index.json", "parse", f"Không đọc được file: {index_broken}", fixed=repair)
+
+        jpath = user_file(username, JOURNAL_FILE)
+        try:
+            with open(jpath, "rb") as f:
+                jlines = f.read().split(b"\n")
+        except FileNotFoundError:
+            jlines = []
+        pending, frozen = 0, False  # frozen: không được ghi các collection có journal (gộp sẽ đè file hỏng)
+        for i, line in enumerate(jlines):
+            if not line.strip():
+                continue
+            try:
+                _json_loads(line)
+                pending += 1
+            except ValueError:
+                if i == len(jlines) - 1:  # Dòng cuối chưa có \n: ghi dở lúc crash, lần phát lại bỏ qua
+                    report("warn", JOURNAL_FILE, "torn_tail", "Dòng cuối journal ghi dở (được bỏ qua khi phát lại)")
+                else:
+                    report("error", JOURNAL_FILE, "parse", f"Dòng journal {i + 1} hỏng (bị bỏ qua khi phát lại)")
+        if pending:
+            journaled_broken = broken & {COLL_FILES[n] for n in JOURNALED_COLLS}
+            if repair and not journaled_broken:
+                journal_compact(username)  # Từ đây các file JSON là dữ liệu đầy đủ
+                report("warn", JOURNAL_FILE, "pending", f"Đã gộp {pending} bản ghi journal vào dữ liệu chính", fixed=True)
+            elif repair:
+                # Gộp lúc này sẽ ghi list rỗng đè lên file hỏng -> giữ nguyên journal
+                frozen = True
+                report("error", JOURNAL_FILE, "pending", "Không gộp journal vì snapshot đang hỏng: " + ", ".join(sorted(journaled_broken)))
+            else:
+                report("warn", JOURNAL_FILE, "pending", f"{pending} bản ghi journal chưa gộp (kiểm tra trên dữ liệu đã phát lại)")
+
+        # 2) Cấu trúc + id của các collection
+        colls, dirty = {}, set()
+        for n, fname in COLL_FILES.items():
+            if fname in broken:
+                continue
+            rows = read_json(user_file(username, fname), [])
+            if not isinstance(rows, list):
+                broken.add(fname)
+                report("error", fname, "schema", f"Phải là list bản ghi, đang là {type(rows).__name__}")
+                continue
+            kept, seen = [], {}
+            for i, r in enumerate(rows):
+                if not isinstance(r, dict):
+                    report("error", fname, "schema", f"Bản ghi #{i} không phải object (bị bỏ)" if repair else f"Bản ghi #{i} không phải object", fixed=repair)
+                    dirty.add(n)
+                    continue
+                rid = r.get("id")
+                if not (isinstance(rid, str) and rid.strip() or _is_count(rid)):  # Thể loại dùng id số
+                    new_id = str(uuid.uuid4())
+                    report("error", fname, "missing_id", f"Bản ghi #{i} không có id" + (f" (gán {new_id})" if repair else ""), fixed=repair)
+                    if repair:
+                        r["id"] = new_id
+                        dirty.add(n)
+                    rid = r["id"] if repair else None
+                if rid is not None and rid in seen:
+                    if seen[rid] == r:
+                        report("warn", fname, "dup_id", f"Bản ghi id={rid} lặp lại y hệt" + (" (bỏ bản trùng)" if repair else ""), fixed=repair)
+                        dirty.add(n)
+                        continue
+                    report("error", fname, "dup_id", f"2 bản ghi khác nhau cùng id={rid} (cần sửa tay)")
+                if rid is not None:
+                    seen.setdefault(rid, r)
+                kept.append(r)
+            colls[n] = kept
+
+        # Journal chưa gộp (không sửa): snapshot còn cũ -> các bước sau kiểm tra trên snapshot + journal đã phát lại
+        stale = False
+        if pending and not repair:
+            try:
+                state = journal_state(username)
+                for n in JOURNALED_COLLS:
+                    if n in colls:
+                        rows = state["colls"][n]
+                        colls[n] = encode_rows(n, rows) if n in MODELS else [dict(x) for x in rows]
+            except Exception:  # Snapshot có bản ghi hỏng -> không dựng lại được
+                stale = True
+                report("warn", JOURNAL_FILE, "pending_unchecked",
+                       "Journal chưa gộp, bỏ qua kiểm tra tham chiếu / trùng lặp / tồn kho: chạy lại với --repair")
+
+        # 3) Giá trị từng trường
+        def check_dt(n, r, key, required):
+            v = r.get(key)
+            if not v and not required:
+                return
+            try:
+                parse_dt(v)
+                return
+            except (TypeError, ValueError):
+                pass
+            fixed = _fix_dt(v) if v else None
+            report("error", COLL_FILES[n], "bad_time", f"{r.get('id')}: {key}={v!r} sai định dạng {DT_FMT}"
+                   + (f" (sửa thành {fixed})" if repair and fixed else ""), fixed=bool(repair and fixed))
+            if repair and fixed:
+                r[key] = fixed
+                dirty.add(n)
+
+        for m in colls.get("manga", []):
+            for key in ("stock", "rent_price"):
+                if not _is_count(m.get(key)):
+                    val = max(0, price_to_int(m.get(key) or 0))
+                    report("error", "manga.json", "bad_number", f"{m['id']}: {key}={m.get(key)!r} không phải số nguyên >= 0"
+                           + (f" (đặt {val})" if repair else ""), fixed=repair)
+                    if repair:
+                        m[key] = val
+                        dirty.add("manga")
+            ids = [gnr for gnr in m.get("genre_ids") or [] if isinstance(gnr, int)]
+            if "genre_ids" in m and m.get("genre_mask") != genre_mask(ids):
+                report("warn", "manga.json", "genre_mask", f"{m['id']}: genre_mask lệch với genre_ids", fixed=repair)
+                if repair:
+                    m["genre_mask"] = genre_mask(ids)
+                    dirty.add("manga")
+        for c in colls.get("customers", []):
+            check_dt("customers", c, "created_at", False)
+        for r in colls.get("rentals", []):
+            for key, required in (("created_at", True), ("due_at", True), ("returned_at", False)):
+                check_dt("rentals", r, key, required)
+            try:
+                if parse_dt(r["due_at"]) < parse_dt(r["created_at"]):
+                    report("warn", "rentals.json", "due_before_start", f"{r['id']}: hạn trả trước ngày thuê")
+            except (KeyError, TypeError, ValueError):
+                pass
+
+        # 4) Tham chiếu: giao dịch (phần nóng + lưu trữ) -> truyện/khách
+        archived = []
+        idx = {"months": {}} if index_broken else read_archive_index(username)
+        for month, files in month_files.items():
+            ref = (idx["months"].get(month) or {}).get("file")
+            for fname in files:
+                if ref and fname != ref:
+                    report("warn", f"{ARCHIVE_DIR_NAME}/{fname}", "orphan_file", f"Tháng {month} đã dùng {ref}, file này thừa")
+            fname = ref if ref in files else files[-1]
+            rows = read_json(os.path.join(adir, fname), [])
+            archived.append((month, fname, rows if isinstance(rows, list) else []))
+        manga_ids = {m["id"] for m in colls.get("manga", [])}
+        cust_ids = {c["id"] for c in colls.get("customers", [])}
+        tomb = {k: {} for k in TOMBSTONE_KINDS} if TOMBSTONE_FILE in broken else tombstones(username)
+        hot = colls.get("rentals", [])
+        # Giao dịch trỏ tới truyện/khách đã mất (tồn kho so với từng cuốn: xem bước 6)
+        for where, rows in [] if stale else [("rentals.json", hot)] + [(f"{ARCHIVE_DIR_NAME}/{f}", rows) for _, f, rows in archived]:
+            for r in rows:
+                if not isinstance(r, dict) or rental_hidden(r, tomb):  # Của truyện/khách đã xóa mềm: không tính là treo
+                    continue
+                is_open = not r.get("returned_at")
+                if "manga" in colls and r.get("manga_id") not in manga_ids:
+                    report("error" if is_open else "warn", where, "dangling_manga",
+                           f"{r.get('id')}: truyện {r.get('manga_id')!r} không còn" + (" (đang thuê, không trả được)" if is_open else ""))
+                if "customers" in colls and r.get("customer_id") not in cust_ids:
+                    report("error" if is_open else "warn", where, "dangling_customer",
+                           f"{r.get('id')}: khách {r.get('customer_id')!r} không còn")
+
+        # 5) Thông báo LOW_STOCK trùng: cùng truyện, cùng nội dung (cùng mức tồn kho), chưa đọc
+        notifs = None if stale else colls.get("notifications")
+        if notifs is not None:
+            newest = {}
+            for nt in notifs:
+                if nt.get("type") != "LOW_STOCK" or nt.get("read"):
+                    continue
+                mid = nt.get("manga_id")
+                if "manga" in colls and mid and mid not in manga_ids and mid not in tomb["manga"]:
+                    report("warn", "notifications.json", "dangling_notification", f"{nt['id']}: truyện {mid!r} không còn", fixed=repair)
+                    nt["_drop"] = True
+                    continue
+                key = (mid, nt.get("message"))
+                old = newest.get(key)
+                if old is None or _iso(nt.get("created_at")) >= _iso(old.get("created_at")):
+                    if old is not None:
+                        old["_drop"] = True
+                    newest[key] = nt
+                else:
+                    nt["_drop"] = True
+            dropped = [nt for nt in notifs if nt.pop("_drop", False)]
+            dups = len([nt for nt in dropped if nt.get("manga_id") in manga_ids])
+            if dups:
+                report("warn", "notifications.json", "dup_low_stock",
+                       f"{dups} thông báo LOW_STOCK chưa đọc bị trùng" + (" (giữ bản mới nhất mỗi truyện)" if repair else ""), fixed=repair)
+            if repair and dropped:
+                drop_ids = {id(nt) for nt in dropped}
+                colls["notifications"] = [nt for nt in notifs if id(nt) not in drop_ids]
+                dirty.add("notifications")
+
+        # 6) Chỉ mục dẫn xuất: index.json của lưu trữ, số lượt thuê theo thể loại
+        rebuilt = {"months": {}}
+        for month, fname, rows in archived:
+            if rows:
+                rebuilt["months"][month] = dict(_summarize_segment(rows), file=fname)
+        stale_months = sorted(
+            set(idx["months"]) ^ set(rebuilt["months"])
+            | {mo for mo in rebuilt["months"] if (idx["months"].get(mo) or {}).get("count") != rebuilt["months"][mo]["count"]
+               or idx["months"].get(mo, {}).get("file") != rebuilt["months"][mo]["file"]}
+        )
+        if stale_months and not index_broken:
+            report("warn", f"{ARCHIVE_DIR_NAME}/index.json", "stale_index", "Lệch với file tháng: " + ", ".join(stale_months), fixed=repair)
+        if repair and (stale_months or index_broken):
+            write_archive_index(username, {**idx, "months": rebuilt["months"]})
+
+        if "genres" in colls and "manga" in colls and not stale:
+            ids_by_manga = {m["id"]: m.get("genre_ids") or [] for m in colls["manga"]}
+            counts = {}
+            for rows in [hot] + [rows for _, _, rows in archived]:
+                for r in rows:
+                    if isinstance(r, dict):
+                        for gid in ids_by_manga.get(r.get("manga_id"), ()):
+                            counts[gid] = counts.get(gid, 0) + 1
+            total = len(hot) + sum(len(rows) for _, _, rows in archived)
+            for gnr in colls["genres"]:
+                # Lượt thuê được cộng theo thể loại lúc thuê (truyện đổi thể loại sau đó vẫn giữ số cũ),
+                # nên chỉ đếm lại khi con số chắc chắn sai
+                if _is_count(gnr.get("rentals")) and gnr["rentals"] <= total:
+                    continue
+                want = counts.get(gnr.get("id"), 0)
+                report("warn", "genres.json", "genre_count", f"{gnr.get('name')}: rentals={gnr.get('rentals')!r} (đếm lại: {want})", fixed=repair)
+                if repair:
+                    gnr["rentals"] = want
+                    dirty.add("genres")
+
+        # Tồn kho là bộ đếm suy ra từ copies.json: cuốn "rented" phải thuộc giao dịch đang mở, stock = số cuốn trên kệ
+        # (tồn kho trong colls đã gồm journal: đã gộp khi sửa, hoặc đã phát lại ở trên)
+        cfg = read_json(user_file(username, "shop_config.json"), {})
+        if "copies" in colls and "manga" in colls and isinstance(cfg, dict) and cfg.get("copy_inventory") and not stale:
+            open_ids = {r.get("id") for r in hot if isinstance(r, dict) and not r.get("returned_at")}
+            shelf = {}
+            for c in colls["copies"]:
+                if c.get("status") == "rented" and c.get("rental_id") not in open_ids:
+                    report("warn", "copies.json", "stray_copy", f"{c.get('id')}: đang cho thuê nhưng giao dịch {c.get('rental_id')!r} không mở"
+                           + (" (đưa về kệ)" if repair else ""), fixed=repair)
+                    if repair:
+                        c.update(status="available", rental_id="")
+                        dirty.add("copies")
+                if c.get("status") == "available":
+                    shelf[c.get("manga_id")] = shelf.get(c.get("manga_id"), 0) + 1
+            for m in colls["manga"]:
+                want = shelf.get(m["id"], 0)
+                if m.get("stock") != want:
+                    report("warn", "manga.json", "stock_drift", f"{m['id']}: stock={m.get('stock')!r} nhưng trên kệ có {want} cuốn"
+                           + (f" (đặt {want})" if repair else ""), fixed=repair)
+                    if repair:
+                        m["stock"] = want
+                        dirty.add("manga")
+
+        if repair:
+            for n in sorted(dirty):
+                if COLL_FILES[n] not in broken and not (frozen and n in JOURNALED_COLLS):
+                    write_coll(username, n, colls[n])
+    return issues
+
+def _check_tenant_job(data_dir, username, repair):
+    # Hàm chạy trong process con (spawn): nhận DATA_DIR từ process cha
+    global DATA_DIR
+    DATA_DIR = data_dir
+    return check_tenant(username, repair)
+
+def iter_tenant_checks(usernames=None, repair=False, workers=None):
+    # Sinh (username, list vấn đề) theo thứ tự cửa hàng nào xong trước
+    usernames = list_tenants() if usernames is None else usernames
+    workers = workers or ADMIN_WORKERS or os.cpu_count() or 1
+    if len(usernames) <= 1 or workers == 1:
+        for u in usernames:
+            yield u, check_tenant(u, repair)
+        return
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(workers, len(usernames)), mp_context=ctx) as ex:
+        futs = {ex.submit(_check_tenant_job, DATA_DIR, u, repair): u for u in usernames}
+        for fut in as_completed(futs):
+            u = futs[fut]
+            try:
+                yield u, fut.result()
+            except Exception as e:
+                yield u, [{"level": "error", "file": "", "code": "crash", "msg": f"Kiểm tra lỗi: {e}", "fixed": False}]
+
+@app.cli.command("check-data")
+@click.option("--repair", is_flag=True, help="Sửa những gì sửa tự động được và dựng lại chỉ mục.")
+@click.option("--user", "users", multiple=True, help="Chỉ kiểm tra cửa hàng này (lặp lại được).")
+@click.option("--json", "as_json", is_flag=True, help="In mỗi cửa hàng 1 dòng JSON.")
+@click.option("--workers", type=int, default=None, help="Số process chạy song song.")
+def check_data_command(repair, users, as_json, workers):
+    """Kiểm tra toàn vẹn dữ liệu mọi cửa hàng (cú pháp, cấu trúc, tham chiếu, chỉ mục)."""
+    unresolved = 0
+    for username, issues in iter_tenant_checks(list(users) or None, repair, workers):
+        unresolved += sum(1 for i in issues if i["level"] == "error" and not i["fixed"])
+        if as_json:
+            print(json.dumps({"username": username, "issues": issues}, ensure_ascii=False))
+            continue
+        print(f"{username}: {'OK' if not issues else str(len(issues)) + ' vấn đề'}")
+        for i in issues:
+            mark = "đã sửa" if i["fixed"] else ("LỖI" if i["level"] == "error" else "cảnh báo")
+            print(f"  [{mark}] {i['file']}: {i['msg']}")
+    if unresolved:
+        raise click.ClickException(f"Còn {unresolved} lỗi chưa sửa được.")
+
+# ================== Sao lưu (snapshot + kho nội dung) ==================
+#
+# "flask backup" chụp data/ thành 1 snapshot trong BACKUP_DIR:
+#   objects/ab/cdef...       nội dung file, đặt tên theo sha256 (mỗi nội dung chỉ lưu 1 lần)
+#   snapshots/<thời điểm>/   cây thư mục giống data/, mỗi file là hard link tới objects/ + manifest.json
+# File không đổi so với snapshot trước (cùng inode/mtime/kích thước) không phải đọc lại, chỉ thêm 1 hard link,
+# nên backup hằng giờ gần như không tốn thời gian và dung lượng. Mỗi cửa hàng được chụp khi đang giữ
+# tenant_lock (nhất quán giữa các file của cửa hàng). Ảnh bìa gốc (data/covers/, dùng chung giữa các cửa hàng) được
+# chụp sau các cửa hàng nên mọi ảnh mà snapshot trỏ tới đều có mặt. Khôi phục 1 cửa hàng = chép lại các file của nó
+# + ảnh bìa nó dùng mà đã bị xóa; dọn snapshot cũ xong thì object nào chỉ còn 1 link (không snapshot nào dùng) bị xóa.
+
+BACKUP_DIR = os.environ.get("BACKUP_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "backups"))
+BACKUP_SKIP_PREFIXES = (".lock", ".tmp-", VERSION_FILE)  # File tạm/khóa không cần sao lưu
+BACKUP_SKIP_ROOT = (ADMIN_CACHE_FILE,)  # File dẫn xuất ở gốc data/ (tính lại được)
+
+def _backup_paths():
+    return os.path.join(BACKUP_DIR, "objects"), os.path.join(BACKUP_DIR, "snapshots")
+
+def list_snapshots():
+    _, sdir = _backup_paths()
+    try:
+        return sorted(d for d in os.listdir(sdir) if not d.startswith("."))
+    except FileNotFoundError:
+        return []
+
+def _snapshot_manifest(name):
+    return read_json(os.path.join(_backup_paths()[1], name, "manifest.json"), {"files": {}})
+
+def _iter_backup_files(root, rel_root):
+    # (đường dẫn tuyệt đối, đường dẫn tương đối trong snapshot) của các file cần sao lưu dưới root
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            if fname.startswith(BACKUP_SKIP_PREFIXES):
+                continue
+            path = os.path.join(dirpath, fname)
+            yield path, os.path.join(rel_root, os.path.relpath(path, root)).replace(os.sep, "/")
+
+def _store_object(path, odir):
+    # Chép file vào kho theo sha256 (chỉ khi nội dung chưa có); trả (sha256, kích thước, có phải object mới)
+    h = hashlib.sha256()
+    tmp = os.path.join(odir, f".tmp-{os.getpid()}-{threading.get_ident()}")
+    with open(path, "rb") as src, open(tmp, "wb") as dst:
+        for chunk in iter(lambda: src.read(1 << 20), b""):
+            h.update(chunk)
+            dst.write(chunk)
+    digest = h.hexdigest()
+    obj = os.path.join(odir, digest[:2], digest[2:])
+    if os.path.exists(obj):
+        os.remove(tmp)
+        return digest, os.path.getsize(obj), False
+    os.makedirs(os.path.dirname(obj), exist_ok=True)
+    os.replace(tmp, obj)
+    return digest, os.path.getsize(obj), True
+
+def _snapshot_file(path, rel, odir, sdir_tmp, prev, files, stats):
+    st = os.stat(path)
+    key = [st.st_ino, st.st_mtime_ns, st.st_size]
+    old = prev.get(rel)
+    if old and old["stat"] == key and os.path.exists(os.path.join(odir, old["sha256"][:2], old["sha256"][2:])):
+        digest, size = old["sha256"], old["size"]  # Không đổi: khỏi đọc lại
+    else:
+        digest, size, new = _store_object(path, odir)
+        stats["hashed"] += 1
+        if new:
+            stats["new_objects"] += 1
+            stats["new_bytes"] += size
+    dst = os.path.join(sdir_tmp, rel)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    os.link(os.path.join(odir, digest[:2], digest[2:]), dst)
+    files[rel] = {"sha256": digest, "size": size, "stat": key}
+    stats["files"] += 1
+    stats["bytes"] += size
+
+def create_backup(usernames=None):
+    """
+    Chụp 1 snapshot mới (mọi cửa hàng, hoặc chỉ usernames). Trả (tên snapshot, thống kê).
+    Object đã ghi vào kho trước khi snapshot hoàn tất là vô hại: lần dọn sau sẽ xóa nếu không ai dùng.
+    """
+    t0 = time.perf_counter()
+    odir, sdir = _backup_paths()
+    os.makedirs(odir, exist_ok=True)
+    os.makedirs(sdir, exist_ok=True)
+    name = datetime.now().strftime("%Y%m%d-%H%M%S")
+    while os.path.exists(os.path.join(sdir, name)):
+        name += "-1"
+    snaps = list_snapshots()
+    prev = _snapshot_manifest(snaps[-1])["files"] if snaps else {}
+    sdir_tmp = os.path.join(sdir, f".tmp-{name}")
+    files = {}
+    stats = {"files": 0, "bytes": 0, "hashed": 0, "new_objects": 0, "new_bytes": 0}
+    try:
+        for entry in sorted(os.scandir(DATA_DIR), key=lambda e: e.name):  # File ở gốc data/ (users.json.migrated...)
+            if entry.is_file() and not entry.name.startswith(BACKUP_SKIP_PREFIXES) and entry.name not in BACKUP_SKIP_ROOT:
+                _snapshot_file(entry.path, entry.name, odir, sdir_tmp, prev, files, stats)
+        tenants = list_tenants() if usernames is None else usernames
+        for username in tenants:
+            with tenant_lock(username):  # Không ai ghi xen vào khi đang chụp cửa hàng này
+                for path, rel in _iter_backup_files(user_root(username), f"users/{username}"):
+                    _snapshot_file(path, rel, odir, sdir_tmp, prev, files, stats)
+        # Ảnh gốc đặt tên theo hash, không bao giờ bị ghi đè: chụp sau cửa hàng (ảnh tải lên trước khi truyện trỏ tới)
+        for path, rel in _iter_backup_files(os.path.join(DATA_DIR, "covers"), "covers"):
+            _snapshot_file(path, rel, odir, sdir_tmp, prev, files, stats)
+        stats["tenants"] = len(tenants)
+        stats["sec"] = round(time.perf_counter() - t0, 3)
+        write_json(os.path.join(sdir_tmp, "manifest.json"),
+                   {"created_at": now_str(), "tenants": tenants, "stats": stats, "files": files}, "compact")
+        os.rename(sdir_tmp, os.path.join(sdir, name))  # Snapshot chỉ xuất hiện khi đã đầy đủ
+    except BaseException:
+        shutil.rmtree(sdir_tmp, ignore_errors=True)
+        raise
+    return name, stats
+
+def restore_tenant(name, username):
+    """
+    Khôi phục dữ liệu 1 cửa hàng từ snapshot name: thay từng file (nguyên tử), xóa file không có trong snapshot,
+    chép lại ảnh bìa mà truyện của cửa hàng trỏ tới nhưng đã bị xóa. Trả số file đã khôi phục.
+    """
+    _, sdir = _backup_paths()
+    prefix = f"users/{username}/"
+    manifest = _snapshot_manifest(name)["files"]
+    wanted = {rel[len(prefix):]: meta for rel, meta in manifest.items() if rel.startswith(prefix)}
+    if not wanted:
+        raise ValueError(f"Snapshot {name} không có cửa hàng {username}")
+    root = user_root(username)
+    with tenant_lock(username):
+        for sub in wanted:
+            dst = os.path.join(root, *sub.split("/"))
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            tmp = os.path.join(os.path.dirname(dst), f".tmp-{os.getpid()}-{threading.get_ident()}-restore")
+            shutil.copyfile(os.path.join(sdir, name, *prefix.split("/"), *sub.split("/")), tmp)  # Chép (không link): file khôi phục sẽ bị ghi tiếp
+            os.replace(tmp, dst)
+        for path, rel in list(_iter_backup_files(root, "")):
+            if rel not in wanted:
+                os.remove(path)
+        bump_tenant_version(username)  # Worker đang chạy nạp lại cửa hàng này
+        _migrated_checked.discard(username)
+        evict_tenant(username)
+        restored = len(wanted)
+        for h in sorted({m.get("cover") for m in shared_models(username, "manga")} - {None, ""}):
+            rel = f"covers/{h[:2]}/{h}"
+            dst = cover_src_path(h)
+            if rel not in manifest or os.path.exists(dst):
+                continue
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            tmp = os.path.join(os.path.dirname(dst), f".tmp-{h}-{os.getpid()}-{threading.get_ident()}")
+            shutil.copyfile(os.path.join(sdir, name, *rel.split("/")), tmp)
+            os.replace(tmp, dst)  # Thumbnail được tạo lại khi trang hiển thị (cover_thumbs)
+            restored += 1
+    return restored
+
+def prune_backups(keep_last=24, keep_daily=7):
+    """
+    Giữ keep_last snapshot mới nhất + snapshot cuối cùng của mỗi ngày trong keep_daily ngày gần nhất có backup;
+    xóa các snapshot còn lại rồi dọn object không còn snapshot nào link tới. Trả (số snapshot xóa, số object xóa).
+    """
+    odir, sdir = _backup_paths()
+    snaps = list_snapshots()
+    keep = set(snaps[-keep_last:]) if keep_last > 0 else set()
+    by_day = {}
+    for s in snaps:
+        by_day[s[:8]] = s  # Tên bắt đầu bằng YYYYMMDD, sắp tăng dần -> giữ bản cuối ngày
+    keep.update(by_day[d] for d in sorted(by_day)[-keep_daily:] if keep_daily > 0)
+    removed = [s for s in snaps if s not in keep]
+    for s in removed:
+        shutil.rmtree(os.path.join(sdir, s))
+    objects = 0
+    for dirpath, _, filenames in os.walk(odir):
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            if fname.startswith(".tmp-") or os.stat(path).st_nlink <= 1:  # Chỉ còn chính nó trong kho
+                os.remove(path)
+                objects += 1
+    return len(removed), objects
+
+@app.cli.command("backup")
+@click.option("--user", "users", multiple=True, help="Chỉ sao lưu cửa hàng này (lặp lại được).")
+@click.option("--prune/--no-prune", default=True, show_default=True, help="Dọn snapshot cũ sau khi chụp.")
+@click.option("--keep-last", type=int, default=24, show_default=True)
+@click.option("--keep-daily", type=int, default=7, show_default=True)
+def backup_command(users, prune, keep_last, keep_daily):
+    """Chụp snapshot data/ vào BACKUP_DIR (chỉ lưu nội dung mới)."""
+    name, st = create_backup(list(users) or None)
+    print(f"Snapshot {name}: {st['tenants']} cửa hàng, {st['files']} file ({st['bytes'] / 1024 / 1024:.1f}MB),"
+          f" đọc lại {st['hashed']} file, {st['new_objects']} object mới ({st['new_bytes'] / 1024 / 1024:.2f}MB) trong {st['sec']}s")
+    if prune:
+        snaps, objs = prune_backups(keep_last, keep_daily)
+        if snaps or objs:
+            print(f"Đã dọn {snaps} snapshot cũ, {objs} object không còn dùng")
+
+@app.cli.command("backup-list")
+def backup_list_command():
+    """Liệt kê các snapshot."""
+    for name in list_snapshots():
+        man = _snapshot_manifest(name)
+        st = man.get("stats", {})
+        print(f"{name}  {man.get('created_at', '')}  {len(man.get('tenants', []))} cửa hàng  {st.get('files', 0)} file"
+              f"  +{st.get('new_bytes', 0) / 1024 / 1024:.2f}MB")
+
+@app.cli.command("backup-restore")
+@click.argument("snapshot")
+@click.option("--user", "username", required=True, help="Cửa hàng cần khôi phục.")
+def backup_restore_command(snapshot, username):
+    """Khôi phục dữ liệu 1 cửa hàng từ SNAPSHOT (tên trong backup-list, hoặc "latest")."""
+    snaps = list_snapshots()
+    if snapshot == "latest" and snaps:
+        snapshot = snaps[-1]
+    if snapshot not in snaps:
+        raise click.ClickException(f"Không có snapshot {snapshot}")
+    try:
+        n = restore_tenant(snapshot, username)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print(f"Đã khôi phục {n} file của {username} từ {snapshot}")
+
+# ================== Khởi động nhanh (cold start) ==================
+#
+# Gói free của Render cho instance ngủ khi không có truy cập; request đầu tiên sau khi thức dậy phải chờ
+# nạp app. Để giảm thời gian này: module gửi mail chỉ nạp khi gửi, template đã biên dịch được lưu ra đĩa
+# (JINJA_CACHE_DIR, dựng sẵn lúc build bằng "flask precompile-templates"), thư mục cửa hàng chỉ makedirs
+# 1 lần mỗi process, và (tùy chọn) WARMUP_TENANTS cửa hàng hoạt động gần nhất được nạp sẵn ở luồng nền.
+# Thời gian nạp app và thời gian đến byte đầu tiên của request đầu tiên xem ở /api/metrics.
+
+JINJA_CACHE_DIR = os.environ.get("JINJA_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".jinja_cache"))  # "" để tắt
+WARMUP_TENANTS = int(os.environ.get("WARMUP_TENANTS", "0"))  # Số cửa hàng nạp sẵn khi process khởi động (0 = tắt)
+APP_PRELOAD = os.environ.get("APP_PRELOAD", "0") == "1"  # Đặt bởi gunicorn.conf.py khi master nạp app trước khi fork
+
+boot_metrics = {
+    "pid": os.getpid(),
+    "started_at": now_str(),
+    "import_sec": None,  # Thời gian nạp module app.py
+    "first_response_sec": None,  # Từ lúc bắt đầu nạp app đến khi có response đầu tiên (TTFB sau khi thức dậy)
+    "first_request": None,  # Đường dẫn + thời gian xử lý của request đầu tiên
+    "warmup_sec": None,
+    "warmed_tenants": [],
+    "preloaded_tenants": None,  # Số cửa hàng master gunicorn nạp sẵn trước khi fork (None = không preload)
+    "preload_sec": None,
+}
+
+if JINJA_CACHE_DIR:
+    try:
+        os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+    except OSError:  # Thư mục chỉ đọc -> biên dịch template trong bộ nhớ như cũ
+        app.logger.warning("Không tạo được JINJA_CACHE_DIR=%s", JINJA_CACHE_DIR)
+
+def compile_templates():
+    # Biên dịch (hoặc nạp bytecode đã lưu) mọi template vào cache của Jinja; trả số template
+    names = app.jinja_env.list_templates(extensions=("html",))
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+def most_active_tenants(limit):
+    # Cửa hàng ghi giao dịch gần nhất lên trước (mtime rentals.json / journal.log)
+    def last_write(username):
+        return max(
+            (os.path.getmtime(p) for p in (user_file(username, COLL_FILES["rentals"]), user_file(username, JOURNAL_FILE))
+             if os.path.exists(p)),
+            default=0,
+        )
+    return heapq.nlargest(limit, filter(owns_tenant, list_tenants()), key=last_write)
+
+def warm_up(limit=None):
+    """
+    Nạp sẵn cho các cửa hàng hoạt động nhiều nhất: chuyển đổi dữ liệu 1 lần, trạng thái journal (chỉ mục id),
+    bảng dạng cột cho thống kê và bảng xếp hạng; kèm biên dịch toàn bộ template.
+    """
+    t0 = time.perf_counter()
+    limit = WARMUP_TENANTS if limit is None else limit
+    with app.app_context():
+        compile_templates()
+    warmed = [u for u in most_active_tenants(limit) if warm_tenant(u)]
+    boot_metrics["warmed_tenants"] = warmed
+    boot_metrics["warmup_sec"] = round(time.perf_counter() - t0, 4)
+    return warmed
+
+def warm_tenant(username):
+    # Nạp mọi trạng thái đọc của 1 cửa hàng vào bộ nhớ process; trả False nếu lỗi
+    try:
+        if username not in _migrated_checked:
+            for migrate in TENANT_MIGRATIONS:
+                migrate(username)
+            _migrated_checked.add(username)
+        for name in MODELS:
+            shared_models(username, name)
+        rental_frame(username)
+        get_leaderboards(username)
+        return True
+    except Exception:
+        app.logger.exception("Nạp sẵn cửa hàng %s lỗi", username)
+        return False
+
+def preload_tenants():
+    """
+    Gọi ở process master của gunicorn (preload, xem gunicorn.conf.py) ngay trước khi fork worker:
+    nạp danh mục + chỉ mục của MỌI cửa hàng rồi gc.freeze() để bộ gom rác của worker không chạm
+    (và vì thế không sao chép) các trang nhớ dùng chung này. Worker chỉ nạp lại cửa hàng có .version đổi.
+    """
+    t0 = time.perf_counter()
+    with app.app_context():
+        compile_templates()
+    warmed = [u for u in list_tenants() if owns_tenant(u) and warm_tenant(u)]
+    for username in warmed:
+        _tenant_usage[username].update(pinned=True, bytes=tenant_bytes(username), dirty=False)
+    gc.collect()
+    gc.freeze()
+    boot_metrics["preloaded_tenants"] = len(warmed)
+    boot_metrics["preload_sec"] = round(time.perf_counter() - t0, 4)
+    return warmed
+
+def start_warmup():
+    # Chạy warm_up ở luồng nền khi process web khởi động (không chạy trong process con của admin-report,
+    # cũng không chạy trong master gunicorn preload: luồng không sống qua fork, master đã tự nạp hết)
+    if WARMUP_TENANTS <= 0 or APP_PRELOAD or multiprocessing.parent_process() is not None:
+        return
+    threading.Thread(target=warm_up, name="warmup", daemon=True).start()
+
+@app.after_request
+def record_first_response(resp):
+    if boot_metrics["first_response_sec"] is None:
+        now = time.perf_counter()
+        boot_metrics["first_response_sec"] = round(now - _BOOT_T0, 4)
+        boot_metrics["first_request"] = {
+            "path": request.path,
+            "sec": round(now - g.get("request_t0", now), 4),
+        }
+        app.logger.info("Response đầu tiên sau %.3fs kể từ lúc khởi động (%s)",
+                        boot_metrics["first_response_sec"], request.path)
+    return resp
+
+def mark_request_start():
+    if boot_metrics["first_response_sec"] is None:
+        g.request_t0 = time.perf_counter()
+
+app.before_request_funcs.setdefault(None, []).insert(0, mark_request_start)  # Chạy trước mọi hook khác (đo cả chuyển đổi dữ liệu)
+
+@app.route("/api/metrics")
+def api_metrics():
+    # Số liệu khởi động của process đang trả lời (mỗi worker gunicorn có số liệu riêng)
+    if require_login():
+        return require_login()
+    if not is_admin():
+        abort(403)
+    return jsonify({
+        "ok": True,
+        "boot": boot_metrics,
+        "uptime_sec": round(time.perf_counter() - _BOOT_T0, 1),
+        "cached_tenants": {
+            "shared": len(_shared_models),
+            "journal": len(_journal_states),
+            "analytics": len(_analytics),
+            "leaderboards": len(_leaderboards),
+        },
+        "affinity_node": AFFINITY_NODE or None,  # Node backend trả lời request này (None = không chạy sau proxy)
+        "tenant_states": tenant_state_stats(),  # Cửa hàng nằm trong bộ nhớ, kích thước ước lượng, tỉ lệ trúng cache
+        "jinja_bytecode_cache": bool(app.jinja_env.bytecode_cache),
+    })
+
+@app.cli.command("precompile-templates")
+def precompile_templates_command():
+    """Biên dịch sẵn mọi template vào JINJA_CACHE_DIR (chạy lúc build để lần khởi động đầu không phải biên dịch)."""
+    if not app.jinja_env.bytecode_cache:
+        raise click.ClickException("JINJA_CACHE_DIR đang tắt.")
+    print(f"Đã biên dịch {compile_templates()} template vào {JINJA_CACHE_DIR}")
+
+@app.cli.command("warm-up")
+@click.option("--limit", type=int, default=5, show_default=True, help="Số cửa hàng hoạt động gần nhất.")
+def warm_up_command(limit):
+    """Thử nạp sẵn các cửa hàng hoạt động nhiều nhất và in thời gian."""
+    warmed = warm_up(limit)
+    print(f"Đã nạp sẵn {len(warmed)} cửa hàng trong {boot_metrics['warmup_sec']}s: {', '.join(warmed)}")
+
+start_warmup()
+boot_metrics["import_sec"] = round(time.perf_counter() - _BOOT_T0, 4)
+
 # ================== Run ==================  # Khu chạy app
 
 if __name__ == "__main__":
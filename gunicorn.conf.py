@@ -0,0 +1,25 @@
+# Cấu hình gunicorn: master nạp app + danh mục mọi cửa hàng MỘT lần rồi mới fork worker,
+# các worker dùng chung trang nhớ đó theo copy-on-write (xem preload_tenants trong app.py).
+# Đặt APP_PRELOAD=0 để quay lại kiểu cũ (mỗi worker tự nạp app và dữ liệu).
+import os
+
+os.environ.setdefault("APP_PRELOAD", "1")  # Phải đặt trước khi nạp app.py
+
+preload_app = os.environ["APP_PRELOAD"] == "1"
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+
+
+def when_ready(server):
+    # Chạy trong master, sau khi nạp app (preload) và trước khi fork worker đầu tiên
+    if preload_app:
+        import app
+
+        warmed = app.preload_tenants()
+        server.log.info("Đã nạp sẵn %d cửa hàng trong %.2fs", len(warmed), app.boot_metrics["preload_sec"])
+
+
+def post_fork(server, worker):
+    if preload_app:
+        import app
+
+        app.boot_metrics["pid"] = os.getpid()  # Số liệu khởi động của từng worker
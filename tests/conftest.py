@@ -0,0 +1,64 @@
+# tests/conftest.py — app chạy trên thư mục data tạm cho mỗi test
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("MAINTENANCE_INTERVAL_SEC", "0")  # Không chạy luồng bảo trì nền trong test
+os.environ.setdefault("PASSWORD_HASH_ITERATIONS", "1000")  # Băm mật khẩu nhanh cho test
+os.environ.setdefault("JINJA_CACHE_DIR", "")
+os.environ.setdefault("WARMUP_TENANTS", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as A  # noqa: E402
+
+_CACHES = ("_journal_states", "_raw_cfg_cache", "_shared_models", "_tombstone_cache", "_analytics",
+           "_leaderboards", "_waitlist_cache", "_copy_cache", "_user_roots", "_account_cache", "_tenant_usage",
+           "_catalog_deleted_cache")
+
+
+@pytest.fixture
+def appmod(tmp_path, monkeypatch):
+    data = tmp_path / "data"
+    monkeypatch.setattr(A, "DATA_DIR", str(data))
+    monkeypatch.setattr(A, "USERS_FILE", str(data / "users.json"))
+    monkeypatch.setattr(A.app, "static_folder", str(tmp_path / "static"))
+    A.app.config["TESTING"] = True
+    for name in _CACHES:
+        getattr(A, name).clear()
+    A._migrated_checked.clear()
+    yield A
+    for name in _CACHES:
+        getattr(A, name).clear()
+
+
+@pytest.fixture
+def client(appmod):
+    c = appmod.app.test_client()
+    r = c.post("/register", data=dict(username="shop1", email="a@b.c", password="x", repass="x", shop_name="S1"))
+    assert r.status_code in (200, 302)
+    return c
+
+
+@pytest.fixture
+def shop(client, appmod):
+    # Cửa hàng shop1 đã đăng nhập, có 2 truyện + 1 khách
+    def post(url, **data):
+        r = client.post(url, data=data)
+        assert r.status_code in (200, 302), r.data[:500]
+        return r
+    post("/manga/add", id="M1", title="Naruto", genre="Action, Ninja", author="K", rent_price="10000", stock="3", barcode="111")
+    post("/manga/add", id="M2", title="One Piece", genre="Action, Pirate", author="O", rent_price="12000", stock="2", barcode="222")
+    post("/customers/add", id="C1", name="An", age="20", phone="0901", address="HN", national_id="1", email="an@x.y")
+    return "shop1"
+
+
+@pytest.fixture
+def set_cfg(appmod):
+    # Sửa thẳng shop_config.json (journal_mode, ...) như khi sửa tay
+    def apply(username, **fields):
+        path = appmod.user_file(username, "shop_config.json")
+        cfg = appmod.read_json(path, {})
+        cfg.update(fields)
+        appmod.write_json(path, cfg)
+    return apply
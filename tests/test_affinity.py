@@ -0,0 +1,60 @@
+# affinity.py: vòng băm nhất quán + proxy trả lỗi khi chưa có backend
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import affinity  # noqa: E402
+
+
+def test_ring_is_stable_and_moves_few_keys():
+    keys = [f"u:shop{i}" for i in range(400)]
+    ring3 = affinity.HashRing(["n0", "n1", "n2"])
+    assert [ring3.node_for(k) for k in keys] == [affinity.HashRing(["n0", "n1", "n2"]).node_for(k) for k in keys]
+    ring4 = affinity.HashRing(["n0", "n1", "n2", "n3"])
+    moved = sum(ring3.node_for(k) != ring4.node_for(k) for k in keys)
+    assert moved < len(keys) / 2  # Thêm 1 node chỉ chuyển khoảng 1/4 số cửa hàng
+    assert all(ring4.node_for(k) == "n3" for k in keys if ring3.node_for(k) != ring4.node_for(k))
+
+
+def test_routing_key_prefers_tenant_cookie():
+    head = b"GET / HTTP/1.1\r\nHost: x\r\nCookie: a=1; tenant=abc\r\n\r\n"
+    assert affinity._routing_key(head, ("1.2.3.4", 5)) == "u:abc"
+    assert affinity._routing_key(b"GET / HTTP/1.1\r\n\r\n", ("1.2.3.4", 5)) == "ip:1.2.3.4"
+
+
+def _roundtrip(disp):
+    async def run():
+        server = await asyncio.start_server(disp.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET / HTTP/1.1\r\nHost: x\r\n\r\n")
+            await writer.drain()
+            data = await reader.read()
+            writer.close()
+            return data
+    return asyncio.run(run())
+
+
+def test_empty_ring_returns_503(tmp_path):
+    disp = affinity.Dispatcher(str(tmp_path), str(tmp_path / "ring.json"), 1)
+    assert _roundtrip(disp).startswith(b"HTTP/1.1 503 ")
+
+
+def test_unreachable_node_returns_502(tmp_path):
+    disp = affinity.Dispatcher(str(tmp_path), str(tmp_path / "ring.json"), 1)
+    disp.ring = affinity.HashRing(["n0"])  # Có trong vòng băm nhưng không có socket
+    assert _roundtrip(disp).startswith(b"HTTP/1.1 502 ")
+
+
+def test_backends_use_gunicorn_config(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(affinity.subprocess, "Popen", lambda args, **kw: calls.append((args, kw)))
+    disp = affinity.Dispatcher(str(tmp_path), str(tmp_path / "ring.json"), 2)
+    disp.spawn()
+    args, kw = calls[0]
+    assert args[args.index("-c") + 1] == os.path.join(affinity.APP_DIR, "gunicorn.conf.py")
+    assert args[args.index("--workers") + 1] == "1"
+    assert kw["env"]["AFFINITY_NODE"] == "n0"
@@ -0,0 +1,79 @@
+# build-assets: file vendor tải về phải khớp sha256 đã ghim; thiếu / chưa ghim / sai hash -> lệnh dừng với mã lỗi
+import hashlib
+import os
+from io import BytesIO
+
+import pytest
+
+
+@pytest.fixture
+def vendor(appmod, tmp_path, monkeypatch):
+    # "CDN" giả: URL -> nội dung; URL không có -> lỗi mạng
+    A = appmod
+    served = {url: f"/* {name} */".encode() for name, url in A.VENDOR_ASSETS.items()}
+    fetched = []
+
+    def urlopen(url, timeout=None):
+        fetched.append(url)
+        if url not in served:
+            raise OSError("mất mạng")
+        return BytesIO(served[url])
+    monkeypatch.setattr(A.urllib.request, "urlopen", urlopen)
+    monkeypatch.setattr(A, "VENDOR_PINS_FILE", str(tmp_path / "vendor-assets.sha256"))
+    return A, served, fetched
+
+
+def _pin(A, served):
+    with open(A.VENDOR_PINS_FILE, "w") as f:
+        for name, url in A.VENDOR_ASSETS.items():
+            f.write(f"{hashlib.sha256(served[url]).hexdigest()}  {name}\n")
+
+
+def _run(A, *args):
+    return A.app.test_cli_runner().invoke(args=["build-assets", *args])
+
+
+def test_pinned_download_builds(vendor):
+    A, served, fetched = vendor
+    _pin(A, served)
+    r = _run(A)
+    assert r.exit_code == 0, r.output
+    assert set(A.VENDOR_ASSETS) <= set(A.asset_manifest())
+    assert len(fetched) == len(A.VENDOR_ASSETS)
+    assert _run(A).exit_code == 0 and len(fetched) == len(A.VENDOR_ASSETS)  # Đã có file: không tải lại
+
+
+def test_tampered_download_is_rejected(vendor):
+    A, served, _ = vendor
+    _pin(A, served)
+    name, url = next(iter(A.VENDOR_ASSETS.items()))
+    served[url] = b"alert('x')"
+    r = _run(A)
+    assert r.exit_code != 0 and name in r.output and "sha256" in r.output
+    assert not os.path.exists(A._static_path(name))  # Không ghi file sai hash
+    assert not os.path.exists(A._static_path(f"{A.ASSET_DIST}/manifest.json"))
+
+
+def test_failed_download_fails_build(vendor):
+    A, served, _ = vendor
+    _pin(A, served)
+    name, url = list(A.VENDOR_ASSETS.items())[-1]
+    del served[url]
+    r = _run(A)
+    assert r.exit_code != 0 and f"{name} (chưa tải được)" in r.output
+    assert _run(A, "--no-fetch").exit_code == 0  # Cố ý không tải: file thiếu dùng CDN
+
+
+def test_unpinned_or_modified_local_file_fails_until_repinned(vendor):
+    A, served, _ = vendor
+    r = _run(A)
+    assert r.exit_code != 0 and "chưa ghim sha256" in r.output
+    assert _run(A, "--pin").exit_code == 0
+    assert A.vendor_pins() == {n: hashlib.sha256(served[u]).hexdigest() for n, u in A.VENDOR_ASSETS.items()}
+
+    name = next(iter(A.VENDOR_ASSETS))
+    with open(A._static_path(name), "ab") as f:
+        f.write(b"/* patched */")
+    r = _run(A, "--no-fetch")
+    assert r.exit_code != 0 and name in r.output
+    assert A.vendor_problems() == [(name, "không khớp sha256 đã ghim")]
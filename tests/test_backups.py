@@ -0,0 +1,76 @@
+# Sao lưu snapshot + kho nội dung: không băm lại file không đổi, khôi phục đúng trạng thái cũ, dọn giữ object còn dùng
+import os
+
+import pytest
+
+
+@pytest.fixture
+def bak(appmod, shop, tmp_path, monkeypatch):
+    monkeypatch.setattr(appmod, "BACKUP_DIR", str(tmp_path / "backups"))
+    return shop
+
+
+def _obj(A, digest):
+    return os.path.join(A._backup_paths()[0], digest[:2], digest[2:])
+
+
+def _rename(A, old, new):
+    sdir = A._backup_paths()[1]
+    os.rename(os.path.join(sdir, old), os.path.join(sdir, new))
+    return new
+
+
+def test_unchanged_files_are_not_rehashed(appmod, bak):
+    A = appmod
+    first, st = A.create_backup()
+    assert st["files"] > 0 and st["hashed"] == st["files"] == st["new_objects"]
+    second, st = A.create_backup()
+    assert second != first
+    assert (st["hashed"], st["new_objects"], st["new_bytes"]) == (0, 0, 0)
+    assert A._snapshot_manifest(second)["files"].keys() == A._snapshot_manifest(first)["files"].keys()
+
+    A.adjust_stock(bak, "M1", -1)  # Đổi manga.json (+ notifications.json): chỉ đọc lại các file đó
+    _, st = A.create_backup()
+    assert 1 <= st["hashed"] <= 2 and st["new_objects"] == st["hashed"]
+
+
+def test_restore_rolls_back_and_removes_extra_files(appmod, bak, client):
+    A = appmod
+    name, _ = A.create_backup()
+    client.post("/rentals/create", data=dict(customer_id="C1", manga_id="M1", rent_price="10000"))
+    client.post("/customers/add", data=dict(id="C2", name="Bo", age="30", phone="0902", address="HN",
+                                            national_id="2", email="bo@x.y"))
+    assert A.read_coll(bak, "rentals") and A.find_by_id(bak, "manga", "M1").stock == 2
+    extra = A.user_file(bak, "extra.json")
+    A.write_json(extra, {"x": 1})
+
+    assert A.restore_tenant(name, bak) == len(A._snapshot_manifest(name)["files"])
+    assert not os.path.exists(extra)
+    assert A.read_coll(bak, "rentals") == []
+    assert A.find_by_id(bak, "manga", "M1").stock == 3  # Đã bỏ bộ nhớ đệm: đọc lại từ file khôi phục
+    assert A.find_by_id(bak, "customers", "C2") is None
+    with pytest.raises(ValueError):
+        A.restore_tenant(name, "shop9")
+
+
+def test_prune_keeps_objects_linked_from_kept_snapshots(appmod, bak):
+    A = appmod
+    old = _rename(A, A.create_backup()[0], "20250101-100000")
+    A.adjust_stock(bak, "M1", -1)
+    new = _rename(A, A.create_backup()[0], "20250102-100000")
+    old_files, new_files = A._snapshot_manifest(old)["files"], A._snapshot_manifest(new)["files"]
+    rel = f"users/{bak}/manga.json"
+    gone = old_files[rel]["sha256"]
+    assert gone != new_files[rel]["sha256"]
+    stray = os.path.join(A._backup_paths()[0], ".tmp-123-dở")
+    open(stray, "wb").close()
+
+    only_old = {m["sha256"] for m in old_files.values()} - {m["sha256"] for m in new_files.values()}
+    assert A.prune_backups(keep_last=1, keep_daily=0) == (1, len(only_old) + 1)  # + file tạm sót lại
+    assert A.list_snapshots() == [new]
+    assert not os.path.exists(_obj(A, gone)) and not os.path.exists(stray)
+    assert all(os.path.exists(_obj(A, m["sha256"])) for m in new_files.values())  # Kể cả object dùng chung với bản đã xóa
+
+    assert A.prune_backups(keep_last=1, keep_daily=0) == (0, 0)
+    assert A.restore_tenant(new, bak) == len(new_files)
+    assert A.find_by_id(bak, "manga", "M1").stock == 2
@@ -0,0 +1,172 @@
+# Chiến dịch email: lease, chạy tiếp sau crash, bỏ qua người đã có trong log, tạm dừng giữa chừng, link hủy nhận
+import email
+import email.policy
+import smtplib
+
+import pytest
+
+
+class FakeConn:
+    def __init__(self, sent, fail_at=None, on_send=None):
+        self.sent, self.fail_at, self.on_send = sent, fail_at, on_send
+
+    def sendmail(self, sender, to, raw):
+        if self.fail_at is not None and len(self.sent) == self.fail_at:
+            raise smtplib.SMTPServerDisconnected("mất kết nối")
+        self.sent.append((to[0], email.message_from_string(raw, policy=email.policy.default)))
+        if self.on_send:
+            self.on_send()
+
+
+class FakePool:
+    def __init__(self):
+        self.sent, self.fail_at, self.on_send = [], None, None
+
+    def acquire(self, cfg):
+        return FakeConn(self.sent, self.fail_at, self.on_send)
+
+    def release(self, cfg, conn, broken=False):
+        pass
+
+
+@pytest.fixture
+def camp(appmod, shop, client, monkeypatch):
+    # Cửa hàng có 4 khách C1..C4, email đã cấu hình, SMTP giả, không chạy luồng nền
+    A = appmod
+    for i in (2, 3, 4):
+        r = client.post("/customers/add", data=dict(id=f"C{i}", name=f"Khách {i}", age="20", phone=f"090{i}",
+                                                    address="HN", national_id=str(i), email=f"c{i}@x.y"))
+        assert r.status_code == 302
+    A.write_json(A.user_file(shop, "email.json"), {"smtp_pass": "p", "sender_name": "S1", "sender_email": "s@x.y"})
+    pool = FakePool()
+    monkeypatch.setattr(A, "smtp_pool", pool)
+    monkeypatch.setattr(A.time, "sleep", lambda s: None)
+    started = []
+    monkeypatch.setattr(A, "start_campaign", lambda u, cid: started.append(cid) or True)
+
+    def create(**form):
+        r = client.post("/campaigns/create", data=dict(dict(subject="Chào {customer_name}", body="Xin chào", rate_per_min="600"), **form))
+        assert r.status_code == 302
+        cid = A.read_coll(shop, "campaigns")[-1]["id"]
+        assert started[-1] == cid
+        return cid
+    return A, shop, pool, create
+
+
+def _campaign(A, username, cid):
+    return next(c for c in A.read_coll(username, "campaigns") if c["id"] == cid)
+
+
+def _to(pool):
+    return [to for to, _ in pool.sent]
+
+
+def test_sends_everyone_once_and_finishes(camp):
+    A, shop, pool, create = camp
+    cid = create()
+    A._run_campaign(shop, cid)
+    assert _to(pool) == ["an@x.y", "c2@x.y", "c3@x.y", "c4@x.y"]
+    assert pool.sent[1][1]["Subject"] == "Chào Khách 2"
+    c = _campaign(A, shop, cid)
+    assert (c["status"], c["sent"], c["cursor"], c["lease_until"]) == ("done", 4, "C4", 0)
+    assert [x["customer_id"] for x in A.campaign_log(shop, cid)] == ["C1", "C2", "C3", "C4"]
+
+    A._run_campaign(shop, cid)  # Đã xong: không gửi lại
+    assert len(pool.sent) == 4
+
+
+def test_status_is_not_reread_per_recipient(camp, monkeypatch):
+    A, shop, pool, create = camp
+    cid = create()
+    reads = []
+    orig = A.read_coll
+
+    def spy(username, name):
+        if name == "campaigns":
+            reads.append(name)
+        return orig(username, name)
+    monkeypatch.setattr(A, "read_coll", spy)
+    A._run_campaign(shop, cid)
+    assert len(pool.sent) == 4
+    assert len(reads) == 3  # Nhận lease + lưu tiến độ + đánh dấu xong; không đọc lại theo từng người nhận
+
+
+def test_pause_midway_stops_before_next_recipient(camp):
+    A, shop, pool, create = camp
+    cid = create()
+    pool.on_send = lambda: len(pool.sent) == 2 and A._campaign_update(shop, cid, {"status": "paused"})
+    A._run_campaign(shop, cid)
+    assert _to(pool) == ["an@x.y", "c2@x.y"]
+    c = _campaign(A, shop, cid)
+    assert (c["status"], c["sent"], c["cursor"]) == ("paused", 2, "C2")
+
+
+def test_live_lease_blocks_second_sender(camp):
+    A, shop, pool, create = camp
+    cid = create()
+    A._campaign_update(shop, cid, {"status": "sending", "lease_until": A.time.time() + 600})
+    A._run_campaign(shop, cid)  # Process khác đang giữ lease
+    assert pool.sent == []
+    assert A.resume_campaigns(shop) == 0
+
+    A._campaign_update(shop, cid, {"lease_until": A.time.time() - 1})  # Process giữ lease đã chết
+    assert A.resume_campaigns(shop) == 1
+
+
+def test_smtp_drop_releases_lease_and_resumes_from_cursor(camp):
+    A, shop, pool, create = camp
+    cid = create()
+    pool.fail_at = 2
+    A._run_campaign(shop, cid)
+    c = _campaign(A, shop, cid)
+    assert (c["status"], c["sent"], c["cursor"]) == ("sending", 2, "C2")
+    assert c["lease_until"] > A.time.time() and "SMTP" in c["error"]
+
+    A._run_campaign(shop, cid)  # Chưa hết thời gian chờ thử lại
+    assert len(pool.sent) == 2
+
+    pool.fail_at = None
+    A._campaign_update(shop, cid, {"lease_until": 0})
+    A._run_campaign(shop, cid)
+    assert _to(pool) == ["an@x.y", "c2@x.y", "c3@x.y", "c4@x.y"]
+    c = _campaign(A, shop, cid)
+    assert (c["status"], c["sent"], c["error"]) == ("done", 4, "")
+
+
+def test_crash_after_log_skips_logged_recipients(camp):
+    A, shop, pool, create = camp
+    cid = create()
+    # Process cũ đã gửi + ghi log C1, C2 rồi chết trước khi lưu cursor
+    A._campaign_update(shop, cid, {"status": "sending", "lease_until": 0})
+    path = A._campaign_log_path(shop, cid)
+    A.os.makedirs(A.os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        for cust_id, status in (("C1", "sent"), ("C2", "failed")):
+            f.write(A.encode_data({"customer_id": cust_id, "status": status, "email": "", "at": "", "error": ""}, "compact") + b"\n")
+        f.write(b'{"customer_id": "C3", "sta')  # Dòng ghi dở lúc crash: C3 chưa được tính là đã gửi
+    A._run_campaign(shop, cid)
+    assert _to(pool) == ["c3@x.y", "c4@x.y"]
+    c = _campaign(A, shop, cid)
+    assert (c["status"], c["sent"], c["failed"], c["cursor"]) == ("done", 3, 1, "C4")
+
+
+def test_unsubscribe_token_round_trip(camp, client):
+    A, shop, pool, create = camp
+    cid = create(body="Xin chào {customer_name}")
+    A._run_campaign(shop, cid)
+    msg = dict(pool.sent)["c3@x.y"]
+    url = msg["List-Unsubscribe"].strip("<>")
+    assert "{unsubscribe_url}" not in msg.get_payload(decode=True).decode()  # Footer được thêm và đã điền link
+    path = url[url.index("/unsubscribe/"):]
+
+    assert client.get(path).status_code == 200  # Trình quét link chỉ GET: chưa đổi gì
+    assert not A.find_by_id(shop, "customers", "C3").get("unsubscribed")
+    assert client.post(path).status_code == 200
+    assert A.find_by_id(shop, "customers", "C3").get("unsubscribed") is True
+    assert client.get("/unsubscribe/" + path.rsplit("/", 1)[1] + "x").status_code == 404
+
+    pool.sent.clear()
+    cid2 = create()
+    A._run_campaign(shop, cid2)
+    assert "c3@x.y" not in _to(pool)
+    assert _campaign(A, shop, cid2)["skipped"] == 1
@@ -0,0 +1,76 @@
+# Phiên bản danh mục cho máy quét: bộ đếm rev trong bộ nhớ, không quét danh mục / đọc đĩa mỗi lượt thuê-trả
+import os
+
+import pytest
+
+
+@pytest.fixture(params=[False, True], ids=["file", "journal"])
+def cshop(request, appmod, shop, set_cfg):
+    set_cfg(shop, journal_mode=request.param)
+    appmod._journal_states.clear()
+    return shop
+
+
+def _changed(client, since):
+    d = client.get(f"/api/catalog?since={since}").get_json()
+    assert not d["full"]
+    return sorted(row[0] for row in d["items"]), d["deleted"], d["version"]
+
+
+def test_every_change_gets_a_new_version(appmod, cshop, client):
+    A = appmod
+    v0 = A.catalog_version(cshop)
+    A.adjust_stock(cshop, "M1", -1)
+    v1 = A.catalog_version(cshop)
+    assert v1 == v0 + 1 and A.find_by_id(cshop, "manga", "M1").rev == v1
+    A.adjust_stock(cshop, "M2", -1)
+    assert _changed(client, v1) == (["M2"], [], v1 + 1)
+
+    client.post("/manga/update/M1", data=dict(title="Naruto 2", genre="Action", author="K", rent_price="10000",
+                                             stock="3", barcode="111"))
+    v3 = A.catalog_version(cshop)
+    assert v3 == v1 + 2
+    client.post("/manga/delete/M2")
+    assert _changed(client, v1 + 1) == (["M1"], ["M2"], v3 + 1)
+    A.adjust_stock(cshop, "M1", 1)
+    assert A.find_by_id(cshop, "manga", "M1").rev == v3 + 2  # Lớn hơn rev của truyện đã xóa
+
+
+def test_stock_change_does_not_rescan_or_read_deleted_file(appmod, cshop, monkeypatch):
+    A = appmod
+    A.adjust_stock(cshop, "M1", -1)  # Nạp bộ đếm + cache catalog_deleted.json
+    reads = []
+    orig = A.read_json
+    monkeypatch.setattr(A, "read_json", lambda path, *a, **k: (reads.append(os.path.basename(path)), orig(path, *a, **k))[1])
+    slot = A._catalog_rev_slot(cshop)
+    before = slot[1]
+    A.adjust_stock(cshop, "M1", -1)
+    assert A.CATALOG_DELETED_FILE not in reads
+    if A.journal_mode(cshop):  # Journal: chỉ nối 1 dòng, bộ đếm tăng tại chỗ, không quét/đọc lại danh mục
+        assert A._catalog_rev_slot(cshop) is slot and slot[1] == before + 1
+        assert reads == []
+
+
+def test_journal_line_from_other_process_raises_version(appmod, shop, set_cfg):
+    A = appmod
+    set_cfg(shop, journal_mode=True)
+    A._journal_states.clear()
+    v = A.catalog_version(shop)
+    line = A.encode_data({"ts": A.now_str(), "ops": [{"op": "stock_set", "manga_id": "M2", "stock": 1, "rev": v + 5}]},
+                         "compact") + b"\n"
+    with open(A.user_file(shop, A.JOURNAL_FILE), "ab") as f:
+        f.write(line)
+    assert A.catalog_version(shop) == v + 5
+    A.adjust_stock(shop, "M1", -1)
+    assert A.find_by_id(shop, "manga", "M1").rev == v + 6
+
+
+def test_rev_counter_inside_unit_of_work(appmod, shop):
+    A = appmod
+    v = A.catalog_version(shop)
+    with A.unit_of_work(shop):
+        A.adjust_stock(shop, "M1", -1)
+        A.adjust_stock(shop, "M2", -1)
+        assert A.catalog_version(shop) == v + 2
+    assert sorted(m.rev for m in A.read_models(shop, "manga"))[-2:] == [v + 1, v + 2]
+    assert A.catalog_version(shop) == v + 2
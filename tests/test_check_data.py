@@ -0,0 +1,75 @@
+# check-data (check_tenant): kiểm tra khi journal chưa gộp, sửa lệch tồn kho
+import pytest
+
+
+def _codes(issues):
+    return sorted({i["code"] for i in issues})
+
+
+@pytest.fixture
+def jshop(shop, set_cfg, appmod):
+    set_cfg(shop, journal_mode=True)
+    appmod._journal_states.clear()
+    return shop
+
+
+def _rent(client, manga_id="M2"):
+    r = client.post("/rentals/create", data=dict(customer_id="C1", manga_id=manga_id, rent_price="12000"))
+    assert r.status_code in (200, 302)
+
+
+def test_clean_shop_has_no_issues(appmod, shop, client):
+    _rent(client)
+    assert appmod.check_tenant(shop) == []
+
+
+def test_pending_journal_checked_against_replayed_state(appmod, jshop, client):
+    A = appmod
+    _rent(client)
+    _rent(client)  # M2 hết hàng -> thông báo LOW_STOCK ghi qua journal
+    rid = A.read_coll(jshop, "rentals")[0]["id"]
+    assert client.post(f"/rentals/return/{rid}").status_code in (200, 302)
+    assert client.post("/notifications?read=all").status_code in (200, 302)
+    A.purge_tombstones(jshop)
+    assert A.read_coll(jshop, "notifications")  # Có thông báo trong journal, snapshot chưa có
+    issues = A.check_tenant(jshop)
+    assert _codes(issues) == ["pending"], issues
+    assert all(not i["fixed"] for i in issues)
+
+
+def test_pending_journal_does_not_report_stale_duplicates(appmod, jshop, client):
+    A = appmod
+    dup = {"type": "LOW_STOCK", "manga_id": "M2", "message": "One Piece sắp hết", "read": False,
+           "created_at": "01-01-2025 10:00:00"}
+    A.write_coll(jshop, "notifications", [dict(dup, id="N1"), dict(dup, id="N2")])
+    assert _codes(A.check_tenant(jshop)) == ["dup_low_stock"]
+    # Đánh dấu đã đọc qua journal: snapshot vẫn còn 2 bản chưa đọc nhưng dữ liệu thật thì không
+    assert client.post("/notifications?read=all").status_code in (200, 302)
+    _rent(client)
+    issues = A.check_tenant(jshop)
+    assert _codes(issues) == ["pending"], issues
+    assert all(not i["fixed"] for i in issues)
+
+
+def test_pending_journal_with_unreadable_snapshot_rows_skips_derived_checks(appmod, jshop, client):
+    A = appmod
+    _rent(client)
+    rows = A.read_json(A.user_file(jshop, "rentals.json"), [])
+    A.write_json(A.user_file(jshop, "rentals.json"), rows + ["not a record"])
+    A._journal_states.clear()
+    codes = _codes(A.check_tenant(jshop))
+    assert "pending_unchecked" in codes and "schema" in codes
+    assert "stock_drift" not in codes and "dangling_manga" not in codes
+
+
+def test_repair_fixes_stock_drift(appmod, shop, client):
+    A = appmod
+    manga = A.read_coll(shop, "manga")
+    manga[0]["stock"] = 9  # Sửa tay lệch với số cuốn trên kệ
+    A.write_coll(shop, "manga", manga)
+    issues = A.check_tenant(shop)
+    assert [i["code"] for i in issues] == ["stock_drift"] and not issues[0]["fixed"]
+    fixed = A.check_tenant(shop, repair=True)
+    assert [i["code"] for i in fixed] == ["stock_drift"] and fixed[0]["fixed"]
+    assert A.find_by_id(shop, "manga", "M1").stock == 3
+    assert A.check_tenant(shop) == []
@@ -0,0 +1,101 @@
+# Ảnh bìa gốc: sao lưu + khôi phục cùng snapshot, xóa khi không còn truyện nào (ở mọi cửa hàng) trỏ tới
+import os
+import time
+from io import BytesIO
+
+import pytest
+
+PIL = pytest.importorskip("PIL.Image")
+
+
+def _png(color):
+    buf = BytesIO()
+    PIL.new("RGB", (40, 60), color).save(buf, "PNG")
+    return buf.getvalue()
+
+
+@pytest.fixture
+def covered(appmod, shop, client, tmp_path, monkeypatch):
+    # M1 có ảnh bìa (đã có thumbnail); ảnh tải lên "từ lâu" để qua thời gian chờ xóa
+    A = appmod
+    monkeypatch.setattr(A, "BACKUP_DIR", str(tmp_path / "backups"))
+    monkeypatch.setattr(A, "queue_cover", lambda h: None)  # Tạo thumbnail đồng bộ trong test
+    A._cover_ready.clear()
+    r = client.post("/manga/update/M1", data=dict(title="Naruto", genre="Action, Ninja", author="K", rent_price="10000",
+                                                 stock="3", barcode="111", cover=(BytesIO(_png("red")), "a.png")))
+    assert r.status_code == 302
+    h = A.find_by_id(shop, "manga", "M1").get("cover")
+    assert h and os.path.exists(A.cover_src_path(h))
+    A._make_cover_thumbs(h)
+    _age(A, h)
+    return h
+
+
+def _age(A, h):
+    old = time.time() - A.COVER_GC_GRACE_SEC - 10
+    os.utime(A.cover_src_path(h), (old, old))
+
+
+def _thumbs(A, h):
+    return [A._cover_thumb_path(h, w, ext) for w in A.COVER_SIZES for ext, _ in A.COVER_FORMATS]
+
+
+def _delete_and_purge(A, client, shop, mid):
+    assert client.post(f"/manga/delete/{mid}").status_code == 302
+    A.purge_tombstones(shop)
+
+
+def test_purge_removes_unused_cover_and_thumbs(appmod, shop, client, covered):
+    A, h = appmod, covered
+    assert all(os.path.exists(p) for p in _thumbs(A, h))
+    _delete_and_purge(A, client, shop, "M1")
+    assert not os.path.exists(A.cover_src_path(h))
+    assert not any(os.path.exists(p) for p in _thumbs(A, h))
+    assert A.cover_thumbs(h) is None
+
+
+def test_cover_shared_with_other_shop_is_kept(appmod, shop, client, covered):
+    A, h = appmod, covered
+    other = A.app.test_client()
+    other.post("/register", data=dict(username="shop2", email="b@b.c", password="x", repass="x", shop_name="S2"))
+    other.post("/manga/add", data=dict(id="X1", title="Same", genre="Action", author="K", rent_price="1", stock="1",
+                                       barcode="9", cover=(BytesIO(_png("red")), "b.png")))
+    assert A.find_by_id("shop2", "manga", "X1").get("cover") == h  # Cùng nội dung -> cùng 1 ảnh gốc
+    _age(A, h)
+    _delete_and_purge(A, client, shop, "M1")
+    assert os.path.exists(A.cover_src_path(h))
+
+
+def test_recently_used_cover_is_kept(appmod, shop, client, covered):
+    A, h = appmod, covered
+    os.utime(A.cover_src_path(h))  # Vừa được tải lên lại (request khác sắp lưu truyện trỏ tới)
+    _delete_and_purge(A, client, shop, "M1")
+    assert os.path.exists(A.cover_src_path(h))
+
+
+def test_removing_or_replacing_cover_releases_old_one(appmod, shop, client, covered):
+    A, h = appmod, covered
+    form = dict(title="Naruto", genre="Action, Ninja", author="K", rent_price="10000", stock="3", barcode="111")
+    client.post("/manga/update/M1", data=dict(form, cover=(BytesIO(_png("blue")), "c.png")))
+    new = A.find_by_id(shop, "manga", "M1").get("cover")
+    assert new != h and os.path.exists(A.cover_src_path(new))
+    assert not os.path.exists(A.cover_src_path(h))
+
+    _age(A, new)
+    client.post("/manga/update/M1", data=dict(form, remove_cover="1"))
+    assert not A.find_by_id(shop, "manga", "M1").get("cover")
+    assert not os.path.exists(A.cover_src_path(new))
+
+
+def test_backup_includes_covers_and_restore_brings_them_back(appmod, shop, client, covered):
+    A, h = appmod, covered
+    name, _ = A.create_backup()
+    rel = f"covers/{h[:2]}/{h}"
+    assert rel in A._snapshot_manifest(name)["files"]
+
+    _delete_and_purge(A, client, shop, "M1")
+    assert not os.path.exists(A.cover_src_path(h))
+    A.restore_tenant(name, shop)
+    assert A.find_by_id(shop, "manga", "M1").get("cover") == h
+    with open(A.cover_src_path(h), "rb") as f:
+        assert f.read() == _png("red")
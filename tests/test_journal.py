@@ -0,0 +1,141 @@
+# Journal (journal_mode): phát lại idempotent, bỏ dòng ghi dở, đọc phần đuôi tăng dần, gộp journal
+import json
+import os
+
+import pytest
+
+
+@pytest.fixture
+def jshop(shop, set_cfg, appmod):
+    set_cfg(shop, journal_mode=True)
+    appmod._journal_states.clear()
+    return shop
+
+
+def _rental(rid, manga_id="M1"):
+    return {"id": rid, "manga_id": manga_id, "manga_title": "Naruto", "customer_id": "C1", "customer_name": "An",
+            "rent_price": 10000, "created_at": "01-01-2025 10:00:00", "due_at": "08-01-2025 10:00:00"}
+
+
+def _journal_path(A, username):
+    return A.user_file(username, A.JOURNAL_FILE)
+
+
+def _snapshot(A, username):
+    state = A.journal_state(username)
+    return {n: A.encode_rows(n, state["colls"][n]) for n in A.JOURNALED_COLLS}
+
+
+def test_append_writes_one_line_and_leaves_snapshot(appmod, jshop):
+    A = appmod
+    before = A.read_json(A.user_file(jshop, "manga.json"), [])
+    A.journal_append(jshop, [{"op": "stock_set", "manga_id": "M1", "stock": 9}])
+    lines = open(_journal_path(A, jshop), "rb").read().splitlines()
+    assert len(lines) == 1 and json.loads(lines[0])["ops"][0]["stock"] == 9
+    assert A.read_json(A.user_file(jshop, "manga.json"), []) == before
+    assert A.find_by_id(jshop, "manga", "M1").stock == 9
+
+
+def test_replay_is_idempotent(appmod, jshop):
+    A = appmod
+    ops = [{"op": "rental_add", "rental": _rental("R1")},
+           {"op": "rental_update", "id": "R1", "fields": {"returned_at": "02-01-2025 10:00:00"}},
+           {"op": "stock_set", "manga_id": "M1", "stock": 5},
+           {"op": "notif_add", "notif": {"id": "N1", "type": "X", "message": "m", "read": False}},
+           {"op": "notif_read", "ids": ["N1"]}]
+    A.journal_append(jshop, ops)
+    once = _snapshot(A, jshop)
+
+    state = A.journal_state(jshop)
+    for op in ops:  # Áp lại lần 2 (ví dụ crash sau khi gộp snapshot, trước khi xóa journal)
+        A._apply_op(state, op)
+    assert _snapshot(A, jshop) == once
+    assert [r["id"] for r in once["rentals"]].count("R1") == 1
+
+    A._journal_states.clear()  # Dựng lại từ đĩa: snapshot + phát lại journal
+    assert _snapshot(A, jshop) == once
+
+
+def test_replay_after_compacted_snapshot_is_idempotent(appmod, jshop):
+    A = appmod
+    A.journal_append(jshop, [{"op": "rental_add", "rental": _rental("R1")},
+                             {"op": "stock_set", "manga_id": "M1", "stock": 2}])
+    expected = _snapshot(A, jshop)
+    # Giả lập crash giữa journal_compact: snapshot đã ghi nhưng journal chưa bị thay bằng file rỗng
+    for n in A.JOURNALED_COLLS:
+        A.write_json(A.user_file(jshop, A.COLL_FILES[n]), expected[n])
+    A._journal_states.clear()
+    assert _snapshot(A, jshop) == expected
+
+
+def test_torn_last_line_is_skipped(appmod, jshop):
+    A = appmod
+    A.journal_append(jshop, [{"op": "stock_set", "manga_id": "M1", "stock": 7}])
+    with open(_journal_path(A, jshop), "ab") as f:
+        f.write(b'{"ts": "x", "ops": [{"op": "stock_set", "manga_id": "M1", "stock": 1')
+    A._journal_states.clear()
+    state = A.journal_state(jshop)
+    assert A.find_by_id(jshop, "manga", "M1").stock == 7
+    assert state["offset"] < os.path.getsize(_journal_path(A, jshop))  # Dòng dở chưa được nhận
+
+    # Ghi tiếp: bản ghi mới bắt đầu ở dòng mới, không dính vào dòng dở
+    A.journal_append(jshop, [{"op": "stock_set", "manga_id": "M2", "stock": 4}])
+    A._journal_states.clear()
+    assert A.find_by_id(jshop, "manga", "M1").stock == 7
+    assert A.find_by_id(jshop, "manga", "M2").stock == 4
+
+
+def test_tail_is_read_incrementally(appmod, jshop):
+    A = appmod
+    A.journal_append(jshop, [{"op": "stock_set", "manga_id": "M1", "stock": 6}])
+    state = A.journal_state(jshop)
+    offset = state["offset"]
+    assert offset == os.path.getsize(_journal_path(A, jshop))
+
+    # Process khác nối thêm 1 dòng: chỉ đọc phần mới, không dựng lại từ snapshot
+    line = A.encode_data({"ts": A.now_str(), "ops": [{"op": "stock_set", "manga_id": "M2", "stock": 8}]}, "compact") + b"\n"
+    with open(_journal_path(A, jshop), "ab") as f:
+        f.write(line)
+    calls = []
+    orig = A._apply_op
+    A._apply_op = lambda st, op: (calls.append(op), orig(st, op))
+    try:
+        again = A.journal_state(jshop)
+    finally:
+        A._apply_op = orig
+    assert again is state
+    assert [op["manga_id"] for op in calls] == ["M2"]
+    assert again["offset"] == offset + len(line)
+    assert A.find_by_id(jshop, "manga", "M2").stock == 8
+
+
+def test_compaction_folds_journal_into_snapshot(appmod, jshop):
+    A = appmod
+    A.journal_append(jshop, [{"op": "rental_add", "rental": _rental("R9", "M2")},
+                             {"op": "stock_set", "manga_id": "M2", "stock": 1}])
+    expected = _snapshot(A, jshop)
+    assert A.journal_compact(jshop)
+    assert os.path.getsize(_journal_path(A, jshop)) == 0
+    assert A.journal_state(jshop)["offset"] == 0
+    disk = {n: A.read_json(A.user_file(jshop, A.COLL_FILES[n]), []) for n in A.JOURNALED_COLLS}
+    assert disk["manga"] == expected["manga"] and disk["rentals"] == expected["rentals"]
+    A._journal_states.clear()
+    assert _snapshot(A, jshop) == expected
+
+
+def test_compaction_triggered_by_size(appmod, jshop, monkeypatch):
+    A = appmod
+    monkeypatch.setattr(A, "JOURNAL_COMPACT_BYTES", 1)
+    A.journal_append(jshop, [{"op": "stock_set", "manga_id": "M1", "stock": 3}])
+    assert os.path.getsize(_journal_path(A, jshop)) == 0
+    assert A.read_json(A.user_file(jshop, "manga.json"), [])[0]["stock"] == 3
+
+
+def test_batch_discarded_on_error(appmod, jshop):
+    A = appmod
+    with pytest.raises(RuntimeError):
+        with A.journal_batch(jshop):
+            A.journal_append(jshop, [{"op": "stock_set", "manga_id": "M1", "stock": 0}])
+            raise RuntimeError("boom")
+    assert not os.path.exists(_journal_path(A, jshop)) or os.path.getsize(_journal_path(A, jshop)) == 0
+    assert A.find_by_id(jshop, "manga", "M1").stock == 3
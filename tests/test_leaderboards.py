@@ -0,0 +1,89 @@
+# Bảng xếp hạng: cập nhật tăng dần (thuê/trả + sang ngày mới) phải khớp với dựng lại từ đầu
+from datetime import datetime, timedelta
+
+import pytest
+
+
+def _at(days_ago, hour=10):
+    return (datetime.now().replace(hour=hour, minute=0, second=0, microsecond=0) - timedelta(days=days_ago))
+
+
+@pytest.fixture
+def lshop(appmod, shop, client):
+    # Giao dịch rải ở các mốc quanh biên cửa sổ 7/30/365 ngày; R0 đang mở và đã quá hạn 2 ngày
+    A = appmod
+    client.post("/customers/add", data=dict(id="C2", name="Bình", age="30", phone="0902", address="HN",
+                                            national_id="2", email="b@x.y"))
+    fmt = A.DT_FMT
+    rows = []
+    for n, (ago, cust, manga, price, late) in enumerate([
+            (1, "C1", "M1", 10000, 0), (5, "C2", "M2", 12000, 5000), (6, "C1", "M2", 12000, 0),
+            (7, "C2", "M1", 10000, 0), (8, "C1", "M1", 10000, 20000), (29, "C2", "M2", 12000, 0),
+            (30, "C1", "M2", 12000, 0), (200, "C2", "M1", 10000, 0), (364, "C1", "M1", 10000, 0),
+            (400, "C2", "M2", 12000, 0)], 1):
+        start = _at(ago)
+        rows.append({"id": f"R{n}", "manga_id": manga, "manga_title": manga, "customer_id": cust,
+                     "customer_name": cust, "rent_price": price, "late_fee": late, "late_fee_per_day": 5000,
+                     "created_at": start.strftime(fmt), "due_at": (start + timedelta(days=1)).strftime(fmt),
+                     "returned_at": (start + timedelta(days=2 if late else 1)).strftime(fmt)})
+    start = _at(4)
+    rows.append({"id": "R0", "manga_id": "M1", "manga_title": "Naruto", "customer_id": "C2", "customer_name": "Bình",
+                 "rent_price": 10000, "late_fee": 0, "late_fee_per_day": 5000, "created_at": start.strftime(fmt),
+                 "due_at": (start + timedelta(days=2)).strftime(fmt), "returned_at": ""})
+    A.write_coll(shop, "rentals", rows)
+    return shop
+
+
+@pytest.fixture
+def clock(appmod, monkeypatch):
+    # Dời đồng hồ của app đi `days` ngày (dựng lại + sang ngày mới như thật)
+    A = appmod
+    real = A.datetime
+
+    def shift(days):
+        class Later(real):
+            @classmethod
+            def now(cls, tz=None):
+                return real.now(tz) + timedelta(days=days)
+        monkeypatch.setattr(A, "datetime", Later)
+    return shift
+
+
+def _core(st):
+    return {
+        "today": st["today"],
+        "buckets": st["buckets"],
+        "totals": st["totals"],
+        "top": {w: {f: sorted(map(tuple, top)) for f, top in v.items()} for w, v in st["top"].items()},
+        "open": st["open"],
+    }
+
+
+def _same_as_rebuild(A, username, st):
+    assert A._leaderboards[username] is st  # Vẫn là bản cập nhật tăng dần, chưa bị dựng lại
+    assert _core(st) == _core(A._build_leaderboards(username))
+
+
+def test_rent_return_and_day_roll_match_rebuild(appmod, lshop, client, clock):
+    A = appmod
+    A.get_leaderboards(lshop)
+    st = A._leaderboards[lshop]
+    assert st["totals"][7]["spent"] == {"C1": 42000, "C2": 27000}  # Phí trễ của R5 tính vào ngày trả (trong cửa sổ)
+
+    client.post("/rentals/create", data=dict(customer_id="C1", manga_id="M2", rent_price="12000"))
+    client.post("/rentals/return/R0")  # Trả trễ: phí trễ cộng vào hôm nay
+    assert A.find_by_id(lshop, "rentals", "R0").late_fee > 0
+    _same_as_rebuild(A, lshop, st)
+
+    clock(3)  # Thuê sau 3 ngày: sang ngày mới trong leaderboard_events rồi mới áp sự kiện
+    client.post("/rentals/create", data=dict(customer_id="C2", manga_id="M1", rent_price="10000"))
+    _same_as_rebuild(A, lshop, st)
+
+    for days in (7, 31, 366, 800):  # Chỉ đọc: get_leaderboards tự sang ngày
+        clock(days)
+        A.get_leaderboards(lshop)
+        _same_as_rebuild(A, lshop, st)
+
+    out = A.get_leaderboards(lshop)
+    A._leaderboards.clear()
+    assert A.get_leaderboards(lshop) == out
@@ -0,0 +1,119 @@
+# Chỉ mục thời gian giao dịch: khoảng ngày (searchsorted 2 đầu), lọc trạng thái/khách/truyện/q, phân trang, lưu trữ
+from datetime import datetime, timedelta
+
+import pytest
+
+
+def _row(rid, cust, manga, created, returned="", due=None, **extra):
+    names = {"C1": "An", "C2": "Bình"}
+    titles = {"M1": "Naruto", "M2": "One Piece"}
+    return dict({"id": rid, "manga_id": manga, "manga_title": titles[manga], "customer_id": cust,
+                 "customer_name": names[cust], "rent_price": 10000, "late_fee": 0, "late_fee_per_day": 10000,
+                 "created_at": created, "due_at": due or created, "returned_at": returned}, **extra)
+
+
+@pytest.fixture
+def rshop(appmod, shop, client):
+    A = appmod
+    client.post("/customers/add", data=dict(id="C2", name="Bình", age="30", phone="0902", address="HN",
+                                            national_id="2", email="b@x.y"))
+    fmt = A.DT_FMT
+    recent = (datetime.now() - timedelta(hours=1)).strftime(fmt)
+    later = (datetime.now() + timedelta(days=5)).strftime(fmt)
+    A.write_coll(shop, "rentals", [
+        _row("R1", "C1", "M1", "01-01-2025 10:00:00", returned="03-01-2025 10:00:00"),
+        _row("R2", "C1", "M2", "15-01-2025 23:59:59", returned="16-01-2025 09:00:00"),
+        _row("R3", "C2", "M1", "16-01-2025 00:00:00", due="20-01-2025 00:00:00"),  # Quá hạn
+        _row("R4", "C2", "M2", recent, due=later),  # Đang thuê, chưa tới hạn
+        _row("R5", "C1", "M1", "31-01-2025 12:00:00", returned="01-02-2025 08:00:00"),
+        _row("R6", "C1", "M2", "ngày hỏng", returned="02-01-2025 10:00:00"),  # Ngày thuê hỏng
+        _row("R7", "C2", "M1", "20-01-2025 10:00:00", returned="21-01-2025 10:00:00", deleted=True),
+    ])
+    return shop
+
+
+def _ids(A, username, **kw):
+    pos, fr, _ = A.query_rentals(username, **kw)
+    return [fr["id"][p] for p in pos]
+
+
+def _range(A, a, b):
+    t0, t1 = A.range_bounds(a, b)
+    return {"t0": t0, "t1": t1}
+
+
+def test_no_filter_newest_first_and_hides_deleted(appmod, rshop):
+    A = appmod
+    assert _ids(A, rshop) == ["R4", "R5", "R3", "R2", "R1", "R6"]  # Ngày hỏng xếp cuối (đầu mảng đã sắp)
+
+
+def test_date_range_boundaries_are_inclusive(appmod, rshop):
+    A = appmod
+    assert _ids(A, rshop, **_range(A, "15-01-2025", "15-01-2025")) == ["R2"]  # Cả ngày: tới 23:59:59
+    assert _ids(A, rshop, **_range(A, "16-01-2025", "")) == ["R4", "R5", "R3"]
+    assert _ids(A, rshop, **_range(A, "", "15-01-2025")) == ["R2", "R1"]  # Có khoảng ngày: bỏ ngày hỏng
+    assert _ids(A, rshop, **_range(A, "15-01-2025 23:59:59", "16-01-2025 00:00:00")) == ["R3", "R2"]
+    assert _ids(A, rshop, **_range(A, "16-01-2025 00:00:01", "31-01-2025 11:59:59")) == []
+    assert _ids(A, rshop, **_range(A, "01-02-2025", "01-01-2025")) == []  # from > to
+    assert A.range_bounds("2025-01-01", "") == (None, None)  # Sai dạng: bỏ qua bộ lọc
+
+
+def test_status_customer_manga_and_text_masks(appmod, rshop):
+    A = appmod
+    assert _ids(A, rshop, status="open") == ["R4", "R3"]
+    assert _ids(A, rshop, status="overdue") == ["R3"]
+    assert _ids(A, rshop, status="returned") == ["R5", "R2", "R1", "R6"]
+    assert _ids(A, rshop, customer_id="C2") == ["R4", "R3"]
+    assert _ids(A, rshop, manga_id="M2") == ["R4", "R2", "R6"]
+    assert _ids(A, rshop, customer_id="C9") == []
+    assert _ids(A, rshop, q="one") == ["R4", "R2", "R6"]
+    assert _ids(A, rshop, q="bình") == ["R4", "R3"]
+    assert _ids(A, rshop, status="returned", manga_id="M1", **_range(A, "01-01-2025", "31-01-2025")) == ["R5", "R1"]
+    future = A.epoch_now() + 10 * 86400
+    assert _ids(A, rshop, status="overdue", now=future) == ["R4", "R3"]  # Hạn so với now truyền vào
+
+
+def test_deleted_customer_is_hidden(appmod, rshop, client):
+    A = appmod
+    client.post("/rentals/return/R3")
+    client.post("/rentals/return/R4")
+    assert client.post("/customers/delete/C2").status_code == 302
+    assert _ids(A, rshop) == ["R5", "R2", "R1", "R6"]
+
+
+def test_api_pagination_totals(appmod, rshop, client, monkeypatch):
+    A = appmod
+    monkeypatch.setattr(A, "RENTALS_PAGE_SIZE", 2)
+    seen = []
+    for offset in (0, 2, 4, 6):
+        d = client.get(f"/api/rentals?offset={offset}").get_json()
+        assert d["ok"] and d["total"] == 6 and d["limit"] == 2
+        seen += [x["id"] for x in d["items"]]
+    assert seen == ["R4", "R5", "R3", "R2", "R1", "R6"]
+    d = client.get("/api/rentals?status=returned&limit=3&offset=1").get_json()
+    assert d["total"] == 4 and [x["id"] for x in d["items"]] == ["R2", "R1", "R6"]
+    assert client.get("/api/rentals?from=2025-01-01").status_code == 400
+    assert client.get("/rentals?archive=1&page=99").status_code == 200  # Trang quá số trang: về trang cuối
+
+
+def test_archived_rows_are_materialised(appmod, rshop):
+    A = appmod
+    assert A.compact_rentals(rshop, hot_days=1) == 4  # R1, R2, R5, R7 dồn sang lưu trữ (R6 ngày hỏng giữ lại)
+    assert {r["id"] for r in A.read_coll(rshop, "rentals")} == {"R3", "R4", "R6"}
+
+    assert _ids(A, rshop, hot_only=True) == ["R4", "R3", "R6"]
+    pos, fr, _ = A.query_rentals(rshop, **_range(A, "01-01-2025", "31-01-2025"))
+    rows = A.rentals_at(rshop, fr, pos)
+    assert [r.id for r in rows] == ["R5", "R3", "R2", "R1"]
+    r1 = rows[-1]
+    assert (r1.customer_name, r1.manga_title, r1.returned_at) == ("An", "Naruto", "03-01-2025 10:00:00")
+
+
+def test_timeline_rebuilt_after_write(appmod, rshop, client):
+    A = appmod
+    tl, _, _ = A.rental_timeline(rshop)
+    assert A.rental_timeline(rshop)[0] is tl  # Không đổi gì: dùng lại chỉ mục
+    r = client.post("/rentals/create", data=dict(customer_id="C1", manga_id="M2", rent_price="10000"))
+    assert r.status_code == 302
+    assert A.rental_timeline(rshop)[0] is not tl
+    assert len(_ids(A, rshop, customer_id="C1", status="open")) == 1
@@ -0,0 +1,49 @@
+# Định dạng lưu trữ: ghi rồi đọc lại đúng dữ liệu ở mọi định dạng; file msgpack khi chưa cài msgpack phải báo lỗi
+import pytest
+
+DATA = {"a": [1, 2.5, "tiếng Việt", None, True], "n": {"x": {"y": []}}, "big": 1 << 70}
+
+# [{"id": "C9"}] mã hóa msgpack bằng tay (không cần cài msgpack để tạo file)
+PACKED = b"\x91\x81\xa2id\xa2C9"
+
+
+@pytest.mark.parametrize("name", ["data.json", "data.json.gz"])
+@pytest.mark.parametrize("fmt", ["json", "compact", "msgpack"])
+def test_round_trip_per_format(appmod, tmp_path, fmt, name):
+    A = appmod
+    if fmt not in A.available_store_formats():
+        pytest.skip("chưa cài msgpack")
+    path = str(tmp_path / name)
+    A.write_json(path, DATA, fmt)
+    assert A.read_json(path, None) == DATA
+    with A._open_bin(path, "r") as f:
+        head = f.read()[:1]
+    assert (head == b"{") == (fmt != "msgpack")
+
+
+def test_missing_file_and_empty_file_give_default(appmod, tmp_path):
+    A = appmod
+    path = tmp_path / "x.json"
+    assert A.read_json(str(path), []) == []
+    path.write_bytes(b"")
+    assert A.read_json(str(path), []) == []
+    path.write_bytes(b'{"a": ')  # JSON hỏng vẫn coi như không có (check-data sẽ báo)
+    assert A.read_json(str(path), []) == []
+
+
+def test_msgpack_file_without_msgpack_is_not_clobbered(appmod, shop, client, monkeypatch):
+    A = appmod
+    monkeypatch.setattr(A, "msgpack", None)
+    path = A.user_file(shop, "customers.json")
+    with open(path, "wb") as f:
+        f.write(PACKED)
+    A._shared_models.clear()
+
+    with pytest.raises(A.StoreFormatError):
+        A.read_json(path, [])
+    with pytest.raises(A.StoreFormatError):  # Không coi là danh sách rỗng rồi ghi đè khi thêm khách
+        client.post("/customers/add", data=dict(id="C2", name="Bo", age="30", phone="0902", address="HN",
+                                                national_id="2", email="bo@x.y"))
+    with open(path, "rb") as f:
+        assert f.read() == PACKED
+    assert "StoreFormatError" in A._parse_problem(path)
@@ -0,0 +1,82 @@
+# Xóa mềm trong thống kê: bảng xếp hạng, báo cáo top-N và số đang thuê/quá hạn bỏ truyện/khách đã xóa
+import pytest
+from flask import template_rendered
+
+
+@pytest.fixture
+def sold(appmod, shop, client):
+    # C1 thuê + trả M1 (10.000); C2 đang thuê M2 (12.000) và đã quá hạn
+    A = appmod
+    client.post("/customers/add", data=dict(id="C2", name="Bo", age="30", phone="0902", address="HN",
+                                            national_id="2", email="bo@x.y"))
+    client.post("/rentals/create", data=dict(customer_id="C1", manga_id="M1", rent_price="10000"))
+    rid = next(r["id"] for r in A.read_coll(shop, "rentals") if r["customer_id"] == "C1")
+    client.post(f"/rentals/return/{rid}")
+    client.post("/rentals/create", data=dict(customer_id="C2", manga_id="M2", rent_price="12000"))
+    rid = next(r["id"] for r in A.read_coll(shop, "rentals") if r["customer_id"] == "C2")
+    A.update_rental(shop, rid, {"due_at": "01-01-2025 10:00:00"})
+    return shop
+
+
+def _board(client):
+    d = client.get("/api/leaderboards?window=7").get_json()["windows"]["7"]
+    return [x["customer_id"] for x in d["customers"]], [x["manga_id"] for x in d["titles"]]
+
+
+def _report(client, name):
+    return client.get(f"/api/reports/{name}").get_json()["data"]
+
+
+def _stats(A, client):
+    seen = {}
+
+    def grab(sender, template, context, **extra):
+        seen.update(context)
+    with template_rendered.connected_to(grab, A.app):
+        assert client.get("/stats").status_code == 200
+    return seen
+
+
+def test_deleted_customer_leaves_leaderboards_and_top_reports(appmod, sold, client):
+    A = appmod
+    assert _board(client) == (["C2", "C1"], ["M1", "M2"])  # Dựng sẵn trong bộ nhớ trước khi xóa
+    assert client.post("/customers/delete/C1").status_code == 302
+    assert _board(client) == (["C2"], ["M2"])
+    assert [x["customer_id"] for x in _report(client, "top-customers")] == ["C2"]
+    assert [x["manga_id"] for x in _report(client, "top-titles")] == ["M2"]
+
+    A.purge_tombstones(sold)  # Đã dọn: giao dịch gắn cờ deleted, vẫn bị ẩn
+    A._leaderboards.clear()
+    assert _board(client) == (["C2"], ["M2"])
+    assert [x["customer_id"] for x in _report(client, "top-customers")] == ["C2"]
+
+
+def test_revenue_kept_only_with_keep_deleted_revenue(appmod, sold, client, set_cfg):
+    A = appmod
+    client.post("/customers/delete/C1")
+    assert _report(client, "revenue")["total_rent"] == 22000  # Mặc định giữ doanh thu của khách đã xóa
+    set_cfg(sold, keep_deleted_revenue=False)
+    assert _report(client, "revenue")["total_rent"] == 12000
+    assert _stats(A, client)["total_trans"] == 1
+
+
+def test_open_and_overdue_skip_deleted(appmod, sold, client):
+    A = appmod
+    st = _stats(A, client)
+    assert (st["total_active"], st["total_overdue"]) == (1, 1)
+    assert [x["customer_id"] for x in client.get("/api/leaderboards").get_json()["overdue"]] == ["C2"]
+
+    A.add_tombstone(sold, "customers", {"id": "C2"})  # Dữ liệu cũ: khách bị xóa khi còn giao dịch mở
+    st = _stats(A, client)
+    assert (st["total_active"], st["total_overdue"]) == (0, 0)
+    assert client.get("/api/leaderboards").get_json()["overdue"] == []
+
+
+def test_incremental_events_skip_hidden_rows(appmod, sold, client):
+    A = appmod
+    A.add_tombstone(sold, "manga", {"id": "M2"})
+    _board(client)
+    st = A._leaderboards[sold]
+    rec = A.find_by_id(sold, "rentals", next(r["id"] for r in A.read_coll(sold, "rentals") if r["manga_id"] == "M2"))
+    A._lb_apply(st, "rent", rec)
+    assert "M2" not in st["totals"][7]["titles"] and all(x[2] != "M2" for x in st["open"])
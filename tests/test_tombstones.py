@@ -0,0 +1,58 @@
+# Xóa mềm: thông báo của truyện/khách đã xóa bị ẩn ngay và được dọn ở nền (mọi loại thông báo)
+import pytest
+
+
+def _notif(A, username, nid, **fields):
+    A.add_notification(username, dict({"id": nid, "type": "HOLD", "created_at": A.now_str(), "read": False,
+                                        "message": nid}, **fields))
+
+
+@pytest.fixture
+def noted(appmod, shop, client):
+    A = appmod
+    r = client.post("/customers/add", data=dict(id="C2", name="Bo", age="30", phone="0902", address="HN",
+                                                national_id="2", email="bo@x.y"))
+    assert r.status_code in (200, 302)
+    A.write_coll(shop, "notifications", [])
+    _notif(A, shop, "hold-c1", manga_id="M1", customer_id="C1")
+    _notif(A, shop, "hold-c2", manga_id="M1", customer_id="C2")
+    _notif(A, shop, "low-m2", type="LOW_STOCK", manga_id="M2")
+    _notif(A, shop, "low-legacy-m2", type="LOW_STOCK", message="Truyện 'One Piece' (ID M2) còn 1 cuốn (< 10).")
+    _notif(A, shop, "low-m1", type="LOW_STOCK", manga_id="M1")
+    return shop
+
+
+def _ids(A, username):
+    return sorted(n["id"] for n in A.read_coll(username, "notifications"))
+
+
+def test_deleted_customer_hold_notifications_hidden_then_purged(appmod, noted, client):
+    A = appmod
+    assert A.count_unread_notifications(noted) == 5
+    assert client.post("/customers/delete/C1").status_code in (200, 302)
+    assert A.count_unread_notifications(noted) == 4
+    page = client.get("/notifications").data.decode()
+    assert "hold-c1" not in page and "hold-c2" in page
+    assert "hold-c1" in _ids(A, noted)  # Chỉ ẩn, chưa dọn
+    assert A.purge_tombstones(noted) == 1
+    assert _ids(A, noted) == ["hold-c2", "low-legacy-m2", "low-m1", "low-m2"]
+
+
+def test_deleted_manga_drops_every_notification_type(appmod, noted, client):
+    A = appmod
+    assert client.post("/manga/delete/M2").status_code in (200, 302)
+    assert A.count_unread_notifications(noted) == 3
+    assert A.purge_tombstones(noted) == 1
+    assert _ids(A, noted) == ["hold-c1", "hold-c2", "low-m1"]
+    assert client.post("/manga/delete/M1").status_code in (200, 302)
+    assert A.count_unread_notifications(noted) == 0
+    A.purge_tombstones(noted)
+    assert _ids(A, noted) == []
+
+
+def test_legacy_message_fallback_only_for_low_stock(appmod, noted, client):
+    A = appmod
+    _notif(A, noted, "hold-legacy", message="Đang giữ truyện 'One Piece' (ID M2) cho khách")
+    assert client.post("/manga/delete/M2").status_code in (200, 302)
+    A.purge_tombstones(noted)
+    assert "hold-legacy" in _ids(A, noted) and "low-legacy-m2" not in _ids(A, noted)
@@ -0,0 +1,157 @@
+# Unit of work theo request: ghi mỗi collection bẩn đúng 1 lần, hủy toàn bộ khi lỗi, on_commit sau khi ghi
+import os
+
+import pytest
+from flask import Response
+
+
+@pytest.fixture
+def writes(appmod, monkeypatch):
+    # Đếm số lần ghi ra đĩa theo tên file
+    counts = {}
+    orig = appmod.write_json
+
+    def spy(path, data, fmt="json"):
+        name = os.path.basename(path)
+        counts[name] = counts.get(name, 0) + 1
+        return orig(path, data, fmt)
+    monkeypatch.setattr(appmod, "write_json", spy)
+    return counts
+
+
+def _disk(A, username, name):
+    return A.read_json(A.user_file(username, A.COLL_FILES[name]), [])
+
+
+def test_each_dirty_collection_flushed_once(appmod, shop, writes):
+    A = appmod
+    with A.unit_of_work(shop):
+        for stock in (5, 6, 7):
+            items = A.read_models(shop, "manga")
+            items[0].stock = stock
+            A.write_models(shop, "manga", items)
+        custs = A.read_coll(shop, "customers")
+        custs[0]["name"] = "Bình"
+        A.write_coll(shop, "customers", custs)
+        assert A.find_by_id(shop, "manga", "M1").stock == 7  # Đọc trong khối thấy bản chưa ghi
+        assert _disk(A, shop, "manga")[0]["stock"] == 3  # Chưa ghi gì ra đĩa
+        assert writes == {}
+    assert writes == {"manga.json": 1, "customers.json": 1}
+    assert _disk(A, shop, "manga")[0]["stock"] == 7
+    assert _disk(A, shop, "customers")[0]["name"] == "Bình"
+
+
+def test_exception_rolls_back_everything(appmod, shop, writes):
+    A = appmod
+    ran = []
+    with pytest.raises(RuntimeError):
+        with A.unit_of_work(shop):
+            A.adjust_stock(shop, "M1", -1)
+            A.write_coll(shop, "customers", [])
+            A.on_commit(shop, lambda: ran.append("locked"))
+            A.on_commit(shop, lambda: ran.append("after"), locked=False)
+            raise RuntimeError("boom")
+    assert writes == {} and ran == []
+    assert _disk(A, shop, "manga")[0]["stock"] == 3
+    assert len(_disk(A, shop, "customers")) == 1
+    assert A.find_by_id(shop, "manga", "M1").stock == 3
+
+
+def test_on_commit_runs_after_flush(appmod, shop):
+    A = appmod
+    seen = []
+    with A.unit_of_work(shop):
+        A.adjust_stock(shop, "M1", -2)
+        A.on_commit(shop, lambda: seen.append(("locked", _disk(A, shop, "manga")[0]["stock"])))
+        A.on_commit(shop, lambda: seen.append(("after", _disk(A, shop, "manga")[0]["stock"])), locked=False)
+        assert seen == []
+    assert seen == [("locked", 1), ("after", 1)]
+
+
+def test_on_commit_without_unit_of_work_runs_now(appmod, shop):
+    seen = []
+    appmod.on_commit(shop, lambda: seen.append(1))
+    assert seen == [1]
+
+
+def test_nested_unit_of_work_shares_outer(appmod, shop, writes):
+    A = appmod
+    with A.unit_of_work(shop) as outer:
+        with A.unit_of_work(shop) as inner:
+            assert inner is outer
+            A.adjust_stock(shop, "M1", 1)
+        assert writes == {}
+    assert writes == {"manga.json": 1, "notifications.json": 1}  # Tồn kho + thông báo LOW_STOCK
+
+
+def _request(A, username, status, body):
+    # Chạy các hook before/after_request quanh body() như 1 request POST
+    with A.app.test_request_context("/x", method="POST"):
+        from flask import session
+        session["username"] = username
+        A.begin_unit_of_work()
+        try:
+            body()
+        except Exception as e:
+            A.end_unit_of_work(e)
+            raise
+        resp = A.commit_unit_of_work(Response(status=status))
+        A.end_unit_of_work(None)
+        return resp
+
+
+def test_request_hooks_commit_on_success(appmod, shop, writes):
+    A = appmod
+    _request(A, shop, 302, lambda: A.adjust_stock(shop, "M1", 1))
+    assert writes == {"manga.json": 1, "notifications.json": 1}
+    assert _disk(A, shop, "manga")[0]["stock"] == 4
+
+
+def test_request_hooks_roll_back_on_error_status(appmod, shop, writes):
+    A = appmod
+    _request(A, shop, 400, lambda: A.adjust_stock(shop, "M1", -1))
+    assert writes == {}
+    assert A.find_by_id(shop, "manga", "M1").stock == 3
+
+
+def test_request_hooks_roll_back_on_exception(appmod, shop, writes):
+    A = appmod
+
+    def body():
+        A.adjust_stock(shop, "M1", -1)
+        raise ValueError("route lỗi")
+    with pytest.raises(ValueError):
+        _request(A, shop, 200, body)
+    assert writes == {}
+    assert A.find_by_id(shop, "manga", "M1").stock == 3
+
+
+def test_get_request_has_no_unit_of_work(appmod, shop):
+    A = appmod
+    with A.app.test_request_context("/x", method="GET"):
+        from flask import g, session
+        session["username"] = shop
+        A.begin_unit_of_work()
+        assert g.get("uow_stack") is None
+
+
+def test_journal_batch_discarded_on_failure(appmod, shop, set_cfg):
+    A = appmod
+    set_cfg(shop, journal_mode=True)
+    A._journal_states.clear()
+    jpath = A.user_file(shop, A.JOURNAL_FILE)
+    with A.unit_of_work(shop):
+        A.adjust_stock(shop, "M1", -1)  # 1 request thành công = 1 bản ghi journal
+    size = os.path.getsize(jpath)
+    assert len(open(jpath, "rb").read().splitlines()) == 1
+
+    _request(A, shop, 400, lambda: A.adjust_stock(shop, "M2", -1))
+    with pytest.raises(RuntimeError):
+        with A.unit_of_work(shop):
+            A.adjust_stock(shop, "M1", -1)
+            raise RuntimeError("boom")
+    assert os.path.getsize(jpath) == size
+    assert A.find_by_id(shop, "manga", "M1").stock == 2
+    assert A.find_by_id(shop, "manga", "M2").stock == 2
+    A._journal_states.clear()
+    assert A.find_by_id(shop, "manga", "M1").stock == 2
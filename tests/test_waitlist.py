@@ -0,0 +1,89 @@
+# Hàng chờ & giữ truyện: vào hàng khi hết, giữ cho người đầu hàng khi trả, chỉ người được giữ thuê được, hết hạn giữ
+import pytest
+
+
+@pytest.fixture
+def wshop(appmod, shop, client):
+    # M2 (2 cuốn) đang được C1 và C2 thuê hết; C3 chưa thuê gì
+    A = appmod
+    for i in (2, 3):
+        client.post("/customers/add", data=dict(id=f"C{i}", name=f"Khách {i}", age="20", phone=f"090{i}",
+                                                address="HN", national_id=str(i), email=f"c{i}@x.y"))
+    for cid in ("C1", "C2"):
+        _rent(client, cid)
+    assert A.find_by_id(shop, "manga", "M2").stock == 0
+    return shop
+
+
+def _rent(client, cid, mid="M2"):
+    assert client.post("/rentals/create", data=dict(customer_id=cid, manga_id=mid, rent_price="12000")).status_code == 302
+
+
+def _open(A, username, cid, mid="M2"):
+    return [r for r in A.read_coll(username, "rentals") if r["customer_id"] == cid and r["manga_id"] == mid
+            and not r["returned_at"]]
+
+
+def _entries(A, username):
+    return [(e["customer_id"], e["status"]) for e in A.read_coll(username, "waitlist")]
+
+
+def _return(A, client, username, cid):
+    assert client.post(f"/rentals/return/{_open(A, username, cid)[0]['id']}").status_code == 302
+
+
+def test_out_of_stock_joins_waitlist_with_eta(appmod, wshop, client):
+    A = appmod
+    _rent(client, "C3")
+    assert _open(A, wshop, "C3") == []
+    assert _entries(A, wshop) == [("C3", "waiting")]
+    _rent(client, "C3")  # Đã có trong hàng: giữ nguyên chỗ
+    assert _entries(A, wshop) == [("C3", "waiting")]
+
+    first_due = min(r["due_at"] for r in A.read_coll(wshop, "rentals"))
+    (row,) = client.get("/api/waitlist?manga_id=M2").get_json()["items"]
+    assert (row["customer_id"], row["position"], row["eta"]) == ("C3", 1, first_due)
+
+
+def test_return_places_hold_for_head_of_queue(appmod, wshop, client):
+    A = appmod
+    _rent(client, "C3")
+    _return(A, client, wshop, "C1")
+    assert _entries(A, wshop) == [("C3", "held")]
+    idx = A.waitlist_index(wshop)
+    mg = A.find_by_id(wshop, "manga", "M2")
+    assert mg.stock == 1 and A.available_copies(mg, idx) == 0  # Cuốn đang giữ không cho người khác thuê
+    notes = [n for n in A.read_coll(wshop, "notifications") if n.get("type") == "HOLD"]
+    assert [n["customer_id"] for n in notes] == ["C3"]
+    (row,) = client.get("/api/waitlist").get_json()["items"]
+    assert (row["position"], row["eta"]) == (0, "")
+
+
+def test_only_holder_can_check_out_held_copy(appmod, wshop, client):
+    A = appmod
+    _rent(client, "C3")
+    _return(A, client, wshop, "C1")
+    _rent(client, "C1")  # Người khác: vào hàng chờ thay vì lấy cuốn đang giữ
+    assert _open(A, wshop, "C1") == []
+    assert _entries(A, wshop) == [("C3", "held"), ("C1", "waiting")]
+
+    _rent(client, "C3")
+    assert len(_open(A, wshop, "C3")) == 1
+    assert _entries(A, wshop) == [("C1", "waiting")]
+    assert A.find_by_id(wshop, "manga", "M2").stock == 0
+
+
+def test_expired_hold_moves_to_next_customer(appmod, wshop, client):
+    A = appmod
+    _rent(client, "C3")
+    _rent(client, "C1")
+    _return(A, client, wshop, "C2")
+    assert A.expire_holds(wshop) == 0  # Chưa quá hạn
+    rows = A.read_coll(wshop, "waitlist")
+    rows[0]["hold_until"] = "01-01-2025 10:00:00"
+    A.write_coll(wshop, "waitlist", rows)
+
+    assert A.expire_holds(wshop) == 1
+    assert _entries(A, wshop) == [("C1", "held")]
+    _rent(client, "C1")
+    assert len(_open(A, wshop, "C1")) == 2